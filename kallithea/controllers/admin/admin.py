@@ -38,13 +38,17 @@ from sqlalchemy.sql.expression import or_, and_, func
 from kallithea.model.db import UserLog
 from kallithea.lib.auth import LoginRequired, HasPermissionAllDecorator
 from kallithea.lib.base import BaseController, render
-from kallithea.lib.utils2 import safe_int, remove_prefix, remove_suffix
+from kallithea.lib.utils2 import remove_prefix, remove_suffix
 from kallithea.lib.indexers import JOURNAL_SCHEMA
-from kallithea.lib.helpers import Page
+from kallithea.lib.helpers import KeysetPage
 
 
 log = logging.getLogger(__name__)
 
+#: columns journals are ordered and paged by, newest entries first; the
+#: indexes of user_logs end with them
+JOURNAL_KEY = [UserLog.action_date, UserLog.user_log_id]
+
 
 def _journal_filter(user_log, search_term):
     """
@@ -133,14 +137,14 @@ class AdminController(BaseController):
         c.search_term = request.GET.get('filter')
         users_log = _journal_filter(users_log, c.search_term)
 
-        users_log = users_log.order_by(UserLog.action_date.desc())
-
-        p = safe_int(request.GET.get('page', 1), 1)
-
         def url_generator(**kw):
             return url.current(filter=c.search_term, **kw)
 
-        c.users_log = Page(users_log, page=p, items_per_page=10, url=url_generator)
+        c.users_log = KeysetPage(users_log, JOURNAL_KEY,
+                                 after=request.GET.get('after'),
+                                 before=request.GET.get('before'),
+                                 items_per_page=10, url=url_generator)
+        UserLog.load_revisions_preview(c.users_log)
 
         if request.environ.get('HTTP_X_PARTIAL_XHR'):
             return render('admin/admin_log.html')
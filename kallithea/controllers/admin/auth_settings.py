@@ -122,6 +122,7 @@ class AuthSettingsController(BaseController):
                 setting = Setting.create_or_update(k, v)
                 Session().add(setting)
             Session().commit()
+            auth_modules.invalidate_auth_plugins_cache()
             h.flash(_('Auth settings updated successfully'),
                        category='success')
         except formencode.Invalid, errors:
@@ -339,13 +339,10 @@ class RepoGroupsController(BaseController):
             .filter(RepoGroup.group_parent_id == c.group.group_id).all()
         c.groups = self.scm_model.get_repo_groups(groups)
 
-        c.repos_list = Repository.query()\
-                        .filter(Repository.group_id == c.group.group_id)\
-                        .order_by(func.lower(Repository.repo_name))\
-                        .all()
-
-        repos_data = RepoModel().get_repos_as_dict(repos_list=c.repos_list,
-                                                   admin=False)
+        # first page of the grid, further pages are fetched from repos_data
+        repos_data = RepoModel().get_repos_page(
+            c.authuser,
+            group_id=c.group.group_id, limit=c.visual.dashboard_items)
         #json used to render the grid
         c.data = json.dumps(repos_data)
 
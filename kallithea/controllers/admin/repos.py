@@ -33,7 +33,6 @@ from webob.exc import HTTPInternalServerError, HTTPForbidden, HTTPNotFound
 from pylons import request, tmpl_context as c, url
 from pylons.controllers.util import redirect
 from pylons.i18n.translation import _
-from sqlalchemy.sql.expression import func
 
 from kallithea.lib import helpers as h
 from kallithea.lib.auth import LoginRequired, HasPermissionAllDecorator, \
@@ -115,19 +114,29 @@ class ReposController(BaseRepoController):
     def index(self, format='html'):
         """GET /repos: All items in the collection"""
         # url('repos')
-        _list = Repository.query()\
-                        .order_by(func.lower(Repository.repo_name))\
-                        .all()
-
-        c.repos_list = RepoList(_list, perm_set=['repository.admin'])
-        repos_data = RepoModel().get_repos_as_dict(repos_list=c.repos_list,
-                                                   admin=True,
-                                                   super_user_actions=True)
+        # first page of the grid, further pages are fetched from repos_data
+        repos_data = RepoModel().get_repos_page(
+            c.authuser, limit=c.visual.admin_grid_items, admin=True)
         #json used to render the grid
         c.data = json.dumps(repos_data)
 
         return render('admin/repos/repos.html')
 
+    @jsonify
+    def repos_data(self):
+        """
+        One page of the grid of repositories the user can administer,
+        filtered, sorted and paged by the server.
+        """
+        limit = safe_int(request.GET.get('limit'), c.visual.admin_grid_items)
+        return RepoModel().get_repos_page(
+            c.authuser, admin=True,
+            name_filter=request.GET.get('filter'),
+            sort=request.GET.get('sort', 'name'),
+            direction=request.GET.get('dir', 'asc'),
+            start=safe_int(request.GET.get('start'), 0),
+            limit=min(limit, 500))
+
     @NotAnonymous()
     def create(self):
         """
@@ -39,6 +39,9 @@ from kallithea.lib.auth import LoginRequired, HasPermissionAllDecorator
 from kallithea.lib.base import BaseController, render
 from kallithea.lib.celerylib import tasks, run_task
 from kallithea.lib.exceptions import HgsubversionImportError
+from kallithea.lib.scm_cache import get_scm_instance_cache
+from kallithea.lib.archive_cache import get_archive_cache
+from kallithea.lib.diff_cache import get_diff_cache
 from kallithea.lib.utils import repo2db_mapper, set_app_settings
 from kallithea.model.db import Ui, Repository, Setting
 from kallithea.model.forms import ApplicationSettingsForm, \
@@ -472,6 +475,11 @@ class SettingsController(BaseController):
         server_info = Setting.get_server_info()
         for key, val in server_info.iteritems():
             setattr(c, key, val)
+        c.scm_cache_stats = get_scm_instance_cache().stats()
+        archive_cache = get_archive_cache()
+        c.archive_cache_stats = archive_cache.stats() if archive_cache else None
+        diff_cache = get_diff_cache()
+        c.diff_cache_stats = diff_cache.stats() if diff_cache else None
 
         return htmlfill.render(
             render('admin/settings/settings.html'),
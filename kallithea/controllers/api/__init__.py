@@ -27,6 +27,7 @@ Original author and date, and relevant copyright and licensing information is be
 
 import inspect
 import logging
+import itertools
 import types
 import traceback
 import time
@@ -72,6 +73,95 @@ def jsonrpc_error(message, retid=None, code=None):
     )
 
 
+#: size of chunks of streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+#: maximal number of requests in one batch
+MAX_BATCH_SIZE = 100
+
+
+class _CallError(Exception):
+    """
+    Invalid request, reported without calling the method
+    """
+
+    def __init__(self, message):
+        self.message = message
+        super(_CallError, self).__init__(message)
+
+
+def _is_stream(result):
+    # generators and other iterators, but not lists or dicts
+    return hasattr(result, 'next') and not isinstance(result, basestring)
+
+
+def _prefetch(items):
+    try:
+        first = next(items)
+    except StopIteration:
+        return iter([])
+    return itertools.chain([first], items)
+
+
+def _iter_response(retid, items, errors=None):
+    """
+    Yields JSON-RPC response with result made of ``items`` in chunks of
+    ``STREAM_CHUNK_SIZE``, encoding the items one by one. The response is
+    already being sent when an item fails, so the failure is reported in
+    *error* next to items encoded before it, and appended to ``errors``
+    if given.
+    """
+    buf = ['{"id": %s, "result": [' % json.dumps(retid)]
+    size = 0
+    error = None
+    try:
+        for i, item in enumerate(items):
+            chunk = json.dumps(item)
+            if i:
+                chunk = ', ' + chunk
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= STREAM_CHUNK_SIZE:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+    except JSONRPCError, e:
+        error = safe_str(e)
+    except Exception:
+        log.error('Encountered unhandled exception in streamed response: %s'
+                  % (traceback.format_exc(),))
+        error = 'Internal server error'
+    if error is not None and errors is not None:
+        errors.append(error)
+    buf.append('], "error": %s}' % json.dumps(error))
+    yield ''.join(buf)
+
+
+class _StreamedOutput(object):
+    """
+    WSGI output of a streamed response, keeps the database session of the
+    request until the response is written and removes it once the server
+    closes the output. The session is put in the WSGI environment as
+    ``kallithea.streamed_session``, so the controllers the request passes
+    through leave it alone.
+    """
+
+    def __init__(self, app_iter, session):
+        self.app_iter = app_iter
+        self.session = session
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.session.close()
+            meta.Session.remove()
+
+
 class JSONRPCController(WSGIController):
     """
      A WSGI-speaking JSON-RPC controller class
@@ -80,6 +170,12 @@ class JSONRPCController(WSGIController):
      <http://json-rpc.org/wiki/specification>`.
 
      Valid controller return values should be json-serializable objects.
+     Iterators, like generators, are returned as JSON arrays streamed to the
+     client, so long lists are never encoded in memory at once.
+
+     The request body can also be a JSON array of requests, a batch, which
+     are all run in one database session and answered by a JSON array of
+     their responses.
 
      Sub-classes should catch their exceptions and raise JSONRPCError
      if they want to pass meaningful errors to the client.
@@ -104,7 +200,9 @@ class JSONRPCController(WSGIController):
         try:
             return self._handle_request(environ, start_response)
         finally:
-            meta.Session.remove()
+            # streamed responses need the session until they are written
+            if 'kallithea.streamed_session' not in environ:
+                meta.Session.remove()
 
     def _handle_request(self, environ, start_response):
         start = time.time()
@@ -134,6 +232,120 @@ class JSONRPCController(WSGIController):
                                  message="JSON parse error ERR:%s RAW:%r"
                                  % (e, raw_body))
 
+        if isinstance(json_body, list):
+            return self._handle_batch(json_body, environ, start_response,
+                                      start)
+
+        try:
+            self._prepare_call(json_body, environ, start_response, {})
+        except _CallError, e:
+            return jsonrpc_error(retid=self._req_id, message=e.message)
+
+        status = []
+        headers = []
+        exc_info = []
+
+        def change_content(new_status, new_headers, new_exc_info=None):
+            status.append(new_status)
+            headers.extend(new_headers)
+            exc_info.append(new_exc_info)
+
+        self._streamed = False
+        self._stream_errors = None
+        output = WSGIController.__call__(self, environ, change_content)
+        if self._streamed:
+            session = environ['kallithea.streamed_session'] = meta.Session()
+            output = _StreamedOutput(output, session)
+        else:
+            output = list(output)
+            headers.append(('Content-Length', str(len(output[0]))))
+        replace_header(headers, 'Content-Type', 'application/json')
+        start_response(status[0], headers, exc_info[0])
+        log.info('IP: %s Request to %s time: %.3fs' % (
+            self._get_ip_addr(environ),
+            safe_unicode(_get_access_path(environ)), time.time() - start)
+        )
+        return output
+
+    def _handle_batch(self, calls, environ, start_response, start):
+        """
+        Runs a batch of calls, given as a JSON array of requests, one after
+        another in one database session and returns JSON array of their
+        responses. Every API key is authenticated only once per batch.
+        """
+        if not calls:
+            return jsonrpc_error(retid=None, message='Empty batch')
+        if len(calls) > MAX_BATCH_SIZE:
+            return jsonrpc_error(retid=None,
+                                 message='Batch of %s requests exceeds limit '
+                                 'of %s' % (len(calls), MAX_BATCH_SIZE))
+
+        # calls are dispatched directly, without a new pylons response
+        # for each of them
+        self._py_object = environ['pylons.pylons']
+        auth_cache = {}
+        responses = []
+        for call in calls:
+            self._req_id = None
+            try:
+                self._prepare_call(call, environ, start_response, auth_cache)
+            except _CallError, e:
+                responses.append(json.dumps(
+                    dict(id=self._req_id, result=None, error=e.message)))
+                continue
+            self._streamed = False
+            self._stream_errors = []
+            response = self._dispatch_call()
+            # the next call can change what a stream would read, so
+            # results of calls in a batch are never streamed
+            responses.append(''.join(response))
+            if self._error is not None or self._stream_errors:
+                # changes of a failed call must not be committed by the
+                # calls following it in the shared session
+                meta.Session().rollback()
+
+        output = '[%s]' % ', '.join(responses)
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(output)))])
+        log.info('IP: %s Batch of %s requests to %s time: %.3fs' % (
+            self._get_ip_addr(environ), len(calls),
+            safe_unicode(_get_access_path(environ)), time.time() - start)
+        )
+        return [output]
+
+    def _authenticate(self, api_key, auth_cache):
+        """
+        Returns user and ``AuthUser`` of ``api_key``, cached in
+        ``auth_cache``, or raises ``_CallError``
+        """
+        if api_key in auth_cache:
+            return auth_cache[api_key]
+        try:
+            u = User.get_by_api_key(api_key)
+            if u is None:
+                raise _CallError('Invalid API KEY')
+
+            #check if we are allowed to use this IP
+            auth_u = AuthUser(u.user_id, api_key, ip_addr=self.ip_addr)
+            if not auth_u.ip_allowed:
+                raise _CallError('request from IP:%s not allowed'
+                                 % (self.ip_addr,))
+            else:
+                log.info('Access for IP:%s allowed' % (self.ip_addr,))
+
+        except _CallError:
+            raise
+        except Exception, e:
+            raise _CallError('Invalid API KEY')
+        auth_cache[api_key] = u, auth_u
+        return u, auth_u
+
+    def _prepare_call(self, json_body, environ, start_response, auth_cache):
+        """
+        Authenticates request ``json_body`` and finds the method it calls,
+        so it is ready for ``_dispatch_call``; raises ``_CallError`` if the
+        request is invalid.
+        """
         # check AUTH based on API KEY
         try:
             self._req_api_key = json_body['api_key']
@@ -148,34 +360,18 @@ class JSONRPCController(WSGIController):
                                             self._request_params)
             )
         except KeyError, e:
-            return jsonrpc_error(retid=self._req_id,
-                                 message='Incorrect JSON query missing %s' % e)
+            raise _CallError('Incorrect JSON query missing %s' % e)
+        except TypeError, e:
+            raise _CallError('Incorrect JSON query, object expected')
 
         # check if we can find this session using api_key
-        try:
-            u = User.get_by_api_key(self._req_api_key)
-            if u is None:
-                return jsonrpc_error(retid=self._req_id,
-                                     message='Invalid API KEY')
-
-            #check if we are allowed to use this IP
-            auth_u = AuthUser(u.user_id, self._req_api_key, ip_addr=ip_addr)
-            if not auth_u.ip_allowed:
-                return jsonrpc_error(retid=self._req_id,
-                        message='request from IP:%s not allowed' % (ip_addr,))
-            else:
-                log.info('Access for IP:%s allowed' % (ip_addr,))
-
-        except Exception, e:
-            return jsonrpc_error(retid=self._req_id,
-                                 message='Invalid API KEY')
+        u, auth_u = self._authenticate(self._req_api_key, auth_cache)
 
         self._error = None
         try:
             self._func = self._find_method()
         except AttributeError, e:
-            return jsonrpc_error(retid=self._req_id,
-                                 message=str(e))
+            raise _CallError(str(e))
 
         # now that we have a method, add self._req_params to
         # self.kargs and dispatch control to WGIController
@@ -198,11 +394,10 @@ class JSONRPCController(WSGIController):
         USER_SESSION_ATTR = 'apiuser'
 
         if USER_SESSION_ATTR not in arglist:
-            return jsonrpc_error(
-                retid=self._req_id,
-                message='This method [%s] does not support '
-                         'authentication (missing %s param)' % (
-                                    self._func.__name__, USER_SESSION_ATTR)
+            raise _CallError(
+                'This method [%s] does not support '
+                'authentication (missing %s param)' % (
+                    self._func.__name__, USER_SESSION_ATTR)
             )
 
         # get our arglist and check if we provided them as args
@@ -215,11 +410,8 @@ class JSONRPCController(WSGIController):
             # skip the required param check if it's default value is
             # NotImplementedType (default_empty)
             if default == default_empty and arg not in self._request_params:
-                return jsonrpc_error(
-                    retid=self._req_id,
-                    message=(
-                        'Missing non optional `%s` arg in JSON DATA' % arg
-                    )
+                raise _CallError(
+                    'Missing non optional `%s` arg in JSON DATA' % arg
                 )
 
         self._rpc_args = {USER_SESSION_ATTR: u}
@@ -230,26 +422,6 @@ class JSONRPCController(WSGIController):
         self._rpc_args['environ'] = environ
         self._rpc_args['start_response'] = start_response
 
-        status = []
-        headers = []
-        exc_info = []
-
-        def change_content(new_status, new_headers, new_exc_info=None):
-            status.append(new_status)
-            headers.extend(new_headers)
-            exc_info.append(new_exc_info)
-
-        output = WSGIController.__call__(self, environ, change_content)
-        output = list(output)
-        headers.append(('Content-Length', str(len(output[0]))))
-        replace_header(headers, 'Content-Type', 'application/json')
-        start_response(status[0], headers, exc_info[0])
-        log.info('IP: %s Request to %s time: %.3fs' % (
-            self._get_ip_addr(environ),
-            safe_unicode(_get_access_path(environ)), time.time() - start)
-        )
-        return output
-
     def _dispatch_call(self):
         """
         Implement dispatch interface specified by WSGIController
@@ -259,6 +431,9 @@ class JSONRPCController(WSGIController):
             raw_response = self._inspect_call(self._func)
             if isinstance(raw_response, HTTPError):
                 self._error = str(raw_response)
+            elif _is_stream(raw_response):
+                # errors before the first item are reported as usual
+                raw_response = _prefetch(raw_response)
         except JSONRPCError, e:
             self._error = safe_str(e)
         except Exception, e:
@@ -270,6 +445,11 @@ class JSONRPCController(WSGIController):
         if self._error is not None:
             raw_response = None
 
+        if _is_stream(raw_response):
+            self._streamed = True
+            return _iter_response(self._req_id, raw_response,
+                                  self._stream_errors)
+
         response = dict(id=self._req_id, result=raw_response, error=self._error)
         try:
             return json.dumps(response)
@@ -609,13 +609,10 @@ class ApiController(JSONRPCController):
             error:  null
         """
 
-        result = []
         users_list = User.query().order_by(User.username) \
-            .filter(User.username != User.DEFAULT_USER) \
-            .all()
-        for user in users_list:
-            result.append(user.get_api_data())
-        return result
+            .filter(User.username != User.DEFAULT_USER)
+        # streamed, users are encoded one by one
+        return (user.get_api_data() for user in users_list)
 
     @HasPermissionAllDecorator('hg.admin')
     def create_user(self, apiuser, username, email, password=Optional(''),
@@ -1320,15 +1317,13 @@ class ApiController(JSONRPCController):
                     ]
             error:  null
         """
-        result = []
         if not HasPermissionAnyApi('hg.admin')(user=apiuser):
             repos = RepoModel().get_all_user_repos(user=apiuser)
         else:
             repos = RepoModel().get_all()
 
-        for repo in repos:
-            result.append(repo.get_api_data())
-        return result
+        # streamed, repositories are encoded one by one
+        return (repo.get_api_data() for repo in repos)
 
     # permission check inside
     def get_repo_nodes(self, apiuser, repoid, revision, root_path,
@@ -1381,7 +1376,8 @@ class ApiController(JSONRPCController):
                 'files': _f,
                 'dirs': _d,
             }
-            return _map[ret_type]
+            # streamed, nodes are encoded one by one
+            return iter(_map[ret_type])
         except KeyError:
             raise JSONRPCError('ret_type must be one of %s'
                                % (','.join(_map.keys())))
@@ -39,6 +39,7 @@ from kallithea.lib.base import BaseRepoController, render
 from kallithea.lib.helpers import RepoPage
 from kallithea.lib.compat import json
 from kallithea.lib.graphmod import graph_data
+from kallithea.lib.vcs.backends.base import ChangesetMetadataCollection
 from kallithea.lib.vcs.exceptions import RepositoryError, ChangesetDoesNotExistError,\
     ChangesetError, NodeDoesNotExistError, EmptyRepositoryError
 from kallithea.lib.utils2 import safe_int, safe_str
@@ -55,7 +56,8 @@ def _load_changelog_summary():
         return url('changelog_summary_home',
                    repo_name=c.db_repo.repo_name, size=size, **kw)
 
-    collection = c.db_repo_scm_instance
+    repo = c.db_repo_scm_instance
+    collection = ChangesetMetadataCollection(repo, repo.revisions)
 
     c.repo_changesets = RepoPage(collection, page=p,
                                  items_per_page=size,
@@ -136,7 +138,7 @@ class ChangelogController(BaseRepoController):
                 collection = list(reversed(collection))
             else:
                 collection = c.db_repo_scm_instance.get_changesets(start=0, end=revision,
-                                                        branch_name=branch_name)
+                                                        branch_name=branch_name).metadata()
             c.total_cs = len(collection)
 
             c.pagination = RepoPage(collection, page=p, item_count=c.total_cs,
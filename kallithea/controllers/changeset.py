@@ -255,16 +255,15 @@ class ChangesetController(BaseRepoController):
             context_lcl = get_line_ctx('', request.GET)
             ign_whitespace_lcl = ign_whitespace_lcl = get_ignore_ws('', request.GET)
 
-            _diff = c.db_repo_scm_instance.get_diff(cs1, cs2,
-                ignore_whitespace=ign_whitespace_lcl, context=context_lcl)
             diff_limit = self.cut_off_limit if not fulldiff else None
-            diff_processor = diffs.DiffProcessor(_diff,
-                                                 vcs=c.db_repo_scm_instance.alias,
-                                                 format='gitdiff',
-                                                 diff_limit=diff_limit)
             cs_changes = OrderedDict()
             if method == 'show':
-                _parsed = diff_processor.prepare()
+                # parse the diff while it is generated, stopping at the limit
+                diff_processor = diffs.get_diff_processor(
+                    c.db_repo_scm_instance, cs1, cs2,
+                    ignore_whitespace=ign_whitespace_lcl, context=context_lcl,
+                    diff_limit=diff_limit, vcs=c.db_repo_scm_instance.alias)
+                _parsed = diff_processor.parsed_diff
                 c.limited_diff = False
                 if isinstance(_parsed, LimitedDiffContainer):
                     c.limited_diff = True
@@ -277,8 +276,21 @@ class ChangesetController(BaseRepoController):
                                                   parsed_lines=[f])
                     cs_changes[fid] = [cs1, cs2, f['operation'], f['filename'],
                                        diff, st]
+                if c.limited_diff:
+                    # files cut off are listed, their diffs loaded on demand
+                    for f in diffs.get_omitted_files(c.db_repo_scm_instance,
+                                                     cs1, cs2, _parsed):
+                        fid = h.FID(changeset.raw_id, f['filename'])
+                        cs_changes[fid] = [cs1, cs2, f['operation'],
+                                           f['filename'], None, f['stats']]
             else:
                 # downloads/raw we only need RAW diff nothing else
+                _diff = c.db_repo_scm_instance.get_diff(cs1, cs2,
+                    ignore_whitespace=ign_whitespace_lcl, context=context_lcl)
+                diff_processor = diffs.DiffProcessor(_diff,
+                                                     vcs=c.db_repo_scm_instance.alias,
+                                                     format='gitdiff',
+                                                     diff_limit=diff_limit)
                 diff = diff_processor.as_raw()
                 cs_changes[''] = [None, None, None, None, diff, None]
             c.changes[changeset.raw_id] = cs_changes
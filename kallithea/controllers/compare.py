@@ -260,13 +260,13 @@ class CompareController(BaseRepoController):
 
         log.debug('running diff between %s and %s in %s'
                   % (rev1, c.cs_rev, org_repo.scm_instance.path))
-        txtdiff = org_repo.scm_instance.get_diff(rev1=rev1, rev2=c.cs_rev,
-                                      ignore_whitespace=ignore_whitespace,
-                                      context=line_context)
-
-        diff_processor = diffs.DiffProcessor(txtdiff or '', format='gitdiff',
-                                             diff_limit=diff_limit)
-        _parsed = diff_processor.prepare()
+        # parse the diff while it is generated, stopping at the limit
+        diff_repo = org_repo.scm_instance
+        diff_processor = diffs.get_diff_processor(diff_repo, rev1, c.cs_rev,
+                                                  ignore_whitespace=ignore_whitespace,
+                                                  context=line_context,
+                                                  diff_limit=diff_limit)
+        _parsed = diff_processor.parsed_diff
 
         c.limited_diff = False
         if isinstance(_parsed, LimitedDiffContainer):
@@ -285,5 +285,12 @@ class CompareController(BaseRepoController):
             c.files.append([fid, f['operation'], f['filename'], f['stats']])
             htmldiff = diff_processor.as_html(enable_comments=False, parsed_lines=[f])
             c.changes[fid] = [f['operation'], f['filename'], htmldiff]
+        if c.limited_diff:
+            # files cut off are listed, their diffs loaded on demand
+            for f in diffs.get_omitted_files(diff_repo, rev1, c.cs_rev,
+                                             _parsed):
+                fid = h.FID('', f['filename'])
+                c.files.append([fid, f['operation'], f['filename'], f['stats']])
+                c.changes[fid] = [f['operation'], f['filename'], None]
 
         return render('compare/compare_diff.html')
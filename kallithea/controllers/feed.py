@@ -64,6 +64,15 @@ class FeedController(BaseRepoController):
         # we can kill the server
         self.feed_diff_limit = safe_int(CONF.get('rss_cut_off_limit', 32 * 1024))
 
+    def _get_last_changesets(self):
+        """
+        Returns metadata of last ``feed_nr`` changesets, oldest first.
+        """
+        repo = c.db_repo_scm_instance
+        count = len(repo.revisions)
+        return repo.get_changeset_metadata(
+            range(max(count - self.feed_nr, 0), count))
+
     def _get_title(self, cs):
         return "%s" % (
             h.shorter(cs.message, 160)
@@ -71,7 +80,7 @@ class FeedController(BaseRepoController):
 
     def __changes(self, cs):
         changes = []
-        diff_processor = DiffProcessor(cs.diff(),
+        diff_processor = DiffProcessor(cs.get_changeset().diff(),
                                        diff_limit=self.feed_diff_limit)
         _parsed = diff_processor.prepare(inline_diff=False)
         limited_diff = False
@@ -129,7 +138,7 @@ class FeedController(BaseRepoController):
                  ttl=self.ttl
             )
 
-            for cs in reversed(list(c.db_repo_scm_instance[-self.feed_nr:])):
+            for cs in reversed(self._get_last_changesets()):
                 feed.add_item(title=self._get_title(cs),
                               link=h.canonical_url('changeset_home', repo_name=repo_name,
                                        revision=cs.raw_id),
@@ -160,7 +169,7 @@ class FeedController(BaseRepoController):
                 ttl=self.ttl
             )
 
-            for cs in reversed(list(c.db_repo_scm_instance[-self.feed_nr:])):
+            for cs in reversed(self._get_last_changesets()):
                 feed.add_item(title=self._get_title(cs),
                               link=h.canonical_url('changeset_home', repo_name=repo_name,
                                        revision=cs.raw_id),
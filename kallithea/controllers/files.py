@@ -29,13 +29,11 @@ from __future__ import with_statement
 import os
 import logging
 import traceback
-import tempfile
-import shutil
 
 from pylons import request, response, tmpl_context as c, url
 from pylons.i18n.translation import _
 from pylons.controllers.util import redirect
-from kallithea.lib.utils import jsonify, action_logger
+from kallithea.lib.utils import jsonify, action_logger_async
 
 from kallithea.lib import diffs
 from kallithea.lib import helpers as h
@@ -45,6 +43,7 @@ from kallithea.lib.utils2 import convert_line_endings, detect_mode, safe_str,\
     str2bool
 from kallithea.lib.auth import LoginRequired, HasRepoPermissionAnyDecorator
 from kallithea.lib.base import BaseRepoController, render
+from kallithea.lib.archive_cache import get_archive_cache, get_archive_name
 from kallithea.lib.vcs.backends.base import EmptyChangeset
 from kallithea.lib.vcs.conf import settings
 from kallithea.lib.vcs.exceptions import RepositoryError, \
@@ -541,59 +540,26 @@ class FilesController(BaseRepoController):
             return _('Empty repository')
         except (ImproperArchiveTypeError, KeyError):
             return _('Unknown archive type')
-        # archive cache
-        from kallithea import CONFIG
-        rev_name = cs.raw_id[:12]
-        archive_name = '%s-%s%s' % (safe_str(repo_name.replace('/', '_')),
-                                    safe_str(rev_name), ext)
-
-        use_cached_archive = False  # defines if we use cached version of archive
-        archive_cache_enabled = CONFIG.get('archive_cache_dir')
-        if not subrepos and archive_cache_enabled:
-            #check if we it's ok to write
-            if not os.path.isdir(CONFIG['archive_cache_dir']):
-                os.makedirs(CONFIG['archive_cache_dir'])
-            cached_archive_path = os.path.join(CONFIG['archive_cache_dir'], archive_name)
-            if os.path.isfile(cached_archive_path):
-                log.debug('Found cached archive in %s' % cached_archive_path)
-                fd, archive = None, cached_archive_path
-                use_cached_archive = True
-            else:
-                log.debug('Archive %s is not yet cached' % (archive_name))
-
-        if not use_cached_archive:
-            # generate new archive
-            fd, archive = tempfile.mkstemp()
-            temp_stream = open(archive, 'wb')
-            log.debug('Creating new temp archive in %s' % archive)
-            cs.fill_archive(stream=temp_stream, kind=fileformat, subrepos=subrepos)
-            temp_stream.close()
-            if not subrepos and archive_cache_enabled:
-                #if we generated the archive and use cache rename that
-                log.debug('Storing new archive in %s' % cached_archive_path)
-                shutil.move(archive, cached_archive_path)
-                archive = cached_archive_path
-
-        def get_chunked_archive(archive):
-            stream = open(archive, 'rb')
-            while True:
-                data = stream.read(16 * 1024)
-                if not data:
-                    stream.close()
-                    if fd:  # fd means we used temporary file
-                        os.close(fd)
-                    if not archive_cache_enabled:
-                        log.debug('Destroying temp archive %s' % archive)
-                        os.remove(archive)
-                    break
-                yield data
+        archive_name = get_archive_name(repo_name, cs.raw_id, ext)
+
+        # archives are streamed while they are created; with archive cache
+        # they are stored in it at the same time and shared by concurrent
+        # downloads
+        archive_cache = get_archive_cache()
+        create = lambda: cs.get_chunked_archive(kind=fileformat,
+                                                subrepos=subrepos)
+        if not subrepos and archive_cache is not None:
+            archive = archive_cache.get(archive_name, create)
+        else:
+            archive = create()
+
         # store download action
-        action_logger(user=c.authuser,
-                      action='user_downloaded_archive:%s' % (archive_name),
-                      repo=repo_name, ipaddr=self.ip_addr, commit=True)
+        action_logger_async(user=c.authuser,
+                            action='user_downloaded_archive:%s' % (archive_name),
+                            repo=repo_name, ipaddr=self.ip_addr)
         response.content_disposition = str('attachment; filename=%s' % (archive_name))
         response.content_type = str(content_type)
-        return get_chunked_archive(archive)
+        return archive
 
     @LoginRequired()
     @HasRepoPermissionAnyDecorator('repository.read', 'repository.write',
@@ -695,6 +661,9 @@ class FilesController(BaseRepoController):
                                          ignore_whitespace=ign_whitespace_lcl,
                                          line_context=line_context_lcl,
                                          enable_comments=False)
+            if request.environ.get('HTTP_X_PARTIAL_XHR'):
+                # diff of a file cut off from a bigger diff, loaded on demand
+                return diff
             op = ''
             filename = node1.path
             cs_changes = {
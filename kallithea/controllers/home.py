@@ -30,12 +30,13 @@ import logging
 
 from pylons import tmpl_context as c, request
 from pylons.i18n.translation import _
-from webob.exc import HTTPBadRequest
-from sqlalchemy.sql.expression import func
+from webob.exc import HTTPBadRequest, HTTPForbidden
 
 from kallithea.lib.utils import jsonify, conditional_cache
 from kallithea.lib.compat import json
-from kallithea.lib.auth import LoginRequired, HasRepoPermissionAnyDecorator
+from kallithea.lib.auth import LoginRequired, HasRepoPermissionAnyDecorator, \
+    HasRepoGroupPermissionAny
+from kallithea.lib.utils2 import safe_int
 from kallithea.lib.base import BaseController, render
 from kallithea.model.db import Repository, RepoGroup
 from kallithea.model.repo import RepoModel
@@ -57,18 +58,38 @@ class HomeController(BaseController):
         c.groups = self.scm_model.get_repo_groups()
         c.group = None
 
-        c.repos_list = Repository.query()\
-                        .filter(Repository.group_id == None)\
-                        .order_by(func.lower(Repository.repo_name))\
-                        .all()
-
-        repos_data = RepoModel().get_repos_as_dict(repos_list=c.repos_list,
-                                                   admin=False)
+        # first page of the grid, further pages are fetched from repos_data
+        repos_data = RepoModel().get_repos_page(
+            c.authuser, group_id=None,
+            limit=c.visual.dashboard_items)
         #json used to render the grid
         c.data = json.dumps(repos_data)
 
         return render('/index.html')
 
+    @LoginRequired()
+    @jsonify
+    def repos_data(self):
+        """
+        One page of the repository grid of the index page or of a repository
+        group page, filtered, sorted and paged by the server.
+        """
+        group_id = safe_int(request.GET.get('group_id'))
+        if group_id is not None:
+            group = RepoGroup.get(group_id)
+            if group is None or not HasRepoGroupPermissionAny(
+                    'group.read', 'group.write', 'group.admin'
+                    )(group.group_name, 'repos data'):
+                raise HTTPForbidden()
+        limit = safe_int(request.GET.get('limit'), c.visual.dashboard_items)
+        return RepoModel().get_repos_page(
+            c.authuser, group_id=group_id,
+            name_filter=request.GET.get('filter'),
+            sort=request.GET.get('sort', 'name'),
+            direction=request.GET.get('dir', 'asc'),
+            start=safe_int(request.GET.get('start'), 0),
+            limit=min(limit, 500))
+
     @LoginRequired()
     @jsonify
     def repo_switcher_data(self):
@@ -40,15 +40,15 @@ from webob.exc import HTTPBadRequest
 from pylons import request, tmpl_context as c, response, url
 from pylons.i18n.translation import _
 
-from kallithea.controllers.admin.admin import _journal_filter
+from kallithea.controllers.admin.admin import _journal_filter, JOURNAL_KEY
 from kallithea.model.db import UserLog, UserFollowing, Repository, User
 from kallithea.model.meta import Session
 from kallithea.model.repo import RepoModel
 import kallithea.lib.helpers as h
-from kallithea.lib.helpers import Page
+from kallithea.lib.helpers import KeysetPage
 from kallithea.lib.auth import LoginRequired, NotAnonymous
 from kallithea.lib.base import BaseController, render
-from kallithea.lib.utils2 import safe_int, AttributeDict
+from kallithea.lib.utils2 import AttributeDict
 from kallithea.lib.compat import json
 
 log = logging.getLogger(__name__)
@@ -98,7 +98,8 @@ class JournalController(BaseController):
             #filter
             journal = _journal_filter(journal, c.search_term)
             journal = journal.filter(filtering_criterion)\
-                        .order_by(UserLog.action_date.desc())
+                        .order_by(UserLog.action_date.desc(),
+                                  UserLog.user_log_id.desc())
         else:
             journal = []
 
@@ -120,7 +121,9 @@ class JournalController(BaseController):
                          language=self.language,
                          ttl=self.ttl)
 
-        for entry in journal[:self.feed_nr]:
+        entries = journal[:self.feed_nr]
+        UserLog.load_revisions_preview(entries)
+        for entry in entries:
             user = entry.user
             if user is None:
                 #fix deleted users
@@ -162,7 +165,9 @@ class JournalController(BaseController):
                          language=self.language,
                          ttl=self.ttl)
 
-        for entry in journal[:self.feed_nr]:
+        entries = journal[:self.feed_nr]
+        UserLog.load_revisions_preview(entries)
+        for entry in entries:
             user = entry.user
             if user is None:
                 #fix deleted users
@@ -192,7 +197,6 @@ class JournalController(BaseController):
     @NotAnonymous()
     def index(self):
         # Return a rendered template
-        p = safe_int(request.GET.get('page', 1), 1)
         c.user = User.get(self.authuser.user_id)
         c.following = self.sa.query(UserFollowing)\
             .filter(UserFollowing.user_id == self.authuser.user_id)\
@@ -204,7 +208,11 @@ class JournalController(BaseController):
         def url_generator(**kw):
             return url.current(filter=c.search_term, **kw)
 
-        c.journal_pager = Page(journal, page=p, items_per_page=20, url=url_generator)
+        c.journal_pager = KeysetPage(journal, JOURNAL_KEY,
+                                     after=request.GET.get('after'),
+                                     before=request.GET.get('before'),
+                                     items_per_page=20, url=url_generator)
+        UserLog.load_revisions_preview(c.journal_pager)
         c.journal_day_aggreagate = self._get_daily_aggregate(c.journal_pager)
 
         if request.environ.get('HTTP_X_PARTIAL_XHR'):
@@ -336,7 +344,6 @@ class JournalController(BaseController):
     @LoginRequired()
     def public_journal(self):
         # Return a rendered template
-        p = safe_int(request.GET.get('page', 1), 1)
 
         c.following = self.sa.query(UserFollowing)\
             .filter(UserFollowing.user_id == self.authuser.user_id)\
@@ -345,8 +352,12 @@ class JournalController(BaseController):
 
         journal = self._get_journal_data(c.following)
 
-        c.journal_pager = Page(journal, page=p, items_per_page=20)
+        c.journal_pager = KeysetPage(journal, JOURNAL_KEY,
+                                     after=request.GET.get('after'),
+                                     before=request.GET.get('before'),
+                                     items_per_page=20)
 
+        UserLog.load_revisions_preview(c.journal_pager)
         c.journal_day_aggreagate = self._get_daily_aggregate(c.journal_pager)
 
         if request.environ.get('HTTP_X_PARTIAL_XHR'):
@@ -48,6 +48,8 @@ from kallithea.lib.utils import action_logger, jsonify
 from kallithea.lib.vcs.utils import safe_str
 from kallithea.lib.vcs.exceptions import EmptyRepositoryError
 from kallithea.lib.diffs import LimitedDiffContainer
+from kallithea.lib.diff_cache import get_diff_cache
+from kallithea.lib.celerylib import tasks, run_task
 from kallithea.model.db import  PullRequest, ChangesetStatus, ChangesetComment,\
     PullRequestReviewers
 from kallithea.model.pull_request import PullRequestModel
@@ -360,6 +362,7 @@ class PullrequestsController(BaseRepoController):
                 other_ref, revisions, reviewers, title, description
             )
             Session().commit()
+            self._warm_diff_cache(pull_request)
             h.flash(_('Successfully opened new pull request'),
                     category='success')
         except Exception:
@@ -370,6 +373,18 @@ class PullrequestsController(BaseRepoController):
 
         return redirect(pull_request.url())
 
+    def _warm_diff_cache(self, pull_request):
+        """
+        Parses the diff shown by the new pull request into the diff cache,
+        in celery if enabled
+        """
+        if get_diff_cache() is None:
+            return
+        org_rev = safe_str(pull_request.org_ref.split(':')[2])
+        other_rev = safe_str(pull_request.other_ref.split(':')[2])
+        run_task(tasks.warm_diff_cache, pull_request.org_repo.repo_name,
+                 other_rev, org_rev, self.cut_off_limit)
+
     def create_update(self, old_pull_request, updaterev, title, description, reviewers_ids):
         org_repo = RepoModel()._get_repo(old_pull_request.org_repo.repo_name)
         org_ref_type, org_ref_name, org_rev = old_pull_request.org_ref.split(':')
@@ -461,6 +476,7 @@ class PullrequestsController(BaseRepoController):
         PullRequestModel().close_pull_request(old_pull_request.pull_request_id)
 
         Session().commit()
+        self._warm_diff_cache(pull_request)
         h.flash(_('Pull request update created'),
                 category='success')
 
@@ -631,13 +647,15 @@ class PullrequestsController(BaseRepoController):
         # we swap org/other ref since we run a simple diff on one repo
         log.debug('running diff between %s and %s in %s'
                   % (c.a_rev, c.cs_rev, org_scm_instance.path))
-        txtdiff = org_scm_instance.get_diff(rev1=safe_str(c.a_rev), rev2=safe_str(c.cs_rev),
-                                      ignore_whitespace=ignore_whitespace,
-                                      context=line_context)
-
-        diff_processor = diffs.DiffProcessor(txtdiff or '', format='gitdiff',
-                                             diff_limit=diff_limit)
-        _parsed = diff_processor.prepare()
+        # parse the diff while it is generated, stopping at the limit
+        diff_repo = org_scm_instance
+        rev1 = safe_str(c.a_rev)
+        diff_processor = diffs.get_diff_processor(diff_repo, rev1,
+                                                  safe_str(c.cs_rev),
+                                                  ignore_whitespace=ignore_whitespace,
+                                                  context=line_context,
+                                                  diff_limit=diff_limit)
+        _parsed = diff_processor.parsed_diff
 
         c.limited_diff = False
         if isinstance(_parsed, LimitedDiffContainer):
@@ -657,6 +675,13 @@ class PullrequestsController(BaseRepoController):
             htmldiff = diff_processor.as_html(enable_comments=True,
                                               parsed_lines=[f])
             c.changes[fid] = [f['operation'], f['filename'], htmldiff]
+        if c.limited_diff:
+            # files cut off are listed, their diffs loaded on demand
+            for f in diffs.get_omitted_files(diff_repo, rev1,
+                                             safe_str(c.cs_rev), _parsed):
+                fid = h.FID('', f['filename'])
+                c.files.append([fid, f['operation'], f['filename'], f['stats']])
+                c.changes[fid] = [f['operation'], f['filename'], None]
 
         # inline comments
         c.inline_cnt = 0
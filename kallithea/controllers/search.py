@@ -31,7 +31,7 @@ import urllib
 from pylons.i18n.translation import _
 from pylons import request, config, tmpl_context as c
 
-from whoosh.index import open_dir, EmptyIndexError
+from whoosh.index import EmptyIndexError
 from whoosh.qparser import QueryParser, QueryParserError
 from whoosh.query import Phrase, Prefix
 from webhelpers.util import update_params
@@ -39,7 +39,7 @@ from webhelpers.util import update_params
 from kallithea.lib.auth import LoginRequired
 from kallithea.lib.base import BaseRepoController, render
 from kallithea.lib.indexers import CHGSETS_SCHEMA, SCHEMA, CHGSET_IDX_NAME, \
-    IDX_NAME, WhooshResultWrapper
+    IDX_NAME, WhooshResultWrapper, get_searcher
 from kallithea.model.repo import RepoModel
 from kallithea.lib.utils2 import safe_str, safe_int
 from kallithea.lib.helpers import Page
@@ -88,9 +88,8 @@ class SearchController(BaseRepoController):
             p = safe_int(request.GET.get('page', 1), 1)
             highlight_items = set()
             try:
-                idx = open_dir(config['app_conf']['index_dir'],
-                               indexname=index_name)
-                searcher = idx.searcher()
+                searcher = get_searcher(config['app_conf']['index_dir'],
+                                        index_name)
 
                 qp = QueryParser(search_type, schema=schema_defn)
                 if c.repo_name:
@@ -107,11 +106,15 @@ class SearchController(BaseRepoController):
                             if i[0] in ['content', 'message']:
                                 highlight_items.add(i[1])
 
-                    matcher = query.matcher(searcher)
-
                     log.debug('query: %s' % query)
                     log.debug('hl terms: %s' % highlight_items)
-                    results = searcher.search(query)
+                    repo_location = RepoModel().repos_path
+                    results = WhooshResultWrapper(search_type, searcher, query,
+                                                  highlight_items,
+                                                  repo_location,
+                                                  pagelen=10)
+                    # score hits up to the requested page only
+                    results.search_page(p)
                     res_ln = len(results)
                     c.runtime = '%s results (%.3f seconds)' % (
                         res_ln, results.runtime
@@ -121,10 +124,8 @@ class SearchController(BaseRepoController):
                         q = urllib.quote(safe_str(c.cur_query))
                         return update_params("?q=%s&type=%s" \
                         % (q, safe_str(c.cur_type)), **kw)
-                    repo_location = RepoModel().repos_path
                     c.formated_results = Page(
-                        WhooshResultWrapper(search_type, searcher, matcher,
-                                            highlight_items, repo_location),
+                        results,
                         page=p,
                         item_count=res_ln,
                         items_per_page=10,
@@ -133,7 +134,6 @@ class SearchController(BaseRepoController):
 
                 except QueryParserError:
                     c.runtime = _('Invalid search query. Try quoting it.')
-                searcher.close()
             except (EmptyIndexError, IOError):
                 log.error(traceback.format_exc())
                 log.error('Empty Index data')
@@ -241,7 +241,5 @@ class SummaryController(BaseRepoController):
             c.trending_languages = json.dumps({})
             c.no_data = True
 
-        recurse_limit = 500  # don't recurse more than 500 times when parsing
-        run_task(get_commits_stats, c.db_repo.repo_name, ts_min_y,
-                 ts_max_y, recurse_limit)
+        run_task(get_commits_stats, c.db_repo.repo_name, ts_min_y, ts_max_y)
         return render('summary/statistics.html')
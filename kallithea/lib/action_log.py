@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.action_log
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Buffered writer of the action log, which writes actions of pulls, pushes
+and downloads to the database in batches in the background
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import os
+import errno
+import atexit
+import logging
+import datetime
+import threading
+
+from kallithea.lib.compat import json
+from kallithea.lib.utils2 import safe_int, safe_unicode, str2bool
+
+log = logging.getLogger(__name__)
+
+#: default number of queued actions which are written right away
+DEFAULT_BATCH_SIZE = 100
+#: default seconds queued actions wait for a write at most
+DEFAULT_FLUSH_INTERVAL = 2
+#: default number of failed writes in a row after which queued actions are
+#: dropped from memory; spooled ones are written by ``recover`` later
+DEFAULT_MAX_RETRIES = 10
+
+_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class ActionLogWriter(object):
+    """
+    Queue of actions written to user_logs by a background thread with a
+    single INSERT of many rows, once ``batch_size`` actions are queued or
+    ``flush_interval`` seconds after the first of them was.
+
+    Users and repositories are given by names and are looked up only when
+    a batch is written, all of them by a single query. Actions of users or
+    repositories deleted meanwhile are kept without a reference, like
+    actions of deleted ones in the log are.
+
+    If ``spool_dir`` is set, every queued action is also appended to a
+    spool file of the process in it, which is removed once the actions
+    are in the database. Spool files left by processes which didn't exit
+    cleanly are written to the database by ``recover``.
+
+    Actions which failed to be written are queued again, until writing
+    fails ``max_retries`` times in a row.
+    """
+
+    def __init__(self, spool_dir=None, batch_size=DEFAULT_BATCH_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._queue = []
+        # spool files of the queued actions, the last one is written to
+        self._spools = []
+        self._spool = None
+        self._spool_seq = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._closed = False
+        # failed writes in a row
+        self._failures = 0
+        self.written = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
+
+    def _open_spool(self):
+        if not os.path.isdir(self.spool_dir):
+            try:
+                os.makedirs(self.spool_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self._spool_seq += 1
+        path = os.path.join(self.spool_dir, 'actions-%s-%s.spool'
+                            % (os.getpid(), self._spool_seq))
+        self._spool = open(path, 'ab')
+        self._spools.append(path)
+
+    def _write_spool(self, entry):
+        try:
+            if self._spool is None:
+                self._open_spool()
+            self._spool.write(json.dumps(entry) + '\n')
+            self._spool.flush()
+        except (IOError, OSError), e:
+            log.error('Cannot spool action to %s: %s' % (self.spool_dir, e))
+
+    def log(self, username, action, repo_name, ipaddr='', user_id=None,
+            repo_id=None, action_date=None, revisions=None):
+        """
+        Queues ``action`` of user ``username`` on repository ``repo_name``;
+        ``user_id`` and ``repo_id`` are looked up by the names if not given.
+        ``revisions`` is the list of revisions pushed by the action.
+        """
+        entry = {
+            'user_id': user_id,
+            'username': safe_unicode(username),
+            'repository_id': repo_id,
+            'repository_name': safe_unicode(repo_name or ''),
+            'action': safe_unicode(action),
+            'user_ip': ipaddr,
+            'action_date': (action_date or datetime.datetime.now())
+                .strftime(_DATE_FORMAT),
+            'revisions': revisions,
+        }
+        with self._lock:
+            self._queue.append(entry)
+            if self.spool_dir:
+                self._write_spool(entry)
+            full = len(self._queue) >= self.batch_size
+        self._start()
+        if full:
+            self._wakeup.set()
+
+    def _start(self):
+        if self._closed:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name='action-log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.error('writing of action log failed', exc_info=True)
+
+    def flush(self):
+        """
+        Writes all queued actions to the database; returns their number.
+        If writing fails the actions stay queued, unless it failed
+        ``max_retries`` times in a row.
+        """
+        with self._flush_lock:
+            with self._lock:
+                entries, self._queue = self._queue, []
+                spools, self._spools = self._spools, []
+                if self._spool is not None:
+                    self._spool.close()
+                    self._spool = None
+            if not entries:
+                return 0
+            try:
+                self._insert(entries)
+            except Exception:
+                with self._lock:
+                    self._failures += 1
+                    if self._failures < self.max_retries:
+                        self._queue[:0] = entries
+                        self._spools[:0] = spools
+                    else:
+                        self._failures = 0
+                        log.error('Dropping %s actions which failed to be '
+                                  'written %s times%s' % (len(entries),
+                                  self.max_retries, ', they are left in '
+                                  'spool files' if spools else ''))
+                raise
+            self._failures = 0
+            for path in spools:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.written += len(entries)
+            return len(entries)
+
+    def _insert(self, entries):
+        from kallithea.model import meta
+        from kallithea.model.db import User, Repository, UserLog, \
+            UserLogRevision
+
+        # own session, flushing can happen in a thread with a request
+        sa = meta.session_factory()
+        try:
+            usernames = set(e['username'] for e in entries
+                            if e['user_id'] is None)
+            users = {}
+            if usernames:
+                users = dict(sa.query(User.username, User.user_id)
+                             .filter(User.username.in_(usernames)).all())
+            repo_names = set(e['repository_name'] for e in entries
+                             if e['repository_id'] is None
+                             and e['repository_name'])
+            repos = {}
+            if repo_names:
+                repos = dict(sa.query(Repository.repo_name,
+                                      Repository.repo_id)
+                             .filter(Repository.repo_name.in_(repo_names))
+                             .all())
+            rows = []
+            for e in entries:
+                row = dict(e)
+                if row['user_id'] is None:
+                    row['user_id'] = users.get(row['username'])
+                if row['repository_id'] is None:
+                    row['repository_id'] = repos.get(row['repository_name'])
+                row['action_date'] = datetime.datetime.strptime(
+                    row['action_date'], _DATE_FORMAT)
+                revisions = row.pop('revisions', None)
+                if revisions is None:
+                    rows.append(row)
+                    continue
+                # pushes are inserted one by one, their ids are needed
+                row['revisions_count'] = len(revisions)
+                user_log_id = sa.execute(UserLog.__table__.insert(), row)\
+                    .inserted_primary_key[0]
+                if revisions:
+                    sa.execute(UserLogRevision.__table__.insert(),
+                               [{'user_log_id': user_log_id, 'ordinal': i,
+                                 'revision': rev}
+                                for i, rev in enumerate(revisions)])
+            if rows:
+                sa.execute(UserLog.__table__.insert(), rows)
+            sa.commit()
+        except Exception:
+            sa.rollback()
+            raise
+        finally:
+            sa.close()
+
+    def close(self):
+        """
+        Stops the background thread and writes queued actions; later
+        actions are written only by ``flush``.
+        """
+        self._closed = True
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(self.flush_interval + 10)
+        return self.flush()
+
+    def _claim(self, name):
+        """
+        Renames spool file ``name`` of a process which is no longer running
+        to a name of this process, so concurrent recoveries don't write it
+        twice; files of recoveries which didn't finish are claimed again.
+        Returns tuple of the claimed path and the original path, or None if
+        the file can't be claimed.
+        """
+        if name.startswith('recovering-'):
+            # recovering-<pid of recovery>-actions-<pid>-<seq>.spool
+            _prefix, pid, original = name.split('-', 2)
+        else:
+            original = name
+            pid = name.split('-')[1]
+        pid = safe_int(pid)
+        if pid is None or pid == os.getpid() or _pid_alive(pid):
+            return None
+        path = os.path.join(self.spool_dir, name)
+        claimed = os.path.join(self.spool_dir, 'recovering-%s-%s'
+                               % (os.getpid(), original))
+        try:
+            os.rename(path, claimed)
+        except OSError:
+            # claimed by another process meanwhile
+            return None
+        return claimed, os.path.join(self.spool_dir, original)
+
+    def recover(self):
+        """
+        Writes actions from spool files of processes which are no longer
+        running to the database; returns their number.
+        """
+        if not self.spool_dir:
+            return 0
+        try:
+            names = os.listdir(self.spool_dir)
+        except OSError:
+            return 0
+        recovered = 0
+        for name in sorted(names):
+            parts = name.split('-')
+            if (parts[0] not in ('actions', 'recovering') or
+                len(parts) != (3 if parts[0] == 'actions' else 5) or
+                not name.endswith('.spool')):
+                continue
+            paths = self._claim(name)
+            if paths is None:
+                continue
+            path, original = paths
+            entries = []
+            try:
+                with open(path, 'rb') as f:
+                    for line in f:
+                        try:
+                            entries.append(json.loads(line))
+                        except ValueError:
+                            # the last line of a crashed process
+                            log.warning('skipping broken line of %s' % path)
+                if entries:
+                    self._insert(entries)
+            except Exception, e:
+                # left for another recovery
+                os.rename(path, original)
+                if isinstance(e, (IOError, OSError)):
+                    log.error('Cannot read spool file %s: %s' % (path, e))
+                    continue
+                raise
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            log.info('recovered %s actions from %s' % (len(entries),
+                                                       original))
+            recovered += len(entries)
+        return recovered
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_action_log_writer():
+    """
+    Returns process wide ``ActionLogWriter`` configured by
+    ``action_log_spool_dir``, ``action_log_batch_size`` and
+    ``action_log_flush_interval`` settings, or None if ``action_log_async``
+    is disabled.
+    """
+    global _writer
+    import kallithea
+    if not str2bool(kallithea.CONFIG.get('action_log_async')):
+        return None
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = ActionLogWriter(
+                    kallithea.CONFIG.get('action_log_spool_dir') or None,
+                    batch_size=safe_int(
+                        kallithea.CONFIG.get('action_log_batch_size'),
+                        DEFAULT_BATCH_SIZE),
+                    flush_interval=safe_int(
+                        kallithea.CONFIG.get('action_log_flush_interval'),
+                        DEFAULT_FLUSH_INTERVAL))
+                try:
+                    writer.recover()
+                except Exception:
+                    log.error('recovery of spooled actions failed',
+                              exc_info=True)
+                # short lived processes, like git hooks, write what is left
+                atexit.register(_flush_at_exit, writer)
+                _writer = writer
+    return _writer
+
+
+def _flush_at_exit(writer):
+    try:
+        writer.close()
+    except Exception:
+        log.error('writing of action log failed, actions are left in '
+                  'spool files', exc_info=True)
@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.archive_cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Bounded cache of repository archives, filled while archives are streamed to
+clients
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import os
+import time
+import errno
+import logging
+import threading
+
+from kallithea.lib.compat import json
+from kallithea.lib.utils2 import safe_int, safe_str
+from kallithea.lib.vcs.utils.archivers import CHUNK_SIZE
+
+try:
+    import fcntl
+except ImportError:  # not posix, archives are built once per process only
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+#: default limit of size of all cached archives, in megabytes
+DEFAULT_CACHE_SIZE = 1024
+#: eviction policies; least recently or least frequently used archives are
+#: removed first
+POLICIES = ('lru', 'lfu')
+#: file in cache directory keeping hit counters shared by all processes
+STATS_FILE = '.stats'
+#: how often archive being built by another process is checked for new
+#: content, in seconds
+POLL_INTERVAL = 0.1
+#: hit counters are kept in memory and written to ``STATS_FILE`` at most
+#: once per this many seconds
+STATS_INTERVAL = 5
+
+
+class ArchiveCacheError(Exception):
+    pass
+
+
+def get_archive_name(repo_name, raw_id, ext):
+    """
+    Returns file name of archive of changeset ``raw_id`` of ``repo_name``
+    with extension ``ext``, used both for downloads and the cache.
+    """
+    return '%s-%s%s' % (safe_str(repo_name.replace('/', '_')),
+                        safe_str(raw_id[:12]), ext)
+
+
+class _ArchiveBuild(object):
+    """
+    Archive being written to a temporary file in the cache directory by
+    a background thread. Any number of clients read the file while it grows;
+    it is renamed to its final name when complete.
+
+    With ``fcntl`` available the temporary file is exclusively locked while
+    it is written, so clients in other processes follow it instead of
+    building the same archive again.
+    """
+
+    def __init__(self, cache, name, tmp_path, f):
+        self.cache = cache
+        self.name = name
+        self.path = cache.get_path(name)
+        self.tmp_path = tmp_path
+        self.size = 0
+        self.done = False
+        self.error = None
+        self._cond = threading.Condition()
+        self._file = f
+        self._chunks = None
+
+    def start(self, chunks):
+        self._chunks = chunks
+        thread = threading.Thread(target=self._run,
+                                  name='archive %s' % self.path)
+        thread.daemon = True
+        thread.start()
+
+    def fail(self, error):
+        """
+        Ends build which couldn't be started, readers get ``error``.
+        """
+        self.error = error
+        self._complete()
+
+    def _run(self):
+        try:
+            for chunk in self._chunks:
+                self._file.write(chunk)
+                self._file.flush()
+                with self._cond:
+                    self.size += len(chunk)
+                    self._cond.notify_all()
+        except Exception, e:
+            log.error('Cannot create archive %s: %s' % (self.path, e))
+            self.error = e
+        self._complete()
+
+    def _complete(self):
+        try:
+            self.cache._finish(self)
+        finally:
+            # releases the lock only after the archive was stored
+            self._file.close()
+            with self._cond:
+                self.done = True
+                self._cond.notify_all()
+
+    def open(self):
+        return open(self.tmp_path, 'rb')
+
+    def read(self, f, chunk_size):
+        """
+        Yields content of the archive from ``f`` opened by ``open``, waiting
+        for the writer as needed.
+        """
+        pos = 0
+        try:
+            while True:
+                with self._cond:
+                    while pos >= self.size and not self.done:
+                        self._cond.wait()
+                    size = self.size
+                if self.error is not None:
+                    raise self.error
+                if pos >= size:
+                    break
+                while pos < size:
+                    data = f.read(min(size - pos, chunk_size))
+                    pos += len(data)
+                    yield data
+        finally:
+            f.close()
+
+
+class ArchiveCache(object):
+    """
+    Archives stored in ``cache_dir`` by file name.
+
+    Archive missing in the cache is created by a single background writer
+    (single-flight, also across processes where ``fcntl`` is available),
+    streamed to all clients requesting it meanwhile and stored in the cache
+    atomically once it is complete.
+
+    When size of all cached archives exceeds ``max_size`` bytes, archives
+    are evicted by ``policy``: ``lru`` removes least recently used ones,
+    ``lfu`` least frequently used ones. Hit counters and usage of every
+    archive are kept in ``STATS_FILE`` in the cache directory, so they are
+    shared by all processes using it.
+    """
+
+    def __init__(self, cache_dir, max_size=0, policy='lru',
+                 chunk_size=CHUNK_SIZE):
+        if policy not in POLICIES:
+            raise ArchiveCacheError('Unknown archive cache policy %s, '
+                                    'expected one of %s'
+                                    % (policy, ', '.join(POLICIES)))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.policy = policy
+        self.chunk_size = chunk_size
+        self._builds = {}
+        self._lock = threading.Lock()
+        # hit counters not yet written to STATS_FILE
+        self._pending = {'entries': {}}
+        self._stats_written = 0
+
+    def get_path(self, name):
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, name, create):
+        """
+        Returns iterable over chunks of archive ``name``, cached or created
+        from chunks returned by ``create`` callable.
+        """
+        return self._get(name, create, True)
+
+    def warm(self, name, create):
+        """
+        Makes sure archive ``name`` is cached, creating it by ``create`` if
+        needed; returns True if the archive had to be created. Meant to be
+        called ahead of downloads, it doesn't count as a hit or miss.
+        """
+        if os.path.exists(self.get_path(name)):
+            return False
+        for _chunk in self._get(name, create, False):
+            pass
+        return True
+
+    def _get(self, name, create, count):
+        path = self.get_path(name)
+        build = None
+        with self._lock:
+            shared = self._builds.get(name)
+            if shared is not None:
+                log.debug('Archive %s is being created, sharing it' % name)
+                # opened while holding the lock, before it can be renamed
+                event, chunks = 'shared', shared.read(shared.open(),
+                                                      self.chunk_size)
+            else:
+                f = self._open_cached(path)
+                if f is None:
+                    if not os.path.isdir(self.cache_dir):
+                        os.makedirs(self.cache_dir)
+                    event, chunks, build = self._start_build(name)
+                else:
+                    log.debug('Found cached archive in %s' % path)
+                    event, chunks = 'hits', self._read_file(f)
+        if build is not None:
+            # other downloads don't wait for start of creation of this one
+            chunks = self._run_build(build, create)
+        if count:
+            self._record(name, event)
+        return chunks
+
+    def _start_build(self, name):
+        """
+        Returns tuple of event, chunks and build; build is registered, but
+        not started yet, if the archive has to be created by this process.
+        """
+        path = self.get_path(name)
+        if fcntl is None:
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            f = open(tmp_path, 'wb')
+        else:
+            tmp_path = '%s.tmp' % path
+            f = self._lock_tmp(tmp_path)
+            if f is None:
+                log.debug('Archive %s is being created by another process, '
+                          'following it' % name)
+                return 'shared', self._follow(tmp_path, path), None
+            # it might have been stored by another process meanwhile
+            cached = self._open_cached(path)
+            if cached is not None:
+                f.close()
+                return 'hits', self._read_file(cached), None
+        log.debug('Archive %s is not yet cached' % name)
+        build = _ArchiveBuild(self, name, tmp_path, f)
+        self._builds[name] = build
+        return 'misses', None, build
+
+    def _run_build(self, build, create):
+        """
+        Starts writing of ``build`` registered by ``_start_build`` with
+        chunks returned by ``create``; called without holding the lock.
+        """
+        try:
+            chunks = create()
+        except Exception, e:
+            build.fail(e)
+            raise
+        reader = build.open()
+        build.start(chunks)
+        return build.read(reader, self.chunk_size)
+
+    def _lock_tmp(self, tmp_path):
+        """
+        Returns temporary file ``tmp_path`` exclusively locked and emptied,
+        or None if another process holds the lock.
+        """
+        while True:
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT, 0666)
+            f = os.fdopen(fd, 'r+b')
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return None
+            try:
+                same = os.stat(tmp_path).st_ino == os.fstat(fd).st_ino
+            except OSError:
+                same = False
+            if same:
+                # leftover of a process which died while building it
+                f.truncate(0)
+                return f
+            # stored or removed before we got the lock, try again
+            f.close()
+
+    def _follow(self, tmp_path, path):
+        """
+        Yields content of archive being written to ``tmp_path`` by another
+        process until that process releases its lock on it. The writer
+        empties the file when it fails, the archive is complete otherwise,
+        even if it was evicted from the cache meanwhile.
+        """
+        try:
+            fd = os.open(tmp_path, os.O_RDONLY)
+        except OSError:
+            # finished meanwhile
+            f = self._open_cached(path)
+            if f is None:
+                raise ArchiveCacheError('Archive %s was not created' % path)
+            for data in self._read_file(f):
+                yield data
+            return
+        try:
+            finished = False
+            while True:
+                data = os.read(fd, self.chunk_size)
+                if data:
+                    yield data
+                elif finished:
+                    break
+                else:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    except IOError:
+                        time.sleep(POLL_INTERVAL)
+                        continue
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    # read whatever was written before the lock was released
+                    finished = True
+            size = os.fstat(fd).st_size
+            if not size or size != os.lseek(fd, 0, os.SEEK_CUR):
+                raise ArchiveCacheError('Archive %s was not created' % path)
+        finally:
+            os.close(fd)
+
+    def _open_cached(self, path):
+        try:
+            return open(path, 'rb')
+        except IOError:
+            return None
+
+    def _read_file(self, f):
+        try:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            f.close()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            log.error('Cannot remove %s: %s' % (path, e))
+
+    def _finish(self, build):
+        with self._lock:
+            del self._builds[build.name]
+            if build.error is not None:
+                # tells processes following it that it is incomplete
+                build._file.truncate(0)
+                self._remove(build.tmp_path)
+                return
+            try:
+                if os.name == 'nt' and os.path.exists(build.path):
+                    os.remove(build.path)
+                os.rename(build.tmp_path, build.path)
+            except OSError, e:
+                log.error('Cannot store archive %s: %s' % (build.path, e))
+                return
+            log.debug('Stored new archive in %s' % build.path)
+        try:
+            self.prune(keep=build.name)
+        except (IOError, OSError), e:
+            log.error('Cannot prune archive cache: %s' % e)
+
+    def _update_stats(self, update):
+        """
+        Calls ``update`` with stats stored in the cache directory, including
+        counters recorded since they were stored last time, and stores them
+        again; returns result of ``update``. Called holding the lock.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fd = os.open(os.path.join(self.cache_dir, STATS_FILE),
+                     os.O_RDWR | os.O_CREAT, 0666)
+        f = os.fdopen(fd, 'r+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            data = f.read()
+            try:
+                stats = json.loads(data) if data else {}
+            except ValueError:
+                log.error('Ignoring broken archive cache stats')
+                stats = {}
+            stats.setdefault('entries', {})
+            for key, value in self._pending.items():
+                if key != 'entries':
+                    stats[key] = stats.get(key, 0) + value
+            for name, (hits, last_used) in self._pending['entries'].items():
+                used = stats['entries'].get(name, [0, 0])
+                stats['entries'][name] = [used[0] + hits,
+                                          max(used[1], last_used)]
+            result = update(stats)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(stats))
+            self._pending = {'entries': {}}
+            self._stats_written = time.time()
+            return result
+        finally:
+            f.close()
+
+    def _record(self, name, event):
+        """
+        Counts ``event`` of archive ``name``; counters are written to
+        ``STATS_FILE`` once per ``STATS_INTERVAL`` and before they are used.
+        """
+        now = time.time()
+        with self._lock:
+            pending = self._pending
+            pending[event] = pending.get(event, 0) + 1
+            used = pending['entries'].setdefault(name, [0, 0])
+            if event != 'misses':
+                used[0] += 1
+            used[1] = now
+            if now - self._stats_written < STATS_INTERVAL:
+                return
+            try:
+                self._update_stats(lambda stats: None)
+            except (IOError, OSError), e:
+                log.error('Cannot update archive cache stats: %s' % e)
+
+    def _list(self):
+        """
+        Returns list of (name, size, mtime) of cached archives.
+        """
+        archives = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return archives
+        for name in names:
+            if name.startswith('.') or name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(self.get_path(name))
+            except OSError:
+                continue
+            archives.append((name, st.st_size, st.st_mtime))
+        return archives
+
+    def prune(self, keep=None, max_size=None):
+        """
+        Evicts archives until size of the cache is within ``max_size``
+        (``self.max_size`` by default, 0 means unlimited); archive ``keep``
+        is never evicted. Returns number of evicted archives.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        if not max_size:
+            return 0
+
+        def update(stats):
+            entries = stats['entries']
+            archives = self._list()
+            size = sum(a[1] for a in archives)
+            # forget archives removed by other means
+            present = set(a[0] for a in archives)
+            for name in entries.keys():
+                if name not in present:
+                    del entries[name]
+            if size <= max_size:
+                return 0
+
+            def order(archive):
+                name, _size, mtime = archive
+                hits, last_used = entries.get(name, (0, mtime))
+                if self.policy == 'lfu':
+                    return (hits, last_used)
+                return (last_used, hits)
+
+            evicted = 0
+            for name, archive_size, _mtime in sorted(archives, key=order):
+                if size <= max_size:
+                    break
+                if name == keep:
+                    continue
+                # clients reading it keep it open until they are done
+                self._remove(self.get_path(name))
+                entries.pop(name, None)
+                size -= archive_size
+                evicted += 1
+                log.debug('Evicted archive %s from cache' % name)
+            stats['evictions'] = stats.get('evictions', 0) + evicted
+            return evicted
+
+        with self._lock:
+            return self._update_stats(update)
+
+    def clear(self):
+        """
+        Removes all cached archives and resets stats; archives being created
+        are stored when complete.
+        """
+        with self._lock:
+            for name, _size, _mtime in self._list():
+                self._remove(self.get_path(name))
+            self._update_stats(lambda stats: stats.clear())
+
+    def stats(self):
+        with self._lock:
+            stats = self._update_stats(dict)
+        archives = self._list()
+        hits = stats.get('hits', 0) + stats.get('shared', 0)
+        requests = hits + stats.get('misses', 0)
+        return {
+            'hits': stats.get('hits', 0),
+            'shared': stats.get('shared', 0),
+            'misses': stats.get('misses', 0),
+            'evictions': stats.get('evictions', 0),
+            'hit_rate': float(hits) / requests if requests else 0.0,
+            'archives': len(archives),
+            'size': sum(a[1] for a in archives),
+            'max_size': self.max_size,
+            'policy': self.policy,
+        }
+
+
+def make_archive_cache(config):
+    """
+    Returns ``ArchiveCache`` configured by ``archive_cache_dir``,
+    ``archive_cache_size`` (in megabytes) and ``archive_cache_policy``
+    settings in ``config`` or None if ``archive_cache_dir`` is not set.
+    """
+    cache_dir = config.get('archive_cache_dir')
+    if not cache_dir:
+        return None
+    size = safe_int(config.get('archive_cache_size'), DEFAULT_CACHE_SIZE)
+    return ArchiveCache(cache_dir, max_size=size * 1024 * 1024,
+                        policy=config.get('archive_cache_policy') or 'lru')
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_archive_cache():
+    """
+    Returns process wide ``ArchiveCache`` configured by application settings
+    or None if archive cache is disabled.
+    """
+    global _cache
+    import kallithea
+    cache_dir = kallithea.CONFIG.get('archive_cache_dir')
+    if not cache_dir:
+        return None
+    if _cache is None or _cache.cache_dir != cache_dir:
+        with _cache_lock:
+            if _cache is None or _cache.cache_dir != cache_dir:
+                _cache = make_archive_cache(kallithea.CONFIG)
+    return _cache
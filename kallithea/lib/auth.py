@@ -35,6 +35,7 @@ import collections
 
 from tempfile import _RandomNameSequence
 from decorator import decorator
+from beaker.cache import cache_region
 
 from pylons import url, request
 from pylons.controllers.util import abort, redirect
@@ -51,11 +52,12 @@ from kallithea.model.user import UserModel
 from kallithea.model.db import User, Repository, Permission, \
     UserToPerm, UserGroupRepoToPerm, UserGroupToPerm, UserGroupMember, \
     RepoGroup, UserGroupRepoGroupToPerm, UserIpMap, UserGroupUserGroupToPerm, \
-    UserGroup, UserApiKeys
+    UserGroup, UserApiKeys, UserRepoToPerm, UserRepoGroupToPerm, \
+    UserUserGroupToPerm, CacheInvalidation
 
 from kallithea.lib.utils2 import safe_unicode, aslist
 from kallithea.lib.utils import get_repo_slug, get_repo_group_slug, \
-    get_user_group_slug, conditional_cache
+    get_user_group_slug
 from kallithea.lib.caching_query import FromCache
 
 
@@ -194,15 +196,46 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
                 return new_perm
             return cur_perm
 
+    # permission names are shared by all entries instead of keeping a copy
+    # read from the database in each of them
+    perm_names = {}
+    def _perm(perm_name):
+        return perm_names.setdefault(perm_name, perm_name)
+
     #======================================================================
-    # fetch default permissions
+    # fetch permissions of the default user and the user itself, only the
+    # needed columns are selected
     #======================================================================
     default_user = User.get_by_username('default', cache=True)
     default_user_id = default_user.user_id
+    uid = user_id
+    user_ids = [default_user_id, uid]
 
-    default_repo_perms = Permission.get_default_perms(default_user_id)
-    default_repo_groups_perms = Permission.get_default_group_perms(default_user_id)
-    default_user_group_perms = Permission.get_default_user_group_perms(default_user_id)
+    repo_perms = Session().query(UserRepoToPerm.user_id, Repository.repo_name,
+                                 Repository.private, Repository.user_id,
+                                 Permission.permission_name)\
+        .join((Repository, UserRepoToPerm.repository_id == Repository.repo_id))\
+        .join((Permission, UserRepoToPerm.permission_id ==
+               Permission.permission_id))\
+        .filter(UserRepoToPerm.user_id.in_(user_ids))\
+        .all()
+    repo_groups_perms = Session().query(UserRepoGroupToPerm.user_id,
+                                        RepoGroup.group_name,
+                                        Permission.permission_name)\
+        .join((RepoGroup, UserRepoGroupToPerm.group_id == RepoGroup.group_id))\
+        .join((Permission, UserRepoGroupToPerm.permission_id ==
+               Permission.permission_id))\
+        .filter(UserRepoGroupToPerm.user_id.in_(user_ids))\
+        .all()
+    user_group_perms = Session().query(UserUserGroupToPerm.user_id,
+                                       UserGroup.users_group_name,
+                                       Permission.permission_name)\
+        .join((UserGroup, UserUserGroupToPerm.user_group_id ==
+               UserGroup.users_group_id))\
+        .join((Permission, UserUserGroupToPerm.permission_id ==
+               Permission.permission_id))\
+        .filter(UserUserGroupToPerm.user_id.in_(user_ids))\
+        .all()
 
     if user_is_admin:
         #==================================================================
@@ -213,64 +246,59 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
         permissions[GLOBAL].add('hg.create.write_on_repogroup.true')
 
         # repositories
-        for perm in default_repo_perms:
-            r_k = perm.UserRepoToPerm.repository.repo_name
-            p = 'repository.admin'
-            permissions[RK][r_k] = p
+        for perm_user_id, r_k, private, owner_id, p in repo_perms:
+            if perm_user_id == default_user_id:
+                permissions[RK][r_k] = 'repository.admin'
 
         # repository groups
-        for perm in default_repo_groups_perms:
-            rg_k = perm.UserRepoGroupToPerm.group.group_name
-            p = 'group.admin'
-            permissions[GK][rg_k] = p
+        for perm_user_id, rg_k, p in repo_groups_perms:
+            if perm_user_id == default_user_id:
+                permissions[GK][rg_k] = 'group.admin'
 
         # user groups
-        for perm in default_user_group_perms:
-            u_k = perm.UserUserGroupToPerm.user_group.users_group_name
-            p = 'usergroup.admin'
-            permissions[UK][u_k] = p
+        for perm_user_id, u_k, p in user_group_perms:
+            if perm_user_id == default_user_id:
+                permissions[UK][u_k] = 'usergroup.admin'
         return permissions
 
     #==================================================================
     # SET DEFAULTS GLOBAL, REPOS, REPOSITORY GROUPS
     #==================================================================
-    uid = user_id
+    global_perms = Session().query(UserToPerm.user_id,
+                                   Permission.permission_name)\
+        .join((Permission, UserToPerm.permission_id ==
+               Permission.permission_id))\
+        .filter(UserToPerm.user_id.in_(user_ids))\
+        .all()
 
     # default global permissions taken from the default user
-    default_global_perms = UserToPerm.query()\
-        .filter(UserToPerm.user_id == default_user_id)\
-        .options(joinedload(UserToPerm.permission))
-
-    for perm in default_global_perms:
-        permissions[GLOBAL].add(perm.permission.permission_name)
+    for perm_user_id, p in global_perms:
+        if perm_user_id == default_user_id:
+            permissions[GLOBAL].add(p)
 
     # defaults for repositories, taken from default user
-    for perm in default_repo_perms:
-        r_k = perm.UserRepoToPerm.repository.repo_name
-        if perm.Repository.private and not (perm.Repository.user_id == uid):
+    for perm_user_id, r_k, private, owner_id, p in repo_perms:
+        if perm_user_id != default_user_id:
+            continue
+        if private and not (owner_id == uid):
             # disable defaults for private repos,
             p = 'repository.none'
-        elif perm.Repository.user_id == uid:
+        elif owner_id == uid:
             # set admin if owner
             p = 'repository.admin'
-        else:
-            p = perm.Permission.permission_name
-
-        permissions[RK][r_k] = p
+        permissions[RK][r_k] = _perm(p)
 
     # defaults for repository groups taken from default user permission
     # on given group
-    for perm in default_repo_groups_perms:
-        rg_k = perm.UserRepoGroupToPerm.group.group_name
-        p = perm.Permission.permission_name
-        permissions[GK][rg_k] = p
+    for perm_user_id, rg_k, p in repo_groups_perms:
+        if perm_user_id == default_user_id:
+            permissions[GK][rg_k] = _perm(p)
 
     # defaults for user groups taken from default user permission
     # on given user group
-    for perm in default_user_group_perms:
-        u_k = perm.UserUserGroupToPerm.user_group.users_group_name
-        p = perm.Permission.permission_name
-        permissions[UK][u_k] = p
+    for perm_user_id, u_k, p in user_group_perms:
+        if perm_user_id == default_user_id:
+            permissions[UK][u_k] = _perm(p)
 
     #======================================================================
     # !! OVERRIDE GLOBALS !! with user permissions if any found
@@ -284,8 +312,13 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
 
     # USER GROUPS comes first
     # user group global permissions
-    user_perms_from_users_groups = Session().query(UserGroupToPerm)\
-        .options(joinedload(UserGroupToPerm.permission))\
+    user_perms_from_users_groups = Session().query(
+            UserGroup.users_group_id, UserGroup.inherit_default_permissions,
+            Permission.permission_name)\
+        .join((UserGroupToPerm, UserGroupToPerm.users_group_id ==
+               UserGroup.users_group_id))\
+        .join((Permission, UserGroupToPerm.permission_id ==
+               Permission.permission_id))\
         .join((UserGroupMember, UserGroupToPerm.users_group_id ==
                UserGroupMember.users_group_id))\
         .filter(UserGroupMember.user_id == uid)\
@@ -295,32 +328,29 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
     # one group
     _grouped = [[x, list(y)] for x, y in
                 itertools.groupby(user_perms_from_users_groups,
-                                  lambda x:x.users_group)]
-    for gr, perms in _grouped:
+                                  lambda x: x[:2])]
+    for (gr_id, gr_inherit_default_permissions), perms in _grouped:
         # since user can be in multiple groups iterate over them and
         # select the lowest permissions first (more explicit)
         ##TODO: do this^^
-        if not gr.inherit_default_permissions:
+        if not gr_inherit_default_permissions:
             # NEED TO IGNORE all configurable permissions and
             # replace them with explicitly set
             permissions[GLOBAL] = permissions[GLOBAL]\
                                             .difference(_configurable)
         for perm in perms:
-            permissions[GLOBAL].add(perm.permission.permission_name)
+            permissions[GLOBAL].add(perm[2])
 
     # user specific global permissions
-    user_perms = Session().query(UserToPerm)\
-            .options(joinedload(UserToPerm.permission))\
-            .filter(UserToPerm.user_id == uid).all()
-
     if not user_inherit_default_permissions:
         # NEED TO IGNORE all configurable permissions and
         # replace them with explicitly set
         permissions[GLOBAL] = permissions[GLOBAL]\
                                         .difference(_configurable)
 
-        for perm in user_perms:
-            permissions[GLOBAL].add(perm.permission.permission_name)
+        for perm_user_id, p in global_perms:
+            if perm_user_id == uid:
+                permissions[GLOBAL].add(p)
     ## END GLOBAL PERMISSIONS
 
     #======================================================================
@@ -334,8 +364,9 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
 
     # user group for repositories permissions
     user_repo_perms_from_users_groups = \
-     Session().query(UserGroupRepoToPerm, Permission, Repository,)\
-        .join((Repository, UserGroupRepoToPerm.repository_id ==
+     Session().query(Repository.repo_name, Repository.user_id,
+                     Permission.permission_name)\
+        .join((UserGroupRepoToPerm, UserGroupRepoToPerm.repository_id ==
                Repository.repo_id))\
         .join((Permission, UserGroupRepoToPerm.permission_id ==
                Permission.permission_id))\
@@ -345,34 +376,31 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
         .all()
 
     multiple_counter = collections.defaultdict(int)
-    for perm in user_repo_perms_from_users_groups:
-        r_k = perm.UserGroupRepoToPerm.repository.repo_name
+    for r_k, owner_id, p in user_repo_perms_from_users_groups:
         multiple_counter[r_k] += 1
-        p = perm.Permission.permission_name
         cur_perm = permissions[RK][r_k]
 
-        if perm.Repository.user_id == uid:
+        if owner_id == uid:
             # set admin if owner
             p = 'repository.admin'
         else:
             if multiple_counter[r_k] > 1:
                 p = _choose_perm(p, cur_perm)
-        permissions[RK][r_k] = p
+        permissions[RK][r_k] = _perm(p)
 
     # user explicit permissions for repositories, overrides any specified
     # by the group permission
-    user_repo_perms = Permission.get_default_perms(uid)
-    for perm in user_repo_perms:
-        r_k = perm.UserRepoToPerm.repository.repo_name
+    for perm_user_id, r_k, private, owner_id, p in repo_perms:
+        if perm_user_id != uid:
+            continue
         cur_perm = permissions[RK][r_k]
         # set admin if owner
-        if perm.Repository.user_id == uid:
+        if owner_id == uid:
             p = 'repository.admin'
         else:
-            p = perm.Permission.permission_name
             if not explicit:
                 p = _choose_perm(p, cur_perm)
-        permissions[RK][r_k] = p
+        permissions[RK][r_k] = _perm(p)
 
     #======================================================================
     # !! PERMISSIONS FOR REPOSITORY GROUPS !!
@@ -384,8 +412,9 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
     #======================================================================
     # user group for repo groups permissions
     user_repo_group_perms_from_users_groups = \
-     Session().query(UserGroupRepoGroupToPerm, Permission, RepoGroup)\
-     .join((RepoGroup, UserGroupRepoGroupToPerm.group_id == RepoGroup.group_id))\
+     Session().query(RepoGroup.group_name, Permission.permission_name)\
+     .join((UserGroupRepoGroupToPerm, UserGroupRepoGroupToPerm.group_id
+            == RepoGroup.group_id))\
      .join((Permission, UserGroupRepoGroupToPerm.permission_id
             == Permission.permission_id))\
      .join((UserGroupMember, UserGroupRepoGroupToPerm.users_group_id
@@ -394,32 +423,29 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
      .all()
 
     multiple_counter = collections.defaultdict(int)
-    for perm in user_repo_group_perms_from_users_groups:
-        g_k = perm.UserGroupRepoGroupToPerm.group.group_name
+    for g_k, p in user_repo_group_perms_from_users_groups:
         multiple_counter[g_k] += 1
-        p = perm.Permission.permission_name
         cur_perm = permissions[GK][g_k]
         if multiple_counter[g_k] > 1:
             p = _choose_perm(p, cur_perm)
-        permissions[GK][g_k] = p
+        permissions[GK][g_k] = _perm(p)
 
     # user explicit permissions for repository groups
-    user_repo_groups_perms = Permission.get_default_group_perms(uid)
-    for perm in user_repo_groups_perms:
-        rg_k = perm.UserRepoGroupToPerm.group.group_name
-        p = perm.Permission.permission_name
+    for perm_user_id, rg_k, p in repo_groups_perms:
+        if perm_user_id != uid:
+            continue
         cur_perm = permissions[GK][rg_k]
         if not explicit:
             p = _choose_perm(p, cur_perm)
-        permissions[GK][rg_k] = p
+        permissions[GK][rg_k] = _perm(p)
 
     #======================================================================
     # !! PERMISSIONS FOR USER GROUPS !!
     #======================================================================
     # user group for user group permissions
     user_group_user_groups_perms = \
-     Session().query(UserGroupUserGroupToPerm, Permission, UserGroup)\
-     .join((UserGroup, UserGroupUserGroupToPerm.target_user_group_id
+     Session().query(UserGroup.users_group_name, Permission.permission_name)\
+     .join((UserGroupUserGroupToPerm, UserGroupUserGroupToPerm.target_user_group_id
             == UserGroup.users_group_id))\
      .join((Permission, UserGroupUserGroupToPerm.permission_id
             == Permission.permission_id))\
@@ -429,28 +455,56 @@ def _cached_perms_data(user_id, user_is_admin, user_inherit_default_permissions,
      .all()
 
     multiple_counter = collections.defaultdict(int)
-    for perm in user_group_user_groups_perms:
-        g_k = perm.UserGroupUserGroupToPerm.target_user_group.users_group_name
+    for g_k, p in user_group_user_groups_perms:
         multiple_counter[g_k] += 1
-        p = perm.Permission.permission_name
         cur_perm = permissions[UK][g_k]
         if multiple_counter[g_k] > 1:
             p = _choose_perm(p, cur_perm)
-        permissions[UK][g_k] = p
+        permissions[UK][g_k] = _perm(p)
 
     #user explicit permission for user groups
-    user_user_groups_perms = Permission.get_default_user_group_perms(uid)
-    for perm in user_user_groups_perms:
-        u_k = perm.UserUserGroupToPerm.user_group.users_group_name
-        p = perm.Permission.permission_name
+    for perm_user_id, u_k, p in user_group_perms:
+        if perm_user_id != uid:
+            continue
         cur_perm = permissions[UK][u_k]
         if not explicit:
             p = _choose_perm(p, cur_perm)
-        permissions[UK][u_k] = p
+        permissions[UK][u_k] = _perm(p)
 
     return permissions
 
 
+def _get_perms_snapshot(user_id, user_is_admin,
+                        user_inherit_default_permissions, explicit, algo):
+    """
+    Returns permission tree of given user, computed once for every version of
+    permissions and kept in ``long_term`` cache region. Version is bumped by
+    every model change affecting permissions (see
+    ``BaseModel._invalidate_permissions``) and read once per database
+    session.
+    """
+    if CacheInvalidation.has_bumped_generations():
+        # this session might see changes not committed yet, they must not
+        # end up in the cache
+        return _cached_perms_data(user_id, user_is_admin,
+                                  user_inherit_default_permissions,
+                                  explicit, algo)
+
+    @cache_region('long_term', 'permissions_snapshot')
+    def _compute(user_id, user_is_admin, user_inherit_default_permissions,
+                 explicit, algo, version):
+        log.debug('Computing permission snapshot of user %s for version %s'
+                  % (user_id, version))
+        return _cached_perms_data(user_id, user_is_admin,
+                                  user_inherit_default_permissions,
+                                  explicit, algo)
+
+    version = CacheInvalidation.get_generation(
+        CacheInvalidation.PERMISSIONS_KEY)
+    return _compute(user_id, user_is_admin, user_inherit_default_permissions,
+                    explicit, algo, version)
+
+
 def allowed_api_access(controller_name, whitelist=None, api_key=None):
     """
     Check if given controller_name is in whitelist API access
@@ -502,7 +556,7 @@ class AuthUser(object):
 
     @LazyProperty
     def permissions(self):
-        return self.get_perms(user=self, cache=False)
+        return self.get_perms(user=self)
 
     @property
     def api_keys(self):
@@ -546,7 +600,7 @@ class AuthUser(object):
 
         log.debug('Auth User is now %s' % self)
 
-    def get_perms(self, user, explicit=True, algo='higherwin', cache=False):
+    def get_perms(self, user, explicit=True, algo='higherwin', cache=True):
         """
         Fills user permission attribute with permissions taken from database
         works for permissions given for repositories, and for permissions that
@@ -561,14 +615,15 @@ class AuthUser(object):
             it's multiple defined, eg user in two different groups. It also
             decides if explicit flag is turned off how to specify the permission
             for case when user is in a group + have defined separate permission
+        :param cache: use snapshot of the permissions valid until they are
+            changed
         """
         user_id = user.user_id
         user_is_admin = user.is_admin
         user_inherit_default_permissions = user.inherit_default_permissions
 
         log.debug('Getting PERMISSION tree')
-        compute = conditional_cache('short_term', 'cache_desc',
-                                    condition=cache, func=_cached_perms_data)
+        compute = _get_perms_snapshot if cache else _cached_perms_data
         return compute(user_id, user_is_admin,
                        user_inherit_default_permissions, explicit, algo)
 
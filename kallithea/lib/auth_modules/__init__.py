@@ -15,12 +15,19 @@
 Authentication modules
 """
 
+import os
+import hmac
+import time
+import hashlib
 import logging
+import threading
 import traceback
 
+from beaker.cache import cache_region, region_invalidate
+
 from kallithea import EXTERN_TYPE_INTERNAL
-from kallithea.lib.compat import importlib
-from kallithea.lib.utils2 import str2bool
+from kallithea.lib.compat import importlib, OrderedDict
+from kallithea.lib.utils2 import str2bool, safe_int, safe_str
 from kallithea.lib.compat import formatted_json, hybrid_property
 from kallithea.lib.auth import PasswordGenerator
 from kallithea.model.user import UserModel
@@ -351,6 +358,57 @@ def loadplugin(plugin):
     return plugin
 
 
+_plugins = {}
+
+
+def get_plugin(module):
+    """
+    Returns instance of authentication plugin in ``module``, loaded once per
+    process.
+    """
+    plugin = _plugins.get(module)
+    if plugin is None:
+        try:
+            plugin = _plugins[module] = loadplugin(module)
+        except (ImportError, AttributeError, TypeError), e:
+            raise ImportError('Failed to load authentication module %s : %s'
+                              % (module, str(e)))
+    return plugin
+
+
+@cache_region('super_short_term')
+def _get_auth_plugins_settings():
+    ret = []
+    auth_settings = Setting.get_auth_settings()
+    for module in auth_settings.get('auth_plugins') or []:
+        plugin = get_plugin(module)
+        plugin_settings = {}
+        for v in plugin.plugin_settings():
+            conf_key = "auth_%s_%s" % (plugin.name, v["name"])
+            plugin_settings[v["name"]] = auth_settings.get(conf_key)
+        ret.append((module, plugin_settings))
+    return ret
+
+
+def get_auth_plugins():
+    """
+    Returns list of tuples of module name, plugin instance and plugin
+    settings of all configured authentication plugins. Settings are loaded
+    by a single query and cached for a few seconds; changes made by other
+    processes are seen once they expire.
+    """
+    return [(module, get_plugin(module), plugin_settings)
+            for module, plugin_settings in _get_auth_plugins_settings()]
+
+
+def invalidate_auth_plugins_cache():
+    """
+    Makes the next authentication load settings of plugins from database
+    again.
+    """
+    region_invalidate(_get_auth_plugins_settings, None)
+
+
 def authenticate(username, password, environ=None):
     """
     Authentication function used for access control,
@@ -362,22 +420,11 @@ def authenticate(username, password, environ=None):
     :returns: None if auth failed, plugin_user dict if auth is correct
     """
 
-    auth_plugins = Setting.get_auth_plugins()
-    log.debug('Authentication against %s plugins' % (auth_plugins,))
-    for module in auth_plugins:
-        try:
-            plugin = loadplugin(module)
-        except (ImportError, AttributeError, TypeError), e:
-            raise ImportError('Failed to load authentication module %s : %s'
-                              % (module, str(e)))
+    auth_plugins = get_auth_plugins()
+    log.debug('Authentication against %s plugins'
+              % ([module for module, _p, _s in auth_plugins],))
+    for module, plugin, plugin_settings in auth_plugins:
         log.debug('Trying authentication using ** %s **' % (module,))
-        # load plugin settings from Kallithea database
-        plugin_name = plugin.name
-        plugin_settings = {}
-        for v in plugin.plugin_settings():
-            conf_key = "auth_%s_%s" % (plugin_name, v["name"])
-            setting = Setting.get_by_name(conf_key)
-            plugin_settings[v["name"]] = setting.app_settings_value if setting else None
         log.debug('Plugin settings \n%s' % formatted_json(plugin_settings))
 
         if not str2bool(plugin_settings["enabled"]):
@@ -417,3 +464,108 @@ def authenticate(username, password, environ=None):
             log.warning("User `%s` failed to authenticate against %s"
                         % (username, plugin.__module__))
     return None
+
+
+class CredentialsCache(object):
+    """
+    Credentials recently verified by ``authenticate``, so clients sending
+    them with every request don't need password hashing or a bind to LDAP
+    every time. Entries are keyed by HMAC of username and password with a
+    secret generated by each process, so credentials are never kept in
+    memory, and expire after ``ttl`` seconds. An entry is used only while
+    its user is active and has the same password hash as when the entry was
+    created, so changed passwords and deactivated users are noticed at once,
+    also when changed by other processes.
+    """
+
+    def __init__(self, ttl, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_key(self, username, password):
+        return hmac.new(self._secret, '%s\0%s' % (safe_str(username),
+                                                  safe_str(password)),
+                        hashlib.sha256).digest()
+
+    def _get_state(self, username):
+        user = User.get_by_username(username)
+        if user is None:
+            return None
+        return user.active, user.password
+
+    def get(self, username, password):
+        """
+        Returns data of authenticated user if ``username`` and ``password``
+        were verified recently, otherwise None.
+        """
+        key = self._get_key(username, password)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self._entries[key]
+                entry = None
+        if entry is None:
+            return None
+        _expires, state, plugin_user = entry
+        if self._get_state(plugin_user['username']) != state:
+            with self._lock:
+                self._entries.pop(key, None)
+            return None
+        return plugin_user
+
+    def set(self, username, password, plugin_user):
+        state = self._get_state(plugin_user['username'])
+        if state is None or not state[0]:
+            return
+        with self._lock:
+            self._entries[self._get_key(username, password)] = (
+                time.time() + self.ttl, state, plugin_user)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_credentials_cache = None
+_credentials_cache_lock = threading.Lock()
+
+
+def get_credentials_cache():
+    """
+    Returns process wide ``CredentialsCache`` keeping entries for
+    ``auth_cache_ttl`` seconds, or None if the setting isn't set.
+    """
+    global _credentials_cache
+    import kallithea
+    ttl = safe_int(kallithea.CONFIG.get('auth_cache_ttl'), 0)
+    if ttl <= 0:
+        return None
+    if _credentials_cache is None or _credentials_cache.ttl != ttl:
+        with _credentials_cache_lock:
+            if _credentials_cache is None or _credentials_cache.ttl != ttl:
+                _credentials_cache = CredentialsCache(ttl)
+    return _credentials_cache
+
+
+def authenticate_cached(username, password, environ=None):
+    """
+    Like ``authenticate``, for credentials sent with every request by VCS
+    clients; credentials verified in the last ``auth_cache_ttl`` seconds are
+    accepted without asking authentication plugins again.
+    """
+    cache = get_credentials_cache()
+    if cache is None or not username or not password:
+        return authenticate(username, password, environ)
+    plugin_user = cache.get(username, password)
+    if plugin_user is None:
+        plugin_user = authenticate(username, password, environ)
+        if plugin_user:
+            cache.set(username, password, plugin_user)
+    else:
+        log.debug('User %s authenticated by cached credentials' % username)
+    return plugin_user
@@ -144,7 +144,7 @@ class BaseVCSController(object):
         # base path of repo locations
         self.basepath = self.config['base_path']
         #authenticate this VCS request using authfunc
-        self.authenticate = BasicAuth('', auth_modules.authenticate,
+        self.authenticate = BasicAuth('', auth_modules.authenticate_cached,
                                       config.get('auth_ret_code'))
         self.ip_addr = '0.0.0.0'
 
@@ -278,7 +278,9 @@ class BaseVCSController(object):
         finally:
             log = logging.getLogger('kallithea.' + self.__class__.__name__)
             log.debug('Request time: %.3fs' % (time.time() - start))
-            meta.Session.remove()
+            # streamed responses remove the session once they are written
+            if 'kallithea.streamed_session' not in environ:
+                meta.Session.remove()
 
 
 class BaseController(WSGIController):
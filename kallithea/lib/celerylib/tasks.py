@@ -29,23 +29,24 @@ Original author and date, and relevant copyright and licensing information is be
 from celery.decorators import task
 
 import os
+import time
 import traceback
 import logging
 from os.path import join as jn
 
 from time import mktime
-from operator import itemgetter
 from string import lower
 
 from pylons import config
 
 from kallithea import CELERY_ON
-from kallithea.lib.celerylib import run_task, locked_task, dbsession, \
+from kallithea.lib.celerylib import locked_task, dbsession, \
     str2bool, __get_lockkey, LockHeld, DaemonLock, get_session
 from kallithea.lib.helpers import person
 from kallithea.lib.rcmail.smtp_mailer import SmtpMailer
 from kallithea.lib.utils import add_cache, action_logger
-from kallithea.lib.compat import json, OrderedDict
+from kallithea.lib.utils2 import safe_int
+from kallithea.lib.compat import json
 from kallithea.lib.hooks import log_create_repository
 
 from kallithea.model.db import Statistics, Repository, User
@@ -53,7 +54,8 @@ from kallithea.model.db import Statistics, Repository, User
 
 add_cache(config)  # pragma: no cover
 
-__all__ = ['whoosh_index', 'get_commits_stats', 'send_email']
+__all__ = ['whoosh_index', 'get_commits_stats', 'send_email',
+           'warm_diff_cache']
 
 
 def get_logger(cls):
@@ -68,19 +70,104 @@ def get_logger(cls):
 @task(ignore_result=True)
 @locked_task
 @dbsession
-def whoosh_index(repo_location, full_index):
+def whoosh_index(repo_location, full_index, workers=None):
     from kallithea.lib.indexers.daemon import WhooshIndexingDaemon
     DBS = get_session()
 
     index_location = config['index_dir']
+    if workers is None:
+        workers = safe_int(config.get('index_workers'), 1)
     WhooshIndexingDaemon(index_location=index_location,
-                         repo_location=repo_location, sa=DBS)\
+                         repo_location=repo_location, sa=DBS,
+                         workers=workers)\
                          .run(full_index=full_index)
 
 
+class CommitActivity(object):
+    """
+    Accumulator of commit statistics per author and day.
+
+    Counters are kept in dicts keyed by author and day timestamp, so adding
+    a changeset doesn't depend on amount of already collected data. JSON
+    structures stored in ``Statistics`` (and rendered as is by statistics
+    page) are only parsed on load and built on dump.
+    """
+    COLUMNS = ('commits', 'added', 'changed', 'removed')
+
+    def __init__(self, commit_activity=None, commit_activity_combined=None):
+        # author -> day -> [commits, added, changed, removed]
+        self.authors = {}
+        # day -> commits
+        self.days = {}
+        if commit_activity:
+            for author, author_data in json.loads(commit_activity).items():
+                days = self.authors[author] = {}
+                for row in author_data['data']:
+                    # placeholder data of repositories without commits
+                    if isinstance(row, dict):
+                        days[row['time']] = [row[c] for c in self.COLUMNS]
+                if not days:
+                    del self.authors[author]
+        if commit_activity_combined:
+            self.days = dict(json.loads(commit_activity_combined))
+
+    def add(self, author, day, added, changed, removed):
+        counters = self.authors.setdefault(author, {}).get(day)
+        if counters is None:
+            self.authors[author][day] = [1, added, changed, removed]
+        else:
+            counters[0] += 1
+            counters[1] += added
+            counters[2] += changed
+            counters[3] += removed
+        self.days[day] = self.days.get(day, 0) + 1
+
+    def dump_activity(self, default_author):
+        """
+        Returns JSON of per author statistics, as used by statistics page.
+        """
+        result = {}
+        for author, days in self.authors.iteritems():
+            result[author] = {
+                "label": author,
+                "data": [dict(zip(self.COLUMNS, days[day]), time=day)
+                         for day in sorted(days)],
+                "schema": ["commits"],
+            }
+        if not result:
+            result[default_author] = {
+                "label": default_author,
+                "data": [0, 1],
+                "schema": ["commits"],
+            }
+        return json.dumps(result)
+
+    def dump_activity_combined(self):
+        """
+        Returns JSON of commit counts per day, sorted by day.
+        """
+        return json.dumps(sorted(self.days.items()))
+
+
+#: seconds between saves of partial results by get_commits_stats
+STATS_CHECKPOINT_INTERVAL = 60
+
+
 @task(ignore_result=True)
 @dbsession
 def get_commits_stats(repo_name, ts_min_y, ts_max_y, recurse_limit=100):
+    """
+    Collects commit statistics of repository, continuing after the last
+    revision parsed before.
+
+    With celery all remaining revisions are parsed in one pass and partial
+    results are saved every ``STATS_CHECKPOINT_INTERVAL`` seconds. Without
+    celery the task runs in the web request, so only ``commit_parse_limit``
+    revisions are parsed per call.
+
+    ``recurse_limit`` is not used anymore, it is kept for compatibility
+    with already queued tasks.
+    """
     log = get_logger(get_commits_stats)
     DBS = get_session()
     lockkey = __get_lockkey('get_commits_stats', repo_name, ts_min_y,
@@ -90,13 +177,15 @@ def get_commits_stats(repo_name, ts_min_y, ts_max_y, recurse_limit=100):
     log.info('running task with lockkey %s' % lockkey)
 
     try:
-        lock = l = DaemonLock(file_=jn(lockkey_path, lockkey))
+        lock = DaemonLock(file_=jn(lockkey_path, lockkey))
+    except LockHeld:
+        log.info('LockHeld')
+        return 'Task with key %s already running' % lockkey
 
+    try:
         # for js data compatibility cleans the key for person from '
         akc = lambda k: person(k).replace('"', "")
 
-        co_day_auth_aggr = {}
-        commits_by_day_aggregate = {}
         repo = Repository.get_by_repo_name(repo_name)
         if repo is None:
             return True
@@ -105,20 +194,16 @@ def get_commits_stats(repo_name, ts_min_y, ts_max_y, recurse_limit=100):
         repo_size = repo.count()
         # return if repo have no revisions
         if repo_size < 1:
-            lock.release()
             return True
 
-        skip_date_limit = True
         parse_limit = int(config['app_conf'].get('commit_parse_limit'))
-        last_rev = None
-        last_cs = None
-        timegetter = itemgetter('time')
 
         dbrepo = DBS.query(Repository)\
             .filter(Repository.repo_name == repo_name).scalar()
         cur_stats = DBS.query(Statistics)\
             .filter(Statistics.repository == dbrepo).scalar()
 
+        last_rev = None
         if cur_stats is not None:
             last_rev = cur_stats.stat_on_revision
 
@@ -126,124 +211,59 @@ def get_commits_stats(repo_name, ts_min_y, ts_max_y, recurse_limit=100):
             # pass silently without any work if we're not on first revision or
             # current state of parsing revision(from db marker) is the
             # last revision
-            lock.release()
             return True
 
         if cur_stats:
-            commits_by_day_aggregate = OrderedDict(json.loads(
-                                        cur_stats.commit_activity_combined))
-            co_day_auth_aggr = json.loads(cur_stats.commit_activity)
-
-        log.debug('starting parsing %s' % parse_limit)
-        lmktime = mktime
+            activity = CommitActivity(cur_stats.commit_activity,
+                                      cur_stats.commit_activity_combined)
+            stats = cur_stats
+        else:
+            activity = CommitActivity()
+            stats = Statistics()
+
+        start = last_rev + 1 if last_rev >= 0 else 0
+        end = repo_size if CELERY_ON else min(start + parse_limit, repo_size)
+        log.debug('Getting revisions from %s to %s' % (start, end))
+
+        def save(last_cs):
+            stats.commit_activity = activity.dump_activity(akc(repo.contact))
+            stats.commit_activity_combined = \
+                activity.dump_activity_combined()
+            try:
+                stats.repository = dbrepo
+                stats.stat_on_revision = last_cs.revision if last_cs else 0
+                DBS.add(stats)
+                DBS.commit()
+            except:
+                log.error(traceback.format_exc())
+                DBS.rollback()
+                return False
+            return True
 
-        last_rev = last_rev + 1 if last_rev >= 0 else 0
-        log.debug('Getting revisions from %s to %s' % (
-             last_rev, last_rev + parse_limit)
-        )
-        for cs in repo[last_rev:last_rev + parse_limit]:
+        last_cs = None
+        last_save = time.time()
+        for cs in repo[start:end]:
             log.debug('parsing %s' % cs)
             last_cs = cs  # remember last parsed changeset
-            k = lmktime([cs.date.timetuple()[0], cs.date.timetuple()[1],
-                          cs.date.timetuple()[2], 0, 0, 0, 0, 0, 0])
-
-            if akc(cs.author) in co_day_auth_aggr:
-                try:
-                    l = [timegetter(x) for x in
-                         co_day_auth_aggr[akc(cs.author)]['data']]
-                    time_pos = l.index(k)
-                except ValueError:
-                    time_pos = None
-
-                if time_pos >= 0 and time_pos is not None:
-
-                    datadict = \
-                        co_day_auth_aggr[akc(cs.author)]['data'][time_pos]
-
-                    datadict["commits"] += 1
-                    datadict["added"] += len(cs.added)
-                    datadict["changed"] += len(cs.changed)
-                    datadict["removed"] += len(cs.removed)
-
-                else:
-                    if k >= ts_min_y and k <= ts_max_y or skip_date_limit:
-
-                        datadict = {"time": k,
-                                    "commits": 1,
-                                    "added": len(cs.added),
-                                    "changed": len(cs.changed),
-                                    "removed": len(cs.removed),
-                                   }
-                        co_day_auth_aggr[akc(cs.author)]['data']\
-                            .append(datadict)
-
-            else:
-                if k >= ts_min_y and k <= ts_max_y or skip_date_limit:
-                    co_day_auth_aggr[akc(cs.author)] = {
-                                        "label": akc(cs.author),
-                                        "data": [{"time":k,
-                                                 "commits":1,
-                                                 "added":len(cs.added),
-                                                 "changed":len(cs.changed),
-                                                 "removed":len(cs.removed),
-                                                 }],
-                                        "schema": ["commits"],
-                                        }
-
-            #gather all data by day
-            if k in commits_by_day_aggregate:
-                commits_by_day_aggregate[k] += 1
-            else:
-                commits_by_day_aggregate[k] = 1
-
-        overview_data = sorted(commits_by_day_aggregate.items(),
-                               key=itemgetter(0))
-
-        if not co_day_auth_aggr:
-            co_day_auth_aggr[akc(repo.contact)] = {
-                "label": akc(repo.contact),
-                "data": [0, 1],
-                "schema": ["commits"],
-            }
-
-        stats = cur_stats if cur_stats else Statistics()
-        stats.commit_activity = json.dumps(co_day_auth_aggr)
-        stats.commit_activity_combined = json.dumps(overview_data)
-
-        log.debug('last revision %s' % last_rev)
-        leftovers = len(repo.revisions[last_rev:])
-        log.debug('revisions to parse %s' % leftovers)
-
-        if last_rev == 0 or leftovers < parse_limit:
+            day = mktime(cs.date.timetuple()[:3] + (0, 0, 0, 0, 0, 0))
+            activity.add(akc(cs.author), day, len(cs.added),
+                         len(cs.changed), len(cs.removed))
+
+            if CELERY_ON and time.time() - last_save > \
+                    STATS_CHECKPOINT_INTERVAL:
+                log.debug('saving statistics up to %s' % cs)
+                if not save(cs):
+                    return False
+                last_save = time.time()
+
+        if start == 0 or end == repo_size:
             log.debug('getting code trending stats')
             stats.languages = json.dumps(__get_codes_stats(repo_name))
 
-        try:
-            stats.repository = dbrepo
-            stats.stat_on_revision = last_cs.revision if last_cs else 0
-            DBS.add(stats)
-            DBS.commit()
-        except:
-            log.error(traceback.format_exc())
-            DBS.rollback()
-            lock.release()
-            return False
-
-        # final release
+        return save(last_cs)
+    finally:
         lock.release()
 
-        # execute another task if celery is enabled
-        if len(repo.revisions) > 1 and CELERY_ON and recurse_limit > 0:
-            recurse_limit -= 1
-            run_task(get_commits_stats, repo_name, ts_min_y, ts_max_y,
-                     recurse_limit)
-        if recurse_limit <= 0:
-            log.debug('Breaking recursive mode due to reach of recurse limit')
-        return True
-    except LockHeld:
-        log.info('LockHeld')
-        return 'Task with key %s already running' % lockkey
-
 
 @task(ignore_result=True)
 @dbsession
@@ -300,6 +320,29 @@ def send_email(recipients, subject, body='', html_body='', headers=None):
         return False
     return True
 
+@task(ignore_result=True)
+@dbsession
+def warm_diff_cache(repo_name, rev1, rev2, diff_limit=None):
+    """
+    Parses diff between ``rev1`` and ``rev2`` of ``repo_name`` into the diff
+    cache, so the first view of a new pull request doesn't wait for it.
+    """
+    from kallithea.lib import diffs
+    log = get_logger(warm_diff_cache)
+    repo = Repository.get_by_repo_name(repo_name)
+    if repo is None:
+        log.error('Repository %s not found' % repo_name)
+        return False
+    try:
+        if diffs.warm_diff_cache(repo.scm_instance, rev1, rev2, diff_limit):
+            log.info('Cached diff of %s..%s in %s' % (rev1, rev2, repo_name))
+    except Exception:
+        log.error('Cannot cache diff of %s..%s in %s' % (rev1, rev2,
+                                                         repo_name))
+        log.error(traceback.format_exc())
+        return False
+    return True
+
 @task(ignore_result=False)
 @dbsession
 def create_repo(form_data, cur_user):
@@ -0,0 +1,35 @@
+import logging
+
+from sqlalchemy import *
+
+from kallithea.lib.dbmigrate.migrate import *
+from kallithea.lib.dbmigrate.migrate.changeset import *
+
+from kallithea.model import meta
+from kallithea.lib.dbmigrate.versions import _reset_base, notify
+
+log = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    """
+    Upgrade operations go here.
+    Don't create your own engine; bind migrate_engine to your metadata
+    """
+    _reset_base(migrate_engine)
+
+    # indexes journals are paged by, newest entries first; the table is
+    # reflected as models of the current version already have them
+    tbl = Table('user_logs', MetaData(bind=migrate_engine), autoload=True)
+    notify('Creating indexes of user_logs, it can take a while')
+    Index('ul_action_date_idx', tbl.c.action_date,
+          tbl.c.user_log_id).create(bind=migrate_engine)
+    Index('ul_repository_id_idx', tbl.c.repository_id, tbl.c.action_date,
+          tbl.c.user_log_id).create(bind=migrate_engine)
+    Index('ul_user_id_idx', tbl.c.user_id, tbl.c.action_date,
+          tbl.c.user_log_id).create(bind=migrate_engine)
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
@@ -0,0 +1,43 @@
+import logging
+
+from sqlalchemy import *
+
+from kallithea.lib.dbmigrate.migrate import *
+from kallithea.lib.dbmigrate.migrate.changeset import *
+
+from kallithea.model import meta
+from kallithea.lib.dbmigrate.versions import _reset_base, notify
+
+log = logging.getLogger(__name__)
+
+
+def upgrade(migrate_engine):
+    """
+    Upgrade operations go here.
+    Don't create your own engine; bind migrate_engine to your metadata
+    """
+    _reset_base(migrate_engine)
+
+    # revisions of pushes are stored apart from the action; the tables are
+    # reflected as models of the current version already have them
+    metadata = MetaData(bind=migrate_engine)
+    tbl = Table('user_logs', metadata, autoload=True)
+    revisions_count = Column("revisions_count", Integer(), nullable=True,
+                             unique=None, default=None)
+    revisions_count.create(table=tbl)
+
+    Table('user_log_revisions', metadata,
+        Column("user_log_id", Integer(),
+               ForeignKey('user_logs.user_log_id', ondelete='CASCADE'),
+               nullable=False, primary_key=True),
+        Column("ordinal", Integer(), nullable=False, primary_key=True,
+               autoincrement=False),
+        Column("revision", String(255, convert_unicode=False),
+               nullable=False),
+        mysql_engine='InnoDB', mysql_charset='utf8',
+    ).create()
+
+
+def downgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.diff_cache
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Bounded cache of parsed diffs shared by all processes, keyed by compared
+revisions and diff options
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import re
+import hashlib
+import logging
+import threading
+import cPickle as pickle
+
+from kallithea.lib.archive_cache import ArchiveCache
+from kallithea.lib.utils2 import safe_int, safe_str
+
+log = logging.getLogger(__name__)
+
+#: default limit of size of all cached diffs, in megabytes
+DEFAULT_CACHE_SIZE = 256
+#: version of the format of cached diffs, changed whenever structure of
+#: parsed diffs changes so entries of older versions are never used
+FORMAT_VERSION = 2
+
+_raw_id_re = re.compile(r'^[0-9a-fA-F]{40}$')
+
+
+def get_diff_key(alias, rev1, rev2, path=None, ignore_whitespace=False,
+                 context=3, diff_limit=None, vcs='hg'):
+    """
+    Returns name of cached diff between ``rev1`` and ``rev2`` of repository
+    of type ``alias`` parsed with given options, or None if the revisions
+    aren't full changeset hashes. Diff of two hashes never changes, so
+    entries are never invalidated and are shared by forks.
+    """
+    if not (_raw_id_re.match(rev1 or '') and _raw_id_re.match(rev2 or '')):
+        return None
+    key = '%s\0%s\0%s\0%s\0%s\0%s\0%s\0%s\0%s' % (
+        FORMAT_VERSION, alias, rev1.lower(), rev2.lower(),
+        safe_str(path or ''), bool(ignore_whitespace),
+        safe_int(context, 3), diff_limit, vcs)
+    return '%s.diff' % hashlib.sha1(safe_str(key)).hexdigest()
+
+
+class DiffCache(object):
+    """
+    Parsed diffs pickled in ``cache_dir``, stored by ``ArchiveCache`` which
+    makes sure every diff is parsed only once even if requested by several
+    processes at once, and evicts them by ``policy`` when size of the cache
+    exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, cache_dir, max_size=0, policy='lru'):
+        self.cache_dir = cache_dir
+        self._cache = ArchiveCache(cache_dir, max_size=max_size,
+                                   policy=policy)
+
+    def _dump(self, create):
+        # parsed in the background writer of the cache, not in the caller
+        yield pickle.dumps(create(), pickle.HIGHEST_PROTOCOL)
+
+    def get(self, key, create):
+        """
+        Returns parsed diff ``key``, cached or created by ``create``
+        callable.
+        """
+        data = ''.join(self._cache.get(key, lambda: self._dump(create)))
+        try:
+            return pickle.loads(data)
+        except Exception, e:
+            log.error('Cannot load cached diff %s: %s' % (key, e))
+            return create()
+
+    def warm(self, key, create):
+        """
+        Makes sure diff ``key`` is cached, creating it by ``create`` if
+        needed; returns True if the diff had to be created.
+        """
+        return self._cache.warm(key, lambda: self._dump(create))
+
+    def prune(self, max_size=None):
+        return self._cache.prune(max_size=max_size)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats['diffs'] = stats.pop('archives')
+        return stats
+
+
+def make_diff_cache(config):
+    """
+    Returns ``DiffCache`` configured by ``diff_cache_dir``,
+    ``diff_cache_size`` (in megabytes) and ``diff_cache_policy`` settings in
+    ``config`` or None if ``diff_cache_dir`` is not set.
+    """
+    cache_dir = config.get('diff_cache_dir')
+    if not cache_dir:
+        return None
+    size = safe_int(config.get('diff_cache_size'), DEFAULT_CACHE_SIZE)
+    return DiffCache(cache_dir, max_size=size * 1024 * 1024,
+                     policy=config.get('diff_cache_policy') or 'lru')
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_diff_cache():
+    """
+    Returns process wide ``DiffCache`` configured by application settings
+    or None if diff cache is disabled.
+    """
+    global _cache
+    import kallithea
+    cache_dir = kallithea.CONFIG.get('diff_cache_dir')
+    if not cache_dir:
+        return None
+    if _cache is None or _cache.cache_dir != cache_dir:
+        with _cache_lock:
+            if _cache is None or _cache.cache_dir != cache_dir:
+                _cache = make_diff_cache(kallithea.CONFIG)
+    return _cache
@@ -29,7 +29,7 @@ import re
 import difflib
 import logging
 
-from itertools import tee, imap
+from itertools import imap
 
 from pylons.i18n.translation import _
 
@@ -37,7 +37,8 @@ from kallithea.lib.vcs.exceptions import VCSError
 from kallithea.lib.vcs.nodes import FileNode, SubModuleNode
 from kallithea.lib.vcs.backends.base import EmptyChangeset
 from kallithea.lib.helpers import escape
-from kallithea.lib.utils2 import safe_unicode
+from kallithea.lib.diff_cache import get_diff_cache, get_diff_key
+from kallithea.lib.utils2 import safe_int, safe_unicode
 
 log = logging.getLogger(__name__)
 
@@ -61,6 +62,8 @@ def wrapped_diff(filenode_old, filenode_new, cut_off_limit=None,
 
     if filenode_old is None:
         filenode_old = FileNode(filenode_new.path, '', EmptyChangeset())
+    # the same context is used by the diff and by its cache key
+    line_context = safe_int(line_context, 3)
 
     if filenode_old.is_binary or filenode_new.is_binary:
         diff = wrap_to_table(_('Binary file'))
@@ -70,10 +73,15 @@ def wrapped_diff(filenode_old, filenode_new, cut_off_limit=None,
     elif cut_off_limit != -1 and (cut_off_limit is None or
     (filenode_old.size < cut_off_limit and filenode_new.size < cut_off_limit)):
 
-        f_gitdiff = get_gitdiff(filenode_old, filenode_new,
-                                ignore_whitespace=ignore_whitespace,
-                                context=line_context)
-        diff_processor = DiffProcessor(f_gitdiff, format='gitdiff')
+        repo = filenode_new.changeset.repository
+        diff_processor = get_diff_processor(repo,
+            getattr(filenode_old.changeset, 'raw_id', repo.EMPTY_CHANGESET),
+            getattr(filenode_new.changeset, 'raw_id', repo.EMPTY_CHANGESET),
+            path=filenode_new.path, ignore_whitespace=ignore_whitespace,
+            context=line_context,
+            get_diff=lambda: get_gitdiff(filenode_old, filenode_new,
+                                         ignore_whitespace=ignore_whitespace,
+                                         context=line_context))
 
         diff = diff_processor.as_html(enable_comments=enable_comments)
         stats = diff_processor.stat()
@@ -104,7 +112,7 @@ def get_gitdiff(filenode_old, filenode_new, ignore_whitespace=True, context=3):
     :param ignore_whitespace: ignore whitespaces in diff
     """
     # make sure we pass in default context
-    context = context or 3
+    context = safe_int(context, 3)
     submodules = filter(lambda o: isinstance(o, SubModuleNode),
                         [filenode_new, filenode_old])
     if submodules:
@@ -123,6 +131,90 @@ def get_gitdiff(filenode_old, filenode_new, ignore_whitespace=True, context=3):
                                 ignore_whitespace, context)
     return vcs_gitdiff
 
+
+def get_omitted_files(repo, rev1, rev2, parsed):
+    """
+    Returns data of files changed between ``rev1`` and ``rev2`` which are
+    missing in ``parsed`` diff because it was cut off, so they can be listed
+    and their diffs loaded on demand. They are found by comparing trees of
+    the revisions, without generating the rest of the diff.
+    """
+    shown = set()
+    for f in parsed:
+        shown.add(f['filename'])
+        shown.add(f.get('old_filename'))
+    added, changed, removed = repo.get_changed_paths(rev1, rev2)
+    omitted = []
+    for op, ops, paths in [('A', {NEW_FILENODE: 'new file'}, added),
+                           ('M', {MOD_FILENODE: 'modified file'}, changed),
+                           ('D', {DEL_FILENODE: 'deleted file'}, removed)]:
+        for path in paths:
+            if path in shown:
+                continue
+            omitted.append({
+                'filename':         path,
+                'old_filename':     path,
+                'chunks':           [],
+                'operation':        op,
+                'stats':            {'added': 0, 'deleted': 0,
+                                     'binary': True, 'ops': dict(ops)},
+            })
+    return sorted(omitted, key=lambda f: f['filename'])
+
+
+def _parse_diff(repo, rev1, rev2, path, ignore_whitespace, context,
+                diff_limit, vcs, get_diff=None):
+    if get_diff is None:
+        diff = repo.get_chunked_diff(rev1, rev2, path=path,
+                                     ignore_whitespace=ignore_whitespace,
+                                     context=context)
+    else:
+        diff = get_diff()
+    diff_processor = DiffProcessor(diff, vcs=vcs, format='gitdiff',
+                                   diff_limit=diff_limit)
+    return diff_processor.prepare()
+
+
+def get_diff_processor(repo, rev1, rev2, path=None, ignore_whitespace=False,
+                       context=3, diff_limit=None, vcs='hg', get_diff=None):
+    """
+    Returns prepared ``DiffProcessor`` of diff between ``rev1`` and ``rev2``
+    of ``repo``, limited to ``path`` if given. The parsed diff is taken from
+    the diff cache if it is enabled and both revisions are changeset hashes.
+
+    :param get_diff: callable returning the diff, ``get_chunked_diff`` of
+        ``repo`` by default
+    """
+    parse = lambda: _parse_diff(repo, rev1, rev2, path, ignore_whitespace,
+                                context, diff_limit, vcs, get_diff)
+    cache = get_diff_cache()
+    key = get_diff_key(repo.alias, rev1, rev2, path=path,
+                       ignore_whitespace=ignore_whitespace, context=context,
+                       diff_limit=diff_limit, vcs=vcs)
+    if cache is None or key is None:
+        parsed = parse()
+    else:
+        parsed = cache.get(key, parse)
+    diff_processor = DiffProcessor(u'', vcs=vcs, format='gitdiff',
+                                   diff_limit=diff_limit)
+    diff_processor.parsed = True
+    diff_processor.parsed_diff = parsed
+    return diff_processor
+
+
+def warm_diff_cache(repo, rev1, rev2, diff_limit=None):
+    """
+    Parses diff between ``rev1`` and ``rev2`` of ``repo`` with default
+    options into the diff cache ahead of its first view, like the one of
+    a new pull request; returns True if it wasn't cached yet.
+    """
+    cache = get_diff_cache()
+    key = get_diff_key(repo.alias, rev1, rev2, diff_limit=diff_limit)
+    if cache is None or key is None:
+        return False
+    return cache.warm(key, lambda: _parse_diff(repo, rev1, rev2, None, False,
+                                               3, diff_limit, 'hg'))
+
 NEW_FILENODE = 1
 DEL_FILENODE = 2
 MOD_FILENODE = 3
@@ -132,6 +224,106 @@ CHMOD_FILENODE = 6
 BIN_FILENODE = 7
 
 
+#: longest part of two lines, in words and separators, between their common
+#: prefix and suffix which is highlighted word by word; longer changes are
+#: highlighted as a whole
+MAX_INTRALINE_WORDS = 500
+#: most insertions and deletions of words looked for by the ``myers`` engine
+#: before it gives up highlighting word by word
+MAX_INTRALINE_EDITS = 64
+
+
+def _difflib_opcodes(a, b):
+    return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+def _myers_opcodes(a, b, max_edits=MAX_INTRALINE_EDITS):
+    """
+    Returns opcodes like ``difflib.SequenceMatcher.get_opcodes`` changing
+    sequence ``a`` into ``b`` by fewest insertions and deletions, found by
+    the O(ND) algorithm of Eugene W. Myers, or None if more than
+    ``max_edits`` of them are needed.
+    """
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in xrange(max_edits + 1):
+        trace.append(v.copy())
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+
+    # walk the path back, collecting equal (=), deleted (-) and inserted (+)
+    # items in reverse order
+    moves = []
+    x, y = n, m
+    for d in xrange(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            moves.append('=')
+            x -= 1
+            y -= 1
+        if d:
+            moves.append('+' if x == prev_x else '-')
+        x, y = prev_x, prev_y
+    moves.reverse()
+
+    opcodes = []
+    i = j = pos = 0
+    while pos < len(moves):
+        i1, j1 = i, j
+        if moves[pos] == '=':
+            while pos < len(moves) and moves[pos] == '=':
+                i += 1
+                j += 1
+                pos += 1
+            opcodes.append(('equal', i1, i, j1, j))
+            continue
+        while pos < len(moves) and moves[pos] != '=':
+            if moves[pos] == '-':
+                i += 1
+            else:
+                j += 1
+            pos += 1
+        if i > i1 and j > j1:
+            tag = 'replace'
+        elif i > i1:
+            tag = 'delete'
+        else:
+            tag = 'insert'
+        opcodes.append((tag, i1, i, j1, j))
+    return opcodes
+
+#: engines finding changed words of two lines, callables returning opcodes
+#: like ``difflib.SequenceMatcher.get_opcodes`` for two lists of words or
+#: None if the lines are too different to be highlighted word by word
+INTRALINE_ENGINES = {
+    'difflib': _difflib_opcodes,
+    'myers': _myers_opcodes,
+}
+
+
 class DiffLimitExceeded(Exception):
     pass
 
@@ -199,29 +391,38 @@ class DiffProcessor(object):
     _escape_re = re.compile(r'(&)|(<)|(>)|(\t)|(\r)|(?<=.)( \n| $)')
 
 
-    def __init__(self, diff, vcs='hg', format='gitdiff', diff_limit=None):
+    def __init__(self, diff, vcs='hg', format='gitdiff', diff_limit=None,
+                 intraline='myers'):
         """
-        :param diff:   a text in diff format
+        :param diff:   a text in diff format, or an iterable over chunks of
+            it as returned by ``get_chunked_diff``, which is then parsed
+            while it is read and closed as soon as the diff limit is hit
         :param vcs: type of version control hg or git
         :param format: format of diff passed, `udiff` or `gitdiff`
         :param diff_limit: define the size of diff that is considered "big"
             based on that parameter cut off will be triggered, set to None
             to show full diff
+        :param intraline: name of engine from ``INTRALINE_ENGINES`` used
+            to highlight changed words of `gitdiff` lines
         """
-        if not isinstance(diff, basestring):
-            raise Exception('Diff must be a basestring got %s instead' % type(diff))
+        if isinstance(diff, basestring):
+            # calculate diff size
+            self.diff_size = len(diff)
+        elif hasattr(diff, '__iter__'):
+            self.diff_size = None
+        else:
+            raise Exception('Diff must be a basestring or an iterable got %s instead' % type(diff))
 
         self._diff = diff
         self._format = format
         self.adds = 0
         self.removes = 0
-        # calculate diff size
-        self.diff_size = len(diff)
         self.diff_limit = diff_limit
         self.cur_diff_size = 0
         self.parsed = False
         self.parsed_diff = []
         self.vcs = vcs
+        self._intraline = INTRALINE_ENGINES[intraline]
 
         if format == 'gitdiff':
             self.differ = self._highlight_line_difflib
@@ -230,14 +431,77 @@ class DiffProcessor(object):
             self.differ = self._highlight_line_udiff
             self._parser = self._parse_udiff
 
-    def _copy_iterator(self):
+    def _iter_lines(self):
+        """
+        Yields lines of the diff, reading chunks of it as needed; lines are
+        split on \\n only, as str.splitlines would split on \\r too
+        """
+        if isinstance(self._diff, basestring):
+            for line in re.finditer(r'.*\n|.+$', self._diff):
+                yield line.group()
+            return
+        pending = []
+        pending_size = 0
+        for chunk in self._diff:
+            lines = chunk.split('\n')
+            if len(lines) == 1:
+                # don't let a single huge line grow beyond the diff limit
+                pending.append(chunk)
+                pending_size += len(chunk)
+                if (self.diff_limit is not None and
+                    self.cur_diff_size + pending_size > self.diff_limit):
+                    raise DiffLimitExceeded('Diff Limit Exceeded')
+                continue
+            pending.append(lines[0])
+            yield ''.join(pending) + '\n'
+            for line in lines[1:-1]:
+                yield line + '\n'
+            pending = [lines[-1]]
+            pending_size = len(lines[-1])
+        rest = ''.join(pending)
+        if rest:
+            yield rest
+
+    def _close(self):
         """
-        make a fresh copy of generator, we should not iterate thru
-        an original as it's needed for repeating operations on
-        this instance of DiffProcessor
+        Stops generating the rest of the diff, if it is being streamed
         """
-        self.__udiff, iterator_copy = tee(self.__udiff)
-        return iterator_copy
+        close = getattr(self._diff, 'close', None)
+        if close is not None:
+            close()
+
+    def _split_files(self):
+        """
+        Yields tuple of header and lines of every file in the diff, the
+        header as a string without the leading ``diff --git`` and lines as
+        an iterator over the rest of the file diff. Lines of a file must be
+        read, or skipped, before the next file is read.
+        """
+        lines = self._iter_lines()
+        line = next(lines, None)
+        while line is not None and not line.startswith('diff --git'):
+            line = next(lines, None)
+        while line is not None:
+            header = [line[len('diff --git'):]]
+            line = next(lines, None)
+            while line is not None and not line.startswith(
+                    ('@', 'literal ', 'delta ', 'diff --git')):
+                header.append(line)
+                line = next(lines, None)
+            current = [line]
+
+            def file_lines():
+                while current[0] is not None and \
+                      not current[0].startswith('diff --git'):
+                    yield current[0]
+                    current[0] = next(lines, None)
+
+            difflines = file_lines()
+            yield ''.join(header), difflines
+            # skip whatever wasn't read of this file
+            for _line in difflines:
+                pass
+            line = current[0]
 
     def _escaper(self, string):
         """
@@ -285,9 +549,41 @@ class DiffProcessor(object):
 
     def _highlight_line_difflib(self, line, next_):
         """
-        Highlight inline changes in both lines.
+        Highlight inline changes in both lines word by word, diffing only
+        words between their common prefix and suffix. Changes too long or
+        too complex for the intraline engine are highlighted as a whole,
+        like ``_highlight_line_udiff`` does.
         """
+        old, new, oldwords, newwords, start, end = self._split_words(line,
+                                                                     next_)
+        a = oldwords[start:len(oldwords) - end]
+        b = newwords[start:len(newwords) - end]
+        opcodes = None
+        if len(a) + len(b) <= MAX_INTRALINE_WORDS:
+            opcodes = self._intraline(a, b)
+        if opcodes is None:
+            opcodes = [('replace', 0, len(a), 0, len(b))]
+        self._highlight_words(old, new, oldwords, newwords, start, end,
+                              opcodes)
 
+    def _highlight_line_udiff(self, line, next_):
+        """
+        Highlight inline changes in both lines as a single change between
+        their common prefix and suffix.
+        """
+        old, new, oldwords, newwords, start, end = self._split_words(line,
+                                                                     next_)
+        self._highlight_words(old, new, oldwords, newwords, start, end,
+            [('replace', 0, len(oldwords) - start - end,
+              0, len(newwords) - start - end)])
+
+    def _split_words(self, line, next_):
+        """
+        Returns removed and added line of the pair, their words and lengths
+        of their common prefix and suffix in words. Lines are split on whole
+        escaped characters and markup, so these are never highlighted
+        partially.
+        """
         if line['action'] == 'del':
             old, new = line, next_
         else:
@@ -295,12 +591,26 @@ class DiffProcessor(object):
 
         oldwords = self._token_re.split(old['line'])
         newwords = self._token_re.split(new['line'])
-        sequence = difflib.SequenceMatcher(None, oldwords, newwords)
+        limit = min(len(oldwords), len(newwords))
+        start = 0
+        while start < limit and oldwords[start] == newwords[start]:
+            start += 1
+        end = 0
+        while end < limit - start and oldwords[-1 - end] == newwords[-1 - end]:
+            end += 1
+        return old, new, oldwords, newwords, start, end
 
-        oldfragments, newfragments = [], []
-        for tag, i1, i2, j1, j2 in sequence.get_opcodes():
-            oldfrag = ''.join(oldwords[i1:i2])
-            newfrag = ''.join(newwords[j1:j2])
+    def _highlight_words(self, old, new, oldwords, newwords, start, end,
+                         opcodes):
+        """
+        Marks words of both lines changed by ``opcodes`` of their words
+        between common prefix of ``start`` words and suffix of ``end``
+        words.
+        """
+        oldfragments, newfragments = oldwords[:start], newwords[:start]
+        for tag, i1, i2, j1, j2 in opcodes:
+            oldfrag = ''.join(oldwords[start + i1:start + i2])
+            newfrag = ''.join(newwords[start + j1:start + j2])
             if tag != 'equal':
                 if oldfrag:
                     oldfrag = '<del>%s</del>' % oldfrag
@@ -308,41 +618,13 @@ class DiffProcessor(object):
                     newfrag = '<ins>%s</ins>' % newfrag
             oldfragments.append(oldfrag)
             newfragments.append(newfrag)
+        oldfragments.extend(oldwords[len(oldwords) - end:])
+        newfragments.extend(newwords[len(newwords) - end:])
 
         old['line'] = "".join(oldfragments)
         new['line'] = "".join(newfragments)
 
-    def _highlight_line_udiff(self, line, next_):
-        """
-        Highlight inline changes in both lines.
-        """
-        start = 0
-        limit = min(len(line['line']), len(next_['line']))
-        while start < limit and line['line'][start] == next_['line'][start]:
-            start += 1
-        end = -1
-        limit -= start
-        while -end <= limit and line['line'][end] == next_['line'][end]:
-            end -= 1
-        end += 1
-        if start or end:
-            def do(l):
-                last = end + len(l['line'])
-                if l['action'] == 'add':
-                    tag = 'ins'
-                else:
-                    tag = 'del'
-                l['line'] = '%s<%s>%s</%s>%s' % (
-                    l['line'][:start],
-                    tag,
-                    l['line'][start:last],
-                    tag,
-                    l['line'][last:]
-                )
-            do(line)
-            do(next_)
-
-    def _get_header(self, diff_chunk):
+    def _get_header(self, diff_chunk, difflines):
         """
         parses the diff header, and returns parts, and leftover diff
         parts consists of 14 elements::
@@ -351,7 +633,8 @@ class DiffProcessor(object):
             old_mode, new_mode, new_file_mode, deleted_file_mode,
             a_blob_id, b_blob_id, b_mode, a_file, b_file
 
-        :param diff_chunk:
+        :param diff_chunk: header of a file diff
+        :param difflines: iterator over the following lines of the file diff
         """
 
         match = None
@@ -363,10 +646,9 @@ class DiffProcessor(object):
             raise Exception('diff not recognized as valid %s diff' % self.vcs)
         groups = match.groupdict()
         rest = diff_chunk[match.end():]
-        if rest and not rest.startswith('@') and not rest.startswith('literal ') and not rest.startswith('delta '):
+        if rest:
             raise Exception('cannot parse diff header: %r followed by %r' % (diff_chunk[:match.end()], rest[:1000]))
-        difflines = imap(self._escaper, re.findall(r'.*\n|.+$', rest)) # don't split on \r as str.splitlines do
-        return groups, difflines
+        return groups, imap(self._escaper, difflines)
 
     def _clean_line(self, line, command):
         if command in ['+', '-', ' ']:
@@ -374,13 +656,15 @@ class DiffProcessor(object):
             line = line[1:]
         return line
 
-    def _parse_gitdiff(self, inline_diff=True):
-        _files = []
-        diff_container = lambda arg: arg
-
+    def _iter_gitdiff(self, inline_diff=True):
+        """
+        Yields data of files of the diff for the template, parsing them one
+        by one while the diff is read. Raises DiffLimitExceeded when the
+        diff limit is hit.
+        """
         ##split the diff in chunks of separate --git a/file b/file chunks
-        for raw_diff in ('\n' + self._diff).split('\ndiff --git')[1:]:
-            head, diff = self._get_header(raw_diff)
+        for raw_diff, difflines in self._split_files():
+            head, diff = self._get_header(raw_diff, difflines)
 
             op = None
             stats = {
@@ -439,20 +723,13 @@ class DiffProcessor(object):
 
             # a real non-binary diff
             if head['a_file'] or head['b_file']:
-                try:
-                    chunks, _stats = self._parse_lines(diff)
-                    stats['binary'] = False
-                    stats['added'] = _stats[0]
-                    stats['deleted'] = _stats[1]
-                    # explicit mark that it's a modified file
-                    if op == 'M':
-                        stats['ops'][MOD_FILENODE] = 'modified file'
-
-                except DiffLimitExceeded:
-                    diff_container = lambda _diff: \
-                        LimitedDiffContainer(self.diff_limit,
-                                            self.cur_diff_size, _diff)
-                    break
+                chunks, _stats = self._parse_lines(diff)
+                stats['binary'] = False
+                stats['added'] = _stats[0]
+                stats['deleted'] = _stats[1]
+                # explicit mark that it's a modified file
+                if op == 'M':
+                    stats['ops'][MOD_FILENODE] = 'modified file'
             else:  # Git binary patch (or empty diff)
                 # Git binary patch
                 if head['bin_patch']:
@@ -472,20 +749,21 @@ class DiffProcessor(object):
                 } for _op, msg in stats['ops'].iteritems()
                   if _op not in [MOD_FILENODE]])
 
-            _files.append({
+            diff_data = {
                 'filename':         head['b_path'],
+                'old_filename':     head['a_path'],
                 'old_revision':     head['a_blob_id'],
                 'new_revision':     head['b_blob_id'],
                 'chunks':           chunks,
                 'operation':        op,
                 'stats':            stats,
-            })
+            }
 
-        if not inline_diff:
-            return diff_container(_files)
+            if not inline_diff:
+                yield diff_data
+                continue
 
-        # highlight inline changes
-        for diff_data in _files:
+            # highlight inline changes
             for chunk in diff_data['chunks']:
                 lineiter = iter(chunk)
                 try:
@@ -500,7 +778,19 @@ class DiffProcessor(object):
                 except StopIteration:
                     pass
 
-        return diff_container(_files)
+            yield diff_data
+
+    def _parse_gitdiff(self, inline_diff=True):
+        _files = []
+        try:
+            for diff_data in self._iter_gitdiff(inline_diff=inline_diff):
+                _files.append(diff_data)
+        except DiffLimitExceeded:
+            # don't read nor generate the rest of the diff
+            self._close()
+            return LimitedDiffContainer(self.diff_limit, self.cur_diff_size,
+                                        _files)
+        return _files
 
     def _parse_udiff(self, inline_diff=True):
         raise NotImplementedError()
@@ -635,8 +925,11 @@ class DiffProcessor(object):
 
     def as_raw(self, diff_lines=None):
         """
-        Returns raw string diff
+        Returns raw string diff; a streamed diff is read completely, which is
+        possible only if it wasn't parsed
         """
+        if not isinstance(self._diff, basestring):
+            return ''.join(self._diff)
         return self._diff
         #return u''.join(imap(self._line_counter, self._diff.splitlines(1)))
 
@@ -17,6 +17,10 @@ Modified mercurial DAG graph functions that re-uses VCS structure
 It allows to have a shared codebase for DAG generation for hg and git repos
 """
 
+import hashlib
+
+from beaker.cache import cache_region
+
 nullrev = -1
 
 def _first_known_ancestors(parentrev_func, minrev, knownrevs, head):
@@ -53,8 +57,19 @@ def graph_data(repo, revs):
       - A list of tuples indicating the edges between the current node and its
         parents.
     """
-    dag = _dagwalker(repo, revs)
-    return list(_colored(repo, dag))
+    if not revs:
+        return []
+
+    # layout of a page depends only on its revisions and the repository
+    # state, so it is kept until something is pushed
+    @cache_region('long_term', 'graph_data')
+    def _graph_data(repo_path, change_token, revs_key):
+        dag = _dagwalker(repo, revs)
+        return list(_colored(repo, dag))
+
+    revs_key = hashlib.sha1(','.join(map(str, revs))).hexdigest()
+    return _graph_data(repo.path, repr(repo.get_change_token(repo.path)),
+                       revs_key)
 
 def _dagwalker(repo, revs):
     if not revs:
@@ -63,8 +78,7 @@ def _dagwalker(repo, revs):
     if repo.alias == 'hg':
         parentrev_func = repo._repo.changelog.parentrevs
     elif repo.alias == 'git':
-        def parentrev_func(rev):
-            return [x.revision for x in repo[rev].parents]
+        parentrev_func = repo._get_parent_revisions
 
     minrev = revs[-1] # assuming sorted reverse
     knownrevs = set(revs)
@@ -95,12 +109,25 @@ def _colored(repo, dag):
       - A list of tuples indicating the edges between the current node and its
         parents.
     """
-    branch_cache = {}
+    dag = list(dag)
+    # branches of all nodes and their parents, read in one batch
+    needed = set()
+    for (rev, dagparents) in dag:
+        needed.add(rev)
+        needed.update(abs(p) for p in dagparents)
+    branch_cache = dict((row.revision, row.branch) for row in
+                        repo.get_changeset_metadata(sorted(needed)))
     def branch(rev):
-        if rev not in branch_cache:
-            branch_cache[rev] = repo[rev].branch
         return branch_cache[rev]
 
+    if repo.alias == 'hg':
+        changelog = repo._repo.changelog
+        def closesbranch(rev):
+            return 'close' in changelog.read(changelog.node(rev))[5]
+    else:
+        def closesbranch(rev):
+            return repo[rev].closesbranch
+
     row = []
     colors = {}
     newcolor = 1
@@ -149,6 +176,6 @@ def _colored(repo, dag):
                     edges.append((ecol, nextrow.index(p), colors[p]))
 
         # Yield and move on
-        closing = int(repo[rev].closesbranch)
+        closing = int(closesbranch(rev))
         yield ((col, color), edges, closing)
         row = nextrow
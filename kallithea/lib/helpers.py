@@ -21,12 +21,14 @@ import random
 import hashlib
 import StringIO
 import math
+import datetime
 import logging
 import re
 import urlparse
 import textwrap
 
 from pygments.formatters.html import HtmlFormatter
+from sqlalchemy import and_, or_, DateTime, Integer
 from pygments import highlight as code_highlight
 from pylons import url
 from pylons.i18n.translation import _, ungettext
@@ -610,7 +612,17 @@ def action_parser(user_log, feed=False, parse_cs=False):
     def get_cs_links():
         revs_limit = 3  # display this amount always
         revs_top_limit = 50  # show upto this amount of changesets hidden
-        revs_ids = action_params.split(',')
+        if user_log.revisions_count is not None:
+            # pushed revisions are stored apart, only the shown ones and
+            # the last one are loaded
+            revs_count = user_log.revisions_count
+            revs_ids = user_log.revisions_preview or ['']
+            revs_last = revs_ids[-1]
+            revs_ids = revs_ids[:revs_top_limit]
+        else:
+            revs_ids = action_params.split(',')
+            revs_count = len(revs_ids)
+            revs_last = revs_ids[-1]
         deleted = user_log.repository is None
         if deleted:
             return ','.join(revs_ids)
@@ -683,7 +695,7 @@ def action_parser(user_log, feed=False, parse_cs=False):
             [lnk(rev, repo_name) for rev in revs[:revs_limit]]
         )]
         _op1, _name1 = _get_op(revs_ids[0])
-        _op2, _name2 = _get_op(revs_ids[-1])
+        _op2, _name2 = _get_op(revs_last)
 
         _rev = '%s...%s' % (_name1, _name2)
 
@@ -691,7 +703,7 @@ def action_parser(user_log, feed=False, parse_cs=False):
             ' <div class="compare_view tooltip" title="%s">'
             '<a href="%s">%s</a> </div>' % (
                 _('Show all combined changesets %s->%s') % (
-                    revs_ids[0][:12], revs_ids[-1][:12]
+                    revs_ids[0][:12], revs_last[:12]
                 ),
                 url('changeset_home', repo_name=repo_name,
                     revision=_rev
@@ -703,11 +715,11 @@ def action_parser(user_log, feed=False, parse_cs=False):
         # if we have exactly one more than normally displayed
         # just display it, takes less space than displaying
         # "and 1 more revisions"
-        if len(revs_ids) == revs_limit + 1:
+        if revs_count == revs_limit + 1:
             cs_links.append(", " + lnk(revs[revs_limit], repo_name))
 
         # hidden-by-default ones
-        if len(revs_ids) > revs_limit + 1:
+        if revs_count > revs_limit + 1:
             uniq_id = revs_ids[0]
             html_tmpl = (
                 '<span> %s <a class="show_more" id="_%s" '
@@ -716,7 +728,7 @@ def action_parser(user_log, feed=False, parse_cs=False):
             if not feed:
                 cs_links.append(html_tmpl % (
                       _('and'),
-                      uniq_id, _('%s more') % (len(revs_ids) - revs_limit),
+                      uniq_id, _('%s more') % (revs_count - revs_limit),
                       _('revisions')
                     )
                 )
@@ -730,7 +742,7 @@ def action_parser(user_log, feed=False, parse_cs=False):
               [lnk(rev, repo_name) for rev in revs[revs_limit:]]
             )
 
-            if len(revs_ids) > revs_top_limit:
+            if revs_count > revs_top_limit:
                 morelinks += ', ...'
 
             cs_links.append(html_tmpl % (uniq_id, morelinks))
@@ -1130,6 +1142,169 @@ class RepoPage(Page):
         list.__init__(self, reversed(self.items))
 
 
+#==============================================================================
+# KEYSET PAGER, PAGER FOR BIG TABLES
+#==============================================================================
+class KeysetPage(list):
+    """
+    Pager of query ordered by ``key_columns`` descending, like
+    ``[UserLog.action_date, UserLog.user_log_id]``, which must be unique.
+    Instead of skipping items of preceding pages with OFFSET, pages are
+    found by seeking to the key of the last item of the newer page
+    (``after`` cursor) or to the key of the first item of the older page
+    (``before`` cursor) in an index of the columns, so deep pages cost the
+    same as the first one. Pages have no numbers, there are links to the
+    first, the previous and the next page only.
+
+    Items aren't counted unless ``item_count`` is used; then at most
+    ``count_limit`` of them are, so the count is approximate for big
+    tables.
+    """
+
+    def __init__(self, query, key_columns, after=None, before=None,
+                 items_per_page=20, url=None, count_limit=10000, **kwargs):
+        self.key_columns = key_columns
+        self.items_per_page = items_per_page
+        self.count_limit = count_limit
+        self._url_generator = url
+        self.kwargs = kwargs
+        # nothing can match if query is not a query, like an empty list
+        self.query = query if hasattr(query, 'filter') else None
+        self._item_count = None
+
+        after = self.parse_cursor(after)
+        before = self.parse_cursor(before)
+        items = []
+        self.has_newer = self.has_older = False
+        if self.query is not None and before is not None:
+            items = self.query.filter(self._seek(before, newer=True))\
+                .order_by(None).order_by(*[c.asc() for c in key_columns])\
+                .limit(items_per_page + 1).all()
+            if len(items) > items_per_page:
+                self.has_newer = self.has_older = True
+                items = items[:items_per_page]
+                items.reverse()
+            else:
+                # the first page, which is shown full
+                items = after = None
+        if self.query is not None and (before is None or items is None):
+            q = self.query
+            if after is not None:
+                q = q.filter(self._seek(after, newer=False))
+            items = q.order_by(None).order_by(*[c.desc() for c in key_columns])\
+                .limit(items_per_page + 1).all()
+            self.has_older = len(items) > items_per_page
+            items = items[:items_per_page]
+            self.has_newer = after is not None
+        list.__init__(self, items)
+
+    def _seek(self, key, newer):
+        # row value comparison written out as (a > x) or (a = x and b > y),
+        # with a range on the leading column all databases can use an
+        # index for
+        cmp = lambda col, val: col > val if newer else col < val
+        clauses = []
+        for i, col in enumerate(self.key_columns):
+            equal = [c == v for c, v in zip(self.key_columns[:i], key[:i])]
+            clauses.append(and_(*(equal + [cmp(col, key[i])])))
+        leading = self.key_columns[0]
+        if newer:
+            leading = leading >= key[0]
+        else:
+            leading = leading <= key[0]
+        return and_(leading, or_(*clauses))
+
+    def cursor(self, item):
+        """
+        Returns cursor of the position of ``item``, used as ``after`` or
+        ``before`` parameter.
+        """
+        values = []
+        for col in self.key_columns:
+            val = getattr(item, col.key)
+            if isinstance(val, datetime.datetime):
+                val = val.strftime('%Y%m%d%H%M%S%f')
+            values.append(str(val))
+        return '_'.join(values)
+
+    def parse_cursor(self, cursor):
+        """
+        Returns key of position given by ``cursor`` or None if it isn't
+        valid.
+        """
+        if not cursor:
+            return None
+        values = cursor.split('_')
+        if len(values) != len(self.key_columns):
+            return None
+        key = []
+        try:
+            for col, val in zip(self.key_columns, values):
+                col_type = col.property.columns[0].type
+                if isinstance(col_type, DateTime):
+                    val = datetime.datetime.strptime(val, '%Y%m%d%H%M%S%f')
+                elif isinstance(col_type, Integer):
+                    val = int(val)
+                key.append(val)
+        except ValueError:
+            return None
+        return key
+
+    @property
+    def item_count(self):
+        """
+        Number of all items, counted up to ``count_limit``; above it the
+        count is ``count_limit`` + 1.
+        """
+        if self._item_count is None:
+            if self.query is None:
+                self._item_count = 0
+            else:
+                self._item_count = self.query.order_by(None)\
+                    .limit(self.count_limit + 1).count()
+        return self._item_count
+
+    @property
+    def item_count_text(self):
+        if self.item_count > self.count_limit:
+            return _('More than %s Entries') % self.count_limit
+        return ungettext('%s Entry', '%s Entries',
+                         self.item_count) % self.item_count
+
+    def _pagerlink(self, text, **params):
+        link_params = dict(self.kwargs)
+        link_params.update(params)
+        url_generator = self._url_generator or url.current
+        return link_to(text, url_generator(**link_params), **self.link_attr)
+
+    def pager(self, format='$link_previous $link_next',
+              symbol_first='<<', symbol_previous='<', symbol_next='>',
+              link_attr={'class': 'pager_link'}):
+        """
+        Returns navigation of pages in ``format``, where ``$link_first``,
+        ``$link_previous``, ``$link_next`` and ``$item_count`` are
+        replaced.
+        """
+        from string import Template
+        self.link_attr = link_attr
+        if not self.has_newer and not self.has_older:
+            return ''
+
+        values = {
+            'link_first': self.has_newer and
+                    self._pagerlink(symbol_first) or '',
+            'link_previous': self.has_newer and self and
+                    self._pagerlink(symbol_previous, before=self.cursor(self[0]))
+                    or HTML.span(symbol_previous, class_="yui-pg-previous"),
+            'link_next': self.has_older and
+                    self._pagerlink(symbol_next, after=self.cursor(self[-1]))
+                    or HTML.span(symbol_next, class_="yui-pg-next"),
+        }
+        if '$item_count' in format:
+            values['item_count'] = escape(self.item_count_text)
+        return literal(Template(format).safe_substitute(values))
+
+
 def changed_tooltip(nodes):
     """
     Generates a html string for changed nodes in changeset page.
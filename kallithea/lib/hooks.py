@@ -28,16 +28,21 @@ Original author and date, and relevant copyright and licensing information is be
 import os
 import sys
 import time
+import logging
 import binascii
 
 from kallithea.lib.vcs.utils.hgcompat import nullrev, revrange
 from kallithea.lib import helpers as h
-from kallithea.lib.utils import action_logger
+from kallithea.lib.utils import action_logger_async
 from kallithea.lib.vcs.backends.base import EmptyChangeset
+from kallithea.lib.vcs.conf import settings as vcs_settings
 from kallithea.lib.exceptions import HTTPLockedRC, UserCreationError
+from kallithea.lib.indexers.queue import IndexUpdateQueue, get_queue_dir
 from kallithea.lib.utils2 import safe_str, _extract_extras
 from kallithea.model.db import Repository, User
 
+log = logging.getLogger(__name__)
+
 
 def _get_scm_size(alias, root_path):
 
@@ -130,9 +135,8 @@ def log_pull_action(ui, repo, **kwargs):
     """
     ex = _extract_extras()
 
-    user = User.get_by_username(ex.username)
     action = 'pull'
-    action_logger(user, action, ex.repository, ex.ip, commit=True)
+    action_logger_async(ex.username, action, ex.repository, ex.ip)
     # extension hook call
     from kallithea import EXTENSIONS
     callback = getattr(EXTENSIONS, 'PULL_HOOK', None)
@@ -142,6 +146,7 @@ def log_pull_action(ui, repo, **kwargs):
         callback(**kw)
 
     if ex.make_lock is not None and ex.make_lock:
+        user = User.get_by_username(ex.username)
         Repository.lock(Repository.get_by_repo_name(ex.repository), user.user_id)
         #msg = 'Made lock on repo `%s`' % repository
         #sys.stdout.write(msg)
@@ -155,6 +160,21 @@ def log_pull_action(ui, repo, **kwargs):
     return 0
 
 
+def _enqueue_index_update(repo_name):
+    """
+    Queues ``repo_name`` for an update of the search index by
+    ``make-index --watch``.
+    """
+    import kallithea
+    index_dir = kallithea.CONFIG.get('index_dir')
+    if not index_dir:
+        return
+    try:
+        IndexUpdateQueue(get_queue_dir(index_dir)).enqueue(repo_name)
+    except (IOError, OSError), e:
+        log.error('Cannot queue %s for index update: %s' % (repo_name, e))
+
+
 def log_push_action(ui, repo, **kwargs):
     """
     Maps user last push action to new changeset id, from mercurial
@@ -165,7 +185,6 @@ def log_push_action(ui, repo, **kwargs):
 
     ex = _extract_extras()
 
-    action_tmpl = ex.action + ':%s'
     revs = []
     if ex.scm == 'hg':
         node = kwargs['node']
@@ -183,13 +202,19 @@ def log_push_action(ui, repo, **kwargs):
         stop, start = get_revs(repo, [node + ':'])
         _h = binascii.hexlify
         revs = [_h(repo[r].node()) for r in xrange(start, stop + 1)]
+        # capped, so first push after an upgrade doesn't read whole history
+        Repository.get_by_repo_name(ex.repository).scm_instance_no_cache() \
+            .update_changeset_metadata(
+                limit=vcs_settings.CHANGESET_METADATA_PUSH_LIMIT)
     elif ex.scm == 'git':
         revs = kwargs.get('_git_revs', [])
         if '_git_revs' in kwargs:
             kwargs.pop('_git_revs')
 
-    action = action_tmpl % ','.join(revs)
-    action_logger(ex.username, action, ex.repository, ex.ip, commit=True)
+    # pushed revisions are stored apart from the action
+    action_logger_async(ex.username, ex.action, ex.repository, ex.ip,
+                        revisions=revs)
+    _enqueue_index_update(ex.repository)
 
     # extension hook call
     from kallithea import EXTENSIONS
@@ -468,3 +493,12 @@ def handle_git_receive(repo_path, revs, env, hook_type='post'):
                 git_revs += ['tag=>%s' % push_ref['name']]
 
         log_push_action(baseui, repo, _git_revs=git_revs)
+
+    if hook_type == 'post':
+        # refs are updated now, advertisements cached before are stale
+        from kallithea.lib.refs_cache import invalidate_refs_cache
+        invalidate_refs_cache(repo_path)
+        # extend revision index right away so web requests find it up to date
+        repo.update_revision_index()
+        repo.update_changeset_metadata(
+            limit=vcs_settings.CHANGESET_METADATA_PUSH_LIMIT)
@@ -28,6 +28,7 @@ Original author and date, and relevant copyright and licensing information is be
 import os
 import sys
 import logging
+import threading
 from os.path import dirname as dn, join as jn
 
 # Add location of top level folder to sys.path
@@ -37,7 +38,7 @@ from whoosh.analysis import RegexTokenizer, LowercaseFilter
 from whoosh.fields import TEXT, ID, STORED, NUMERIC, BOOLEAN, Schema, FieldType, DATETIME
 from whoosh.formats import Characters
 from whoosh.highlight import highlight as whoosh_highlight, HtmlFormatter, ContextFragmenter
-from kallithea.lib.utils2 import LazyProperty
+from whoosh.index import open_dir, EmptyIndexError
 
 log = logging.getLogger(__name__)
 
@@ -59,6 +60,10 @@ SCHEMA = Schema(
 IDX_NAME = 'HG_INDEX'
 FORMATTER = HtmlFormatter('span', between='\n<span class="break">...</span>\n')
 FRAGMENTER = ContextFragmenter(200)
+# matches of a file highlighted in search results
+MAX_FRAGMENTS = 5
+# characters of commit messages highlighted in search results
+MAX_HIGHLIGHT_LEN = 10000
 
 CHGSETS_SCHEMA = Schema(
     raw_id=ID(unique=True, stored=True),
@@ -77,6 +82,14 @@ CHGSETS_SCHEMA = Schema(
 
 CHGSET_IDX_NAME = 'CHGSET_INDEX'
 
+# last revision of every repository the file index was updated to
+INDEXED_REVS_SCHEMA = Schema(
+    repository=ID(unique=True, stored=True),
+    raw_id=ID(stored=True),
+)
+
+INDEXED_REVS_IDX_NAME = 'INDEXED_REVS_INDEX'
+
 # used only to generate queries in journal
 JOURNAL_SCHEMA = Schema(
     username=TEXT(),
@@ -86,59 +99,140 @@ JOURNAL_SCHEMA = Schema(
     ip=TEXT(),
 )
 
+# searchers reused by get_searcher, per thread
+_searchers = threading.local()
+
+
+def get_searcher(index_location, indexname):
+    """
+    Returns searcher of index ``indexname`` in ``index_location``, reused by
+    following requests of the same thread as long as the index isn't changed.
+    Searchers are refreshed when a new generation of the index is committed
+    and reopened when the index is rebuilt from scratch, which recreates
+    ``index_location``. Returned searchers must not be closed.
+    """
+    cache = getattr(_searchers, 'cache', None)
+    if cache is None:
+        cache = _searchers.cache = {}
+    key = (index_location, indexname)
+    try:
+        location_id = os.stat(index_location).st_ino
+    except OSError:
+        raise EmptyIndexError('Index directory %r does not exist'
+                              % index_location)
+    cached = cache.pop(key, None)
+    if cached is not None:
+        searcher, cached_location_id = cached
+        if cached_location_id == location_id:
+            try:
+                searcher = searcher.refresh()
+            except Exception:
+                log.debug('cannot refresh searcher of %s, reopening' % indexname)
+                searcher.close()
+                searcher = None
+        else:
+            searcher.close()
+            searcher = None
+    else:
+        searcher = None
+    if searcher is None:
+        searcher = open_dir(index_location, indexname=indexname).searcher()
+    cache[key] = (searcher, location_id)
+    return searcher
+
 
 class WhooshResultWrapper(object):
-    def __init__(self, search_type, searcher, matcher, highlight_items,
-                 repo_location):
+    """
+    Lazy sequence of search results of ``query``, used as collection of
+    :class:`~kallithea.lib.helpers.Page`. Slicing it scores only as many hits
+    as needed to reach the end of the slice and highlights only documents in
+    the slice, from character positions stored in the index; the number and
+    size of highlighted fragments are capped so rendering a page doesn't
+    depend on size of matched files.
+    """
+
+    def __init__(self, search_type, searcher, query, highlight_items,
+                 repo_location, pagelen=10):
         self.search_type = search_type
         self.searcher = searcher
-        self.matcher = matcher
+        self.query = query
         self.highlight_items = highlight_items
         self.fragment_size = 200
+        self.max_fragments = MAX_FRAGMENTS
+        self.max_highlight_len = MAX_HIGHLIGHT_LEN
         self.repo_location = repo_location
+        self.pagelen = pagelen
+        self._results = None
+        self._limit = 0
+        self._page = None
 
-    @LazyProperty
-    def doc_ids(self):
-        docs_id = []
-        while self.matcher.is_active():
-            docnum = self.matcher.id()
-            chunks = [offsets for offsets in self.get_chunks()]
-            docs_id.append([docnum, chunks])
-            self.matcher.next()
-        return docs_id
+    def _get_results(self, limit):
+        """
+        Returns whoosh results with at least ``limit`` top hits scored
+        """
+        if self._results is None or limit > self._limit:
+            self._results = self.searcher.search(self.query, limit=limit)
+            self._limit = limit
+        return self._results
+
+    @property
+    def runtime(self):
+        return self._get_results(self.pagelen).runtime
 
     def __str__(self):
-        return '<%s at %s>' % (self.__class__.__name__, len(self.doc_ids))
+        return '<%s at %s>' % (self.__class__.__name__, len(self))
 
     def __repr__(self):
         return self.__str__()
 
     def __len__(self):
-        return len(self.doc_ids)
+        return len(self._get_results(self.pagelen))
 
     def __iter__(self):
         """
-        Allows Iteration over results,and lazy generate content
-
-        *Requires* implementation of ``__getitem__`` method.
+        Allows Iteration over results, page by page
         """
-        for docid in self.doc_ids:
-            yield self.get_full_content(docid)
+        for offset in xrange(0, len(self), self.pagelen):
+            for res in self[offset:offset + self.pagelen]:
+                yield res
 
     def __getitem__(self, key):
         """
         Slicing of resultWrapper
         """
-        i, j = key.start, key.stop
+        i, j = key.start or 0, key.stop
+        if j is None:
+            j = len(self)
+        return self.search_page(i // self.pagelen + 1,
+                                pagelen=j - i, offset=i)
 
-        slices = []
-        for docid in self.doc_ids[i:j]:
-            slices.append(self.get_full_content(docid))
-        return slices
+    def search_page(self, pagenum, pagelen=None, offset=None):
+        """
+        Returns hits of page ``pagenum``, numbered from 1; only hits up to
+        the end of the page are scored.
+        """
+        if pagelen is None:
+            pagelen = self.pagelen
+        if offset is None:
+            offset = (max(pagenum, 1) - 1) * pagelen
+        if pagelen <= 0:
+            return []
+        if self._page is not None and self._page[0] == (offset, pagelen):
+            return self._page[1]
+        results = self._get_results(offset + pagelen)
+        docnums = [results.docnum(n) for n in
+                   xrange(offset, min(offset + pagelen,
+                                      results.scored_length()))]
+        chunks = {}
+        if self.search_type == 'content':
+            chunks = self.get_chunks(docnums)
+        hits = [self.get_full_content((docnum, chunks.get(docnum, [])))
+                for docnum in docnums]
+        self._page = ((offset, pagelen), hits)
+        return hits
 
     def get_full_content(self, docid):
         res = self.searcher.stored_fields(docid[0])
-        log.debug('result: %s' % res)
         if self.search_type == 'content':
             full_repo_path = jn(self.repo_location, res['repository'])
             f_path = res['path'].split(full_repo_path)[-1]
@@ -154,25 +248,44 @@ class WhooshResultWrapper(object):
             f_path = f_path.lstrip(os.sep)
             res.update({'f_path': f_path})
         elif self.search_type == 'message':
-            res.update({'message_hl': self.highlight(res['message'])})
+            res.update({'message_hl': self.highlight(
+                res['message'][:self.max_highlight_len])})
+        # full content isn't shown, don't keep it around
+        res.pop('content', None)
 
-        log.debug('result: %s' % res)
+        log.debug('result: %s' % dict((k, v) for k, v in res.items()
+                                      if k != 'content_short'))
 
         return res
 
     def get_short_content(self, res, chunks):
-
         return ''.join([res['content'][chunk[0]:chunk[1]] for chunk in chunks])
 
-    def get_chunks(self):
+    def get_chunks(self, docnums):
         """
         Smart function that implements chunking the content
         but not overlap chunks so it doesn't highlight the same
         close occurrences twice.
+
+        Returns mapping of ``docnums`` to chunks of their content around the
+        first ``max_fragments`` matches, found from character positions
+        stored in the index by moving a single matcher forward.
         """
-        memory = [(0, 0)]
-        if self.matcher.supports('positions'):
-            for span in self.matcher.spans():
+        chunks = {}
+        matcher = self.query.matcher(self.searcher)
+        if not matcher.supports('positions'):
+            return chunks
+        for docnum in sorted(docnums):
+            if not matcher.is_active():
+                break
+            if matcher.id() < docnum:
+                matcher.skip_to(docnum)
+                if not matcher.is_active():
+                    break
+            if matcher.id() != docnum:
+                continue
+            memory = [(0, 0)]
+            for span in matcher.spans()[:self.max_fragments]:
                 start = span.startchar or 0
                 end = span.endchar or 0
                 start_offseted = max(0, start - self.fragment_size)
@@ -181,7 +294,8 @@ class WhooshResultWrapper(object):
                 if start_offseted < memory[-1][1]:
                     start_offseted = memory[-1][1]
                 memory.append((start_offseted, end_offseted,))
-                yield (start_offseted, end_offseted,)
+            chunks[docnum] = memory[1:]
+        return chunks
 
     def highlight(self, content, top=5):
         if self.search_type not in ['content', 'message']:
@@ -31,6 +31,7 @@ import os
 import sys
 import logging
 import traceback
+import multiprocessing
 
 from shutil import rmtree
 from time import mktime
@@ -47,17 +48,127 @@ from kallithea.model.scm import ScmModel
 from kallithea.model.db import Repository
 from kallithea.lib.utils2 import safe_unicode, safe_str
 from kallithea.lib.indexers import SCHEMA, IDX_NAME, CHGSETS_SCHEMA, \
-    CHGSET_IDX_NAME
+    CHGSET_IDX_NAME, INDEXED_REVS_SCHEMA, INDEXED_REVS_IDX_NAME
 
+from kallithea.lib.vcs.backends import get_backend
 from kallithea.lib.vcs.exceptions import ChangesetError, RepositoryError, \
     NodeDoesNotExistError
 
 from whoosh.index import create_in, open_dir, exists_in
+from whoosh.writing import SegmentWriter
 from whoosh.query import *
 from whoosh.qparser import QueryParser
 
 log = logging.getLogger('whoosh_indexer')
 
+# daemon running a parallel indexing and index written by it, inherited by
+# forked pool workers
+_parallel_daemon = None
+_parallel_index = None
+
+
+def _run_job(job):
+    """
+    Runs indexing ``job`` of ``_parallel_daemon`` in a pool worker, see
+    ``WhooshIndexingDaemon._run_job``.
+    """
+    method, repo_name, args = job
+    try:
+        repo = _parallel_daemon.repo_paths[repo_name]
+        # instances opened before fork share file offsets with the parent
+        repo = get_backend(repo.alias)(safe_str(repo.path))
+    except Exception:
+        return repo_name, None, None, None, traceback.format_exc()
+    return _parallel_daemon._run_job(_parallel_index, job, repo)
+
+
+class _IndexWriter(object):
+    """
+    Whoosh writer of index ``idx`` extended by deletion of all documents of
+    a repository, committing also segments written by indexing jobs.
+    """
+
+    def __init__(self, idx, writer):
+        self.idx = idx
+        self.writer = writer
+        # repositories whose documents are deleted on commit
+        self.deleted_repos = set()
+        # segments of successful jobs
+        self.segments = []
+
+    def delete_repository(self, repo_name):
+        self.deleted_repos.add(safe_unicode(repo_name))
+
+    def add_job(self, segment, deletions):
+        """
+        Adds ``segment`` and ``deletions`` of a successful job, as returned by
+        ``_JobWriter.finish``, to be committed.
+        """
+        with self.writer.searcher() as searcher:
+            for method, args in deletions:
+                if method == 'delete_repository':
+                    self.delete_repository(*args)
+                else:
+                    self.writer.delete_by_term(*args, searcher=searcher)
+        if segment is not None:
+            self.segments.append(segment)
+
+    def commit(self, **kwargs):
+        """
+        Deletes documents of all repositories passed to ``delete_repository``
+        in a single pass over the index and commits the writer together with
+        segments of jobs. Documents added by jobs are not affected by the
+        deletion.
+        """
+        writer = self.writer
+        if self.deleted_repos:
+            with writer.reader() as reader:
+                for docnum, fields in reader.iter_docs():
+                    if fields['repository'] in self.deleted_repos:
+                        writer.delete_document(docnum)
+        # like whoosh.multiproc.MpWriter with multisegment, small segments
+        # are merged by the merge policy
+        writer.segments.extend(self.segments)
+        writer._setup_doc_offsets()
+        writer.commit(**kwargs)
+
+
+class _JobWriter(object):
+    """
+    Writer of a single indexing job: documents are written to a new segment
+    of index ``idx`` without taking its lock, deletions are recorded. Both
+    are committed by ``_IndexWriter`` of the process holding the lock only if
+    the job succeeds.
+    """
+
+    def __init__(self, idx):
+        self.writer = SegmentWriter(idx, _lk=False)
+        self.deletions = []
+
+    def add_document(self, **fields):
+        self.writer.add_document(**fields)
+
+    def delete_by_term(self, fieldname, text):
+        self.deletions.append(('delete_by_term', (fieldname, text)))
+
+    def delete_repository(self, repo_name):
+        self.deletions.append(('delete_repository', (repo_name,)))
+
+    def finish(self):
+        """
+        Returns tuple of the written segment, None if there are no documents,
+        and recorded deletions.
+        """
+        if not self.writer.doc_count():
+            self.cancel()
+            return None, self.deletions
+        return self.writer._finalize_segment(), self.deletions
+
+    def cancel(self):
+        # files of the segment are removed by the next commit of the index;
+        # temporary storage is shared with other writers and is kept
+        self.writer._close_segment()
+
 
 class WhooshIndexingDaemon(object):
     """
@@ -66,18 +177,26 @@ class WhooshIndexingDaemon(object):
 
     def __init__(self, indexname=IDX_NAME, index_location=None,
                  repo_location=None, sa=None, repo_list=None,
-                 repo_update_list=None):
+                 repo_update_list=None, workers=1, repos=None):
+        """
+        :param repos: dict of repository instances by name to index instead
+          of repositories found in ``repo_location``
+        """
         self.indexname = indexname
+        # number of processes producing documents of repositories
+        self.workers = workers
 
         self.index_location = index_location
         if not index_location:
             raise Exception('You have to provide index location')
 
         self.repo_location = repo_location
-        if not repo_location:
+        if repos is not None:
+            self.repo_paths = repos
+        elif not repo_location:
             raise Exception('You have to provide repositories location')
-
-        self.repo_paths = ScmModel(sa).repo_scan(self.repo_location)
+        else:
+            self.repo_paths = ScmModel(sa).repo_scan(self.repo_location)
 
         #filter repo list
         if repo_list:
@@ -127,14 +246,14 @@ class WhooshIndexingDaemon(object):
         cs = repo.get_changeset(index_rev)
         return cs
 
-    def get_paths(self, repo):
+    def get_paths(self, repo, index_rev=None):
         """
         recursive walk in root dir and return a set of all path in that dir
         based on repository walk function
         """
         index_paths_ = set()
         try:
-            cs = self._get_index_changeset(repo)
+            cs = self._get_index_changeset(repo, index_rev=index_rev)
             for _topnode, _dirs, files in cs.walk('/'):
                 for f in files:
                     index_paths_.add(jn(safe_str(repo.path), safe_str(f.path)))
@@ -247,19 +366,21 @@ class WhooshIndexingDaemon(object):
         log.debug('indexed %d changesets for repo %s' % (indexed, repo_name))
         return indexed
 
-    def index_files(self, file_idx_writer, repo_name, repo):
+    def index_files(self, file_idx_writer, repo_name, repo, index_rev=None):
         """
         Index files for given repo_name
 
         :param file_idx_writer: the whoosh index writer to add to
         :param repo_name: name of the repository we're indexing
         :param repo: instance of vcs repo
+        :param index_rev: revision to index, landing revision by default
         """
         i_cnt = iwc_cnt = 0
+        if index_rev is None:
+            index_rev = self._get_index_revision(repo)
         log.debug('building index for %s @revision:%s' % (repo.path,
-                                                self._get_index_revision(repo)))
-        index_rev = self._get_index_revision(repo)
-        for idx_path in self.get_paths(repo):
+                                                          index_rev))
+        for idx_path in self.get_paths(repo, index_rev):
             i, iwc = self.add_doc(file_idx_writer, idx_path, repo, repo_name, index_rev)
             i_cnt += i
             iwc_cnt += iwc
@@ -268,15 +389,91 @@ class WhooshIndexingDaemon(object):
                   (i_cnt + iwc_cnt, iwc_cnt, repo.path))
         return i_cnt, iwc_cnt
 
+    def _run_job(self, idx, job, repo):
+        """
+        Runs indexing ``job`` on ``repo`` with ``_JobWriter`` of index
+        ``idx``; returns tuple of repository name, written segment, recorded
+        deletions, result of the job and formatted exception if it failed.
+        """
+        method, repo_name, args = job
+        writer = _JobWriter(idx)
+        try:
+            result = getattr(self, method)(writer, repo_name, repo, *args)
+            segment, deletions = writer.finish()
+        except Exception:
+            writer.cancel()
+            return repo_name, None, None, None, traceback.format_exc()
+        return repo_name, segment, deletions, result, None
+
+    def _run_jobs(self, writer, jobs):
+        """
+        Runs indexing ``jobs``, tuples of (method name, repository name,
+        extra arguments), for ``_IndexWriter`` ``writer``. Every job writes
+        its documents to its own segment of the index, which is committed by
+        ``writer`` together with deletions of the job only if it succeeds.
+        With more than one worker, jobs run in a pool of processes.
+
+        Failure of one repository is logged and doesn't stop the others;
+        returns dict of results of successful jobs by repository name.
+        """
+        global _parallel_daemon, _parallel_index
+        results = {}
+        total = len(jobs)
+        workers = min(self.workers, total)
+        if workers > 1 and os.name == 'nt':
+            log.warning('parallel indexing is not supported on windows')
+            workers = 1
+        elif workers > 1 and multiprocessing.current_process().daemon:
+            # i.e. celery workers, which are not allowed to have children
+            log.warning('parallel indexing is not possible in daemon process')
+            workers = 1
+
+        def report(done, repo_name, error):
+            if error is not None:
+                log.error('indexing of %s failed: %s' % (repo_name, error))
+            log.info('indexed %s of %s repositories (%s)' % (done, total,
+                                                              repo_name))
+
+        if workers > 1:
+            # workers are forked and inherit this daemon
+            _parallel_daemon = self
+            _parallel_index = writer.idx
+            pool = multiprocessing.Pool(workers)
+            try:
+                done = 0
+                for repo_name, segment, deletions, result, error in \
+                        pool.imap_unordered(_run_job, jobs):
+                    if error is None:
+                        writer.add_job(segment, deletions)
+                        results[repo_name] = result
+                    done += 1
+                    report(done, repo_name, error)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+                _parallel_daemon = _parallel_index = None
+        else:
+            for done, job in enumerate(jobs):
+                repo_name, segment, deletions, result, error = \
+                    self._run_job(writer.idx, job, self.repo_paths[job[1]])
+                if error is None:
+                    writer.add_job(segment, deletions)
+                    results[repo_name] = result
+                report(done + 1, repo_name, error)
+        return results
+
     def update_changeset_index(self):
         idx = open_dir(self.index_location, indexname=CHGSET_IDX_NAME)
 
         with idx.searcher() as searcher:
             writer = idx.writer()
+            index_writer = _IndexWriter(idx, writer)
             writer_is_dirty = False
             try:
-                indexed_total = 0
-                repo_name = None
+                jobs = []
+                # raw ids of the previous last changeset(s) of repositories
+                last_ids = {}
                 for repo_name, repo in self.repo_paths.items():
                     # skip indexing if there aren't any revs in the repo
                     num_of_revs = len(repo)
@@ -300,110 +497,163 @@ class WhooshIndexingDaemon(object):
 
                     # there are new changesets to index or a new repo to index
                     if last_rev == 0 or num_of_revs > last_rev + 1:
-                        # delete the docs in the index for the previous
-                        # last changeset(s)
-                        for hit in results:
-                            q = qp.parse(u"last:t AND %s AND raw_id:%s" %
-                                            (repo_name, hit['raw_id']))
-                            writer.delete_by_query(q)
-
+                        last_ids[repo_name] = [hit['raw_id']
+                                               for hit in results]
                         # index from the previous last changeset + all new ones
-                        indexed_total += self.index_changesets(writer,
-                                                repo_name, repo, start_id)
+                        jobs.append(('index_changesets', repo_name,
+                                     (start_id,)))
                         writer_is_dirty = True
-                log.debug('indexed %s changesets for repo %s' % (
-                          indexed_total, repo_name)
-                )
+                indexed = self._run_jobs(index_writer, jobs)
+                # delete the docs in the index for the previous last
+                # changeset(s) of successfully indexed repositories; new docs
+                # are in segments of the jobs, not affected before commit
+                for repo_name in indexed:
+                    for raw_id in last_ids[repo_name]:
+                        q = qp.parse(u"last:t AND %s AND raw_id:%s" %
+                                        (repo_name, raw_id))
+                        writer.delete_by_query(q)
+                log.debug('indexed %s changesets' % sum(indexed.values()))
             finally:
                 if writer_is_dirty:
                     log.debug('>> COMMITING CHANGES TO CHANGESET INDEX<<')
-                    writer.commit(merge=True)
+                    index_writer.commit(merge=True)
                     log.debug('>>> FINISHED REBUILDING CHANGESET INDEX <<<')
                 else:
                     log.debug('>> NOTHING TO COMMIT TO CHANGESET INDEX<<')
 
+    def _get_indexed_revisions(self):
+        """
+        Returns dict mapping repository names to the last revision the file
+        index was updated to, created empty if it doesn't exist yet.
+        """
+        if not exists_in(self.index_location, INDEXED_REVS_IDX_NAME):
+            create_in(self.index_location, INDEXED_REVS_SCHEMA,
+                      indexname=INDEXED_REVS_IDX_NAME)
+            return {}
+        idx = open_dir(self.index_location, indexname=INDEXED_REVS_IDX_NAME)
+        with idx.reader() as reader:
+            return dict((fields['repository'], fields['raw_id'])
+                        for _docnum, fields in reader.iter_docs())
+
+    def _set_indexed_revisions(self, indexed_revs):
+        """
+        Records revisions of repositories in ``indexed_revs`` dict as
+        indexed in the file index.
+        """
+        if not indexed_revs:
+            return
+        idx = open_dir(self.index_location, indexname=INDEXED_REVS_IDX_NAME)
+        writer = idx.writer()
+        for repo_name, raw_id in indexed_revs.items():
+            writer.update_document(repository=safe_unicode(repo_name),
+                                   raw_id=unicode(raw_id))
+        writer.commit()
+
+    def _get_repo_path(self, repo, path):
+        return safe_unicode(jn(safe_str(repo.path), safe_str(path)))
+
+    def update_repo_files(self, writer, repo_name, repo, index_rev, last_rev):
+        """
+        Updates documents of files of ``repo`` which differ between
+        ``last_rev`` and ``index_rev``, or of all its files if ``last_rev``
+        is None or no longer exists. Returns the same counters as
+        ``index_files``.
+        """
+        changes = None
+        if last_rev is not None:
+            try:
+                changes = repo.get_changed_paths(last_rev, index_rev)
+            except (ChangesetError, RepositoryError):
+                # i.e. the indexed revision was stripped
+                log.debug(traceback.format_exc())
+        if changes is None:
+            log.debug('reindexing all files of %s' % repo_name)
+            writer.delete_repository(repo_name)
+            cs = self._get_index_changeset(repo, index_rev)
+            added = [f.path for _topnode, _dirs, files in cs.walk('/')
+                     for f in files]
+            changed = removed = []
+        else:
+            added, changed, removed = changes
+            log.debug('%s files added, %s changed and %s removed in '
+                      '%s since %s' % (len(added), len(changed),
+                      len(removed), repo_name, last_rev))
+
+        i_cnt = iwc_cnt = 0
+        # added paths are deleted too, in case a previous update was
+        # interrupted before it recorded its revision
+        for path in added + changed + removed:
+            writer.delete_by_term('fileid', self._get_repo_path(repo, path))
+        for path in added + changed:
+            path = self._get_repo_path(repo, path)
+            try:
+                i, iwc = self.add_doc(writer, path, repo, repo_name,
+                                      index_rev)
+            except (ChangesetError, NodeDoesNotExistError):
+                # submodules and other non file nodes
+                log.debug('skipping %s' % path)
+                continue
+            log.debug('re indexing %s' % path)
+            i_cnt += i
+            iwc_cnt += iwc
+        log.debug('added %s files %s with content for repo %s' % (
+                     i_cnt + iwc_cnt, iwc_cnt, repo.path)
+        )
+        return i_cnt, iwc_cnt
+
     def update_file_index(self):
+        """
+        Updates file index of repositories to their index revisions. Only
+        files which differ between the tree of the last indexed revision and
+        the tree of the index revision are touched; repositories without
+        recorded revision are indexed again from scratch.
+        """
         log.debug((u'STARTING INCREMENTAL INDEXING UPDATE FOR EXTENSIONS %s '
                    'AND REPOS %s') % (INDEX_EXTENSIONS, self.repo_paths.keys()))
 
         idx = open_dir(self.index_location, indexname=self.indexname)
-        # The set of all paths in the index
-        indexed_paths = set()
-        # The set of all paths we need to re-index
-        to_index = set()
+        indexed_revs = self._get_indexed_revisions()
+        # revisions indexed by this update
+        new_revs = {}
 
         writer = idx.writer()
+        index_writer = _IndexWriter(idx, writer)
         writer_is_dirty = False
         try:
-            with idx.reader() as reader:
-
-                # Loop over the stored fields in the index
-                for fields in reader.all_stored_fields():
-                    indexed_path = fields['path']
-                    indexed_repo_path = fields['repository']
-                    indexed_paths.add(indexed_path)
-
-                    if not indexed_repo_path in self.filtered_repo_update_paths:
-                        continue
-
-                    repo = self.repo_paths[indexed_repo_path]
-
-                    try:
-                        node = self.get_node(repo, indexed_path)
-                        # Check if this file was changed since it was indexed
-                        indexed_time = fields['modtime']
-                        mtime = self.get_node_mtime(node)
-                        if mtime > indexed_time:
-                            # The file has changed, delete it and add it to
-                            # the list of files to reindex
-                            log.debug(
-                                'adding to reindex list %s mtime: %s vs %s' % (
-                                    indexed_path, mtime, indexed_time)
-                            )
-                            writer.delete_by_term('fileid', indexed_path)
-                            writer_is_dirty = True
-
-                            to_index.add(indexed_path)
-                    except (ChangesetError, NodeDoesNotExistError):
-                        # This file was deleted since it was indexed
-                        log.debug('removing from index %s' % indexed_path)
-                        writer.delete_by_term('path', indexed_path)
-                        writer_is_dirty = True
-
-            # Loop over the files in the filesystem
-            # Assume we have a function that gathers the filenames of the
-            # documents to be indexed
-            ri_cnt_total = 0  # indexed
-            riwc_cnt_total = 0  # indexed with content
+            jobs = []
             for repo_name, repo in self.repo_paths.items():
                 # skip indexing if there aren't any revisions
                 if len(repo) < 1:
                     continue
-                ri_cnt = 0   # indexed
-                riwc_cnt = 0  # indexed with content
-                for path in self.get_paths(repo):
-                    path = safe_unicode(path)
-                    if path in to_index or path not in indexed_paths:
-
-                        # This is either a file that's changed, or a new file
-                        # that wasn't indexed before. So index it!
-                        i, iwc = self.add_doc(writer, path, repo, repo_name)
-                        writer_is_dirty = True
-                        log.debug('re indexing %s' % path)
-                        ri_cnt += i
-                        ri_cnt_total += 1
-                        riwc_cnt += iwc
-                        riwc_cnt_total += iwc
-                log.debug('added %s files %s with content for repo %s' % (
-                             ri_cnt + riwc_cnt, riwc_cnt, repo.path)
-                )
+                try:
+                    cs = self._get_index_changeset(repo)
+                except (ChangesetError, RepositoryError):
+                    log.error('cannot get index revision of %s' % repo_name)
+                    log.debug(traceback.format_exc())
+                    continue
+                last_rev = indexed_revs.get(safe_unicode(repo_name))
+                if last_rev == cs.raw_id:
+                    log.debug('file index of %s is up to date' % repo_name)
+                    continue
+                new_revs[repo_name] = cs.raw_id
+                jobs.append(('update_repo_files', repo_name,
+                             (cs.raw_id, last_rev)))
+                writer_is_dirty = True
+
+            indexed = self._run_jobs(index_writer, jobs)
+            # failed repositories are updated from their old revision again
+            for repo_name in new_revs.keys():
+                if repo_name not in indexed:
+                    del new_revs[repo_name]
             log.debug('indexed %s files in total and %s with content' % (
-                        ri_cnt_total, riwc_cnt_total)
+                        sum(i + iwc for i, iwc in indexed.values()),
+                        sum(iwc for i, iwc in indexed.values()))
             )
         finally:
             if writer_is_dirty:
                 log.debug('>> COMMITING CHANGES TO FILE INDEX <<')
-                writer.commit(merge=True)
+                index_writer.commit(merge=True)
+                self._set_indexed_revisions(new_revs)
                 log.debug('>>> FINISHED REBUILDING FILE INDEX <<<')
             else:
                 log.debug('>> NOTHING TO COMMIT TO FILE INDEX <<')
@@ -419,24 +669,43 @@ class WhooshIndexingDaemon(object):
 
         chgset_idx = create_in(self.index_location, CHGSETS_SCHEMA,
                                indexname=CHGSET_IDX_NAME)
-        chgset_idx_writer = chgset_idx.writer()
+        chgset_idx_writer = _IndexWriter(chgset_idx, chgset_idx.writer())
 
         file_idx = create_in(self.index_location, SCHEMA, indexname=IDX_NAME)
-        file_idx_writer = file_idx.writer()
+        file_idx_writer = _IndexWriter(file_idx, file_idx.writer())
+        create_in(self.index_location, INDEXED_REVS_SCHEMA,
+                  indexname=INDEXED_REVS_IDX_NAME)
+        indexed_revs = {}
         log.debug('BUILDING INDEX FOR EXTENSIONS %s '
                   'AND REPOS %s' % (INDEX_EXTENSIONS, self.repo_paths.keys()))
 
+        file_jobs = []
+        chgset_jobs = []
         for repo_name, repo in self.repo_paths.items():
             # skip indexing if there aren't any revisions
             if len(repo) < 1:
                 continue
+            try:
+                index_rev = self._get_index_changeset(repo).raw_id
+            except (ChangesetError, RepositoryError):
+                log.error('cannot get index revision of %s' % repo_name)
+                log.debug(traceback.format_exc())
+                continue
+            indexed_revs[repo_name] = index_rev
+            file_jobs.append(('index_files', repo_name, (index_rev,)))
+            chgset_jobs.append(('index_changesets', repo_name, ()))
 
-            self.index_files(file_idx_writer, repo_name, repo)
-            self.index_changesets(chgset_idx_writer, repo_name, repo)
+        indexed = self._run_jobs(file_idx_writer, file_jobs)
+        # failed repositories are indexed from scratch by the next update
+        for repo_name in indexed_revs.keys():
+            if repo_name not in indexed:
+                del indexed_revs[repo_name]
+        self._run_jobs(chgset_idx_writer, chgset_jobs)
 
         log.debug('>> COMMITING CHANGES <<')
         file_idx_writer.commit(merge=True)
         chgset_idx_writer.commit(merge=True)
+        self._set_indexed_revisions(indexed_revs)
         log.debug('>>> FINISHED BUILDING INDEX <<<')
 
     def update_indexes(self):
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.indexers.queue
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Queue of repositories waiting for an update of the search index, filled on
+push and consumed by ``make-index --watch``
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import os
+import time
+import errno
+import urllib
+import logging
+
+from os.path import dirname as dn
+
+from kallithea.lib.utils2 import safe_str, safe_unicode, safe_int
+
+log = logging.getLogger(__name__)
+
+#: seconds without a push before a repository is indexed
+DEFAULT_DELAY = 5
+#: seconds after the first push a repository is indexed at the latest, even
+#: if pushes keep coming
+DEFAULT_MAX_DELAY = 60
+
+
+def get_queue_dir(index_location):
+    """
+    Returns directory of the queue used with index in ``index_location``;
+    it is kept next to the index, which is removed by full builds.
+    """
+    return os.path.join(dn(index_location), 'index_queue')
+
+
+class IndexUpdateQueue(object):
+    """
+    Repositories waiting for an index update, one marker file per
+    repository in ``queue_dir``. Pushes only create or touch the marker, so
+    bursts of pushes to one repository coalesce into a single update; the
+    marker keeps time of the first push, its modification time is the time
+    of the last one.
+    """
+
+    def __init__(self, queue_dir):
+        self.queue_dir = queue_dir
+
+    def _get_path(self, repo_name):
+        return os.path.join(self.queue_dir,
+                            urllib.quote(safe_str(repo_name), safe=''))
+
+    def enqueue(self, repo_name):
+        if not os.path.isdir(self.queue_dir):
+            try:
+                os.makedirs(self.queue_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        path = self._get_path(repo_name)
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            os.utime(path, None)
+            return
+        try:
+            os.write(fd, repr(time.time()))
+        finally:
+            os.close(fd)
+
+    def __len__(self):
+        try:
+            return len(os.listdir(self.queue_dir))
+        except OSError:
+            return 0
+
+    def pop_ready(self, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                  now=None):
+        """
+        Removes from the queue and returns names of repositories which
+        weren't pushed to for ``delay`` seconds or have been waiting for
+        ``max_delay`` seconds.
+
+        Markers are removed before the repositories are indexed, so pushes
+        made during indexing queue them again.
+        """
+        if now is None:
+            now = time.time()
+        try:
+            names = os.listdir(self.queue_dir)
+        except OSError:
+            return []
+        ready = []
+        for name in names:
+            path = os.path.join(self.queue_dir, name)
+            try:
+                last_push = os.stat(path).st_mtime
+                with open(path) as f:
+                    first_push = float(f.read() or last_push)
+            except (IOError, OSError, ValueError):
+                continue
+            if now - last_push < delay and now - first_push < max_delay:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            ready.append(safe_unicode(urllib.unquote(name)))
+        return ready
+
+
+def watch_queue(index_location, config, workers=1, poll_interval=1,
+                once=False):
+    """
+    Applies incremental updates of file and changeset index to
+    repositories popped from the queue of ``index_location``, and fills in
+    their changeset metadata left out by push hooks, until
+    interrupted or, with ``once``, until the queue is empty or an update
+    fails. Repositories of a failed update are queued again. Delays are
+    taken from ``index_update_delay`` and ``index_update_max_delay``
+    settings in ``config``.
+    """
+    from kallithea.lib.pidlock import LockHeld, DaemonLock
+    from kallithea.lib.indexers.daemon import WhooshIndexingDaemon
+    from kallithea.model.db import Repository
+    from kallithea.model.meta import Session
+
+    queue = IndexUpdateQueue(get_queue_dir(index_location))
+    delay = safe_int(config.get('index_update_delay'), DEFAULT_DELAY)
+    max_delay = safe_int(config.get('index_update_max_delay'),
+                         DEFAULT_MAX_DELAY)
+    log.info('watching index update queue in %s' % queue.queue_dir)
+    while True:
+        if not len(queue):
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+        try:
+            lock = DaemonLock(file_=os.path.join(dn(dn(index_location)),
+                                                 'make_index.lock'))
+        except LockHeld:
+            # full build or another update is running, retry later
+            time.sleep(poll_interval)
+            continue
+        ready = []
+        failed = False
+        try:
+            if once:
+                ready = queue.pop_ready(0, 0)
+            else:
+                ready = queue.pop_ready(delay, max_delay)
+            repos = {}
+            for repo_name in ready:
+                db_repo = Repository.get_by_repo_name(repo_name)
+                if db_repo is None:
+                    log.debug('skipping unknown repository %s' % repo_name)
+                    continue
+                scm_repo = db_repo.scm_instance_no_cache()
+                # push hooks fill changeset metadata only partially
+                try:
+                    scm_repo.update_changeset_metadata()
+                except Exception:
+                    log.error('update of changeset metadata of %s failed'
+                              % repo_name, exc_info=True)
+                repos[db_repo.repo_name] = scm_repo
+            if repos:
+                daemon = WhooshIndexingDaemon(index_location=index_location,
+                                              repos=repos, workers=workers)
+                if daemon.initial:
+                    log.warning('search index does not exist yet, run '
+                                'make-index first; skipping update of %s'
+                                % ', '.join(repos))
+                else:
+                    log.info('updating search index of %s'
+                             % ', '.join(repos))
+                    daemon.update_indexes()
+        except Exception:
+            log.error('index update failed, queueing %s again'
+                      % ', '.join(ready), exc_info=True)
+            failed = True
+            for repo_name in ready:
+                try:
+                    queue.enqueue(repo_name)
+                except OSError, e:
+                    log.error('cannot queue %s again: %s' % (repo_name, e))
+        finally:
+            lock.release()
+            Session.remove()
+        if once:
+            if failed:
+                break
+        else:
+            time.sleep(poll_interval)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.invalidation
+~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Notifiers telling worker processes about invalidated repository caches
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import os
+import mmap
+import struct
+import logging
+import binascii
+import threading
+
+from kallithea.lib.utils2 import safe_str
+from kallithea.lib.vcs.utils.imports import import_class
+
+log = logging.getLogger(__name__)
+
+DEFAULT_NOTIFIER = 'kallithea.lib.invalidation.DatabaseNotifier'
+
+
+class BaseNotifier(object):
+    """
+    Spreads invalidations of repository caches. ``CacheInvalidation`` calls
+    ``notify`` for every invalidated repository and asks ``get_generation``
+    whether caches of a repository are still valid.
+    """
+
+    def __init__(self, **config):
+        pass
+
+    def notify(self, repo_name):
+        """
+        Tells other processes that caches of ``repo_name`` are invalid.
+        """
+        raise NotImplementedError
+
+    def get_generation(self, repo_name):
+        """
+        Returns number changing with every invalidation of ``repo_name`` or
+        None if generation stored in the database should be used.
+        """
+        raise NotImplementedError
+
+
+class DatabaseNotifier(BaseNotifier):
+    """
+    Relies on generation counters stored in the database only, which are
+    read once per database session; works for any number of hosts.
+    """
+
+    def notify(self, repo_name):
+        pass
+
+    def get_generation(self, repo_name):
+        return None
+
+
+class SharedMemoryNotifier(BaseNotifier):
+    """
+    Keeps generation counters in a memory mapped file shared by all
+    processes of a single host, so checking them needs no database access at
+    all. Repositories are hashed into a fixed number of slots; collisions
+    only cause some extra invalidations.
+
+    Requires ``cache_invalidation_notifier.path`` setting; posix only.
+    """
+
+    SLOTS = 4096
+    SLOT = struct.Struct('<I')
+
+    def __init__(self, path=None, **config):
+        if not path:
+            raise ValueError('path of %s is not configured'
+                             % self.__class__.__name__)
+        size = self.SLOTS * self.SLOT.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        self._lock_path = '%s.lock' % path
+
+    def _offset(self, repo_name):
+        slot = (binascii.crc32(safe_str(repo_name)) & 0xffffffff) % self.SLOTS
+        return slot * self.SLOT.size
+
+    def notify(self, repo_name):
+        import fcntl
+        offset = self._offset(repo_name)
+        lock = open(self._lock_path, 'a')
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            generation = self.SLOT.unpack_from(self._map, offset)[0]
+            self.SLOT.pack_into(self._map, offset,
+                                (generation + 1) & 0xffffffff)
+        finally:
+            lock.close()
+
+    def get_generation(self, repo_name):
+        return self.SLOT.unpack_from(self._map, self._offset(repo_name))[0]
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    """
+    Returns process wide notifier configured by ``cache_invalidation_notifier``
+    setting; options for it are taken from settings prefixed with
+    ``cache_invalidation_notifier.``.
+    """
+    global _notifier
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                import kallithea
+                prefix = 'cache_invalidation_notifier.'
+                config = dict((k[len(prefix):], v)
+                              for k, v in kallithea.CONFIG.items()
+                              if k.startswith(prefix))
+                name = kallithea.CONFIG.get('cache_invalidation_notifier',
+                                            DEFAULT_NOTIFIER)
+                try:
+                    _notifier = import_class(name)(**config)
+                except Exception, e:
+                    log.error('Cannot set up cache invalidation notifier '
+                              '%s: %s, falling back to database' % (name, e))
+                    _notifier = DatabaseNotifier()
+    return _notifier
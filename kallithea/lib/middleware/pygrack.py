@@ -6,6 +6,8 @@ import traceback
 from webob import Request, Response, exc
 
 import kallithea
+from kallithea.lib.utils2 import safe_int
+from kallithea.lib.refs_cache import get_refs_cache
 from kallithea.lib.vcs import subprocessio
 
 log = logging.getLogger(__name__)
@@ -61,6 +63,32 @@ class GitRepository(object):
         """
         return path.split(self.repo_name, 1)[-1].strip('/')
 
+    def _run_git(self, command, flags, inputstream=None, starting_values=[],
+                 **opts):
+        """
+        Returns iterable over output of git ``command`` with ``flags`` run
+        on this repository, served by engine selected by ``git_http_engine``
+        setting: ``threads`` or ``poll``, which doesn't need any threads but
+        is available on posix only. Size of chunks is set by
+        ``git_http_buffer_size``.
+        """
+        _git_path = kallithea.CONFIG.get('git_path', 'git')
+        buffer_size = safe_int(kallithea.CONFIG.get('git_http_buffer_size'),
+                               65536)
+        if (kallithea.CONFIG.get('git_http_engine') == 'poll' and
+            subprocessio.POLLING_AVAILABLE):
+            return subprocessio.PollingSubprocessIO(
+                [_git_path, command] + flags + [self.content_path],
+                inputstream=inputstream,
+                buffer_size=buffer_size, starting_values=starting_values,
+                **opts)
+        cmd = r'%s %s %s "%s"' % (_git_path, command, ' '.join(flags),
+                                  self.content_path)
+        log.debug('handling cmd %s' % cmd)
+        return subprocessio.SubprocessIOChunker(
+            cmd, inputstream=inputstream, buffer_size=buffer_size,
+            starting_values=starting_values, **opts)
+
     def inforefs(self, request, environ):
         """
         WSGI Response producer for HTTP GET Git Smart
@@ -79,24 +107,34 @@ class GitRepository(object):
         # blows up if you sprinkle "flush" (0000) as "0001\n".
         # It reads binary, per number of bytes specified.
         # if you do add '\n' as part of data, count it.
-        server_advert = '# service=%s' % git_command
+        server_advert = '# service=%s' % str(git_command)
         packet_len = str(hex(len(server_advert) + 4)[2:].rjust(4, '0')).lower()
-        _git_path = kallithea.CONFIG.get('git_path', 'git')
+        create = lambda: self._run_git(
+            git_command[4:], ['--stateless-rpc', '--advertise-refs'],
+            starting_values=[
+                packet_len + server_advert + '0000'
+            ]
+        )
+        # refs advertised for fetching are cached until the next push, pushes
+        # always get the current refs
+        refs_cache = None
+        if git_command == 'git-upload-pack':
+            refs_cache = get_refs_cache()
+        resp = Response()
         try:
-            out = subprocessio.SubprocessIOChunker(
-                r'%s %s --stateless-rpc --advertise-refs "%s"' % (
-                    _git_path, git_command[4:], self.content_path),
-                starting_values=[
-                    packet_len + server_advert + '0000'
-                ]
-            )
+            if refs_cache is not None:
+                etag, resp.body = refs_cache.get(self.content_path,
+                                                 str(git_command), create)
+                resp.etag = etag
+                resp.conditional_response = True
+            else:
+                resp.app_iter = create()
         except EnvironmentError, e:
             log.error(traceback.format_exc())
             raise exc.HTTPExpectationFailed()
-        resp = Response()
         resp.content_type = 'application/x-%s-advertisement' % str(git_command)
         resp.charset = None
-        resp.app_iter = out
+        resp.cache_control.no_cache = True
         return resp
 
     def backend(self, request, environ):
@@ -106,7 +144,6 @@ class GitRepository(object):
         returns an iterator obj with contents of git command's
         response to stdout
         """
-        _git_path = kallithea.CONFIG.get('git_path', 'git')
         git_command = self._get_fixedpath(request.path_info)
         if git_command not in self.commands:
             log.debug('command %s not allowed' % git_command)
@@ -126,11 +163,8 @@ class GitRepository(object):
                 env=gitenv,
                 cwd=self.content_path,
             )
-            cmd = r'%s %s --stateless-rpc "%s"' % (_git_path, git_command[4:],
-                                                   self.content_path),
-            log.debug('handling cmd %s' % cmd)
-            out = subprocessio.SubprocessIOChunker(
-                cmd,
+            out = self._run_git(
+                git_command[4:], ['--stateless-rpc'],
                 inputstream=inputstream,
                 **opts
             )
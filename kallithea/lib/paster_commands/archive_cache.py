@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.paster_commands.archive_cache
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+archive-cache paster command for Kallithea
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+from __future__ import with_statement
+
+import os
+import sys
+import logging
+import string
+
+from kallithea.lib.utils import BasePasterCommand
+from kallithea.lib.utils2 import safe_str
+from kallithea.lib.vcs.conf import settings
+from kallithea.model.db import Repository
+
+# Add location of top level folder to sys.path
+from os.path import dirname as dn
+rc_path = dn(dn(dn(os.path.realpath(__file__))))
+sys.path.append(rc_path)
+
+log = logging.getLogger(__name__)
+
+
+class Command(BasePasterCommand):
+
+    max_args = 1
+    min_args = 1
+
+    usage = "CONFIG_FILE"
+    group_name = "Kallithea"
+    takes_config_file = -1
+    parser = BasePasterCommand.standard_parser(verbose=True)
+    summary = "Archive cache utils"
+
+    def command(self):
+        #get SqlAlchemy session
+        self._init_session()
+        from pylons import config
+        from kallithea.lib.archive_cache import make_archive_cache
+        from kallithea.lib.helpers import format_byte_size
+
+        cache = make_archive_cache(config)
+        if cache is None:
+            print 'archive cache is disabled, archive_cache_dir is not set'
+            sys.exit(1)
+
+        if self.options.warm_tags:
+            self._warm_tags(cache)
+        if self.options.prune:
+            print 'evicted %s archives' % cache.prune()
+        if self.options.clear:
+            cache.clear()
+            print 'removed all archives'
+        if self.options.show:
+            stats = cache.stats()
+            print 'archives: %s' % stats['archives']
+            print 'size: %s of %s (%s)' % (format_byte_size(stats['size']),
+                format_byte_size(stats['max_size'])
+                if stats['max_size'] else 'unlimited', stats['policy'])
+            print 'hit rate: %.1f%%' % (stats['hit_rate'] * 100)
+            print 'hits: %(hits)s shared: %(shared)s misses: %(misses)s ' \
+                  'evictions: %(evictions)s' % stats
+        elif not (self.options.warm_tags or self.options.prune or
+                  self.options.clear):
+            print 'nothing done exiting...'
+        sys.exit(0)
+
+    def _warm_tags(self, cache):
+        """
+        Creates archives of all tags of given repositories not yet cached.
+        """
+        from kallithea.lib.archive_cache import get_archive_name
+        formats = map(string.strip, self.options.formats.split(','))
+        for fileformat in formats:
+            if fileformat not in settings.ARCHIVE_SPECS:
+                print 'unknown archive format %s' % fileformat
+                sys.exit(1)
+        if self.options.warm_tags == '*':
+            repos = Repository.getAll()
+        else:
+            names = map(string.strip, self.options.warm_tags.split(','))
+            repos = list(Repository.query()
+                         .filter(Repository.repo_name.in_(names)))
+        for repo in repos:
+            if not repo.enable_downloads:
+                continue
+            scm_repo = repo.scm_instance_no_cache()
+            for tag, raw_id in sorted(scm_repo.tags.items()):
+                cs = scm_repo.get_changeset(raw_id)
+                for fileformat in formats:
+                    name = get_archive_name(repo.repo_name, cs.raw_id,
+                                            settings.ARCHIVE_SPECS[fileformat][1])
+                    create = lambda: cs.get_chunked_archive(kind=fileformat)
+                    try:
+                        if cache.warm(name, create):
+                            print 'created %s for tag %s' % (name,
+                                                              safe_str(tag))
+                    except Exception, e:
+                        print 'cannot create %s: %s' % (name, e)
+
+    def update_parser(self):
+        self.parser.add_option(
+            '--show',
+            action='store_true',
+            dest='show',
+            help="show size and hit rate of the archive cache"
+        )
+
+        self.parser.add_option(
+            '--prune',
+            action='store_true',
+            dest='prune',
+            help="evict archives exceeding archive_cache_size"
+        )
+
+        self.parser.add_option(
+            '--clear',
+            action='store_true',
+            dest='clear',
+            help="remove all cached archives"
+        )
+
+        self.parser.add_option(
+            '--warm-tags',
+            action='store',
+            dest='warm_tags',
+            help="comma separated list of repositories, or * for all, to "
+                 "create archives of tags not yet cached for"
+        )
+
+        self.parser.add_option(
+            '--formats',
+            action='store',
+            dest='formats',
+            default='tgz,zip',
+            help="comma separated list of archive formats created by "
+                 "--warm-tags, tgz and zip by default"
+        )
@@ -61,7 +61,8 @@ class Command(BasePasterCommand):
         _caches = CacheInvalidation.query().order_by(CacheInvalidation.cache_key).all()
         if self.options.show:
             for c_obj in _caches:
-                print 'key:%s active:%s' % (c_obj.cache_key, c_obj.cache_active)
+                print 'key:%s active:%s generation:%s' % (c_obj.cache_key,
+                    c_obj.cache_active, c_obj.cache_generation)
         elif self.options.cleanup:
             for c_obj in _caches:
                 Session().delete(c_obj)
@@ -35,6 +35,7 @@ import logging
 from string import strip
 from kallithea.model.repo import RepoModel
 from kallithea.lib.utils import BasePasterCommand, load_rcextensions
+from kallithea.lib.utils2 import safe_int
 
 # Add location of top level folder to sys.path
 from os.path import dirname as dn
@@ -69,6 +70,13 @@ class Command(BasePasterCommand):
         repo_update_list = map(strip, self.options.repo_update_list.split(',')) \
             if self.options.repo_update_list else None
 
+        workers = self.options.workers or safe_int(config.get('index_workers'), 1)
+
+        if self.options.watch:
+            from kallithea.lib.indexers.queue import watch_queue
+            watch_queue(index_location, config, workers=workers)
+            return
+
         #======================================================================
         # WHOOSH DAEMON
         #======================================================================
@@ -80,7 +88,8 @@ class Command(BasePasterCommand):
             WhooshIndexingDaemon(index_location=index_location,
                                  repo_location=repo_location,
                                  repo_list=repo_list,
-                                 repo_update_list=repo_update_list)\
+                                 repo_update_list=repo_update_list,
+                                 workers=workers)\
                 .run(full_index=self.options.full_index)
             l.release()
         except LockHeld:
@@ -105,6 +114,21 @@ class Command(BasePasterCommand):
                           help="Specifies a comma separated list of repositories "
                                 "to re-build index on. OPTIONAL",
                           )
+        self.parser.add_option('--workers',
+                          action='store',
+                          type='int',
+                          dest='workers',
+                          help="Specifies number of processes indexing "
+                                "repositories in parallel, defaults to "
+                                "index_workers setting. OPTIONAL",
+                          )
+        self.parser.add_option('--watch',
+                          action='store_true',
+                          dest='watch',
+                          help="Keeps running and incrementally updates index "
+                                "of repositories shortly after they were "
+                                "pushed to. OPTIONAL",
+                          default=False)
         self.parser.add_option('-f',
                           action='store_true',
                           dest='full_index',
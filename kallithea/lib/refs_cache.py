@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.refs_cache
+~~~~~~~~~~~~~~~~~~~~~~~~
+
+Cache of ref advertisements of git repositories served over smart http,
+so polling clients don't need a git process for every fetch
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import os
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+
+from kallithea.lib.compat import OrderedDict
+from kallithea.lib.utils2 import safe_int, safe_str, str2bool
+
+log = logging.getLogger(__name__)
+
+#: default number of advertisements kept in memory of each process
+DEFAULT_CACHE_ENTRIES = 512
+
+
+def _normpath(repo_path):
+    # the same repository is reached by paths built from different settings
+    return os.path.realpath(safe_str(repo_path))
+
+
+class RefsCache(object):
+    """
+    Ref advertisements of repositories, keyed by path of the repository and
+    git service. Every entry remembers change token of the repository (see
+    ``BaseRepository.get_change_token``) it was created for and is used only
+    while the token is unchanged; pushes through Kallithea also drop entries
+    explicitly, so updates within mtime resolution are never missed.
+
+    Entries are kept in memory of the process, at most ``max_entries`` of
+    them, and if ``cache_dir`` is set also on disk, where they are shared by
+    all processes. Entries in memory are used only while their file on disk
+    is unchanged, so invalidation made by any process is seen by all of
+    them.
+    """
+
+    def __init__(self, cache_dir=None, max_entries=DEFAULT_CACHE_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get_token(self, repo_path):
+        from kallithea.lib.vcs.backends.git import GitRepository
+        token = GitRepository.get_change_token(repo_path)
+        return hashlib.sha1(repr(token)).hexdigest()
+
+    def _get_file(self, repo_path, service):
+        if not self.cache_dir:
+            return None
+        name = hashlib.sha1(repo_path).hexdigest()
+        return os.path.join(self.cache_dir, '%s.%s' % (name, service))
+
+    def _stat(self, path):
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def _load(self, path, token):
+        try:
+            with open(path, 'rb') as f:
+                header = f.readline().split()
+                if header[:1] != [token] or len(header) != 2:
+                    return None
+                return header[1], f.read()
+        except (IOError, OSError):
+            return None
+
+    def _store(self, path, token, etag, data):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                try:
+                    os.makedirs(self.cache_dir)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write('%s %s\n' % (token, etag))
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError), e:
+            log.error('Cannot store refs advertisement %s: %s' % (path, e))
+
+    def get(self, repo_path, service, create):
+        """
+        Returns tuple of ETag and ref advertisement of ``service`` of
+        repository at ``repo_path``, cached or created by ``create``
+        callable returning iterable over the advertisement.
+        """
+        repo_path = _normpath(repo_path)
+        key = (repo_path, service)
+        path = self._get_file(repo_path, service)
+        # the token is taken before the advertisement is created, so refs
+        # updated meanwhile make the new entry stale right away
+        token = self._get_token(repo_path)
+        stat = self._stat(path)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[:2] == (token, stat):
+                self._entries[key] = entry
+                self.hits += 1
+                return entry[2], entry[3]
+        loaded = stat is not None and self._load(path, token)
+        if loaded:
+            etag, data = loaded
+            with self._lock:
+                self.hits += 1
+        else:
+            data = ''.join(create())
+            etag = hashlib.sha1(data).hexdigest()
+            if path is not None:
+                self._store(path, token, etag, data)
+                stat = self._stat(path)
+            with self._lock:
+                self.misses += 1
+        with self._lock:
+            self._entries[key] = (token, stat, etag, data)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return etag, data
+
+    def invalidate(self, repo_path):
+        """
+        Drops advertisements of all services of repository at ``repo_path``.
+        """
+        repo_path = _normpath(repo_path)
+        with self._lock:
+            for key in self._entries.keys():
+                if key[0] == repo_path:
+                    del self._entries[key]
+        if self.cache_dir:
+            prefix = hashlib.sha1(repo_path).hexdigest() + '.'
+            try:
+                names = os.listdir(self.cache_dir)
+            except OSError:
+                names = []
+            for name in names:
+                if name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, name))
+                    except OSError:
+                        pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_refs_cache():
+    """
+    Returns process wide ``RefsCache`` configured by ``git_refs_cache_dir``
+    and ``git_refs_cache_entries`` settings, or None if ``git_refs_cache``
+    is disabled.
+    """
+    global _cache
+    import kallithea
+    if not str2bool(kallithea.CONFIG.get('git_refs_cache', True)):
+        return None
+    cache_dir = kallithea.CONFIG.get('git_refs_cache_dir') or None
+    if _cache is None or _cache.cache_dir != cache_dir:
+        with _cache_lock:
+            if _cache is None or _cache.cache_dir != cache_dir:
+                _cache = RefsCache(cache_dir, max_entries=safe_int(
+                    kallithea.CONFIG.get('git_refs_cache_entries'),
+                    DEFAULT_CACHE_ENTRIES))
+    return _cache
+
+
+def invalidate_refs_cache(repo_path):
+    """
+    Drops cached ref advertisements of git repository at ``repo_path``,
+    either its working directory or the bare repository.
+    """
+    cache = get_refs_cache()
+    if cache is None:
+        return
+    for path in [repo_path, os.path.join(repo_path, '.git')]:
+        cache.invalidate(path)
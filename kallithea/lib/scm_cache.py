@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.lib.scm_cache
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Process wide cache of open scm repository instances
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import logging
+import threading
+
+from kallithea.lib.compat import OrderedDict
+from kallithea.lib.utils2 import safe_int
+
+log = logging.getLogger(__name__)
+
+#: default limit of estimated memory held by cached instances, in megabytes
+DEFAULT_CACHE_SIZE = 256
+
+
+class ScmInstanceCache(object):
+    """
+    Bounded LRU cache of backend repository instances, keyed by repository
+    path. Every entry remembers change token of the repository (see
+    ``BaseRepository.get_change_token``) it was created for; entries are
+    reused only while the token is unchanged, so changes made by other
+    processes (pushes, hooks) are noticed without any database round trip.
+
+    Least recently used instances are evicted when estimated memory footprint
+    of all cached instances exceeds ``max_size`` bytes.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path, backend, create):
+        """
+        Returns cached instance of repository at ``path`` if it is still up
+        to date, otherwise instance returned by ``create`` is cached and
+        returned.
+
+        :param backend: backend class of the repository
+        :param create: callable creating new instance
+        """
+        token = backend.get_change_token(path)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry[0] == token:
+                self._entries[path] = entry
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        repo = create()
+        with self._lock:
+            self._entries[path] = (token, repo)
+            self._evict()
+        return repo
+
+    def invalidate(self, path):
+        """
+        Drops cached instance of repository at ``path``.
+        """
+        with self._lock:
+            self._entries.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def footprint(self):
+        """
+        Returns estimated memory held by cached instances, in bytes.
+        """
+        return sum(repo.get_memory_footprint()
+                   for _token, repo in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'instances': len(self._entries),
+                'footprint': self.footprint(),
+                'max_size': self.max_size,
+            }
+
+    def _evict(self):
+        # cached instances grow while used (lazy properties), so footprint
+        # is estimated again every time
+        footprint = self.footprint()
+        # the most recently used instance is always kept
+        while footprint > self.max_size and len(self._entries) > 1:
+            path = iter(self._entries).next()
+            _token, repo = self._entries.pop(path)
+            footprint -= repo.get_memory_footprint()
+            self.evictions += 1
+            log.debug('Evicted scm instance of %s from cache' % path)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_scm_instance_cache():
+    """
+    Returns process wide ``ScmInstanceCache`` sized by
+    ``vcs_instance_cache_size`` setting (in megabytes).
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                import kallithea
+                size = safe_int(kallithea.CONFIG.get('vcs_instance_cache_size'),
+                                DEFAULT_CACHE_SIZE)
+                _cache = ScmInstanceCache(size * 1024 * 1024)
+    return _cache
@@ -54,7 +54,8 @@ from kallithea.lib.caching_query import FromCache
 
 from kallithea.model import meta
 from kallithea.model.db import Repository, User, Ui, \
-    UserLog, RepoGroup, Setting, CacheInvalidation, UserGroup
+    UserLog, UserLogRevision, RepoGroup, Setting, CacheInvalidation, \
+    UserGroup
 from kallithea.model.meta import Session
 from kallithea.model.repo_group import RepoGroupModel
 from kallithea.lib.utils2 import safe_str, safe_unicode, get_current_authuser
@@ -151,7 +152,8 @@ def get_repo_by_id(repo_name):
     return None
 
 
-def action_logger(user, action, repo, ipaddr='', sa=None, commit=False):
+def action_logger(user, action, repo, ipaddr='', sa=None, commit=False,
+                  revisions=None):
     """
     Action logger for various actions made by users
 
@@ -163,6 +165,7 @@ def action_logger(user, action, repo, ipaddr='', sa=None, commit=False):
         that action was made on
     :param ipaddr: optional ip address from what the action was made
     :param sa: optional sqlalchemy session
+    :param revisions: optional list of revisions pushed by the action
 
     """
 
@@ -201,6 +204,15 @@ def action_logger(user, action, repo, ipaddr='', sa=None, commit=False):
     user_log.action_date = datetime.datetime.now()
     user_log.user_ip = ipaddr
     sa.add(user_log)
+    if revisions is not None:
+        user_log.revisions_count = len(revisions)
+        if revisions:
+            # pushes can have many revisions, they are inserted at once
+            sa.flush()
+            sa.execute(UserLogRevision.__table__.insert(),
+                       [{'user_log_id': user_log.user_log_id,
+                         'ordinal': i, 'revision': rev}
+                        for i, rev in enumerate(revisions)])
 
     log.info('Logging action:%s on %s by user:%s ip:%s' %
              (action, safe_unicode(repo), user_obj, ipaddr))
@@ -208,6 +220,51 @@ def action_logger(user, action, repo, ipaddr='', sa=None, commit=False):
         sa.commit()
 
 
+def action_logger_async(user, action, repo, ipaddr='', revisions=None):
+    """
+    Action logger for actions which don't have to be in the database right
+    away, like pulls, pushes and downloads. If ``action_log_async`` is
+    enabled, the action is only queued and written to the database in a
+    batch by ``ActionLogWriter``, else it's logged by ``action_logger``
+    and committed.
+
+    :param user: user that made this action, username or object with
+        user_id and username attributes
+    :param action: action to log
+    :param repo: repository name or object with repo_id and repo_name
+        attributes
+    :param ipaddr: optional ip address from what the action was made
+    :param revisions: optional list of revisions pushed by the action
+    """
+    from kallithea.lib.action_log import get_action_log_writer
+    writer = get_action_log_writer()
+    if writer is None:
+        return action_logger(user, action, repo, ipaddr, commit=True,
+                             revisions=revisions)
+
+    if not ipaddr:
+        ipaddr = getattr(get_current_authuser(), 'ip_addr', '')
+
+    if getattr(user, 'user_id', None):
+        user_id, username = user.user_id, user.username
+    elif isinstance(user, basestring):
+        user_id, username = None, user
+    else:
+        raise Exception('You have to provide a user object or a username')
+
+    if getattr(repo, 'repo_id', None):
+        repo_id, repo_name = repo.repo_id, repo.repo_name
+    elif isinstance(repo, basestring):
+        repo_id, repo_name = None, repo.lstrip('/')
+    else:
+        repo_id, repo_name = None, ''
+
+    writer.log(username, action, repo_name, ipaddr, user_id=user_id,
+               repo_id=repo_id, revisions=revisions)
+    log.info('Queued action:%s on %s by user:%s ip:%s' %
+             (action, safe_unicode(repo), username, ipaddr))
+
+
 def get_filesystem_repos(path, recursive=False, skip_removed_repos=True):
     """
     Scans given path for repos and return (name,(type,path)) tuple
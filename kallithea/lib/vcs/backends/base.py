@@ -9,20 +9,46 @@
     :copyright: (c) 2010-2011 by Marcin Kuzminski, Lukasz Balcerzak.
 """
 
+import os
+import time
 import datetime
 import itertools
 
-from kallithea.lib.vcs.utils import author_name, author_email, safe_unicode
+from kallithea.lib.vcs.utils import author_name, author_email, safe_unicode, \
+    date_fromtimestamp
 from kallithea.lib.vcs.utils.lazy import LazyProperty
 from kallithea.lib.vcs.utils.helpers import get_dict_for_attrs
+from kallithea.lib.vcs.utils.archivers import ArchiveStream, CHUNK_SIZE
 from kallithea.lib.vcs.conf import settings
+from kallithea.lib.vcs.backends.metadata import ChangesetMetadataStore
 
 from kallithea.lib.vcs.exceptions import (
     ChangesetError, EmptyRepositoryError, NodeAlreadyAddedError,
     NodeAlreadyChangedError, NodeAlreadyExistsError, NodeAlreadyRemovedError,
-    NodeDoesNotExistError, NodeNotChangedError, RepositoryError
+    NodeDoesNotExistError, NodeNotChangedError, RepositoryError,
+    ImproperArchiveTypeError, VCSError
 )
 
+#: estimated memory held by repository instance itself, in bytes
+INSTANCE_FOOTPRINT = 256 * 1024
+#: estimated memory held per revision id in revisions list, in bytes
+REVISION_FOOTPRINT = 100
+
+
+def stat_token(paths):
+    """
+    Returns tuple of (mtime, size) of given paths, None for missing ones.
+    """
+    token = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            token.append(None)
+        else:
+            token.append((st.st_mtime, st.st_size))
+    return tuple(token)
+
 
 class BaseRepository(object):
     """
@@ -131,6 +157,26 @@ class BaseRepository(object):
             pass
         return size
 
+    @classmethod
+    def get_change_token(cls, repo_path):
+        """
+        Returns value which is cheap to compute and changes whenever
+        changesets or refs of repository at ``repo_path`` change. Used to
+        decide whether long living instances are still up to date.
+        """
+        raise NotImplementedError
+
+    def get_memory_footprint(self):
+        """
+        Returns rough estimate of memory held by this instance, in bytes.
+        """
+        size = INSTANCE_FOOTPRINT
+        # don't trigger lazy properties, count only what was loaded already
+        revisions = self.__dict__.get('revisions')
+        if isinstance(revisions, list):
+            size += len(revisions) * REVISION_FOOTPRINT
+        return size
+
     def is_valid(self):
         """
         Validates repository.
@@ -194,6 +240,94 @@ class BaseRepository(object):
     def count(self):
         return len(self.revisions)
 
+    def get_changeset_metadata(self, indexes):
+        """
+        Returns list of ``ChangesetMetadata`` for given integer revisions, in
+        the same order. Rows are read from persistent metadata store and
+        those missing in it are read from the repository; store is extended
+        on the way if it lags behind by no more than
+        ``settings.CHANGESET_METADATA_FILL_LIMIT`` revisions.
+        """
+        revisions = self.revisions
+        indexes = [i + len(revisions) if i < 0 else i for i in indexes]
+        rows = {}
+        store = self._get_changeset_metadata_store()
+        if store is not None and indexes:
+            missing = max(indexes) + 1 - len(store)
+            if missing > 0 and \
+                    missing <= settings.CHANGESET_METADATA_FILL_LIMIT:
+                store.update(revisions, self._read_changeset_metadata,
+                             limit=missing)
+            rows = store.get_rows(indexes)
+        tags, bookmarks, branches = self._get_changeset_metadata_refs()
+        result = []
+        for index in indexes:
+            row = rows.get(index)
+            if row is None or row[0] != revisions[index]:
+                row = self._read_changeset_metadata(index)
+            raw_id = row[0]
+            result.append(ChangesetMetadata(self, index, *row,
+                tags=tags.get(raw_id, []),
+                bookmarks=bookmarks.get(raw_id, []),
+                branch_head=branches.get(raw_id)))
+        return result
+
+    def update_changeset_metadata(self, limit=None):
+        """
+        Brings persistent changeset metadata store in line with current
+        revisions, should be called after new changesets were added (i.e. by
+        push hooks). At most ``limit`` missing rows are added if given.
+        """
+        store = self._get_changeset_metadata_store()
+        if store is not None:
+            store.update(self.revisions, self._read_changeset_metadata,
+                         limit=limit)
+
+    def _get_changeset_metadata_store(self):
+        """
+        Returns ``ChangesetMetadataStore`` of this repository or None if
+        backend doesn't keep one.
+        """
+        path = self._get_changeset_metadata_path()
+        if not settings.CHANGESET_METADATA or path is None:
+            return None
+        return ChangesetMetadataStore(path)
+
+    def _get_changeset_metadata_path(self):
+        return None
+
+    def _get_revision_numbers(self, revisions):
+        """
+        Returns integer revisions of given revisions (ids or integers).
+        """
+        return [rev if isinstance(rev, (int, long))
+                else self.revisions.index(rev) for rev in revisions]
+
+    def _read_changeset_metadata(self, index):
+        """
+        Returns metadata row for given integer revision, read from the
+        repository: tuple of (raw_id, timestamp, timezone offset, author,
+        branch, message, parent revisions). ``branch`` should be None for
+        backends which don't record branch in changesets.
+        """
+        cs = self.get_changeset(index)
+        timestamp = time.mktime(cs.date.timetuple())
+        return (cs.raw_id, timestamp, 0, cs.author, cs.branch, cs.message,
+                [p.revision for p in cs.parents])
+
+    def _get_changeset_metadata_refs(self):
+        """
+        Returns tuple of dicts mapping raw ids to lists of tags, lists of
+        bookmarks and to branch names for changesets without recorded branch.
+        """
+        tags = {}
+        for name, raw_id in self.tags.iteritems():
+            tags.setdefault(raw_id, []).append(name)
+        bookmarks = {}
+        for name, raw_id in self.bookmarks.iteritems():
+            bookmarks.setdefault(raw_id, []).append(name)
+        return tags, bookmarks, {}
+
     def tag(self, name, user, revision=None, message=None, date=None, **opts):
         """
         Creates and returns a tag for the given ``revision``.
@@ -238,6 +372,27 @@ class BaseRepository(object):
         """
         raise NotImplementedError
 
+    def get_chunked_diff(self, rev1, rev2, path=None, ignore_whitespace=False,
+            context=3):
+        """
+        Returns iterable over chunks of the same diff as :meth:`get_diff`,
+        generated while it is consumed. Closing it, or not consuming it
+        completely, stops generating the rest of the diff.
+
+        Revisions are checked before it is returned and may raise
+        ``ChangesetDoesNotExistError``.
+        """
+        raise NotImplementedError
+
+    def get_changed_paths(self, rev1, rev2):
+        """
+        Returns tuple of (added, changed, removed) lists of paths of files
+        differing between trees of ``rev1`` and ``rev2``, computed from
+        a single tree comparison without walking history. Renames are
+        reported as removal and addition.
+        """
+        raise NotImplementedError
+
     # ========== #
     # COMMIT API #
     # ========== #
@@ -561,22 +716,39 @@ class BaseChangeset(object):
 
         raise NotImplementedError
 
-    def get_chunked_archive(self, **kwargs):
+    def get_chunked_archive(self, kind='tgz', prefix=None, subrepos=False,
+                            chunk_size=CHUNK_SIZE):
         """
-        Returns iterable archive. Tiny wrapper around ``fill_archive`` method.
+        Returns iterable over chunks of archive of this changeset, produced
+        while it is consumed. Takes the same arguments as ``fill_archive``
+        does.
 
         :param chunk_size: extra parameter which controls size of returned
-            chunks. Default:8k.
+            chunks.
+        """
+        prefix = self._get_archive_prefix(kind, prefix)
+        return ArchiveStream(lambda stream: self.fill_archive(stream=stream,
+            kind=kind, prefix=prefix, subrepos=subrepos), chunk_size)
+
+    def _get_archive_prefix(self, kind, prefix):
+        """
+        Validates archive ``kind`` and returns ``prefix`` of archive entries.
+
+        :raise ImproperArchiveTypeError: If given kind is wrong.
+        :raise VCSError: If given prefix is not valid
         """
+        allowed_kinds = settings.ARCHIVE_SPECS.keys()
+        if kind not in allowed_kinds:
+            raise ImproperArchiveTypeError('Archive kind not supported use one'
+                'of %s', allowed_kinds)
 
-        chunk_size = kwargs.pop('chunk_size', 8192)
-        stream = kwargs.get('stream')
-        self.fill_archive(**kwargs)
-        while True:
-            data = stream.read(chunk_size)
-            if not data:
-                break
-            yield data
+        if prefix is None:
+            prefix = '%s-%s' % (self.repository.name, self.short_id)
+        elif prefix.startswith('/'):
+            raise VCSError("Prefix cannot start with leading slash")
+        elif prefix.strip() == '':
+            raise VCSError("Prefix cannot be empty")
+        return prefix
 
     @LazyProperty
     def root(self):
@@ -1017,6 +1189,97 @@ class EmptyChangeset(BaseChangeset):
         return 0
 
 
+class ChangesetMetadata(object):
+    """
+    Lightweight, read only row of changeset metadata returned by
+    ``BaseRepository.get_changeset_metadata``. Provides attributes needed to
+    render lists of changesets without instantiating backend's changesets;
+    full changeset is available by ``get_changeset``.
+    """
+
+    def __init__(self, repository, revision, raw_id, timestamp, tzoffset,
+                 author, branch, message, parent_revisions, tags=None,
+                 bookmarks=None, branch_head=None):
+        self.repository = repository
+        self.revision = revision
+        self.raw_id = raw_id
+        self.id = raw_id
+        self.short_id = raw_id[:12]
+        self._timestamp = timestamp
+        self._tzoffset = tzoffset
+        self.author = author
+        self.branch = branch if branch is not None else branch_head
+        self.message = message
+        self.parent_revisions = parent_revisions
+        self.tags = tags or []
+        self.bookmarks = bookmarks or []
+
+    def __str__(self):
+        return '<%s at %s:%s>' % (self.__class__.__name__, self.revision,
+            self.short_id)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __unicode__(self):
+        return u'%s:%s' % (self.revision, self.short_id)
+
+    def __eq__(self, other):
+        return self.raw_id == getattr(other, 'raw_id', None)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @LazyProperty
+    def date(self):
+        return date_fromtimestamp(self._timestamp, self._tzoffset)
+
+    @LazyProperty
+    def author_name(self):
+        return safe_unicode(author_name(self.author))
+
+    @LazyProperty
+    def author_email(self):
+        return safe_unicode(author_email(self.author))
+
+    @LazyProperty
+    def parents(self):
+        """
+        Returns list of ``ChangesetMetadata`` of parents.
+        """
+        return self.repository.get_changeset_metadata(self.parent_revisions)
+
+    def get_changeset(self):
+        """
+        Returns full changeset this row describes.
+        """
+        return self.repository.get_changeset(self.raw_id)
+
+
+class ChangesetMetadataCollection(object):
+    """
+    Sliceable collection of ``ChangesetMetadata`` of given revisions (ids or
+    integer revisions); rows are fetched in bulk on iteration.
+    """
+
+    def __init__(self, repo, revs):
+        self.repo = repo
+        self.revs = revs
+
+    def __len__(self):
+        return len(self.revs)
+
+    def __iter__(self):
+        indexes = self.repo._get_revision_numbers(self.revs)
+        return iter(self.repo.get_changeset_metadata(indexes))
+
+    def __getslice__(self, i, j):
+        return ChangesetMetadataCollection(self.repo, self.revs[i:j])
+
+    def __repr__(self):
+        return '<ChangesetMetadataCollection[len:%s]>' % (len(self))
+
+
 class CollectionGenerator(object):
 
     def __init__(self, repo, revs):
@@ -1039,3 +1302,9 @@ class CollectionGenerator(object):
 
     def __repr__(self):
         return '<CollectionGenerator[len:%s]>' % (len(self))
+
+    def metadata(self):
+        """
+        Returns ``ChangesetMetadataCollection`` of the same revisions.
+        """
+        return ChangesetMetadataCollection(self.repo, self.revs)
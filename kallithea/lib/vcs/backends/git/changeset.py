@@ -7,16 +7,18 @@ from kallithea.lib.vcs.conf import settings
 from kallithea.lib.vcs.backends.base import BaseChangeset, EmptyChangeset
 from kallithea.lib.vcs.exceptions import (
     RepositoryError, ChangesetError, NodeDoesNotExistError, VCSError,
-    ChangesetDoesNotExistError, ImproperArchiveTypeError
+    ChangesetDoesNotExistError
 )
 from kallithea.lib.vcs.nodes import (
     FileNode, DirNode, NodeKind, RootNode, RemovedFileNode, SubModuleNode,
     ChangedFileNodesGenerator, AddedFileNodesGenerator, RemovedFileNodesGenerator
 )
 from kallithea.lib.vcs.utils import (
-    safe_unicode, safe_str, safe_int, date_fromtimestamp
+    safe_unicode, safe_str, date_fromtimestamp
 )
 from kallithea.lib.vcs.utils.lazy import LazyProperty
+from kallithea.lib.vcs.utils.archivers import iter_process_output, \
+    iter_compressed, CHUNK_SIZE
 
 
 class GitChangeset(BaseChangeset):
@@ -279,23 +281,12 @@ class GitChangeset(BaseChangeset):
         Returns history of file as reversed list of ``Changeset`` objects for
         which file at given ``path`` has been modified.
 
-        TODO: This function now uses os underlying 'git' and 'grep' commands
-        which is generally not good. Should be replaced with algorithm
-        iterating commits.
+        History is computed by engine configured by
+        ``settings.GIT_HISTORY_ENGINE``.
         """
         self._get_filectx(path)
-        cs_id = safe_str(self.id)
-        f_path = safe_str(path)
-
-        if limit:
-            cmd = 'log -n %s --pretty="format: %%H" -s %s -- "%s"' % (
-                      safe_int(limit, 0), cs_id, f_path)
-
-        else:
-            cmd = 'log --pretty="format: %%H" -s %s -- "%s"' % (
-                      cs_id, f_path)
-        so, se = self.repository.run_git_command(cmd)
-        ids = re.findall(r'[0-9a-fA-F]{40}', so)
+        engine = self.repository.history_engine
+        ids = engine.get_history(self.id, path, limit=limit)
         return [self.repository.get_changeset(sha) for sha in ids]
 
     def get_file_history_2(self, path):
@@ -349,18 +340,22 @@ class GitChangeset(BaseChangeset):
         :raise VcsError: If given stream is None
 
         """
-        allowed_kinds = settings.ARCHIVE_SPECS.keys()
-        if kind not in allowed_kinds:
-            raise ImproperArchiveTypeError('Archive kind not supported use one'
-                'of %s', allowed_kinds)
-
-        if prefix is None:
-            prefix = '%s-%s' % (self.repository.name, self.short_id)
-        elif prefix.startswith('/'):
-            raise VCSError("Prefix cannot start with leading slash")
-        elif prefix.strip() == '':
-            raise VCSError("Prefix cannot be empty")
+        prefix = self._get_archive_prefix(kind, prefix)
+        if stream is None:
+            raise VCSError('You need to pass in a valid stream for filling'
+                           ' with archival data')
+        for chunk in self.get_chunked_archive(kind=kind, prefix=prefix,
+                                              subrepos=subrepos):
+            stream.write(chunk)
 
+    def get_chunked_archive(self, kind='tgz', prefix=None, subrepos=False,
+                            chunk_size=CHUNK_SIZE):
+        """
+        Returns iterable over chunks of archive of this changeset, read from
+        ``git archive`` while it is consumed. Archives are compressed by this
+        process, so failure of git isn't hidden by exit status of a pipe.
+        """
+        prefix = self._get_archive_prefix(kind, prefix)
         if kind == 'zip':
             frmt = 'zip'
         else:
@@ -368,24 +363,12 @@ class GitChangeset(BaseChangeset):
         _git_path = settings.GIT_EXECUTABLE_PATH
         cmd = '%s archive --format=%s --prefix=%s/ %s' % (_git_path,
                                                 frmt, prefix, self.raw_id)
-        if kind == 'tgz':
-            cmd += ' | gzip -9'
-        elif kind == 'tbz2':
-            cmd += ' | bzip2 -9'
-
-        if stream is None:
-            raise VCSError('You need to pass in a valid stream for filling'
-                           ' with archival data')
         popen = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True,
                       cwd=self.repository.path)
-
-        buffer_size = 1024 * 8
-        chunk = popen.stdout.read(buffer_size)
-        while chunk:
-            stream.write(chunk)
-            chunk = popen.stdout.read(buffer_size)
-        # Make sure all descriptors would be read
-        popen.communicate()
+        chunks = iter_process_output(popen, chunk_size)
+        if kind in ('tgz', 'tbz2'):
+            chunks = iter_compressed(chunks, kind)
+        return chunks
 
     def get_nodes(self, path):
         if self._get_kind(path) != NodeKind.DIR:
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    vcs.backends.git.history
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Engines computing history of a single path, used by
+    ``GitChangeset.get_file_history``. Engine is chosen by
+    ``settings.GIT_HISTORY_ENGINE``.
+"""
+
+import re
+import heapq
+import stat
+
+from dulwich.lru_cache import LRUCache
+
+from kallithea.lib.vcs.utils import safe_str, safe_int
+from kallithea.lib.vcs.utils.lazy import LazyProperty
+
+_missing = object()
+
+
+class BaseHistoryEngine(object):
+    """
+    Computes ids of commits which modified given path, newest first, the same
+    way ``git log -- path`` does (default history simplification, renames
+    are not followed).
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def get_history(self, commit_id, path, limit=None):
+        """
+        Returns list of ids of commits reachable from ``commit_id`` which
+        modified ``path``, at most ``limit`` of them if given.
+        """
+        raise NotImplementedError
+
+    def get_memory_footprint(self):
+        """
+        Returns rough estimate of memory held by caches of this engine, in
+        bytes.
+        """
+        return 0
+
+
+class GitLogHistoryEngine(BaseHistoryEngine):
+    """
+    Runs ``git log`` for every request.
+    """
+
+    def get_history(self, commit_id, path, limit=None):
+        cs_id = safe_str(commit_id)
+        f_path = safe_str(path)
+        if limit:
+            cmd = 'log -n %s --pretty="format: %%H" -s %s -- "%s"' % (
+                      safe_int(limit, 0), cs_id, f_path)
+        else:
+            cmd = 'log --pretty="format: %%H" -s %s -- "%s"' % (
+                      cs_id, f_path)
+        so, se = self.repository.run_git_command(cmd)
+        return re.findall(r'[0-9a-fA-F]{40}', so)
+
+
+class DulwichHistoryEngine(BaseHistoryEngine):
+    """
+    Walks commits in process using dulwich, newest commit date first.
+
+    For every commit only the entries along ``path`` are resolved. Parsed
+    commits and tree entries are kept in bounded caches living as long as
+    the repository object, so unchanged directories are read only once and
+    subsequent lookups (i.e. last changesets of all files of a directory)
+    mostly don't touch the object store at all. Walk stops as soon as
+    ``limit`` commits were found.
+    """
+
+    #: number of (tree, parents, commit time) tuples kept in memory
+    COMMIT_CACHE_SIZE = 100000
+    #: number of (tree id, name) -> entry pairs kept in memory
+    ENTRY_CACHE_SIZE = 100000
+
+    def __init__(self, repository):
+        super(DulwichHistoryEngine, self).__init__(repository)
+        self._commits = LRUCache(self.COMMIT_CACHE_SIZE)
+        self._entries = LRUCache(self.ENTRY_CACHE_SIZE)
+
+    #: estimated memory held by single cached commit or entry, in bytes
+    CACHE_ITEM_FOOTPRINT = 300
+
+    def get_memory_footprint(self):
+        return (len(self._commits) + len(self._entries)) * \
+            self.CACHE_ITEM_FOOTPRINT
+
+    @LazyProperty
+    def _store(self):
+        return self.repository._repo.object_store
+
+    def _get_commit(self, sha):
+        """
+        Returns (tree id, parent ids, commit time) of commit ``sha``.
+        """
+        commit = self._commits.get(sha)
+        if commit is None:
+            obj = self._store[sha]
+            commit = self._commits[sha] = (obj.tree, obj.parents,
+                                           obj.commit_time)
+        return commit
+
+    def _get_entry(self, tree_id, name):
+        """
+        Returns (mode, sha) of ``name`` in tree ``tree_id`` or None.
+        """
+        key = (tree_id, name)
+        entry = self._entries.get(key, _missing)
+        if entry is _missing:
+            try:
+                entry = self._store[tree_id][name]
+            except KeyError:
+                entry = None
+            self._entries[key] = entry
+        return entry
+
+    def _lookup(self, tree_id, parts):
+        for depth, name in enumerate(parts):
+            entry = self._get_entry(tree_id, name)
+            if entry is None or depth + 1 == len(parts):
+                return entry
+            mode, tree_id = entry
+            if not stat.S_ISDIR(mode):
+                return None
+
+    def get_history(self, commit_id, path, limit=None):
+        parts = [p for p in safe_str(path).split('/') if p]
+        history = []
+        start = safe_str(commit_id)
+        # equal dates are taken in insertion order, like in git
+        counter = 0
+        pending = [(-self._get_commit(start)[2], counter, start)]
+        seen = set([start])
+        while pending:
+            sha = heapq.heappop(pending)[2]
+            tree_id, parent_ids, _time = self._get_commit(sha)
+            entry = self._lookup(tree_id, parts)
+            follow = parent_ids
+            # like git, follow only first parent with identical path and
+            # don't report the commit then
+            for parent_id in parent_ids:
+                parent_tree_id = self._get_commit(parent_id)[0]
+                if self._lookup(parent_tree_id, parts) == entry:
+                    follow = [parent_id]
+                    break
+            else:
+                if parent_ids or entry is not None:
+                    history.append(sha)
+                    if limit and len(history) >= limit:
+                        break
+            for parent_id in follow:
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    counter += 1
+                    heapq.heappush(pending, (-self._get_commit(parent_id)[2],
+                                             counter, parent_id))
+        return history
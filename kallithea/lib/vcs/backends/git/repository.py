@@ -17,6 +17,7 @@ import urllib2
 import logging
 import posixpath
 import string
+from subprocess import Popen, PIPE
 try:
     # Python <=2.7
     from pipes import quote
@@ -24,12 +25,14 @@ except ImportError:
     # Python 3.3+
     from shlex import quote
 
-from dulwich.objects import Tag
+from dulwich.objects import Tag, S_ISGITLINK
 from dulwich.repo import Repo, NotGitRepository
 from dulwich.config import ConfigFile
 
 from kallithea.lib.vcs import subprocessio
-from kallithea.lib.vcs.backends.base import BaseRepository, CollectionGenerator
+from kallithea.lib.vcs.backends.base import BaseRepository, CollectionGenerator, \
+    stat_token
+from kallithea.lib.vcs.backends.metadata import STORE_DIR as METADATA_STORE_DIR
 from kallithea.lib.vcs.conf import settings
 
 from kallithea.lib.vcs.exceptions import (
@@ -37,9 +40,11 @@ from kallithea.lib.vcs.exceptions import (
     RepositoryError, TagAlreadyExistError, TagDoesNotExistError
 )
 from kallithea.lib.vcs.utils import safe_unicode, makedate, date_fromtimestamp
+from kallithea.lib.vcs.utils.imports import import_class
 from kallithea.lib.vcs.utils.lazy import LazyProperty
 from kallithea.lib.vcs.utils.ordered_dict import OrderedDict
 from kallithea.lib.vcs.utils.paths import abspath, get_user_home
+from kallithea.lib.vcs.utils.archivers import iter_process_output, CHUNK_SIZE
 
 from kallithea.lib.vcs.utils.hgcompat import (
     hg_url, httpbasicauthhandler, httpdigestauthhandler
@@ -47,6 +52,7 @@ from kallithea.lib.vcs.utils.hgcompat import (
 
 from .changeset import GitChangeset
 from .inmemory import GitInMemoryChangeset
+from .revindex import GitRevisionIndex, GitRevisionIndexer
 from .workdir import GitWorkdir
 
 SHA_PATTERN = re.compile(r'^[[0-9a-fA-F]{12}|[0-9a-fA-F]{40}]$')
@@ -54,6 +60,28 @@ SHA_PATTERN = re.compile(r'^[[0-9a-fA-F]{12}|[0-9a-fA-F]{40}]$')
 log = logging.getLogger(__name__)
 
 
+def _strip_show_header(chunks):
+    """
+    Skips the changeset description ``git show`` outputs before the diff.
+    """
+    try:
+        head = ''
+        for chunk in chunks:
+            head += chunk
+            parts = head.split('\ndiff ', 1)
+            if len(parts) > 1:
+                yield 'diff ' + parts[1]
+                break
+        else:
+            if head:
+                yield head
+            return
+        for chunk in chunks:
+            yield chunk
+    finally:
+        chunks.close()
+
+
 class GitRepository(BaseRepository):
     """
     Git repository backend.
@@ -76,6 +104,26 @@ class GitRepository(BaseRepository):
              abspath(get_user_home(), '.gitconfig'),
          ]
 
+    @classmethod
+    def get_change_token(cls, repo_path):
+        controldir = os.path.join(repo_path, '.git')
+        if not os.path.isdir(controldir):
+            controldir = repo_path
+        # refs are updated by renaming lock files, which touches the
+        # directory containing the ref
+        paths = [os.path.join(controldir, 'HEAD'),
+                 os.path.join(controldir, 'packed-refs')]
+        for root, dirs, _files in os.walk(os.path.join(controldir, 'refs')):
+            paths.append(root)
+        return stat_token(paths)
+
+    def get_memory_footprint(self):
+        size = super(GitRepository, self).get_memory_footprint()
+        engine = self.__dict__.get('history_engine')
+        if engine is not None:
+            size += engine.get_memory_footprint()
+        return size
+
     @property
     def _repo(self):
         return Repo(self.path)
@@ -104,9 +152,77 @@ class GitRepository(BaseRepository):
         """
         Returns list of revisions' ids, in ascending order.  Being lazy
         attribute allows external tools to inject shas from cache.
+
+        If enabled, revisions are served from the persistent revision index
+        (``GitRevisionIndex``) which only has to be extended when refs
+        changed.
         """
+        if settings.GIT_REVISION_INDEX and settings.GIT_REV_FILTER == '--all':
+            index = self._get_revision_index()
+            if index is not None:
+                return index
         return self._get_all_revisions()
 
+    def _get_revision_index(self):
+        _repo = self._repo
+        try:
+            _repo.head()
+        except KeyError:
+            return None
+        return GitRevisionIndexer(self).get_index(_repo.get_refs())
+
+    def update_revision_index(self):
+        """
+        Extends persistent revision index by revisions added since it was
+        last updated, should be called after refs of this repository were
+        changed (i.e. by post receive hook).
+        """
+        if not settings.GIT_REVISION_INDEX:
+            return
+        index = self._get_revision_index()
+        if index is not None:
+            self.revisions = index
+
+    def _get_parent_revisions(self, revision):
+        """
+        Returns list of integer revisions of parents of given integer
+        ``revision``, read from revision index when available.
+        """
+        parents = None
+        if isinstance(self.revisions, GitRevisionIndex):
+            parents = self.revisions.parentrevs(revision)
+        if parents is None:
+            parents = [cs.revision
+                       for cs in self.get_changeset(revision).parents]
+        return parents
+
+    @LazyProperty
+    def _object_store(self):
+        return self._repo.object_store
+
+    def _get_changeset_metadata_path(self):
+        return os.path.join(self._repo.controldir(), METADATA_STORE_DIR)
+
+    def _read_changeset_metadata(self, index):
+        raw_id = self.revisions[index]
+        try:
+            commit = self._object_store[raw_id]
+        except KeyError:
+            # object store is kept for the life of this instance and might
+            # not see packs added since
+            commit = self._repo[raw_id]
+        return (raw_id, commit.commit_time, commit.commit_timezone,
+                safe_unicode(commit.author), None,
+                safe_unicode(commit.message),
+                self._get_parent_revisions(index))
+
+    def _get_changeset_metadata_refs(self):
+        tags, bookmarks, _branches = \
+            super(GitRepository, self)._get_changeset_metadata_refs()
+        branches = dict((raw_id, safe_unicode(name)) for raw_id, name
+                        in self._heads(reverse=False).iteritems())
+        return tags, bookmarks, branches
+
     @classmethod
     def _run_git_command(cls, cmd, **opts):
         """
@@ -603,6 +719,51 @@ class GitRepository(BaseRepository):
         :param context: How many lines before/after changed lines should be
           shown. Defaults to ``3``.
         """
+        cmd = self._get_diff_cmd(rev1, rev2, path, ignore_whitespace, context)
+        stdout, stderr = self.run_git_command(cmd)
+        # TODO: don't ignore stderr
+        # If we used 'show' command, strip first few lines (until actual diff
+        # starts)
+        if cmd.startswith('show '):
+            parts = stdout.split('\ndiff ', 1)
+            if len(parts) > 1:
+                stdout = 'diff ' + parts[1]
+        return stdout
+
+    def get_chunked_diff(self, rev1, rev2, path=None, ignore_whitespace=False,
+                         context=3, chunk_size=CHUNK_SIZE):
+        """
+        Returns iterable over chunks of the diff of :meth:`get_diff`, read
+        from ``git diff`` while it is consumed; the git process is stopped
+        when the iterable is closed before the end of the diff.
+        """
+        cmd = self._get_diff_cmd(rev1, rev2, path, ignore_whitespace, context)
+        gitenv = dict(os.environ)
+        gitenv.pop('GIT_DIR', None)
+        gitenv['GIT_CONFIG_NOGLOBAL'] = '1'
+        _cmd = ' '.join([settings.GIT_EXECUTABLE_PATH, '-c',
+                         'core.quotepath=false', cmd])
+        opts = {}
+        if os.path.isdir(self.path):
+            opts['cwd'] = self.path
+        try:
+            popen = Popen(_cmd, stdout=PIPE, stderr=PIPE, shell=True,
+                          env=gitenv, **opts)
+        except (EnvironmentError, OSError), err:
+            tb_err = ("Couldn't run git command (%s).\n"
+                      "Original error was:%s\n" % (_cmd, err))
+            log.error(tb_err)
+            raise RepositoryError(tb_err)
+        chunks = iter_process_output(popen, chunk_size)
+        if cmd.startswith('show '):
+            chunks = _strip_show_header(chunks)
+        return chunks
+
+    def _get_diff_cmd(self, rev1, rev2, path, ignore_whitespace, context):
+        """
+        Returns git command generating diff of :meth:`get_diff`; revisions
+        are checked and may raise ``ChangesetDoesNotExistError``
+        """
         flags = ['-U%s' % context, '--full-index', '--binary', '-p', '-M', '--abbrev=40']
         if ignore_whitespace:
             flags.append('-w')
@@ -623,16 +784,47 @@ class GitRepository(BaseRepository):
 
         if path:
             cmd += ' -- "%s"' % path
+        return cmd
 
-        stdout, stderr = self.run_git_command(cmd)
-        # TODO: don't ignore stderr
-        # If we used 'show' command, strip first few lines (until actual diff
-        # starts)
-        if rev1 == self.EMPTY_CHANGESET:
-            parts = stdout.split('\ndiff ', 1)
-            if len(parts) > 1:
-                stdout = 'diff ' + parts[1]
-        return stdout
+    def get_changed_paths(self, rev1, rev2):
+        """
+        Returns tuple of (added, changed, removed) lists of paths of files
+        differing between trees of ``rev1`` and ``rev2``, computed from
+        a single tree comparison without walking history. Renames are
+        reported as removal and addition.
+        """
+        trees = []
+        for rev in (rev1, rev2):
+            if rev == self.EMPTY_CHANGESET:
+                trees.append(None)
+            else:
+                raw_id = self.get_changeset(rev).raw_id
+                trees.append(self._repo[raw_id].tree)
+        added, changed, removed = [], [], []
+        for (old_path, new_path), (old_mode, new_mode), _shas in \
+                self._repo.object_store.tree_changes(trees[0], trees[1]):
+            # submodules are not files of this repository
+            if old_mode is not None and S_ISGITLINK(old_mode):
+                old_path = None
+            if new_mode is not None and S_ISGITLINK(new_mode):
+                new_path = None
+            if old_path is None and new_path is None:
+                continue
+            elif old_path is None:
+                added.append(new_path)
+            elif new_path is None:
+                removed.append(old_path)
+            else:
+                changed.append(new_path)
+        return added, changed, removed
+
+    @LazyProperty
+    def history_engine(self):
+        """
+        Returns engine computing history of files, as configured by
+        ``settings.GIT_HISTORY_ENGINE``.
+        """
+        return import_class(settings.GIT_HISTORY_ENGINE)(self)
 
     @LazyProperty
     def in_memory_changeset(self):
@@ -0,0 +1,501 @@
+# -*- coding: utf-8 -*-
+"""
+    vcs.backends.git.revindex
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Persistent, append-only index of git revisions.
+
+    The index lives in ``kallithea-revindex`` inside the git control
+    directory and consists of:
+
+    ``state``
+        generation, number of indexed revisions and parent entries, followed
+        by the snapshot of refs (``sha peeled_sha refname`` lines) the index
+        was built for. It is always replaced atomically and is the commit
+        point of every update.
+    ``shas.<gen>``
+        binary (20 bytes) shas in revision order
+    ``offsets.<gen>`` and ``parents.<gen>``
+        parent table; ``offsets`` holds for every revision a little endian
+        int32 offset into the flat int32 array of parent revisions
+    ``lookup.<gen>``
+        (binary sha, revision) pairs sorted by sha, used for sha -> revision
+        lookups by binary search
+
+    Revisions are only ever appended as long as pushes just add commits or
+    fast forward refs, so integer revisions stay stable. History rewrites
+    (force push, deleted unmerged branches) trigger a rebuild into a new
+    generation.
+"""
+
+import os
+import mmap
+import struct
+import logging
+import binascii
+
+from dulwich.objects import Tag, Commit
+
+from kallithea.lib.vcs.exceptions import RepositoryError
+from kallithea.lib.vcs.utils.storefiles import StoreLock, append_at
+
+log = logging.getLogger(__name__)
+
+INDEX_DIR = 'kallithea-revindex'
+STATE_FILE = 'state'
+
+SHA_SIZE = 20
+INT = struct.Struct('<i')
+LOOKUP = struct.Struct('<20si')
+
+
+def _map_file(path, size):
+    """
+    Returns read only memory map of first ``size`` bytes of given file.
+    """
+    if not size:
+        return ''
+    f = open(path, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def _peel(dulwich_repo, sha):
+    """
+    Returns id of commit given ``sha`` points to (following annotated tags)
+    or None if it doesn't point to a commit.
+    """
+    try:
+        obj = dulwich_repo[sha]
+        while isinstance(obj, Tag):
+            obj = dulwich_repo[obj.object[1]]
+    except KeyError:
+        return None
+    if isinstance(obj, Commit):
+        return obj.id
+    return None
+
+
+class GitRevisionIndex(object):
+    """
+    Read only, list like view of revision ids backed by memory mapped index
+    files. Revisions added by in-memory changesets are kept in memory on top
+    of the mapped ones until the next index update.
+    """
+
+    def __init__(self, index_path, generation, count, nparents, refs):
+        self.index_path = index_path
+        self.generation = generation
+        self.refs = refs
+        self._count = count
+        self._nparents = nparents
+        self._shas = _map_file(self._file('shas'), count * SHA_SIZE)
+        self._offsets = _map_file(self._file('offsets'), count * INT.size)
+        self._parents = _map_file(self._file('parents'), nparents * INT.size)
+        lookup_path = self._file('lookup')
+        self._lookup = _map_file(lookup_path, os.path.getsize(lookup_path))
+        self._lookup_count = len(self._lookup) // LOOKUP.size
+        self._extra = []
+        self._extra_revs = {}
+
+    def _file(self, name):
+        return os.path.join(self.index_path, '%s.%s' % (name, self.generation))
+
+    def __repr__(self):
+        return '<%s %s revisions at %s>' % (self.__class__.__name__,
+                                            len(self), self.index_path)
+
+    def __len__(self):
+        return self._count + len(self._extra)
+
+    def __eq__(self, other):
+        if not isinstance(other, (GitRevisionIndex, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __iter__(self):
+        for rev in xrange(len(self)):
+            yield self[rev]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[rev] for rev in xrange(*key.indices(len(self)))]
+        key = int(key)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('revision index out of range')
+        if key >= self._count:
+            return self._extra[key - self._count]
+        offset = key * SHA_SIZE
+        return binascii.hexlify(self._shas[offset:offset + SHA_SIZE])
+
+    def __contains__(self, sha):
+        return self._find(sha) is not None
+
+    def index(self, sha):
+        """
+        Returns integer revision of given ``sha``, like ``list.index``.
+        """
+        rev = self._find(sha)
+        if rev is None:
+            raise ValueError('%s is not in revisions' % (sha,))
+        return rev
+
+    def append(self, sha):
+        sha = str(sha)
+        self._extra_revs[sha] = len(self)
+        self._extra.append(sha)
+
+    def _find(self, sha):
+        if not isinstance(sha, basestring) or len(sha) != 40:
+            return None
+        rev = self._extra_revs.get(sha)
+        if rev is not None:
+            return rev
+        try:
+            binsha = binascii.unhexlify(sha)
+        except TypeError:
+            return None
+        lo, hi = 0, self._lookup_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, rev = LOOKUP.unpack_from(self._lookup, mid * LOOKUP.size)
+            if key < binsha:
+                lo = mid + 1
+            elif key > binsha:
+                hi = mid
+            else:
+                # lookup might already know about revisions appended after
+                # our state was read
+                return rev if rev < self._count else None
+        return None
+
+    def parentrevs(self, rev):
+        """
+        Returns list of integer revisions of parents of ``rev`` or None if
+        they are not known by the index.
+        """
+        if not 0 <= rev < self._count:
+            return None
+        start = INT.unpack_from(self._offsets, rev * INT.size)[0]
+        if rev + 1 < self._count:
+            end = INT.unpack_from(self._offsets, (rev + 1) * INT.size)[0]
+        else:
+            end = self._nparents
+        return list(struct.unpack_from('<%di' % (end - start), self._parents,
+                                       start * INT.size))
+
+
+def _read_state(index_path):
+    """
+    Returns (generation, count, nparents, refs) of last committed update or
+    None if there is no index yet. ``refs`` maps ref names to tuples of
+    (sha, peeled_sha).
+    """
+    try:
+        f = open(os.path.join(index_path, STATE_FILE), 'rb')
+    except IOError:
+        return None
+    try:
+        lines = f.read().splitlines()
+    finally:
+        f.close()
+    try:
+        generation, count, nparents = map(int, lines[0].split())
+        refs = {}
+        for line in lines[1:]:
+            sha, peeled, name = line.split(' ', 2)
+            refs[name] = (sha, peeled if peeled != '-' else None)
+    except (IndexError, ValueError):
+        log.warning('Ignoring corrupted revision index state in %s'
+                    % index_path)
+        return None
+    return generation, count, nparents, refs
+
+
+def _write_state(index_path, generation, count, nparents, refs):
+    lines = ['%d %d %d' % (generation, count, nparents)]
+    for name, (sha, peeled) in sorted(refs.iteritems()):
+        lines.append('%s %s %s' % (sha, peeled or '-', name))
+    _write_atomic(os.path.join(index_path, STATE_FILE),
+                  ['\n'.join(lines), '\n'])
+
+
+def _write_atomic(path, chunks):
+    tmp_path = '%s.tmp' % path
+    f = open(tmp_path, 'wb')
+    try:
+        for chunk in chunks:
+            f.write(chunk)
+    finally:
+        f.close()
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(tmp_path, path)
+
+
+def load_revision_index(index_path):
+    """
+    Returns ``GitRevisionIndex`` for the last committed state of index at
+    ``index_path`` or None if it isn't available.
+    """
+    state = _read_state(index_path)
+    if state is None:
+        return None
+    try:
+        return GitRevisionIndex(index_path, *state)
+    except (IOError, OSError, ValueError), e:
+        # files of this generation could have been just replaced by rebuild
+        log.debug('Cannot open revision index %s: %s' % (index_path, e))
+        return None
+
+
+class GitRevisionIndexer(object):
+    """
+    Brings the revision index of given ``GitRepository`` in line with its
+    current refs.
+    """
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.index_path = os.path.join(repository._repo.controldir(),
+                                       INDEX_DIR)
+
+    def get_index(self, refs=None):
+        """
+        Returns up to date ``GitRevisionIndex`` or None if index cannot be
+        used right now (i.e. another process is updating it or it is not
+        writable), in which case the caller should fall back to ``git
+        rev-list``.
+
+        :param refs: current refs of repository, as returned by dulwich
+        """
+        if refs is None:
+            refs = self.repository._repo.get_refs()
+        index = load_revision_index(self.index_path)
+        if index is not None and self._same_refs(index.refs, refs):
+            return index
+
+        try:
+            if not os.path.isdir(self.index_path):
+                os.makedirs(self.index_path)
+        except OSError, e:
+            log.debug('Cannot create revision index %s: %s'
+                      % (self.index_path, e))
+            return None
+        lock = StoreLock(os.path.join(self.index_path, STATE_FILE))
+        if not lock.acquire():
+            log.debug('Revision index %s is locked' % self.index_path)
+            return None
+        try:
+            # someone could have finished update while we waited for lock
+            index = load_revision_index(self.index_path)
+            if index is not None and self._same_refs(index.refs, refs):
+                return index
+            return self._update(index, refs)
+        except (IOError, OSError, RepositoryError), e:
+            log.error('Failed to update revision index %s: %s'
+                      % (self.index_path, e))
+            return None
+        finally:
+            lock.release()
+
+    @staticmethod
+    def _same_refs(indexed_refs, refs):
+        if len(indexed_refs) != len(refs):
+            return False
+        for name, sha in refs.iteritems():
+            if indexed_refs.get(name, (None,))[0] != sha:
+                return False
+        return True
+
+    def _peeled_refs(self, refs, indexed_refs):
+        _repo = self.repository._repo
+        peeled_refs = {}
+        for name, sha in refs.iteritems():
+            indexed = indexed_refs.get(name)
+            if indexed is not None and indexed[0] == sha:
+                peeled_refs[name] = indexed
+            else:
+                peeled_refs[name] = (sha, _peel(_repo, sha))
+        return peeled_refs
+
+    def _rev_list(self, includes, excludes=()):
+        """
+        Returns list of (sha, [parent shas]) of commits reachable from
+        ``includes`` and not from ``excludes``, parents first.
+        """
+        if not includes:
+            return []
+        revs = ''.join(['%s\n' % sha for sha in includes] +
+                       ['^%s\n' % sha for sha in excludes])
+        cmd = 'rev-list --reverse --date-order --parents --stdin'
+        # the child must not inherit write end of its own stdin pipe,
+        # otherwise it never sees EOF
+        so, se = self.repository._run_git_command(
+            cmd, inputstream=revs, cwd=self.repository.path,
+            close_fds=os.name != 'nt')
+        commits = []
+        for line in so.splitlines():
+            shas = line.split()
+            commits.append((shas[0], shas[1:]))
+        return commits
+
+    def _update(self, index, refs):
+        indexed_refs = index.refs if index is not None else {}
+        peeled_refs = self._peeled_refs(refs, indexed_refs)
+        tips = set(p for s, p in peeled_refs.itervalues() if p)
+        if index is not None:
+            indexed_tips = set(p for s, p in indexed_refs.itervalues() if p)
+            try:
+                new_commits = self._rev_list(tips - indexed_tips,
+                                             indexed_tips)
+            except RepositoryError, e:
+                # indexed tips are gone after a forced push and gc
+                log.debug('Cannot list new commits of %s: %s'
+                          % (self.repository.path, e))
+                new_commits = None
+            if new_commits is not None and self._is_extension(
+                    index, indexed_tips - tips, tips, new_commits):
+                return self._extend(index, peeled_refs, new_commits)
+            log.debug('History of %s was rewritten, rebuilding revision index'
+                      % self.repository.path)
+        return self._rebuild(index, peeled_refs, self._rev_list(tips))
+
+    def _is_extension(self, index, lost_tips, tips, new_commits):
+        """
+        Checks that all commits of ``index`` are still reachable, i.e. that
+        every indexed tip which is not a tip anymore is an ancestor of one of
+        current ``tips``. Only the part of graph newer than the oldest lost
+        tip is walked.
+        """
+        if not lost_tips:
+            return True
+        lost_revs = set()
+        for sha in lost_tips:
+            rev = index._find(sha)
+            if rev is None:
+                return False
+            lost_revs.add(rev)
+        minrev = min(lost_revs)
+
+        # find where the walk enters already indexed part of graph
+        new_parents = dict(new_commits)
+        pending = list(tips)
+        seen = set()
+        revs = []
+        while pending:
+            sha = pending.pop()
+            if sha in seen:
+                continue
+            seen.add(sha)
+            if sha in new_parents:
+                pending.extend(new_parents[sha])
+                continue
+            rev = index._find(sha)
+            if rev is not None and rev >= minrev:
+                revs.append(rev)
+
+        seen = set()
+        while revs and lost_revs:
+            rev = revs.pop()
+            if rev in seen:
+                continue
+            seen.add(rev)
+            lost_revs.discard(rev)
+            revs.extend(p for p in index.parentrevs(rev) if p >= minrev)
+        return not lost_revs
+
+    def _pack(self, commits, first_rev, nparents, lookup, index=None):
+        """
+        Returns packed (shas, offsets, parents) for ``commits`` numbered from
+        ``first_rev``; adds their entries to ``lookup`` dict. Parents not
+        found in ``lookup`` are looked up in ``index``.
+        """
+        shas, offsets, parents = [], [], []
+        for i, (sha, parent_shas) in enumerate(commits):
+            binsha = binascii.unhexlify(sha)
+            lookup[binsha] = first_rev + i
+            shas.append(binsha)
+            offsets.append(INT.pack(nparents + len(parents)))
+            for parent_sha in parent_shas:
+                prev = lookup.get(binascii.unhexlify(parent_sha))
+                if prev is None and index is not None:
+                    prev = index._find(parent_sha)
+                if prev is not None:
+                    parents.append(INT.pack(prev))
+        return ''.join(shas), ''.join(offsets), parents
+
+    def _extend(self, index, peeled_refs, new_commits):
+        generation, count = index.generation, index._count
+        nparents = index._nparents
+        if new_commits:
+            lookup = {}
+            shas, offsets, parents = self._pack(new_commits, count, nparents,
+                                                lookup, index)
+            append_at(index._file('shas'), count * SHA_SIZE, shas)
+            append_at(index._file('offsets'), count * INT.size, offsets)
+            append_at(index._file('parents'), nparents * INT.size,
+                    ''.join(parents))
+            new_entries = sorted(LOOKUP.pack(binsha, rev)
+                                 for binsha, rev in lookup.iteritems())
+            _write_atomic(index._file('lookup'),
+                          self._merge_lookup(index._lookup, new_entries))
+            count += len(new_commits)
+            nparents += len(parents)
+        _write_state(self.index_path, generation, count, nparents,
+                     peeled_refs)
+        return load_revision_index(self.index_path)
+
+    @staticmethod
+    def _merge_lookup(old, new_entries):
+        """
+        Yields chunks of sorted lookup table made of ``old`` table and sorted
+        ``new_entries``, copying runs of old entries in bulk.
+        """
+        size = LOOKUP.size
+        start, count = 0, len(old) // size
+        for entry in new_entries:
+            lo, hi = start, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if old[mid * size:mid * size + SHA_SIZE] < entry[:SHA_SIZE]:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            yield old[start * size:lo * size]
+            yield entry
+            start = lo
+        yield old[start * size:count * size]
+
+    def _rebuild(self, index, peeled_refs, commits):
+        generation = index.generation + 1 if index is not None else 1
+        lookup = {}
+        shas, offsets, parents = self._pack(commits, 0, 0, lookup)
+        index_file = lambda name: os.path.join(self.index_path,
+                                               '%s.%s' % (name, generation))
+        _write_atomic(index_file('shas'), [shas])
+        _write_atomic(index_file('offsets'), [offsets])
+        _write_atomic(index_file('parents'), parents)
+        _write_atomic(index_file('lookup'),
+                      (LOOKUP.pack(binsha, lookup[binsha])
+                       for binsha in sorted(lookup)))
+        _write_state(self.index_path, generation, len(commits), len(parents),
+                     peeled_refs)
+        if index is not None:
+            # open maps of readers keep working (at least on posix)
+            for name in ('shas', 'offsets', 'parents', 'lookup'):
+                try:
+                    os.remove(index._file(name))
+                except OSError:
+                    pass
+        log.debug('Built revision index %s with %s revisions'
+                  % (self.index_path, len(commits)))
+        return load_revision_index(self.index_path)
@@ -1,11 +1,10 @@
 import os
 import posixpath
 
-from kallithea.lib.vcs.conf import settings
 from kallithea.lib.vcs.backends.base import BaseChangeset
 from kallithea.lib.vcs.exceptions import (
-    ChangesetDoesNotExistError, ChangesetError, ImproperArchiveTypeError,
-    NodeDoesNotExistError, VCSError
+    ChangesetDoesNotExistError, ChangesetError, NodeDoesNotExistError,
+    VCSError
 )
 from kallithea.lib.vcs.nodes import (
     AddedFileNodesGenerator, ChangedFileNodesGenerator, DirNode, FileNode,
@@ -15,6 +14,7 @@ from kallithea.lib.vcs.utils import safe_str, safe_unicode, date_fromtimestamp
 from kallithea.lib.vcs.utils.lazy import LazyProperty
 from kallithea.lib.vcs.utils.paths import get_dirs_for_path
 from kallithea.lib.vcs.utils.hgcompat import archival, hex
+from kallithea.lib.vcs.utils.archivers import ArchiveStream, CHUNK_SIZE
 
 
 class MercurialChangeset(BaseChangeset):
@@ -265,22 +265,11 @@ class MercurialChangeset(BaseChangeset):
         :raise VcsError: If given stream is None
         """
 
-        allowed_kinds = settings.ARCHIVE_SPECS.keys()
-        if kind not in allowed_kinds:
-            raise ImproperArchiveTypeError('Archive kind not supported use one'
-                'of %s', allowed_kinds)
-
+        prefix = self._get_archive_prefix(kind, prefix)
         if stream is None:
             raise VCSError('You need to pass in a valid stream for filling'
                            ' with archival data')
 
-        if prefix is None:
-            prefix = '%s-%s' % (self.repository.name, self.short_id)
-        elif prefix.startswith('/'):
-            raise VCSError("Prefix cannot start with leading slash")
-        elif prefix.strip() == '':
-            raise VCSError("Prefix cannot be empty")
-
         archival.archive(self.repository._repo, stream, self.raw_id,
                          kind, prefix=prefix, subrepos=subrepos)
 
@@ -291,6 +280,18 @@ class MercurialChangeset(BaseChangeset):
         else:
             stream.seek(0)
 
+    def get_chunked_archive(self, kind='tgz', prefix=None, subrepos=False,
+                            chunk_size=CHUNK_SIZE):
+        """
+        Returns iterable over chunks of archive of this changeset, written by
+        mercurial while it is consumed.
+        """
+        prefix = self._get_archive_prefix(kind, prefix)
+        def fill(stream):
+            archival.archive(self.repository._repo, stream, self.raw_id,
+                             kind, prefix=prefix, subrepos=subrepos)
+        return ArchiveStream(fill, chunk_size)
+
     def get_nodes(self, path):
         """
         Returns combined ``DirNode`` and ``FileNode`` objects list representing
@@ -16,7 +16,9 @@ import urllib2
 import logging
 import datetime
 
-from kallithea.lib.vcs.backends.base import BaseRepository, CollectionGenerator
+from kallithea.lib.vcs.backends.base import BaseRepository, CollectionGenerator, \
+    stat_token
+from kallithea.lib.vcs.backends.metadata import STORE_DIR as METADATA_STORE_DIR
 
 from kallithea.lib.vcs.exceptions import (
     BranchDoesNotExistError, ChangesetDoesNotExistError, EmptyRepositoryError,
@@ -40,6 +42,9 @@ from .workdir import MercurialWorkdir
 
 log = logging.getLogger(__name__)
 
+#: estimated memory held per entry of loaded changelog index, in bytes
+CHANGELOG_ENTRY_FOOTPRINT = 64
+
 
 class MercurialRepository(BaseRepository):
     """
@@ -227,6 +232,42 @@ class MercurialRepository(BaseRepository):
                  self._repo._bookmarks.items()]
         return OrderedDict(sorted(_bookmarks, key=sortkey, reverse=True))
 
+    @classmethod
+    def get_change_token(cls, repo_path):
+        controldir = os.path.join(repo_path, '.hg')
+        return stat_token([
+            os.path.join(controldir, 'store', '00changelog.i'),
+            os.path.join(controldir, 'store', 'phaseroots'),
+            os.path.join(controldir, 'bookmarks'),
+        ])
+
+    def get_memory_footprint(self):
+        size = super(MercurialRepository, self).get_memory_footprint()
+        revisions = self.__dict__.get('revisions')
+        if isinstance(revisions, list):
+            # changelog index loaded by mercurial
+            size += len(revisions) * CHANGELOG_ENTRY_FOOTPRINT
+        return size
+
+    def _get_changeset_metadata_path(self):
+        return os.path.join(self._repo.path, METADATA_STORE_DIR)
+
+    def _read_changeset_metadata(self, index):
+        changelog = self._repo.changelog
+        node = changelog.node(index)
+        _manifest, user, (timestamp, tzoffset), _files, description, extra = \
+            changelog.read(node)
+        return (hex(node), timestamp, tzoffset, safe_unicode(user),
+                safe_unicode(extra.get('branch', self.DEFAULT_BRANCH_NAME)),
+                safe_unicode(description),
+                [p for p in changelog.parentrevs(index) if p >= 0])
+
+    def _get_revision_numbers(self, revisions):
+        changelog = self._repo.changelog
+        return [rev if isinstance(rev, (int, long))
+                else changelog.rev(changelog.lookup(rev))
+                for rev in revisions]
+
     def _get_all_revisions(self):
 
         return map(lambda x: hex(x[7]), self._repo.changelog.index)[:-1]
@@ -246,6 +287,16 @@ class MercurialRepository(BaseRepository):
         :param context: How many lines before/after changed lines should be
           shown. Defaults to ``3``.
         """
+        return ''.join(self.get_chunked_diff(rev1, rev2, path=path,
+                                    ignore_whitespace=ignore_whitespace,
+                                    context=context))
+
+    def get_chunked_diff(self, rev1, rev2, path='', ignore_whitespace=False,
+                         context=3):
+        """
+        Returns iterable over chunks of the diff of :meth:`get_diff`, as
+        generated by Mercurial file by file.
+        """
         if hasattr(rev1, 'raw_id'):
             rev1 = getattr(rev1, 'raw_id')
 
@@ -262,10 +313,25 @@ class MercurialRepository(BaseRepository):
         else:
             file_filter = None
 
-        return ''.join(patch.diff(self._repo, rev1, rev2, match=file_filter,
+        return patch.diff(self._repo, rev1, rev2, match=file_filter,
                           opts=diffopts(git=True,
                                         ignorews=ignore_whitespace,
-                                        context=context)))
+                                        context=context))
+
+    def get_changed_paths(self, rev1, rev2):
+        """
+        Returns tuple of (added, changed, removed) lists of paths of files
+        differing between trees of ``rev1`` and ``rev2``, computed from
+        a single manifest comparison without walking history. Renames are
+        reported as removal and addition.
+        """
+        if rev1 == self.EMPTY_CHANGESET:
+            node1 = nullid
+        else:
+            node1 = self._repo[self.get_changeset(rev1).raw_id].node()
+        node2 = self._repo[self.get_changeset(rev2).raw_id].node()
+        status = self._repo.status(node1, node2)
+        return list(status[1]), list(status[0]), list(status[2])
 
     @classmethod
     def _check_url(cls, url, repoui=None):
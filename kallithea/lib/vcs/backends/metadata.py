@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+"""
+    vcs.backends.metadata
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    Persistent, append-only store of changeset metadata (author, date,
+    message, branch and parents) shared by all backends.
+
+    The store lives in ``kallithea-metadata`` inside of the repository's
+    control directory and consists of:
+
+    ``state``
+        number of stored revisions, strings, message bytes and parent
+        entries. It is always replaced atomically and is the commit point of
+        every update; data written after sizes recorded in it are leftovers
+        of interrupted updates and are dropped by the next one.
+    ``rows``
+        one fixed size record per integer revision: binary sha, timestamp,
+        timezone offset, author and branch string numbers, message offset and
+        length, offset and number of parent revisions
+    ``strings``
+        table of authors and branch names, one utf-8 encoded per line
+    ``messages``
+        utf-8 encoded commit messages, concatenated
+    ``parents``
+        flat little endian int32 array of parent revisions
+
+    Rows are keyed by integer revision and carry the sha they were built
+    for, so rows following a history rewrite are detected and dropped.
+"""
+
+import os
+import struct
+import logging
+import binascii
+
+from kallithea.lib.vcs.utils.storefiles import StoreLock, append_at
+
+log = logging.getLogger(__name__)
+
+STORE_DIR = 'kallithea-metadata'
+STATE_FILE = 'state'
+
+INT = struct.Struct('<i')
+ROW = struct.Struct('<20sdiiiqiii')
+NO_BRANCH = -1
+
+
+class ChangesetMetadataStore(object):
+    """
+    Reads and appends rows of the store at ``store_path``. Rows are tuples of
+    (raw_id, timestamp, tzoffset, author, branch, message, parents) where
+    strings are unicode, ``branch`` is None if backend doesn't record
+    branches in changesets and ``parents`` is list of integer revisions.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self._strings = []
+        self._state = None
+
+    def _path(self, name):
+        return os.path.join(self.store_path, name)
+
+    def _read_state(self):
+        """
+        Returns (count, nstrings, messages size, nparents) of last committed
+        update.
+        """
+        try:
+            f = open(self._path(STATE_FILE), 'rb')
+        except IOError:
+            return 0, 0, 0, 0
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            count, nstrings, nmessages, nparents = map(int, data.split())
+        except ValueError:
+            log.warning('Ignoring corrupted changeset metadata state in %s'
+                        % self.store_path)
+            return 0, 0, 0, 0
+        return count, nstrings, nmessages, nparents
+
+    def _write_state(self, state):
+        path = self._path(STATE_FILE)
+        tmp_path = '%s.tmp' % path
+        f = open(tmp_path, 'wb')
+        try:
+            f.write('%d %d %d %d\n' % state)
+        finally:
+            f.close()
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
+        self._state = state
+
+    def refresh(self):
+        """
+        Re-reads committed state of the store, i.e. after another process
+        has extended it.
+        """
+        self._state = self._read_state()
+        nstrings = self._state[1]
+        if len(self._strings) > nstrings:
+            self._strings = []
+        if len(self._strings) < nstrings:
+            f = open(self._path('strings'), 'rb')
+            try:
+                lines = f.read().split('\n')[:nstrings]
+            finally:
+                f.close()
+            self._strings = [line.decode('utf-8') for line in lines]
+
+    def __len__(self):
+        if self._state is None:
+            self.refresh()
+        return self._state[0]
+
+    def _read_raw_rows(self, revisions):
+        """
+        Returns dict mapping stored integer revisions from ``revisions`` to
+        unpacked records.
+        """
+        count = len(self)
+        revisions = sorted(set(rev for rev in revisions if 0 <= rev < count))
+        raw_rows = {}
+        if not revisions:
+            return raw_rows
+        f = open(self._path('rows'), 'rb')
+        try:
+            for rev in revisions:
+                f.seek(rev * ROW.size)
+                raw_rows[rev] = ROW.unpack(f.read(ROW.size))
+        finally:
+            f.close()
+        return raw_rows
+
+    def get_raw_ids(self, start=0):
+        """
+        Returns list of shas of stored rows starting at ``start``.
+        """
+        count = len(self)
+        if start >= count:
+            return []
+        f = open(self._path('rows'), 'rb')
+        try:
+            f.seek(start * ROW.size)
+            data = f.read((count - start) * ROW.size)
+        finally:
+            f.close()
+        return [binascii.hexlify(data[offset:offset + 20])
+                for offset in xrange(0, len(data), ROW.size)]
+
+    def get_rows(self, revisions):
+        """
+        Returns dict mapping stored integer revisions from ``revisions`` to
+        rows.
+        """
+        raw_rows = self._read_raw_rows(revisions)
+        rows = {}
+        if not raw_rows:
+            return rows
+        strings = self._strings
+        messages = open(self._path('messages'), 'rb')
+        parents = open(self._path('parents'), 'rb')
+        try:
+            for rev, (binsha, timestamp, tzoffset, author, branch, msg_offset,
+                      msg_length, parents_offset, nparents) in raw_rows.iteritems():
+                messages.seek(msg_offset)
+                message = messages.read(msg_length).decode('utf-8')
+                parents.seek(parents_offset * INT.size)
+                parent_revs = list(struct.unpack('<%di' % nparents,
+                                           parents.read(nparents * INT.size)))
+                rows[rev] = (binascii.hexlify(binsha), timestamp, tzoffset,
+                             strings[author],
+                             strings[branch] if branch != NO_BRANCH else None,
+                             message, parent_revs)
+        finally:
+            messages.close()
+            parents.close()
+        return rows
+
+    def update(self, revisions, read_row, limit=None):
+        """
+        Drops rows which don't match ``revisions`` any longer (after history
+        rewrite) and appends rows for revisions not stored yet, at most
+        ``limit`` of them if given. Rows are created by ``read_row`` called
+        with integer revision. Returns False if store couldn't be updated
+        right now (it is being updated by other process or is not writable).
+        """
+        try:
+            if not os.path.isdir(self.store_path):
+                os.makedirs(self.store_path)
+            lock = StoreLock(self._path(STATE_FILE))
+            if not lock.acquire():
+                return False
+        except (IOError, OSError), e:
+            log.debug('Cannot update changeset metadata in %s: %s'
+                      % (self.store_path, e))
+            return False
+        try:
+            self.refresh()
+            self._drop_rewritten(revisions)
+            count = len(self)
+            end = len(revisions)
+            if limit is not None:
+                end = min(end, count + limit)
+            if end > count:
+                self._append([read_row(rev) for rev in xrange(count, end)])
+            return True
+        except (IOError, OSError), e:
+            log.warning('Cannot update changeset metadata in %s: %s'
+                        % (self.store_path, e))
+            return False
+        finally:
+            lock.release()
+
+    def _drop_rewritten(self, revisions):
+        count = len(self)
+        if not count:
+            return
+        last = count - 1
+        if last < len(revisions) and \
+                self._read_raw_rows([last])[last][0] == \
+                binascii.unhexlify(revisions[last]):
+            return
+        keep = 0
+        for rev, raw_id in enumerate(self.get_raw_ids()):
+            if rev >= len(revisions) or revisions[rev] != raw_id:
+                break
+            keep = rev + 1
+        log.debug('Dropping %s rewritten changeset metadata rows in %s'
+                  % (count - keep, self.store_path))
+        if keep:
+            row = self._read_raw_rows([keep])[keep]
+            self._write_state((keep, self._state[1], row[5], row[7]))
+        else:
+            self._write_state((0, self._state[1], 0, 0))
+
+    def _append(self, rows):
+        count, nstrings, nmessages, nparents = self._state
+        string_ids = dict((s, i) for i, s in enumerate(self._strings))
+        new_strings = []
+
+        def string_id(value):
+            i = string_ids.get(value)
+            if i is None:
+                i = string_ids[value] = nstrings + len(new_strings)
+                new_strings.append(value)
+            return i
+
+        row_data = []
+        message_data = []
+        parent_data = []
+        for raw_id, timestamp, tzoffset, author, branch, message, parents \
+                in rows:
+            # strings table is line based
+            author = author.replace('\n', ' ')
+            message = message.encode('utf-8')
+            branch_id = NO_BRANCH
+            if branch is not None:
+                branch_id = string_id(branch.replace('\n', ' '))
+            row_data.append(ROW.pack(binascii.unhexlify(raw_id),
+                                     timestamp, tzoffset or 0,
+                                     string_id(author), branch_id,
+                                     nmessages, len(message),
+                                     nparents, len(parents)))
+            message_data.append(message)
+            nmessages += len(message)
+            parent_data.append(struct.pack('<%di' % len(parents), *parents))
+            nparents += len(parents)
+
+        append_at(self._path('strings'), self._strings_size(),
+                ''.join(s.encode('utf-8') + '\n' for s in new_strings))
+        append_at(self._path('messages'), self._state[2],
+                ''.join(message_data))
+        append_at(self._path('parents'), self._state[3] * INT.size,
+                ''.join(parent_data))
+        append_at(self._path('rows'), count * ROW.size, ''.join(row_data))
+        self._write_state((count + len(rows), nstrings + len(new_strings),
+                           nmessages, nparents))
+        self._strings.extend(new_strings)
+
+    def _strings_size(self):
+        return sum(len(s.encode('utf-8')) + 1 for s in self._strings)
@@ -23,6 +23,20 @@ DEFAULT_ENCODINGS = aslist('utf8')
 GIT_EXECUTABLE_PATH = 'git'
 # can be also --branches --tags
 GIT_REV_FILTER = '--all'
+# keep persistent revision index inside of git repositories, used only
+# together with default GIT_REV_FILTER
+GIT_REVISION_INDEX = True
+# engine computing history of files, GitLogHistoryEngine runs `git log`
+GIT_HISTORY_ENGINE = \
+    'kallithea.lib.vcs.backends.git.history.DulwichHistoryEngine'
+# keep persistent store of changeset metadata inside of repositories
+CHANGESET_METADATA = True
+# number of missing rows of metadata store filled in while reading it,
+# bigger gaps are filled in only by update_changeset_metadata
+CHANGESET_METADATA_FILL_LIMIT = 1000
+# number of missing rows of metadata store filled in by push hooks, the
+# rest is filled in by later pushes or by the search index queue watcher
+CHANGESET_METADATA_PUSH_LIMIT = 1000
 
 BACKENDS = {
     'hg': 'kallithea.lib.vcs.backends.hg.MercurialRepository',
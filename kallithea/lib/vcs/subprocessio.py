@@ -23,9 +23,19 @@ along with git_http_backend.py Project.
 If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import errno
+import select
 import subprocess
 from kallithea.lib.vcs.utils.compat import deque, Event, Thread, _bytes, _bytearray
 
+try:
+    import fcntl
+except ImportError:  # not posix
+    fcntl = None
+
+#: whether ``PollingSubprocessIO`` can be used on this platform
+POLLING_AVAILABLE = fcntl is not None and hasattr(select, 'poll')
+
 
 class StreamFeeder(Thread):
     """
@@ -425,3 +435,186 @@ class SubprocessIOChunker(object):
 
     def __del__(self):
         self.close()
+
+
+class PollingSubprocessIO(object):
+    """
+    Alternative to ``SubprocessIOChunker`` running without any threads.
+
+    Pipes of the process are served by a single loop polling them, run by
+    whoever iterates over the output - typically the WSGI server sending it
+    to the client. Standard output is read only when the next chunk is
+    asked for, so a slow client stops the process instead of filling
+    buffers (backpressure), and input is fed to the process only when its
+    pipe can take it. Chunks are passed on as read by ``os.read``, without
+    being copied to intermediate buffers.
+
+    The command is an argument list run without shell. Like with
+    ``SubprocessIOChunker``, errors of the process reported before its
+    first output are raised as ``EnvironmentError`` from the constructor.
+    """
+
+    def __init__(self, cmd, inputstream=None, buffer_size=65536,
+                 starting_values=[], max_error_size=16000, **kwargs):
+        """
+        :param cmd: list of the command and its arguments
+        :param inputstream: (Default: None) A file-like or a string fed to
+            the process as standard input.
+        :param buffer_size: (Default: 65536) Largest chunk read from
+            standard input and output at a time in bytes.
+        :param starting_values: (Default: []) An array of strings to put in
+            front of output.
+        :param max_error_size: (Default: 16000) How much of standard error is
+            kept for error messages in bytes.
+        """
+        if isinstance(inputstream, basestring):
+            from cStringIO import StringIO
+            inputstream = StringIO(inputstream)
+        self.buffer_size = buffer_size
+        self.max_error_size = max_error_size
+        self._input = inputstream
+        self._pending = ''
+        self._offset = 0
+        self._error = []
+        self._error_size = 0
+        self._complete = False
+
+        kwargs['shell'] = False
+        self.process = subprocess.Popen(cmd, bufsize=0,
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        **kwargs)
+        self._stdin = self.process.stdin.fileno()
+        self._stdout = self.process.stdout.fileno()
+        self._stderr = self.process.stderr.fileno()
+        self._pipes = {}
+        self._poller = select.poll()
+        for pipe, mask in [(self.process.stdout, select.POLLIN),
+                           (self.process.stderr, select.POLLIN),
+                           (self.process.stdin, select.POLLOUT)]:
+            self._pipes[pipe.fileno()] = pipe
+            self._poller.register(pipe, mask)
+        fcntl.fcntl(self._stdin, fcntl.F_SETFL,
+                    fcntl.fcntl(self._stdin, fcntl.F_GETFL) | os.O_NONBLOCK)
+        if inputstream is None:
+            self._close_pipe(self._stdin)
+
+        # read until the first output or the end of the process, to find
+        # out if it failed
+        self._output = list(starting_values)
+        first = self._read_output()
+        if first is not None:
+            self._output.append(first)
+        else:
+            self._finish()
+        returncode = self.process.poll()
+        if returncode or (returncode is None and self._error):
+            out = ''.join(self._output[len(starting_values):])
+            err = ''.join(self._error)
+            if (err.strip() == 'fatal: The remote end hung up unexpectedly' and
+                out.startswith('0034shallow ')):
+                # hack inspired by https://github.com/schacon/grack/pull/7
+                self.close()
+                self._complete = True
+                return
+            self.close()
+            if err:
+                raise EnvironmentError(
+                    "Subprocess exited due to an error:\n" + err)
+            raise EnvironmentError(
+                "Subprocess exited with non 0 ret code:%s" % returncode)
+
+    def _close_pipe(self, fd):
+        pipe = self._pipes.pop(fd, None)
+        if pipe is not None:
+            self._poller.unregister(fd)
+            pipe.close()
+
+    def _write_input(self, fd):
+        if self._offset >= len(self._pending):
+            self._pending = self._input.read(self.buffer_size)
+            self._offset = 0
+            if not self._pending:
+                self._close_pipe(fd)
+                return
+        try:
+            self._offset += os.write(fd, buffer(self._pending, self._offset))
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return
+            if e.errno != errno.EPIPE:
+                raise
+            # the process doesn't read any more input
+            self._close_pipe(fd)
+
+    def _read_error(self, fd):
+        data = os.read(fd, 4096)
+        if not data:
+            self._close_pipe(fd)
+        elif self._error_size < self.max_error_size:
+            self._error.append(data)
+            self._error_size += len(data)
+
+    def _read_output(self):
+        """
+        Polls the pipes until a chunk of output is read and returns it, or
+        returns None when the output ended.
+        """
+        while self._stdout in self._pipes:
+            try:
+                events = self._poller.poll()
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            chunk = None
+            for fd, _event in events:
+                if fd not in self._pipes:
+                    continue
+                if fd == self._stdout:
+                    chunk = os.read(fd, self.buffer_size)
+                    if not chunk:
+                        self._close_pipe(fd)
+                elif fd == self._stderr:
+                    self._read_error(fd)
+                else:
+                    self._write_input(fd)
+            if chunk:
+                return chunk
+        return None
+
+    def _finish(self):
+        """
+        Waits for the process after its output ended, reading the rest of
+        standard error so it can't block on it.
+        """
+        self._close_pipe(self._stdin)
+        while self._stderr in self._pipes:
+            self._read_error(self._stderr)
+        return self.process.wait()
+
+    def __iter__(self):
+        output, self._output = self._output, []
+        for chunk in output:
+            yield chunk
+        if self._complete:
+            return
+        while True:
+            chunk = self._read_output()
+            if chunk is None:
+                break
+            yield chunk
+        if self._finish():
+            raise EnvironmentError("Subprocess exited due to an error:\n" +
+                                   ''.join(self._error))
+
+    def close(self):
+        for fd in self._pipes.keys():
+            self._close_pipe(fd)
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except OSError:
+                pass
+            self.process.wait()
@@ -9,59 +9,162 @@
     :copyright: (c) 2010-2011 by Marcin Kuzminski, Lukasz Balcerzak.
 """
 
+import bz2
+import zlib
+import Queue
+import threading
 
-class BaseArchiver(object):
+from kallithea.lib.vcs.exceptions import VCSError
 
-    def __init__(self):
-        self.archive_file = self._get_archive_file()
+#: default size of chunks of streamed archives
+CHUNK_SIZE = 16 * 1024
+#: number of chunks buffered between archive writer and its consumer
+QUEUE_SIZE = 16
 
-    def addfile(self):
-        """
-        Adds a file to archive container
-        """
-        pass
 
-    def close(self):
-        """
-        Closes and finalizes operation of archive container object
-        """
-        self.archive_file.close()
-
-    def _get_archive_file(self):
-        """
-        Returns container for specific archive
-        """
-        raise NotImplementedError()
-
-
-class TarArchiver(BaseArchiver):
-    pass
-
-
-class Tbz2Archiver(BaseArchiver):
-    pass
-
-
-class TgzArchiver(BaseArchiver):
-    pass
-
-
-class ZipArchiver(BaseArchiver):
-    pass
+class ArchiveAborted(Exception):
+    """
+    Raised to the archive writer when consumer of the archive went away.
+    """
 
 
-def get_archiver(self, kind):
+class _QueueWriter(object):
+    """
+    Write only file like object passing written data to the queue in chunks
+    of at least ``chunk_size`` bytes.
     """
-    Returns instance of archiver class specific to given kind
 
-    :param kind: archive kind
+    def __init__(self, queue, chunk_size, aborted):
+        self._queue = queue
+        self._chunk_size = chunk_size
+        self._aborted = aborted
+        self._buffer = []
+        self._size = 0
+
+    def write(self, data):
+        if not data:
+            return
+        self._buffer.append(data)
+        self._size += len(data)
+        if self._size >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._put(('data', ''.join(self._buffer)))
+            self._buffer = []
+            self._size = 0
+
+    def _put(self, item):
+        while True:
+            if self._aborted.is_set():
+                raise ArchiveAborted()
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+
+class ArchiveStream(object):
     """
+    Iterable over chunks of an archive written by ``fill`` callable into
+    a file like object passed to it. ``fill`` runs in a separate thread and
+    is throttled by the consumer, so the archive is never held in memory or
+    on disk as a whole. Errors raised by ``fill`` are raised from iteration.
 
-    archivers = {
-        'tar': TarArchiver,
-        'tbz2': Tbz2Archiver,
-        'tgz': TgzArchiver,
-        'zip': ZipArchiver,
-    }
+    Archivers which write to a file object (like mercurial's ``archival``)
+    can be streamed this way.
+    """
 
-    return archivers[kind]()
+    def __init__(self, fill, chunk_size=CHUNK_SIZE):
+        self._fill = fill
+        self._chunk_size = chunk_size
+
+    def _run(self, writer):
+        try:
+            self._fill(writer)
+            writer.flush()
+            writer._put(('done', None))
+        except ArchiveAborted:
+            pass
+        except Exception, e:
+            try:
+                writer._put(('error', e))
+            except ArchiveAborted:
+                pass
+
+    def __iter__(self):
+        queue = Queue.Queue(QUEUE_SIZE)
+        aborted = threading.Event()
+        writer = _QueueWriter(queue, self._chunk_size, aborted)
+        thread = threading.Thread(target=self._run, args=(writer,),
+                                  name='archive writer')
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                kind, value = queue.get()
+                if kind == 'data':
+                    yield value
+                elif kind == 'error':
+                    raise value
+                else:
+                    break
+        finally:
+            # stops the writer if the consumer didn't read everything
+            aborted.set()
+
+
+def iter_process_output(popen, chunk_size=CHUNK_SIZE):
+    """
+    Yields chunks of standard output of ``popen`` process; the process is
+    stopped if the consumer didn't read all of it. Standard error is read by
+    a separate thread, so the process never blocks on a full pipe; raises
+    ``VCSError`` with it when the process exits with non-zero status.
+    """
+    errors = []
+    reader = None
+    if popen.stderr:
+        reader = threading.Thread(target=lambda:
+                                  errors.append(popen.stderr.read()),
+                                  name='process stderr reader')
+        reader.daemon = True
+        reader.start()
+    try:
+        while True:
+            chunk = popen.stdout.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        # closed pipe stops the process if it didn't finish yet
+        popen.stdout.close()
+        if reader is not None:
+            reader.join()
+            popen.stderr.close()
+        popen.wait()
+    if popen.returncode:
+        raise VCSError('Process failed with exit status %s: %s'
+                       % (popen.returncode, ''.join(errors).strip()))
+
+
+def iter_compressed(chunks, kind):
+    """
+    Yields ``chunks`` compressed by gzip for ``kind`` 'tgz' or by bzip2 for
+    'tbz2'.
+    """
+    if kind == 'tgz':
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = bz2.BZ2Compressor(9)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+    vcs.utils.storefiles
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Helpers shared by append-only stores kept in repositories' control
+    directories, like the git revision index and the changeset metadata
+    store: lock of their writers and appending to their data files.
+"""
+
+import os
+import time
+import logging
+
+from kallithea.lib.vcs.utils.lockfiles import LockFile
+
+log = logging.getLogger(__name__)
+
+#: lock files older than this (in seconds) are considered left over by
+#: a crashed process
+STALE_LOCK_AGE = 600
+
+
+class StoreLock(LockFile):
+    """
+    Guards writers of a store; readers never take it. Locks older than
+    ``STALE_LOCK_AGE`` are removed before the lock is taken.
+    """
+    __slots__ = ()
+
+    def acquire(self):
+        """
+        Takes the lock without waiting; returns False if it is held by
+        someone else.
+        """
+        lock_file = self._lock_file_path()
+        try:
+            if time.time() - os.stat(lock_file).st_mtime > STALE_LOCK_AGE:
+                log.warning('Removing stale lock %s' % lock_file)
+                os.remove(lock_file)
+        except OSError:
+            pass
+        try:
+            self._obtain_lock()
+        except IOError:
+            return False
+        return True
+
+    def release(self):
+        self._release_lock()
+
+
+def append_at(path, size, data):
+    """
+    Cuts file at given ``size`` (dropping leftovers of interrupted updates)
+    and appends ``data`` to it.
+    """
+    f = open(path, 'r+b' if os.path.exists(path) else 'wb')
+    try:
+        f.truncate(size)
+        f.seek(size)
+        f.write(data)
+    finally:
+        f.close()
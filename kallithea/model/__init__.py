@@ -133,6 +133,15 @@ class BaseModel(object):
         return self._get_instance(Permission, permission,
                                   callback=Permission.get_by_key)
 
+    def _invalidate_permissions(self):
+        """
+        Invalidates cached permission snapshots of all users; has to be called
+        by every change affecting permissions, it takes effect when the
+        change is committed.
+        """
+        from kallithea.model.db import CacheInvalidation
+        CacheInvalidation.bump_generation(CacheInvalidation.PERMISSIONS_KEY)
+
     @classmethod
     def get_all(cls):
         """
@@ -30,6 +30,7 @@ import time
 import logging
 import datetime
 import traceback
+import weakref
 import hashlib
 import collections
 import functools
@@ -37,7 +38,6 @@ import functools
 from sqlalchemy import *
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, joinedload, class_mapper, validates
-from beaker.cache import cache_region, region_invalidate
 from webob.exc import HTTPNotFound
 
 from pylons.i18n.translation import lazy_ugettext as _
@@ -757,6 +757,10 @@ class UserIpMap(Base, BaseModel):
 class UserLog(Base, BaseModel):
     __tablename__ = 'user_logs'
     __table_args__ = (
+        # journals are paged by (action_date, user_log_id), see KeysetPage
+        Index('ul_action_date_idx', 'action_date', 'user_log_id'),
+        Index('ul_repository_id_idx', 'repository_id', 'action_date', 'user_log_id'),
+        Index('ul_user_id_idx', 'user_id', 'action_date', 'user_log_id'),
         {'extend_existing': True, 'mysql_engine': 'InnoDB',
          'mysql_charset': 'utf8', 'sqlite_autoincrement': True},
     )
@@ -768,6 +772,9 @@ class UserLog(Base, BaseModel):
     user_ip = Column("user_ip", String(255, convert_unicode=False), nullable=True, unique=None, default=None)
     action = Column("action", UnicodeText(1200000, convert_unicode=False), nullable=True, unique=None, default=None)
     action_date = Column("action_date", DateTime(timezone=False), nullable=True, unique=None, default=None)
+    # number of pushed revisions, which are in UserLogRevision; None for
+    # other actions and for pushes with revisions in action
+    revisions_count = Column("revisions_count", Integer(), nullable=True, unique=None, default=None)
 
     def __unicode__(self):
         return u"<%s('id:%s:%s')>" % (self.__class__.__name__,
@@ -780,6 +787,64 @@ class UserLog(Base, BaseModel):
 
     user = relationship('User')
     repository = relationship('Repository', cascade='')
+    revisions = relationship('UserLogRevision', order_by='UserLogRevision.ordinal',
+                             cascade="all, delete-orphan", passive_deletes=True)
+
+    #: number of first revisions of pushes shown in journals
+    REVISIONS_PREVIEW = 50
+
+    @classmethod
+    def load_revisions_preview(cls, user_logs):
+        """
+        Loads first ``REVISIONS_PREVIEW`` revisions and the last revision
+        of every push in ``user_logs`` by a single query, as their
+        ``revisions_preview``.
+        """
+        logs = dict((ul.user_log_id, ul) for ul in user_logs
+                    if ul.revisions_count is not None)
+        for ul in logs.itervalues():
+            ul._revisions_preview = []
+        if not logs:
+            return
+        q = Session().query(UserLogRevision.user_log_id,
+                            UserLogRevision.revision)\
+            .join(UserLog, UserLog.user_log_id == UserLogRevision.user_log_id)\
+            .filter(UserLogRevision.user_log_id.in_(logs.keys()))\
+            .filter(or_(UserLogRevision.ordinal < cls.REVISIONS_PREVIEW,
+                        UserLogRevision.ordinal == UserLog.revisions_count - 1))\
+            .order_by(UserLogRevision.user_log_id, UserLogRevision.ordinal)
+        for user_log_id, revision in q:
+            logs[user_log_id]._revisions_preview.append(revision)
+
+    @property
+    def revisions_preview(self):
+        """
+        First ``REVISIONS_PREVIEW`` pushed revisions, followed by the last
+        one if there are more of them.
+        """
+        if getattr(self, '_revisions_preview', None) is None:
+            self.load_revisions_preview([self])
+        return self._revisions_preview
+
+
+class UserLogRevision(Base, BaseModel):
+    """
+    Revision pushed by action in UserLog, ``ordinal`` is the position of
+    the revision in the push.
+    """
+    __tablename__ = 'user_log_revisions'
+    __table_args__ = (
+        {'extend_existing': True, 'mysql_engine': 'InnoDB',
+         'mysql_charset': 'utf8'},
+    )
+    user_log_id = Column("user_log_id", Integer(), ForeignKey('user_logs.user_log_id', ondelete='CASCADE'), nullable=False, primary_key=True)
+    ordinal = Column("ordinal", Integer(), nullable=False, primary_key=True, autoincrement=False)
+    revision = Column("revision", String(255, convert_unicode=False), nullable=False)
+
+    def __unicode__(self):
+        return u"<%s('%s:%s:%s')>" % (self.__class__.__name__,
+                                      self.user_log_id, self.ordinal,
+                                      self.revision)
 
 
 class UserGroup(Base, BaseModel):
@@ -1419,18 +1484,16 @@ class Repository(Base, BaseModel):
         return self.__get_instance()
 
     def scm_instance_cached(self, valid_cache_keys=None):
-        @cache_region('long_term')
-        def _c(repo_name):
-            return self.__get_instance()
-        rn = self.repo_name
-
-        valid = CacheInvalidation.test_and_set_valid(rn, None, valid_cache_keys=valid_cache_keys)
-        if not valid:
-            log.debug('Cache for %s invalidated, getting new object' % (rn))
-            region_invalidate(_c, None, rn)
-        else:
-            log.debug('Getting scm_instance of %s from cache' % (rn))
-        return _c(rn)
+        """
+        Returns instance from process wide cache of scm instances, which
+        notices changes of the repository by itself. ``valid_cache_keys`` is
+        not used any longer and kept for compatibility.
+        """
+        from kallithea.lib.scm_cache import get_scm_instance_cache
+        repo_full_path = self.repo_full_path
+        return get_scm_instance_cache().get(repo_full_path,
+                                            get_backend(self.repo_type),
+                                            self.__get_instance)
 
     def __get_instance(self):
         repo_full_path = self.repo_full_path
@@ -2029,18 +2092,36 @@ class CacheInvalidation(Base, BaseModel):
     cache_key = Column("cache_key", String(255, convert_unicode=False), nullable=True, unique=None, default=None)
     # cache_args is a repo_name
     cache_args = Column("cache_args", String(255, convert_unicode=False), nullable=True, unique=None, default=None)
-    # instance sets cache_active True when it is caching,
-    # other instances set cache_active to False to indicate that this cache is invalid
+    # cache_active is set True when the key is registered and False when the
+    # cache is invalidated; it is informational only
     cache_active = Column("cache_active", Boolean(), nullable=True, unique=None, default=False)
+    # incremented on every invalidation, instances compare it with the
+    # generation their cached values were created for
+    cache_generation = Column("cache_generation", Integer(), nullable=True, unique=None, default=0)
+
+    # key bumped by every change of permissions, shared by all instances
+    PERMISSIONS_KEY = '_permissions_'
+    # key holding the generation new keys start at, above generations of
+    # all deleted keys
+    DELETED_KEY = '_deleted_'
+
+    # cache_key -> generation cached values of this process are valid for
+    _valid_generations = {}
+    # session -> snapshot of cache_key -> generation, read once per session
+    _session_generations = weakref.WeakKeyDictionary()
+    # sessions which bumped generations, possibly not committed yet
+    _bumped_sessions = weakref.WeakKeyDictionary()
 
     def __init__(self, cache_key, repo_name=''):
         self.cache_key = cache_key
         self.cache_args = repo_name
         self.cache_active = False
+        self.cache_generation = 0
 
     def __unicode__(self):
-        return u"<%s('%s:%s[%s]')>" % (self.__class__.__name__,
-                            self.cache_id, self.cache_key, self.cache_active)
+        return u"<%s('%s:%s[%s:%s]')>" % (self.__class__.__name__,
+                            self.cache_id, self.cache_key, self.cache_active,
+                            self.cache_generation)
 
     def _cache_key_partition(self):
         prefix, repo_name, suffix = self.cache_key.partition(self.cache_args)
@@ -2086,54 +2167,148 @@ class CacheInvalidation(Base, BaseModel):
     @classmethod
     def set_invalidate(cls, repo_name, delete=False):
         """
-        Mark all caches of a repo as invalid in the database.
+        Mark all caches of a repo as invalid in the database, by bumping
+        generations of all its keys with a single statement.
+
+        With ``delete`` the keys are also removed from the database and are
+        registered again on their next use. ``DELETED_KEY`` is raised above
+        their generations, so keys registered again never start at a
+        generation other processes could still consider valid.
+        """
+        from kallithea.lib.invalidation import get_notifier
+        q = Session().query(cls).filter(cls.cache_args == repo_name)
+        count = q.update({
+            cls.cache_active: False,
+            cls.cache_generation: func.coalesce(cls.cache_generation, 0) + 1,
+        }, synchronize_session=False)
+        if delete and count:
+            top = (Session().query(func.max(cls.cache_generation))
+                   .filter(cls.cache_args == repo_name).scalar() or 0) + 1
+            updated = Session().query(cls)\
+                .filter(cls.cache_key == cls.DELETED_KEY)\
+                .update({
+                    cls.cache_generation: case(
+                        [(func.coalesce(cls.cache_generation, 0) < top, top)],
+                        else_=cls.cache_generation),
+                }, synchronize_session=False)
+            if not updated:
+                inv_obj = CacheInvalidation(cls.DELETED_KEY)
+                inv_obj.cache_generation = top
+                Session().add(inv_obj)
+            q.delete(synchronize_session=False)
+        log.debug('invalidated %s cache keys of repo %s'
+                  % (count, safe_str(repo_name)))
+        Session().commit()
+        # this session has to see the new generations
+        cls._session_generations.pop(Session(), None)
+        get_notifier().notify(repo_name)
+
+    @classmethod
+    def _get_first_generation(cls):
+        """
+        Returns generation new keys start at, above generations of all
+        deleted keys.
+        """
+        first = Session().query(cls.cache_generation)\
+            .filter(cls.cache_key == cls.DELETED_KEY).scalar()
+        return first or 0
+
+    @classmethod
+    def _get_generations(cls):
+        """
+        Returns dict mapping cache keys to generations read by the current
+        session (i.e. request) so far; each key is read once per session.
         """
-        inv_objs = Session().query(cls).filter(cls.cache_args == repo_name).all()
-        log.debug('for repo %s got %s invalidation objects'
-                  % (safe_str(repo_name), inv_objs))
+        session = Session()
+        generations = cls._session_generations.get(session)
+        if generations is None:
+            generations = cls._session_generations[session] = {}
+        return generations
 
-        for inv_obj in inv_objs:
-            log.debug('marking %s key for invalidation based on repo_name=%s'
-                      % (inv_obj, safe_str(repo_name)))
-            if delete:
-                Session().delete(inv_obj)
+    @classmethod
+    def get_generation(cls, cache_key, repo_name=''):
+        """
+        Returns current generation of given cache key, registering the key on
+        its first use so invalidations can find it.
+        """
+        generations = cls._get_generations()
+        generation = generations.get(cache_key)
+        if generation is None:
+            # other keys of the repository are likely to be used by the same
+            # request, they are read together
+            q = Session().query(cls.cache_key, cls.cache_generation)
+            if repo_name:
+                q = q.filter(cls.cache_args == repo_name)
             else:
-                inv_obj.cache_active = False
+                q = q.filter(cls.cache_key == cache_key)
+            for key, key_generation in q.all():
+                generations.setdefault(key, key_generation or 0)
+            generation = generations.get(cache_key)
+        if generation is None:
+            inv_obj = cls.query().filter(cls.cache_key == cache_key).scalar()
+            if inv_obj is None:
+                inv_obj = CacheInvalidation(cache_key, repo_name)
+                inv_obj.cache_active = True
+                inv_obj.cache_generation = cls._get_first_generation()
                 Session().add(inv_obj)
-        Session().commit()
+                Session().commit()
+            generation = generations[cache_key] = inv_obj.cache_generation or 0
+        return generation
 
     @classmethod
-    def test_and_set_valid(cls, repo_name, kind, valid_cache_keys=None):
+    def bump_generation(cls, cache_key):
+        """
+        Increments generation of given cache key within the current
+        transaction, so other processes see the new generation together with
+        the changes it stands for.
+        """
+        session = Session()
+        count = session.query(cls).filter(cls.cache_key == cache_key)\
+            .update({
+                cls.cache_generation: func.coalesce(cls.cache_generation, 0) + 1,
+            }, synchronize_session=False)
+        if not count:
+            inv_obj = CacheInvalidation(cache_key)
+            inv_obj.cache_active = True
+            inv_obj.cache_generation = cls._get_first_generation() + 1
+            session.add(inv_obj)
+        cls._session_generations.pop(session, None)
+        cls._bumped_sessions[session] = True
+
+    @classmethod
+    def has_bumped_generations(cls):
         """
-        Mark this cache key as active and currently cached.
-        Return True if the existing cache registration still was valid.
-        Return False to indicate that it had been invalidated and caches should be refreshed.
+        Returns True if generations were bumped in the current session; values
+        computed by it may depend on uncommitted changes and shouldn't be
+        cached.
         """
+        return Session() in cls._bumped_sessions
 
+    @classmethod
+    def test_and_set_valid(cls, repo_name, kind, valid_cache_keys=None):
+        """
+        Remember current generation of this cache key as the one cached values
+        of this process are valid for.
+        Return True if cached values still are valid.
+        Return False to indicate that the cache had been invalidated since it
+        was used last and caches should be refreshed.
+
+        ``valid_cache_keys`` is not used any longer and kept for
+        compatibility.
+        """
+        from kallithea.lib.invalidation import get_notifier
         key = (repo_name + '_' + kind) if kind else repo_name
         cache_key = cls._get_cache_key(key)
 
-        if valid_cache_keys and cache_key in valid_cache_keys:
-            return True
+        generation = get_notifier().get_generation(repo_name)
+        if generation is None:
+            generation = cls.get_generation(cache_key, repo_name)
 
-        inv_obj = cls.query().filter(cls.cache_key == cache_key).scalar()
-        if not inv_obj:
-            inv_obj = CacheInvalidation(cache_key, repo_name)
-        if inv_obj.cache_active:
+        if cls._valid_generations.get(cache_key) == generation:
             return True
-        inv_obj.cache_active = True
-        Session().add(inv_obj)
-        Session().commit()
+        cls._valid_generations[cache_key] = generation
         return False
 
-    @classmethod
-    def get_valid_cache_keys(cls):
-        """
-        Return opaque object with information of which caches still are valid
-        and can be used without checking for invalidation.
-        """
-        return set(inv_obj.cache_key for inv_obj in cls.query().filter(cls.cache_active).all())
-
 
 class ChangesetComment(Base, BaseModel):
     __tablename__ = 'changeset_comments'
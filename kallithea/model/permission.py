@@ -96,6 +96,7 @@ class PermissionModel(BaseModel):
                           % (gr, perm_name))
                 new_perm = _make_perm(perm_name)
                 self.sa.add(new_perm)
+        self._invalidate_permissions()
 
     def update(self, form_result):
         perm_user = User.get_by_username(username=form_result['perm_user_name'])
@@ -169,6 +170,7 @@ class PermissionModel(BaseModel):
                     g2p.permission = _def
                     self.sa.add(g2p)
 
+            self._invalidate_permissions()
             self.sa.commit()
         except (DatabaseError,):
             log.error(traceback.format_exc())
@@ -32,7 +32,8 @@ import shutil
 import logging
 import traceback
 from datetime import datetime
-from sqlalchemy.orm import subqueryload
+from sqlalchemy import func, and_, or_, not_, exists
+from sqlalchemy.orm import subqueryload, joinedload
 
 from kallithea.lib.utils import make_ui
 from kallithea.lib.vcs.backends import get_backend
@@ -264,6 +265,118 @@ class RepoModel(BaseModel):
             "records": repos_data
         }
 
+    #: columns repositories can be sorted by in ``get_repos_page``
+    PAGE_SORT_KEYS = {
+        'name': func.lower(Repository.repo_name),
+        'desc': func.lower(Repository.description),
+        'last_change': Repository.updated_on,
+        # last changeset is the last change of the repository
+        'last_changeset': Repository.updated_on,
+        'owner': func.lower(User.username),
+        'state': Repository.repo_state,
+    }
+
+    def _get_permission_criterion(self, user_id, perms):
+        """
+        Returns criterion of repositories where non admin user ``user_id``
+        has one of ``perms``, evaluated by the database like
+        ``AuthUser.permissions`` do: owners are admins, explicit permissions
+        of the user override permissions of his user groups, where the
+        highest one wins, and those override default permissions, which
+        don't apply to private repositories.
+        """
+        granted = Permission.permission_name.in_(perms)
+
+        def user_perm(uid, *criteria):
+            return exists().where(and_(
+                UserRepoToPerm.repository_id == Repository.repo_id,
+                UserRepoToPerm.user_id == uid,
+                UserRepoToPerm.permission_id == Permission.permission_id,
+                *criteria))
+
+        def user_group_perm(*criteria):
+            return exists().where(and_(
+                UserGroupRepoToPerm.repository_id == Repository.repo_id,
+                UserGroupRepoToPerm.users_group_id ==
+                    UserGroupMember.users_group_id,
+                UserGroupMember.user_id == user_id,
+                UserGroupRepoToPerm.permission_id == Permission.permission_id,
+                *criteria))
+
+        default_user_id = User.get_default_user(cache=True).user_id
+        default_perm = and_(Repository.private == False,
+                            user_perm(default_user_id, granted))
+        return or_(
+            Repository.user_id == user_id,
+            user_perm(user_id, granted),
+            and_(not_(user_perm(user_id)),
+                 or_(user_group_perm(granted),
+                     and_(not_(user_group_perm()), default_perm))))
+
+    def get_repos_page(self, authuser, group_id=None, name_filter=None,
+                       sort='name', direction='asc', start=0, limit=20,
+                       admin=False):
+        """
+        Returns one page of repositories in repository group ``group_id``
+        (top level ones for None) readable by ``authuser``, in the format of
+        ``get_repos_as_dict``. Permissions are checked, and filtering by
+        ``name_filter``, sorting and paging is done by the database, so only
+        rows of the page are rendered.
+
+        :param authuser: ``AuthUser`` the page is shown to
+        :param sort: one of ``PAGE_SORT_KEYS``
+        :param direction: asc or desc
+        :param admin: page of the admin repository list instead, with
+            repositories of all groups ``authuser`` can administer and their
+            admin actions; ``name_filter`` matches their full names
+        """
+        q = Repository.query().join(User, Repository.user_id == User.user_id)
+        if admin:
+            perms = ['repository.admin']
+        else:
+            perms = ['repository.read', 'repository.write', 'repository.admin']
+            q = q.filter(Repository.group_id == group_id)
+        if not authuser.is_admin:
+            q = q.filter(self._get_permission_criterion(authuser.user_id,
+                                                        perms))
+        if group_id is not None and not admin:
+            group = RepoGroup.get(group_id)
+            prefix = group.group_name + self.URL_SEPARATOR if group else ''
+        else:
+            prefix = ''
+        if name_filter:
+            # repository names are matched without names of their groups
+            escape = lambda s: s.lower().replace('|', '||')\
+                .replace('%', '|%').replace('_', '|_')
+            q = q.filter(func.lower(Repository.repo_name).like(
+                u'%s%%%s%%' % (escape(prefix), escape(name_filter)),
+                escape='|'))
+
+        order_by = self.PAGE_SORT_KEYS.get(sort)
+        if order_by is None:
+            sort, order_by = 'name', self.PAGE_SORT_KEYS['name']
+        if direction == 'desc':
+            order_by = order_by.desc()
+        else:
+            direction = 'asc'
+        total = q.count()
+        repos = q.options(joinedload(Repository.user),
+                          joinedload(Repository.fork))\
+            .order_by(order_by, func.lower(Repository.repo_name))\
+            .offset(max(start, 0)).limit(max(limit, 0)).all()
+
+        # rows are rendered just like in the grids of all repositories
+        data = self.get_repos_as_dict(repos_list=repos, admin=admin,
+                                      perm_check=False,
+                                      super_user_actions=admin)
+        return {
+            "totalRecords": total,
+            "startIndex": start,
+            "sort": sort,
+            "dir": direction,
+            "records": data["records"]
+        }
+
     def _get_defaults(self, repo_name):
         """
         Gets information about repository, and returns a dict for
@@ -366,6 +479,8 @@ class RepoModel(BaseModel):
                     ex_field.field_value = kwargs[field]
                     self.sa.add(ex_field)
             self.sa.add(cur_repo)
+            # name, owner or privacy might have changed
+            self._invalidate_permissions()
 
             if org_repo_name != new_name:
                 # rename repository
@@ -465,6 +580,7 @@ class RepoModel(BaseModel):
             # now automatically start following this repository as owner
             ScmModel(self.sa).toggle_following_repo(new_repo.repo_id,
                                                     owner.user_id)
+            self._invalidate_permissions()
             # we need to flush here, in order to check if database won't
             # throw any exceptions, create filesystem dirs at the very end
             self.sa.flush()
@@ -559,6 +675,7 @@ class RepoModel(BaseModel):
             old_repo_dict = repo.get_dict()
             try:
                 self.sa.delete(repo)
+                self._invalidate_permissions()
                 if fs_remove:
                     self._delete_filesystem_repo(repo)
                 else:
@@ -594,6 +711,7 @@ class RepoModel(BaseModel):
         obj.user = user
         obj.permission = permission
         self.sa.add(obj)
+        self._invalidate_permissions()
         log.debug('Granted perm %s to %s on %s' % (perm, user, repo))
         return obj
 
@@ -614,6 +732,7 @@ class RepoModel(BaseModel):
             .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
             log.debug('Revoked perm on %s on %s' % (repo, user))
 
     def grant_user_group_permission(self, repo, group_name, perm):
@@ -644,6 +763,7 @@ class RepoModel(BaseModel):
         obj.users_group = group_name
         obj.permission = permission
         self.sa.add(obj)
+        self._invalidate_permissions()
         log.debug('Granted perm %s to %s on %s' % (perm, group_name, repo))
         return obj
 
@@ -664,6 +784,7 @@ class RepoModel(BaseModel):
             .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
             log.debug('Revoked perm to %s on %s' % (repo, group_name))
 
     def delete_stats(self, repo_name):
@@ -181,6 +181,7 @@ class RepoGroupModel(BaseModel):
             else:
                 perm_obj = self._create_default_perms(new_repo_group)
                 self.sa.add(perm_obj)
+            self._invalidate_permissions()
 
             if not just_db:
                 # we need to flush here, in order to check if database won't
@@ -322,6 +323,8 @@ class RepoGroupModel(BaseModel):
                                 % (obj.repo_name, new_name))
                     obj.repo_name = new_name
                 self.sa.add(obj)
+            # names of the group and all its children might have changed
+            self._invalidate_permissions()
 
             self._rename_group(old_path, new_path)
 
@@ -334,6 +337,7 @@ class RepoGroupModel(BaseModel):
         repo_group = self._get_repo_group(repo_group)
         try:
             self.sa.delete(repo_group)
+            self._invalidate_permissions()
             self._delete_group(repo_group, force_delete)
         except Exception:
             log.error('Error removing repo_group %s' % repo_group)
@@ -466,6 +470,7 @@ class RepoGroupModel(BaseModel):
         obj.user = user
         obj.permission = permission
         self.sa.add(obj)
+        self._invalidate_permissions()
         log.debug('Granted perm %s to %s on %s' % (perm, user, repo_group))
         return obj
 
@@ -487,6 +492,7 @@ class RepoGroupModel(BaseModel):
             .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
             log.debug('Revoked perm on %s on %s' % (repo_group, user))
 
     def grant_user_group_permission(self, repo_group, group_name, perm):
@@ -518,6 +524,7 @@ class RepoGroupModel(BaseModel):
         obj.users_group = group_name
         obj.permission = permission
         self.sa.add(obj)
+        self._invalidate_permissions()
         log.debug('Granted perm %s to %s on %s' % (perm, group_name, repo_group))
         return obj
 
@@ -539,4 +546,5 @@ class RepoGroupModel(BaseModel):
             .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
             log.debug('Revoked perm to %s on %s' % (repo_group, group_name))
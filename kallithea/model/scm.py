@@ -50,13 +50,15 @@ from kallithea.lib import helpers as h
 from kallithea.lib.utils2 import safe_str, safe_unicode, get_server_url,\
     _set_extras
 from kallithea.lib.auth import HasRepoPermissionAny, HasRepoGroupPermissionAny,\
-    HasUserGroupPermissionAny
+    HasUserGroupPermissionAny, AuthUser
 from kallithea.lib.utils import get_filesystem_repos, make_ui, \
     action_logger
 from kallithea.model import BaseModel
 from kallithea.model.db import Repository, Ui, CacheInvalidation, \
     UserFollowing, UserLog, User, RepoGroup, PullRequest
 from kallithea.lib.hooks import log_push_action
+from kallithea.lib.scm_cache import get_scm_instance_cache
+from kallithea.lib.refs_cache import invalidate_refs_cache
 from kallithea.lib.exceptions import NonRelativePathError, IMCCommitError
 
 log = logging.getLogger(__name__)
@@ -100,15 +102,11 @@ class CachedRepoList(object):
         return '<%s (%s)>' % (self.__class__.__name__, self.__len__())
 
     def __iter__(self):
-        # pre-propagated valid_cache_keys to save executing select statements
-        # for each repo
-        valid_cache_keys = CacheInvalidation.get_valid_cache_keys()
-
+        perm_checker = HasRepoPermissionAny(*self.perm_set)
         for dbr in self.db_repo_list:
-            scmr = dbr.scm_instance_cached(valid_cache_keys)
+            scmr = dbr.scm_instance_cached()
             # check permission at this level
-            if not HasRepoPermissionAny(
-                *self.perm_set)(dbr.repo_name, 'get repo check'):
+            if not perm_checker(dbr.repo_name, 'get repo check'):
                 continue
 
             try:
@@ -150,10 +148,10 @@ class SimpleCachedRepoList(CachedRepoList):
     """
 
     def __iter__(self):
+        perm_checker = HasRepoPermissionAny(*self.perm_set)
         for dbr in self.db_repo_list:
             # check permission at this level
-            if not HasRepoPermissionAny(
-                *self.perm_set)(dbr.repo_name, 'get repo check'):
+            if not perm_checker(dbr.repo_name, 'get repo check'):
                 continue
 
             tmp_d = {
@@ -188,11 +186,17 @@ class _PermCheckIterator(object):
         return '<%s (%s)>' % (self.__class__.__name__, self.__len__())
 
     def __iter__(self):
+        extra_kwargs = self.extra_kwargs
+        user = extra_kwargs.get('user')
+        if user is not None and not isinstance(user, AuthUser):
+            # resolve permissions of the user once, not for every object
+            extra_kwargs = dict(extra_kwargs, user=AuthUser(user.user_id))
+        perm_checker = self.perm_checker(*self.perm_set)
         for db_obj in self.obj_list:
             # check permission at this level
             name = getattr(db_obj, self.obj_attr, None)
-            if not self.perm_checker(*self.perm_set)(
-                    name, self.__class__.__name__, **self.extra_kwargs):
+            if not perm_checker(
+                    name, self.__class__.__name__, **extra_kwargs):
                 continue
 
             yield db_obj
@@ -341,6 +345,9 @@ class ScmModel(BaseModel):
         CacheInvalidation.set_invalidate(repo_name, delete=delete)
         repo = Repository.get_by_repo_name(repo_name)
         if repo:
+            get_scm_instance_cache().invalidate(repo.repo_full_path)
+            if repo.repo_type == 'git':
+                invalidate_refs_cache(repo.repo_full_path)
             repo.update_changeset_cache()
 
     def toggle_following_repo(self, follow_repo_id, user_id):
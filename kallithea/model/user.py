@@ -389,6 +389,7 @@ class UserModel(BaseModel):
         new.user = user
         new.permission = perm
         self.sa.add(new)
+        self._invalidate_permissions()
         return new
 
     def revoke_perm(self, user, perm):
@@ -407,6 +408,7 @@ class UserModel(BaseModel):
                 .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
 
     def add_extra_email(self, user, email):
         """
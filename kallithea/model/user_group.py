@@ -118,6 +118,7 @@ class UserGroupModel(BaseModel):
             self.sa.add(new_user_group)
             perm_obj = self._create_default_perms(new_user_group)
             self.sa.add(perm_obj)
+            self._invalidate_permissions()
 
             self.grant_user_permission(user_group=new_user_group,
                                        user=owner, perm='usergroup.admin')
@@ -146,6 +147,8 @@ class UserGroupModel(BaseModel):
                 setattr(user_group, k, v)
 
             self.sa.add(user_group)
+            # name or members might have changed
+            self._invalidate_permissions()
         except Exception:
             log.error(traceback.format_exc())
             raise
@@ -170,6 +173,7 @@ class UserGroupModel(BaseModel):
                 raise UserGroupsAssignedException(
                     'User Group assigned to %s' % ", ".join(assigned_groups))
             self.sa.delete(user_group)
+            self._invalidate_permissions()
         except Exception:
             log.error(traceback.format_exc())
             raise
@@ -193,6 +197,7 @@ class UserGroupModel(BaseModel):
             user.group_member.append(user_group_member)
 
             self.sa.add(user_group_member)
+            self._invalidate_permissions()
             return user_group_member
         except Exception:
             log.error(traceback.format_exc())
@@ -212,6 +217,7 @@ class UserGroupModel(BaseModel):
         if user_group_member:
             try:
                 self.sa.delete(user_group_member)
+                self._invalidate_permissions()
                 return True
             except Exception:
                 log.error(traceback.format_exc())
@@ -244,6 +250,7 @@ class UserGroupModel(BaseModel):
         new.users_group = user_group
         new.permission = perm
         self.sa.add(new)
+        self._invalidate_permissions()
         return new
 
     def revokehas_permrevoke_permgrant_perm_perm(self, user_group, perm):
@@ -255,6 +262,7 @@ class UserGroupModel(BaseModel):
             .filter(UserGroupToPerm.permission == perm).scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
 
     def grant_user_permission(self, user_group, user, perm):
         """
@@ -283,6 +291,7 @@ class UserGroupModel(BaseModel):
         obj.user = user
         obj.permission = permission
         self.sa.add(obj)
+        self._invalidate_permissions()
         log.debug('Granted perm %s to %s on %s' % (perm, user, user_group))
         return obj
 
@@ -304,6 +313,7 @@ class UserGroupModel(BaseModel):
             .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
             log.debug('Revoked perm on %s on %s' % (user_group, user))
 
     def grant_user_group_permission(self, target_user_group, user_group, perm):
@@ -334,6 +344,7 @@ class UserGroupModel(BaseModel):
         obj.target_user_group = target_user_group
         obj.permission = permission
         self.sa.add(obj)
+        self._invalidate_permissions()
         log.debug('Granted perm %s to %s on %s' % (perm, target_user_group, user_group))
         return obj
 
@@ -353,6 +364,7 @@ class UserGroupModel(BaseModel):
             .scalar()
         if obj:
             self.sa.delete(obj)
+            self._invalidate_permissions()
             log.debug('Revoked perm on %s on %s' % (target_user_group, user_group))
 
     def enforce_groups(self, user, groups, extern_type=None):
@@ -216,6 +216,117 @@ class BaseTestApi(object):
         self.assertEqual(response.status, '200 OK')
         self._compare_ok(id_, expected, response.body)
 
+    def test_api_batch(self):
+        id1, call1 = _build_data(self.apikey, 'get_user',
+                                 userid=TEST_USER_ADMIN_LOGIN)
+        id2, call2 = _build_data('trololo', 'get_user')
+        id3, call3 = _build_data(self.apikey, 'get_repo')
+        params = '[%s]' % ', '.join([call1, call2, call3])
+        response = api_call(self, params)
+        self.assertEqual(response.status, '200 OK')
+
+        usr = UserModel().get_by_username(TEST_USER_ADMIN_LOGIN)
+        ret = usr.get_api_data()
+        ret['permissions'] = AuthUser(usr.user_id).permissions
+        expected = jsonify([
+            {'id': id1, 'result': ret, 'error': None},
+            {'id': id2, 'result': None, 'error': 'Invalid API KEY'},
+            {'id': id3, 'result': None,
+             'error': 'Missing non optional `repoid` arg in JSON DATA'},
+        ])
+        self.assertEqual(expected, json.loads(response.body))
+
+    def test_api_batch_authenticates_once(self):
+        calls = [_build_data(self.apikey, 'get_repo', repoid=self.REPO)
+                 for _i in range(3)]
+        params = '[%s]' % ', '.join(call for id_, call in calls)
+        with mock.patch.object(User, 'get_by_api_key',
+                               wraps=User.get_by_api_key) as get_by_api_key:
+            response = api_call(self, params)
+        self.assertEqual(get_by_api_key.call_count, 1)
+
+        given = json.loads(response.body)
+        self.assertEqual([r['id'] for r in given],
+                         [id_ for id_, call in calls])
+        for r in given:
+            self.assertEqual(r['error'], None)
+            self.assertEqual(r['result']['repo_name'], self.REPO)
+
+    def test_api_batch_streamed_result(self):
+        id1, call1 = _build_data(self.apikey, 'get_repos')
+        id2, call2 = _build_data(self.apikey, 'get_repo', repoid=self.REPO)
+        response = api_call(self, '[%s, %s]' % (call1, call2))
+
+        given = json.loads(response.body)
+        self.assertEqual(len(given), 2)
+        self._compare_ok(id1, [repo.get_api_data()
+                               for repo in RepoModel().get_all()],
+                         given=json.dumps(given[0]))
+        self.assertEqual(given[1]['result']['repo_name'], self.REPO)
+
+    def test_api_batch_empty(self):
+        response = api_call(self, '[]')
+        self._compare_error(None, 'Empty batch', given=response.body)
+
+    def test_api_batch_too_large(self):
+        calls = [_build_data(self.apikey, 'get_repo', repoid=self.REPO)
+                 for _i in range(101)]
+        params = '[%s]' % ', '.join(call for id_, call in calls)
+        response = api_call(self, params)
+        self._compare_error(None, 'Batch of 101 requests exceeds limit of 100',
+                            given=response.body)
+
+    def test_api_batch_rollback_after_error(self):
+        get_api_data = Repository.get_api_data
+        calls = []
+
+        def fail_third(repo):
+            calls.append(repo)
+            if len(calls) == 3:
+                raise Exception('Total Crash !')
+            return get_api_data(repo)
+
+        id1, call1 = _build_data(self.apikey, 'get_repo', repoid=self.REPO)
+        id2, call2 = _build_data(self.apikey, 'get_repo', repoid='no-such-repo')
+        id3, call3 = _build_data(self.apikey, 'get_repos')
+        params = '[%s, %s, %s]' % (call1, call2, call3)
+        with mock.patch.object(Repository, 'get_api_data', fail_third):
+            with mock.patch.object(Session(), 'rollback') as rollback:
+                response = api_call(self, params)
+
+        given = json.loads(response.body)
+        self.assertEqual([r['id'] for r in given], [id1, id2, id3])
+        self.assertEqual([r['error'] for r in given],
+                         [None, 'repository `no-such-repo` does not exist',
+                          'Internal server error'])
+        # after the failed call and the one failed while streaming
+        self.assertEqual(rollback.call_count, 2)
+
+    def test_api_get_repos_stream_failure(self):
+        get_api_data = Repository.get_api_data
+        calls = []
+
+        def fail_second(repo):
+            calls.append(repo)
+            if len(calls) == 2:
+                raise Exception('Total Crash !')
+            return get_api_data(repo)
+
+        id_, params = _build_data(self.apikey, 'get_repos')
+        with mock.patch.object(Repository, 'get_api_data', fail_second):
+            response = api_call(self, params)
+
+        given = json.loads(response.body)
+        self.assertEqual(given['id'], id_)
+        self.assertEqual(given['error'], 'Internal server error')
+        self.assertEqual(given['result'], jsonify([get_api_data(calls[0])]))
+
+    @mock.patch.object(Repository, 'get_api_data', crash)
+    def test_api_get_repos_exception_occurred(self):
+        id_, params = _build_data(self.apikey, 'get_repos')
+        response = api_call(self, params)
+        self._compare_error(id_, 'Internal server error', given=response.body)
+
     def test_api_get_users(self):
         id_, params = _build_data(self.apikey, 'get_users', )
         response = api_call(self, params)
@@ -148,3 +148,47 @@ class TestAdminController(TestController):
         response = self.app.get(url(controller='admin/admin', action='index',
                                     filter='date:20121020'))
         response.mustcontain('17 Entries')
+
+    def test_keyset_pages(self):
+        from kallithea.lib.helpers import KeysetPage
+        from kallithea.controllers.admin.admin import JOURNAL_KEY
+        expected = [ul.user_log_id for ul in UserLog.query()
+                    .order_by(UserLog.action_date.desc(),
+                              UserLog.user_log_id.desc())]
+        pages = []
+        after = None
+        while True:
+            page = KeysetPage(UserLog.query(), JOURNAL_KEY, after=after,
+                              items_per_page=300)
+            pages.append([ul.user_log_id for ul in page])
+            if not page.has_older:
+                break
+            after = page.cursor(page[-1])
+        assert sum(pages, []) == expected
+        assert page.item_count == 2034
+
+        # walking back gives the same pages
+        for i in reversed(range(len(pages) - 1)):
+            page = KeysetPage(UserLog.query(), JOURNAL_KEY,
+                              before=page.cursor(page[0]), items_per_page=300)
+            assert [ul.user_log_id for ul in page] == pages[i]
+        assert not page.has_newer
+
+        page = KeysetPage(UserLog.query(), JOURNAL_KEY, count_limit=1000)
+        assert page.item_count_text == 'More than 1000 Entries'
+        page = KeysetPage(UserLog.query(), JOURNAL_KEY, after='invalid')
+        assert [ul.user_log_id for ul in page] == expected[:20]
+
+    def test_index_pages(self):
+        self.log_user()
+        response = self.app.get(url(controller='admin/admin', action='index',
+                                    filter='repository:xxx'))
+        response.mustcontain('3 Entries')
+        response.mustcontain(no=['after='])
+
+        response = self.app.get(url(controller='admin/admin', action='index'))
+        after = response.body.split('after=', 1)[1].split('"', 1)[0]
+        response = self.app.get(url(controller='admin/admin', action='index',
+                                    after=after))
+        response.mustcontain('2034 Entries')
+        response.mustcontain('before=')
@@ -48,6 +48,61 @@ class _BaseTest(TestController):
         self.log_user()
         response = self.app.get(url('repos'))
 
+    def test_repos_data(self):
+        self.log_user()
+        response = self.app.get(url('admin_repos_data'),
+                                {'filter': self.REPO, 'limit': 1})
+        data = response.json
+        assert data['totalRecords'] == Repository.query().filter(
+            Repository.repo_name.like(u'%' + self.REPO + u'%')).count()
+        assert len(data['records']) == 1
+        assert data['records'][0]['raw_name'] == self.REPO
+        assert 'action' in data['records'][0]
+
+        response = self.app.get(url('admin_repos_data'),
+                                {'sort': 'owner', 'dir': 'desc', 'start': 1})
+        assert response.json['totalRecords'] == Repository.query().count()
+        assert response.json['startIndex'] == 1
+
+    def test_repos_data_permissions(self):
+        group_name = u'admin_data_%s' % self.REPO_TYPE
+        repo_name = group_name + u'/repo'
+        gr = fixture.create_repo_group(group_name)
+        fixture.create_repo(name=repo_name, repo_group=gr,
+                            repo_type=self.REPO_TYPE,
+                            cur_user=TEST_USER_ADMIN_LOGIN)
+        try:
+            # repositories of all groups are listed, matched by full names
+            self.log_user()
+            response = self.app.get(url('admin_repos_data'),
+                                    {'filter': group_name})
+            names = [r['raw_name'] for r in response.json['records']]
+            assert names == [repo_name]
+
+            # other users see only repositories they administer
+            self.app.get(url('logout_home'))
+            self.log_user(TEST_USER_REGULAR_LOGIN, TEST_USER_REGULAR_PASS)
+            RepoModel().grant_user_permission(repo_name,
+                                              TEST_USER_REGULAR_LOGIN,
+                                              'repository.write')
+            Session().commit()
+            response = self.app.get(url('admin_repos_data'),
+                                    {'filter': group_name})
+            assert response.json['totalRecords'] == 0
+
+            RepoModel().grant_user_permission(repo_name,
+                                              TEST_USER_REGULAR_LOGIN,
+                                              'repository.admin')
+            Session().commit()
+            response = self.app.get(url('admin_repos_data'),
+                                    {'filter': group_name})
+            names = [r['raw_name'] for r in response.json['records']]
+            assert names == [repo_name]
+        finally:
+            RepoModel().delete(repo_name)
+            RepoGroupModel().delete(repo_group=group_name, force_delete=True)
+            Session().commit()
+
     def test_create(self):
         self.log_user()
         repo_name = self.NEW_REPO
@@ -21,3 +21,45 @@ class TestChangesetController(TestController):
 
         response = self.app.get(url(controller='changeset', action='changeset_download',
                                     repo_name=HG_REPO, revision='a53d9201d4bc278910d416d94941b7ea007ecd52'))
+
+    def test_limited_diff(self):
+        import mock
+        from pylons import config
+        self.log_user()
+        with mock.patch.dict(config, {'cut_off_limit': '1000'}):
+            response = self.app.get(url(controller='changeset', action='index',
+                                        repo_name=HG_REPO,
+                                        revision='3803844fdbd3b711175fc3da9bdacfcd6d29a6fb'))
+        response.mustcontain('Changeset was too big and was cut off...')
+        # files cut off are listed, with their diffs loaded on demand
+        response.mustcontain('class="btn btn-mini diff-expand"')
+        response.mustcontain('setup.py')
+
+        response = self.app.get(url('files_diff_home',
+                                    repo_name=HG_REPO, f_path='setup.py',
+                                    diff1='7d4bc8ec6be56c0f10425afb40b6fc315a4c25e7',
+                                    diff2='3803844fdbd3b711175fc3da9bdacfcd6d29a6fb',
+                                    diff='diff', fulldiff=1),
+                                extra_environ={'HTTP_X_PARTIAL_XHR': '1'})
+        self.assertTrue(response.body.startswith('<table class="code-difftable">'))
+
+    def test_diff_cache(self):
+        import re
+        import mock
+        import tempfile
+        import kallithea
+        from kallithea.lib.diff_cache import get_diff_cache
+        self.log_user()
+        revision = '3803844fdbd3b711175fc3da9bdacfcd6d29a6fb'
+        with mock.patch.dict(kallithea.CONFIG,
+                             {'diff_cache_dir': tempfile.mkdtemp()}):
+            bodies = [self.app.get(url(controller='changeset', action='index',
+                                       repo_name=HG_REPO,
+                                       revision=revision)).body
+                      for i in range(2)]
+            stats = get_diff_cache().stats()
+        # containers of diffs are numbered by id() of objects
+        bodies = [re.sub(r'diff-container-\d+', '', b) for b in bodies]
+        self.assertEqual(bodies[0], bodies[1])
+        self.assertEqual((stats['diffs'], stats['hits'], stats['misses']),
+                         (1, 1, 1))
@@ -4,6 +4,7 @@ from kallithea.model.meta import Session
 from kallithea.model.db import Repository
 from kallithea.model.repo import RepoModel
 from kallithea.model.repo_group import RepoGroupModel
+from kallithea.model.user_group import UserGroupModel
 
 
 fixture = Fixture()
@@ -54,3 +55,81 @@ class TestHomeController(TestController):
             RepoModel().delete('gr1/repo_in_group')
             RepoGroupModel().delete(repo_group='gr1', force_delete=True)
             Session().commit()
+
+    def test_repos_data(self):
+        self.log_user()
+        response = self.app.get(url('repos_data'),
+                                {'filter': HG_REPO, 'limit': 1})
+        data = response.json
+        assert data['totalRecords'] == len(Repository.query().filter(
+            Repository.repo_name.like(u'%' + HG_REPO + u'%'),
+            Repository.group_id == None).all())
+        assert data['startIndex'] == 0
+        assert len(data['records']) == 1
+        assert data['records'][0]['raw_name'] == HG_REPO
+
+        response = self.app.get(url('repos_data'),
+                                {'sort': 'name', 'dir': 'desc'})
+        names = [r['raw_name'] for r in response.json['records']]
+        assert names == sorted(names, reverse=True)
+
+        response = self.app.get(url('repos_data'),
+                                {'filter': '%', 'start': 1})
+        assert response.json['totalRecords'] == 0
+        assert response.json['records'] == []
+
+    def test_repos_data_on_groups(self):
+        gr = fixture.create_repo_group(u'gr_data')
+        group_id = gr.group_id
+        fixture.create_repo(name=u'gr_data/repo_public', repo_group=gr,
+                            cur_user=TEST_USER_ADMIN_LOGIN)
+        fixture.create_repo(name=u'gr_data/repo_private', repo_group=gr,
+                            repo_private=True,
+                            cur_user=TEST_USER_ADMIN_LOGIN)
+        try:
+            self.log_user(TEST_USER_REGULAR_LOGIN, TEST_USER_REGULAR_PASS)
+            response = self.app.get(url('repos_data'),
+                                    {'group_id': group_id,
+                                     'filter': 'repo_'})
+            names = [r['raw_name'] for r in response.json['records']]
+            assert names == [u'gr_data/repo_public']
+            assert response.json['totalRecords'] == 1
+
+            # names of groups are not matched by the filter
+            response = self.app.get(url('repos_data'),
+                                    {'group_id': group_id,
+                                     'filter': 'gr_data'})
+            assert response.json['totalRecords'] == 0
+
+            # permissions of user groups override default ones ...
+            user_group = fixture.create_user_group(u'gr_data_readers')
+            UserGroupModel().add_user_to_group(user_group,
+                                               TEST_USER_REGULAR_LOGIN)
+            RepoModel().grant_user_group_permission(
+                u'gr_data/repo_private', u'gr_data_readers',
+                'repository.read')
+            Session().commit()
+            response = self.app.get(url('repos_data'),
+                                    {'group_id': group_id})
+            names = [r['raw_name'] for r in response.json['records']]
+            assert names == [u'gr_data/repo_private', u'gr_data/repo_public']
+            assert response.json['totalRecords'] == 2
+
+            # ... and explicit permissions of the user override both
+            RepoModel().grant_user_permission(u'gr_data/repo_private',
+                                              TEST_USER_REGULAR_LOGIN,
+                                              'repository.none')
+            RepoModel().grant_user_permission(u'gr_data/repo_public',
+                                              TEST_USER_REGULAR_LOGIN,
+                                              'repository.none')
+            Session().commit()
+            response = self.app.get(url('repos_data'),
+                                    {'group_id': group_id})
+            assert response.json['records'] == []
+            assert response.json['totalRecords'] == 0
+        finally:
+            fixture.destroy_user_group(u'gr_data_readers')
+            RepoModel().delete(u'gr_data/repo_public')
+            RepoModel().delete(u'gr_data/repo_private')
+            RepoGroupModel().delete(repo_group=u'gr_data', force_delete=True)
+            Session().commit()
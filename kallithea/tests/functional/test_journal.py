@@ -37,3 +37,31 @@ class TestJournalController(TestController):
     def test_public_journal_rss(self):
         self.log_user()
         response = self.app.get(url(controller='journal', action='public_journal_rss'),)
+
+    def test_index_push_revisions(self):
+        from kallithea.lib.utils import action_logger
+        from kallithea.model.db import UserLog
+        from kallithea.model.meta import Session
+        revs = [('%02x' % i) * 20 for i in xrange(1, 61)]
+        action_logger(TEST_USER_ADMIN_LOGIN, 'push', HG_REPO, '127.0.0.1',
+                      commit=True, revisions=revs)
+        ul = UserLog.query().order_by(UserLog.user_log_id.desc()).first()
+        try:
+            assert ul.action == 'push'
+            assert ul.revisions_count == 60
+            assert [r.revision for r in ul.revisions] == revs
+            assert ul.revisions_preview == revs[:50] + revs[-1:]
+
+            self.log_user()
+            for action in ['index', 'journal_atom', 'journal_rss']:
+                response = self.app.get(url(controller='journal',
+                                            action=action))
+                # the last revision is in the link to the compare view
+                response.mustcontain('%s...%s' % (revs[0], revs[-1]))
+            response = self.app.get(url(controller='journal', action='index'))
+            response.mustcontain('57 more')
+            response.mustcontain(revs[49][:8])
+            response.mustcontain(no=[revs[50][:12]])
+        finally:
+            Session().delete(ul)
+            Session().commit()
@@ -0,0 +1,102 @@
+import os
+import mock
+import tempfile
+
+from kallithea.tests import *
+
+from kallithea.lib.invalidation import SharedMemoryNotifier
+from kallithea.model.db import CacheInvalidation
+from kallithea.model.meta import Session
+
+
+class TestCacheInvalidation(BaseTestCase):
+
+    def _reset_generations(self):
+        # generations remembered by this process, as after a restart
+        CacheInvalidation._valid_generations.clear()
+        CacheInvalidation._session_generations.clear()
+
+    def setUp(self):
+        self._reset_generations()
+
+    def tearDown(self):
+        CacheInvalidation.query().filter(
+            CacheInvalidation.cache_args == u'inv-repo').delete()
+        Session().commit()
+        Session.remove()
+        self._reset_generations()
+
+    def test_generation_based_invalidation(self):
+        # first use registers the key and tells caches to refresh
+        self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+        self.assertTrue(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+        self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'ATOM'))
+
+        first = CacheInvalidation._get_first_generation()
+        CacheInvalidation.set_invalidate(u'inv-repo')
+        keys = CacheInvalidation.query().filter(
+            CacheInvalidation.cache_args == u'inv-repo').all()
+        self.assertEqual([(k.cache_active, k.cache_generation) for k in keys],
+                         [(False, first + 1), (False, first + 1)])
+
+        # a new session (request) sees the new generation once
+        Session.remove()
+        self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+        self.assertTrue(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+        self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'ATOM'))
+        self.assertTrue(CacheInvalidation.test_and_set_valid(u'inv-repo', 'ATOM'))
+
+    def test_invalidation_with_delete(self):
+        self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+        # caches of another process are valid for the same generation
+        other_process = dict(CacheInvalidation._valid_generations)
+
+        CacheInvalidation.set_invalidate(u'inv-repo', delete=True)
+        self.assertEqual(CacheInvalidation.query().filter(
+            CacheInvalidation.cache_args == u'inv-repo').count(), 0)
+        Session.remove()
+        # the key registered again starts above the deleted generation
+        with mock.patch.object(CacheInvalidation, '_valid_generations',
+                               other_process):
+            self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+            self.assertTrue(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+        self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+
+        # and again after the next deletion
+        other_process = dict(CacheInvalidation._valid_generations)
+        CacheInvalidation.set_invalidate(u'inv-repo', delete=True)
+        Session.remove()
+        with mock.patch.object(CacheInvalidation, '_valid_generations',
+                               other_process):
+            self.assertFalse(CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS'))
+
+    def test_generations_are_read_per_repository(self):
+        CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS')
+        CacheInvalidation.test_and_set_valid(u'inv-repo', 'ATOM')
+        CacheInvalidation.test_and_set_valid(u'inv-repo-other', 'RSS')
+        try:
+            Session.remove()
+            CacheInvalidation.test_and_set_valid(u'inv-repo', 'RSS')
+            self.assertEqual(
+                sorted(CacheInvalidation._get_generations()),
+                sorted(CacheInvalidation._get_cache_key(u'inv-repo_' + kind)
+                       for kind in ['RSS', 'ATOM']))
+        finally:
+            CacheInvalidation.query().filter(
+                CacheInvalidation.cache_args == u'inv-repo-other').delete()
+            Session().commit()
+
+    def test_shared_memory_notifier(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            notifier = SharedMemoryNotifier(path=path)
+            other = SharedMemoryNotifier(path=path)
+            self.assertEqual(notifier.get_generation(u'inv-repo'), 0)
+            other.notify(u'inv-repo')
+            other.notify(u'inv-repo')
+            self.assertEqual(notifier.get_generation(u'inv-repo'), 2)
+        finally:
+            os.remove(path)
+            if os.path.exists(path + '.lock'):
+                os.remove(path + '.lock')
@@ -1,7 +1,9 @@
 from __future__ import with_statement
+import re
 from kallithea.tests import *
-from kallithea.lib.diffs import DiffProcessor, NEW_FILENODE, DEL_FILENODE, \
-    MOD_FILENODE, RENAMED_FILENODE, CHMOD_FILENODE, BIN_FILENODE, COPIED_FILENODE
+from kallithea.lib.diffs import DiffProcessor, LimitedDiffContainer, \
+    NEW_FILENODE, DEL_FILENODE, MOD_FILENODE, RENAMED_FILENODE, \
+    CHMOD_FILENODE, BIN_FILENODE, COPIED_FILENODE
 from kallithea.tests.fixture import Fixture
 
 fixture = Fixture()
@@ -275,3 +277,76 @@ class DiffLibTest(BaseTestCase):
         data = [(x['filename'], x['operation'], x['stats']) for x in diff_proc_d]
         expected_data = DIFF_FIXTURES[diff_fixture]
         self.assertListEqual(expected_data, data)
+
+    @parameterized.expand([(x,) for x in DIFF_FIXTURES])
+    def test_diff_streamed(self, diff_fixture):
+        diff = fixture.load_resource(diff_fixture, strip=False)
+        chunks = (diff[i:i + 7] for i in xrange(0, len(diff), 7))
+        streamed = DiffProcessor(chunks).prepare()
+        self.assertEqual(streamed, DiffProcessor(diff).prepare())
+
+    def test_diff_streamed_limit(self):
+        diff = fixture.load_resource('hg_diff_binary_and_normal.diff',
+                                     strip=False)
+        read = []
+        closed = []
+
+        def chunks():
+            try:
+                for line in diff.splitlines(True):
+                    read.append(line)
+                    yield line
+            finally:
+                closed.append(True)
+        diff_proc = DiffProcessor(chunks(), diff_limit=1000)
+        parsed = diff_proc.prepare()
+        self.assertTrue(isinstance(parsed, LimitedDiffContainer))
+        # reading stopped at the limit and the source was closed
+        self.assertTrue(sum(map(len, read)) < 2000)
+        self.assertEqual(closed, [True])
+
+    def test_intraline_engines(self):
+        from kallithea.lib.diffs import INTRALINE_ENGINES
+        old = 'def foo(a, b=&lt;default&gt;):\n'
+        new = 'def bar(a, c=&lt;other&gt;, d):\n'
+        strip = lambda s: re.sub(r'</?(ins|del)>', '', s)
+        for engine in INTRALINE_ENGINES:
+            proc = DiffProcessor('', intraline=engine)
+            line = {'action': 'del', 'line': old}
+            next_ = {'action': 'add', 'line': new}
+            proc._highlight_line_difflib(line, next_)
+            self.assertEqual(strip(line['line']), old)
+            self.assertEqual(strip(next_['line']), new)
+            self.assertTrue(line['line'].startswith('def <del>foo</del>(a, '))
+            self.assertTrue(next_['line'].startswith('def <ins>bar</ins>(a, '))
+            # escaped characters are never highlighted partially
+            self.assertTrue('&lt;' in line['line'])
+            self.assertTrue('&gt;' in next_['line'])
+
+    def test_intraline_fallback(self):
+        old = 'var x=[%s];\n' % ','.join(map(str, xrange(1000)))
+        new = 'var x=[%s];\n' % ','.join(map(str, xrange(1000, 0, -1)))
+        proc = DiffProcessor('')
+        line = {'action': 'add', 'line': new}
+        next_ = {'action': 'del', 'line': old}
+        proc._highlight_line_difflib(line, next_)
+        # too long to diff word by word, changed part is highlighted whole
+        self.assertEqual(next_['line'], 'var x=[<del>%s</del>];\n'
+                         % ','.join(map(str, xrange(1000))))
+        self.assertEqual(line['line'], 'var x=[<ins>%s</ins>];\n'
+                         % ','.join(map(str, xrange(1000, 0, -1))))
+
+    def test_myers_opcodes(self):
+        from kallithea.lib.diffs import _myers_opcodes
+        a, b = list('abcabba'), list('cbabac')
+        opcodes = _myers_opcodes(a, b)
+        rebuilt = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal':
+                self.assertEqual(a[i1:i2], b[j1:j2])
+            rebuilt.extend(b[j1:j2])
+        self.assertEqual(rebuilt, b)
+        # shortest edit script has 5 insertions and deletions
+        self.assertEqual(sum(i2 - i1 + j2 - j1 for tag, i1, i2, j1, j2
+                             in opcodes if tag != 'equal'), 5)
+        self.assertEqual(_myers_opcodes(a, b, max_edits=4), None)
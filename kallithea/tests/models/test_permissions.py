@@ -3,7 +3,7 @@ from kallithea.tests.fixture import Fixture
 from kallithea.model.repo_group import RepoGroupModel
 from kallithea.model.repo import RepoModel
 from kallithea.model.db import RepoGroup, User, UserGroupRepoGroupToPerm,\
-    Permission, UserToPerm
+    Permission, UserToPerm, CacheInvalidation
 from kallithea.model.user import UserModel
 
 from kallithea.model.meta import Session
@@ -83,6 +83,33 @@ class TestPermissions(BaseTestCase):
         self.assertEqual(u1_auth.permissions['repositories'][HG_REPO],
                          new_perm)
 
+    def test_permission_snapshot(self):
+        def _committed():
+            # start over like a new request, after changes were committed
+            CacheInvalidation._bumped_sessions.clear()
+            CacheInvalidation._session_generations.clear()
+
+        _committed()
+        perms = AuthUser(user_id=self.u1.user_id).permissions
+        self.assertTrue(AuthUser(user_id=self.u1.user_id).permissions is perms)
+        self.assertEqual(perms['repositories'][HG_REPO], 'repository.read')
+
+        self.ug1 = fixture.create_user_group(u'G1')
+        UserGroupModel().add_user_to_group(self.ug1, self.u1)
+        RepoModel().grant_user_group_permission(repo=HG_REPO,
+                                                group_name=self.ug1,
+                                                perm='repository.write')
+        # not committed yet, snapshot is bypassed
+        perms = AuthUser(user_id=self.u1.user_id).permissions
+        self.assertEqual(perms['repositories'][HG_REPO], 'repository.write')
+        Session().commit()
+
+        _committed()
+        perms = AuthUser(user_id=self.u1.user_id).permissions
+        self.assertEqual(perms['repositories'][HG_REPO], 'repository.write')
+        self.assertTrue(AuthUser(user_id=self.u1.user_id).permissions is perms)
+        self.assertFalse(AuthUser(user_id=self.u2.user_id).permissions is perms)
+
     def test_default_admin_perms_set(self):
         a1_auth = AuthUser(user_id=self.a1.user_id)
         perms = {
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import tempfile
+
+from whoosh.index import open_dir
+
+from kallithea.tests import *
+from kallithea.lib.indexers import IDX_NAME
+from kallithea.lib.indexers.daemon import WhooshIndexingDaemon
+from kallithea.model.meta import Session
+
+
+class TestWhooshIndexingDaemon(BaseTestCase):
+
+    def tearDown(self):
+        Session.remove()
+
+    def _get_daemon(self, index_location, repo_name, workers=1):
+        return WhooshIndexingDaemon(index_location=index_location,
+                                    repo_location=TESTS_TMP_PATH,
+                                    repo_list=[repo_name], workers=workers)
+
+    def _get_docs(self, index_location):
+        idx = open_dir(index_location, indexname=IDX_NAME)
+        with idx.reader() as reader:
+            return sorted((fields['path'], fields['content'])
+                          for _docnum, fields in reader.iter_docs())
+
+    def _test_incremental_update(self, repo_name):
+        index_location = tempfile.mkdtemp()
+        daemon = self._get_daemon(index_location, repo_name)
+        daemon.run(full_index=True)
+        full = self._get_docs(index_location)
+        self.assertTrue(full)
+        repo = daemon.repo_paths[repo_name]
+        tip = repo.get_changeset().raw_id
+        self.assertEqual(daemon._get_indexed_revisions(), {repo_name: tip})
+
+        # up to date, nothing is touched
+        self._get_daemon(index_location, repo_name).run()
+        self.assertEqual(self._get_docs(index_location), full)
+
+        # pretend index was built for an old revision, files differing from
+        # tip are updated from a single tree diff
+        daemon._set_indexed_revisions({repo_name: repo.revisions[10]})
+        self._get_daemon(index_location, repo_name).run()
+        self.assertEqual(self._get_docs(index_location), full)
+        self.assertEqual(daemon._get_indexed_revisions(), {repo_name: tip})
+
+        # unknown revision reindexes the repository from scratch
+        daemon._set_indexed_revisions({repo_name: 'f' * 40})
+        self._get_daemon(index_location, repo_name).run()
+        self.assertEqual(self._get_docs(index_location), full)
+
+    def test_incremental_update_hg(self):
+        self._test_incremental_update(HG_REPO)
+
+    def test_incremental_update_git(self):
+        self._test_incremental_update(GIT_REPO)
+
+    def test_reindex_repository(self):
+        index_location = tempfile.mkdtemp()
+        daemon = WhooshIndexingDaemon(index_location=index_location,
+                                      repo_location=TESTS_TMP_PATH,
+                                      repo_list=[HG_REPO, GIT_REPO])
+        daemon.run(full_index=True)
+        full = self._get_docs(index_location)
+        # documents of other repositories are kept
+        daemon._set_indexed_revisions({HG_REPO: 'f' * 40})
+        WhooshIndexingDaemon(index_location=index_location,
+                             repo_location=TESTS_TMP_PATH,
+                             repo_list=[HG_REPO, GIT_REPO]).run()
+        self.assertEqual(self._get_docs(index_location), full)
+
+    def test_changeset_index_update(self):
+        import os
+        from mercurial import hg, ui
+        from whoosh.qparser import QueryParser
+        from kallithea.lib.indexers import CHGSET_IDX_NAME, CHGSETS_SCHEMA
+        from kallithea.lib.vcs.backends.hg import MercurialRepository
+        repo = MercurialRepository(os.path.join(TESTS_TMP_PATH, HG_REPO))
+        old_path = os.path.join(tempfile.mkdtemp(), HG_REPO)
+        hg.clone(ui.ui(), {}, repo.path, old_path, rev=[repo.revisions[10]],
+                 update=False)
+        index_location = tempfile.mkdtemp()
+
+        def run(repo, **kwargs):
+            daemon = WhooshIndexingDaemon(index_location=index_location,
+                                          repos={HG_REPO: repo})
+            for name, value in kwargs.items():
+                setattr(daemon, name, value)
+            daemon.update_changeset_index()
+
+        def get_last():
+            idx = open_dir(index_location, indexname=CHGSET_IDX_NAME)
+            q = QueryParser('repository', schema=CHGSETS_SCHEMA).parse(
+                u'last:t AND %s' % HG_REPO)
+            with idx.searcher() as searcher:
+                return (searcher.doc_count(),
+                        [hit['raw_id'] for hit in searcher.search(q)])
+
+        WhooshIndexingDaemon(index_location=index_location,
+                             repos={HG_REPO: MercurialRepository(old_path)}
+                             ).run(full_index=True)
+        self.assertEqual(get_last(), (11, [repo.revisions[10]]))
+        # failed update keeps the previous last changeset
+        run(repo, index_changesets=None)
+        self.assertEqual(get_last(), (11, [repo.revisions[10]]))
+        run(repo)
+        self.assertEqual(get_last(), (len(repo), [repo.revisions[-1]]))
+
+    def test_parallel_build(self):
+        serial_location = tempfile.mkdtemp()
+        WhooshIndexingDaemon(index_location=serial_location,
+                             repo_location=TESTS_TMP_PATH,
+                             repo_list=[HG_REPO, GIT_REPO]).run(full_index=True)
+        parallel_location = tempfile.mkdtemp()
+        daemon = WhooshIndexingDaemon(index_location=parallel_location,
+                                      repo_location=TESTS_TMP_PATH,
+                                      repo_list=[HG_REPO, GIT_REPO], workers=2)
+        daemon.run(full_index=True)
+        self.assertEqual(self._get_docs(parallel_location),
+                         self._get_docs(serial_location))
+        self.assertEqual(sorted(daemon._get_indexed_revisions()),
+                         sorted([HG_REPO, GIT_REPO]))
+
+        # failed repositories are logged and keep their old revision
+        old_revs = {HG_REPO: daemon.repo_paths[HG_REPO].revisions[0],
+                    GIT_REPO: daemon.repo_paths[GIT_REPO].revisions[0]}
+        daemon._set_indexed_revisions(old_revs)
+        daemon = WhooshIndexingDaemon(index_location=parallel_location,
+                                      repo_location=TESTS_TMP_PATH,
+                                      repo_list=[HG_REPO, GIT_REPO], workers=2)
+        daemon.update_repo_files = None
+        daemon.run()
+        self.assertEqual(daemon._get_indexed_revisions(), old_revs)
+        self.assertEqual(self._get_docs(parallel_location),
+                         self._get_docs(serial_location))
+
+
+class TestIndexUpdateQueue(BaseTestCase):
+
+    def test_debounce(self):
+        import os
+        import time
+        from kallithea.lib.indexers.queue import IndexUpdateQueue
+        queue = IndexUpdateQueue(os.path.join(tempfile.mkdtemp(), 'queue'))
+        self.assertEqual(queue.pop_ready(), [])
+        now = time.time()
+        queue.enqueue(u'group/repo')
+        queue.enqueue(u'group/repo')
+        queue.enqueue(u'other')
+        self.assertEqual(len(queue), 2)
+        # repositories still being pushed to wait
+        self.assertEqual(queue.pop_ready(5, 60, now=now + 1), [])
+        self.assertEqual(sorted(queue.pop_ready(5, 60, now=now + 10)),
+                         [u'group/repo', u'other'])
+        self.assertEqual(len(queue), 0)
+
+        # continuous pushes wait at most max_delay
+        queue.enqueue(u'busy')
+        path = os.path.join(queue.queue_dir, 'busy')
+        os.utime(path, (now + 59, now + 59))
+        self.assertEqual(queue.pop_ready(5, 60, now=now + 58), [])
+        self.assertEqual(queue.pop_ready(5, 60, now=now + 61), [u'busy'])
+
+    def test_watch_queue(self):
+        import os
+        import mock
+        from kallithea.lib.indexers.queue import IndexUpdateQueue, \
+            get_queue_dir, watch_queue
+        index_location = os.path.join(tempfile.mkdtemp(), 'index')
+        daemon = WhooshIndexingDaemon(index_location=index_location,
+                                      repo_location=TESTS_TMP_PATH,
+                                      repo_list=[HG_REPO])
+        daemon.run(full_index=True)
+        repo = daemon.repo_paths[HG_REPO]
+        daemon._set_indexed_revisions({HG_REPO: repo.revisions[0]})
+
+        queue = IndexUpdateQueue(get_queue_dir(index_location))
+        queue.enqueue(HG_REPO)
+        # repositories of failed updates are queued again
+        with mock.patch.object(WhooshIndexingDaemon, 'update_indexes',
+                               side_effect=IOError('broken')):
+            watch_queue(index_location, {}, once=True)
+        self.assertEqual(len(queue), 1)
+        watch_queue(index_location, {}, once=True)
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(daemon._get_indexed_revisions(),
+                         {HG_REPO: repo.get_changeset().raw_id})
+
+
+class TestWhooshResultWrapper(BaseTestCase):
+
+    def test_paged_results(self):
+        import os
+        from whoosh.qparser import QueryParser
+        from kallithea.lib.indexers import SCHEMA, MAX_FRAGMENTS, \
+            WhooshResultWrapper, get_searcher
+        index_location = os.path.join(tempfile.mkdtemp(), 'index')
+        WhooshIndexingDaemon(index_location=index_location,
+                             repo_location=TESTS_TMP_PATH,
+                             repo_list=[HG_REPO]).run(full_index=True)
+        searcher = get_searcher(index_location, IDX_NAME)
+        # reused until the index changes
+        self.assertTrue(get_searcher(index_location, IDX_NAME) is searcher)
+
+        query = QueryParser('content', schema=SCHEMA).parse(u'def')
+        results = WhooshResultWrapper('content', searcher, query,
+                                      set([u'def']), TESTS_TMP_PATH,
+                                      pagelen=5)
+        first = results.search_page(1)
+        self.assertEqual(len(first), 5)
+        # only the first page was scored
+        self.assertEqual(results._limit, 5)
+        self.assertTrue(len(results) > 10)
+        self.assertTrue(results[0:5] is first)
+
+        second = results.search_page(2)
+        self.assertEqual(results._limit, 10)
+        all_hits = list(results)
+        self.assertEqual(len(all_hits), len(results))
+        self.assertEqual([r['path'] for r in all_hits[:10]],
+                         [r['path'] for r in first + second])
+        for res in all_hits:
+            self.assertFalse('content' in res)
+            self.assertTrue('<span class="match term0">def</span>'
+                            in res['content_short_hl'])
+            self.assertTrue(len(res['content_short']) <=
+                            MAX_FRAGMENTS * (2 * results.fragment_size + 3))
+
+        # rebuilt index is reopened
+        WhooshIndexingDaemon(index_location=index_location,
+                             repo_location=TESTS_TMP_PATH,
+                             repo_list=[HG_REPO]).run(full_index=True)
+        self.assertFalse(get_searcher(index_location, IDX_NAME) is searcher)
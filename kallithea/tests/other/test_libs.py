@@ -31,7 +31,7 @@ import hashlib
 import mock
 from kallithea.tests import *
 from kallithea.lib.utils2 import AttributeDict
-from kallithea.model.db import Repository
+from kallithea.model.db import Repository, User
 
 proto = 'http'
 TEST_URLS = [
@@ -373,3 +373,589 @@ class TestLibs(BaseTestCase):
         _test = _extract_id_from_repo_name(test)
         self.assertEqual(_test, expected, msg='url:%s, got:`%s` expected: `%s`'
                                               % (test, _test, expected))
+
+    def test_commit_activity_roundtrip(self):
+        from kallithea.lib.celerylib.tasks import CommitActivity
+        from kallithea.lib.compat import json
+        activity = CommitActivity()
+        activity.add('joe', 86400.0, 1, 2, 0)
+        activity.add('joe', 0.0, 3, 0, 1)
+        activity.add('joe', 86400.0, 0, 1, 1)
+        activity.add('jane', 86400.0, 1, 0, 0)
+
+        data = activity.dump_activity('nobody')
+        combined = activity.dump_activity_combined()
+        self.assertEqual(json.loads(data)['joe'], {
+            'label': 'joe',
+            'data': [{'time': 0.0, 'commits': 1, 'added': 3, 'changed': 0,
+                      'removed': 1},
+                     {'time': 86400.0, 'commits': 2, 'added': 1,
+                      'changed': 3, 'removed': 1}],
+            'schema': ['commits']})
+        self.assertEqual(json.loads(combined), [[0.0, 1], [86400.0, 3]])
+
+        activity = CommitActivity(data, combined)
+        activity.add('jane', 86400.0, 1, 0, 0)
+        self.assertEqual(json.loads(activity.dump_activity('nobody'))['jane']
+                         ['data'], [{'time': 86400.0, 'commits': 2,
+                                     'added': 2, 'changed': 0, 'removed': 0}])
+        self.assertEqual(json.loads(activity.dump_activity_combined()),
+                         [[0.0, 1], [86400.0, 4]])
+
+    def test_commit_activity_without_commits(self):
+        from kallithea.lib.celerylib.tasks import CommitActivity
+        from kallithea.lib.compat import json
+        data = CommitActivity().dump_activity('nobody')
+        self.assertEqual(json.loads(data), {'nobody': {
+            'label': 'nobody', 'data': [0, 1], 'schema': ['commits']}})
+        self.assertEqual(CommitActivity(data).authors, {})
+
+    def test_scm_instance_cache(self):
+        from kallithea.lib.scm_cache import ScmInstanceCache
+
+        class FakeRepo(object):
+            def __init__(self, path):
+                self.path = path
+
+            def get_memory_footprint(self):
+                return 10
+
+        tokens = {'a': 1, 'b': 1, 'c': 1}
+
+        class FakeBackend(object):
+            @classmethod
+            def get_change_token(cls, path):
+                return tokens[path]
+
+        cache = ScmInstanceCache(max_size=20)
+        get = lambda path: cache.get(path, FakeBackend,
+                                     lambda: FakeRepo(path))
+        repo_a = get('a')
+        self.assertTrue(get('a') is repo_a)
+        tokens['a'] = 2
+        self.assertFalse(get('a') is repo_a)
+        repo_a = get('a')
+        get('b')
+        # least recently used 'a' doesn't fit any longer
+        get('c')
+        self.assertFalse(get('a') is repo_a)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'],
+                          stats['instances'], stats['footprint']),
+                         (2, 5, 2, 2, 20))
+        cache.invalidate('a')
+        self.assertEqual(cache.stats()['instances'], 1)
+
+    def test_graph_data(self):
+        from kallithea.lib import graphmod
+        for repo_name in [HG_REPO, GIT_REPO]:
+            repo = Repository.get_by_repo_name(repo_name).scm_instance
+            revs = range(len(repo.revisions))[20:40][::-1]
+            graph = graphmod.graph_data(repo, revs)
+            self.assertEqual(len(graph), len(revs))
+            # layout of a deep page is served from cache
+            with mock.patch.object(graphmod, '_dagwalker') as dagwalker:
+                self.assertEqual(graphmod.graph_data(repo, revs), graph)
+                self.assertFalse(dagwalker.called)
+            self.assertEqual(list(graphmod._colored(repo,
+                graphmod._dagwalker(repo, revs))), graph)
+
+    def test_archive_cache(self):
+        import os
+        import tempfile
+        import threading
+        from kallithea.lib.archive_cache import ArchiveCache
+        cache = ArchiveCache(tempfile.mkdtemp(), chunk_size=4)
+        release = threading.Event()
+        created = []
+
+        def create():
+            created.append(True)
+            def chunks():
+                yield 'abcd'
+                release.wait()
+                yield 'efghij'
+            return chunks()
+
+        first = cache.get('a.tar', create)
+        # concurrent download shares the archive being created
+        second = cache.get('a.tar', create)
+        release.set()
+        self.assertEqual(''.join(first), 'abcdefghij')
+        self.assertEqual(''.join(second), 'abcdefghij')
+        self.assertEqual(''.join(cache.get('a.tar', create)), 'abcdefghij')
+        self.assertEqual(len(created), 1)
+        self.assertEqual(sorted(os.listdir(cache.cache_dir)),
+                         ['.stats', 'a.tar'])
+
+        def fail():
+            yield 'abcd'
+            raise IOError('broken')
+        with self.assertRaises(IOError):
+            list(cache.get('b.tar', fail))
+        self.assertEqual(sorted(os.listdir(cache.cache_dir)),
+                         ['.stats', 'a.tar'])
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['shared'], stats['misses']),
+                         (1, 1, 2))
+        self.assertEqual((stats['archives'], stats['size']), (1, 10))
+
+        # archives are created without holding the lock of the cache
+        create = lambda: iter([str(cache.stats()['archives'])])
+        self.assertEqual(''.join(cache.get('c.tar', create)), '1')
+
+    def test_archive_cache_stats_interval(self):
+        import json
+        import tempfile
+        from kallithea.lib.archive_cache import ArchiveCache, STATS_FILE
+        cache = ArchiveCache(tempfile.mkdtemp())
+        create = lambda: iter(['x' * 10])
+        stored = lambda: json.load(open(cache.get_path(STATS_FILE)))
+        list(cache.get('a.tar', create))
+        self.assertEqual(stored()['misses'], 1)
+        list(cache.get('a.tar', create))
+        list(cache.get('a.tar', create))
+        # hits are not written on every download ...
+        self.assertNotIn('hits', stored())
+        # ... but they are not lost
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(stored()['entries']['a.tar'][0], 2)
+
+    def test_archive_cache_other_process(self):
+        import os
+        import tempfile
+        import threading
+        from kallithea.lib.archive_cache import ArchiveCache, \
+            ArchiveCacheError
+        cache_dir = tempfile.mkdtemp()
+        # separate instances don't share builds, like separate processes
+        cache = ArchiveCache(cache_dir, chunk_size=4)
+        other = ArchiveCache(cache_dir, chunk_size=4)
+        release = threading.Event()
+        created = []
+
+        def create():
+            created.append(True)
+            def chunks():
+                yield 'abcd'
+                release.wait()
+                yield 'efghij'
+            return chunks()
+
+        first = cache.get('a.tar', create)
+        second = other.get('a.tar', create)
+        release.set()
+        self.assertEqual(''.join(second), 'abcdefghij')
+        self.assertEqual(''.join(first), 'abcdefghij')
+        self.assertEqual(len(created), 1)
+        self.assertEqual(other.stats()['shared'], 1)
+
+        # archive evicted while it is followed was still streamed completely
+        release.clear()
+        first = cache.get('b.tar', create)
+        second = other.get('b.tar', create)
+        self.assertEqual(next(second), 'abcd')
+        release.set()
+        self.assertEqual(''.join(first), 'abcdefghij')
+        os.remove(cache.get_path('b.tar'))
+        self.assertEqual(''.join(second), 'efghij')
+
+        # failed build is not taken for a complete one
+        def fail():
+            yield 'abcd'
+            release.wait()
+            raise IOError('broken')
+        release.clear()
+        first = cache.get('c.tar', fail)
+        second = other.get('c.tar', fail)
+        self.assertEqual(next(second), 'abcd')
+        release.set()
+        with self.assertRaises(IOError):
+            list(first)
+        with self.assertRaises(ArchiveCacheError):
+            list(second)
+
+    def test_archive_cache_eviction(self):
+        import os
+        import tempfile
+        from kallithea.lib.archive_cache import ArchiveCache
+        for policy, expected in [('lru', ['b.tar', 'c.tar']),
+                                 ('lfu', ['a.tar', 'c.tar'])]:
+            cache = ArchiveCache(tempfile.mkdtemp(), max_size=25,
+                                 policy=policy)
+            create = lambda: iter(['x' * 10])
+            list(cache.get('a.tar', create))
+            list(cache.get('a.tar', create))
+            list(cache.get('b.tar', create))
+            self.assertFalse(cache.warm('b.tar', create))
+            # c.tar exceeds the budget, it is never evicted itself
+            self.assertTrue(cache.warm('c.tar', create))
+            self.assertEqual(sorted(n for n in os.listdir(cache.cache_dir)
+                                    if not n.startswith('.')), expected)
+            self.assertEqual(cache.stats()['evictions'], 1)
+            self.assertEqual(cache.prune(max_size=5), 2)
+            cache.clear()
+            self.assertEqual(cache.stats()['archives'], 0)
+
+    def test_diff_cache(self):
+        import tempfile
+        import kallithea
+        from kallithea.lib import diffs
+        repo = Repository.get_by_repo_name(HG_REPO).scm_instance
+        rev1 = '7d4bc8ec6be56c0f10425afb40b6fc315a4c25e7'
+        rev2 = '3803844fdbd3b711175fc3da9bdacfcd6d29a6fb'
+        with mock.patch.dict(kallithea.CONFIG,
+                             {'diff_cache_dir': tempfile.mkdtemp()}):
+            parsed = diffs.get_diff_processor(repo, rev1, rev2).parsed_diff
+            limited = diffs.get_diff_processor(repo, rev1, rev2,
+                                               diff_limit=1024).parsed_diff
+            self.assertTrue(isinstance(limited, diffs.LimitedDiffContainer))
+            with mock.patch.object(repo, 'get_chunked_diff') as get_diff:
+                self.assertEqual(
+                    diffs.get_diff_processor(repo, rev1, rev2).parsed_diff,
+                    parsed)
+                cached = diffs.get_diff_processor(repo, rev1, rev2,
+                                                  diff_limit=1024).parsed_diff
+                self.assertTrue(isinstance(cached,
+                                           diffs.LimitedDiffContainer))
+                self.assertEqual(list(cached), list(limited))
+                self.assertFalse(diffs.warm_diff_cache(repo, rev1, rev2))
+                self.assertFalse(get_diff.called)
+            # other options and symbolic revisions are parsed again
+            self.assertTrue(diffs.warm_diff_cache(repo, rev1, rev2,
+                                                  diff_limit=2048))
+            diffs.get_diff_processor(repo, rev1, rev2, context=5)
+            self.assertEqual(
+                diffs.get_diff_processor(repo, rev1, 'tip').parsed_diff,
+                diffs.get_diff_processor(repo, rev1, 'tip').parsed_diff)
+            stats = diffs.get_diff_cache().stats()
+            self.assertEqual((stats['diffs'], stats['hits'],
+                              stats['misses']), (4, 2, 3))
+
+    def test_diff_cache_line_context(self):
+        import tempfile
+        import kallithea
+        from kallithea.lib import diffs
+        repo = Repository.get_by_repo_name(HG_REPO).scm_instance
+        path = 'vcs/backends/base.py'
+        node1 = repo.get_changeset('6fff84722075f1607a30f436523403845f84cd9e') \
+            .get_node(path)
+        node2 = repo.get_changeset('7d4bc8ec6be56c0f10425afb40b6fc315a4c25e7') \
+            .get_node(path)
+        with mock.patch.dict(kallithea.CONFIG,
+                             {'diff_cache_dir': tempfile.mkdtemp()}):
+            no_context = diffs.wrapped_diff(node1, node2, line_context=0)[3]
+            context = diffs.wrapped_diff(node1, node2, line_context=3)[3]
+            # context given as text is the same as the number
+            self.assertEqual(
+                diffs.wrapped_diff(node1, node2, line_context='0')[3],
+                no_context)
+            stats = diffs.get_diff_cache().stats()
+        self.assertNotEqual(no_context, context)
+        self.assertEqual((stats['diffs'], stats['hits'], stats['misses']),
+                         (2, 1, 2))
+
+    def test_polling_subprocess_io(self):
+        import os
+        from kallithea.lib.vcs.subprocessio import PollingSubprocessIO
+        data = os.urandom(300000)
+        out = PollingSubprocessIO(['cat'], inputstream=data, buffer_size=4096,
+                                  starting_values=['start'])
+        self.assertEqual(''.join(out), 'start' + data)
+        with self.assertRaises(EnvironmentError):
+            PollingSubprocessIO(['sh', '-c', 'echo failed >&2; exit 1'])
+        # process is stopped when the client goes away
+        out = PollingSubprocessIO(['sh', '-c', 'yes | head -c 10000000'])
+        iter(out).next()
+        out.close()
+        self.assertTrue(out.process.returncode)
+
+    def test_git_http_engines(self):
+        import kallithea
+        from webob import Request
+        from kallithea.lib.middleware.pygrack import GitDirectory
+        repo = Repository.get_by_repo_name(GIT_REPO)
+        tip = repo.scm_instance.get_changeset().raw_id
+        want = 'want %s side-band-64k no-progress\n' % tip
+        body = '%04x%s00000009done\n' % (len(want) + 4, want)
+        responses = {}
+        for engine in ['threads', 'poll']:
+            app = GitDirectory(TESTS_TMP_PATH, GIT_REPO, {})
+            with mock.patch.dict(kallithea.CONFIG, {'git_http_engine': engine,
+                                                    'git_http_buffer_size': '1024'}):
+                refs = Request.blank('/%s/info/refs?service=git-upload-pack'
+                                     % GIT_REPO).get_response(app)
+                req = Request.blank('/%s/git-upload-pack' % GIT_REPO,
+                    POST=body, content_type='application/x-git-upload-pack-request',
+                    headers={'Accept': 'application/x-git-upload-pack-result'})
+                pack = req.get_response(app)
+            responses[engine] = (refs.status_int, refs.body,
+                                 pack.status_int, pack.body)
+        # packs are built by git with threads, only their headers with the
+        # number of objects are always the same
+        for engine, (refs_status, refs, pack_status, pack) in responses.items():
+            self.assertEqual((refs_status, pack_status), (200, 200))
+            header = pack[pack.index('PACK'):pack.index('PACK') + 12]
+            responses[engine] = (refs, header)
+        self.assertEqual(responses['poll'], responses['threads'])
+        self.assertTrue(responses['poll'][0].startswith(
+            '001d# service=git-upload-pack0000'))
+        self.assertTrue(tip in responses['poll'][0])
+
+    def test_refs_cache(self):
+        import os
+        import tempfile
+        import subprocess
+        from kallithea.lib.refs_cache import RefsCache
+        repo_path = tempfile.mkdtemp()
+        git = lambda *args: subprocess.check_call(
+            ['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com']
+            + list(args), cwd=repo_path, stdout=open(os.devnull, 'w'))
+        git('init', '-q')
+        git('commit', '-q', '--allow-empty', '-m', 'first')
+        created = []
+        def create():
+            created.append(1)
+            return ['refs ', git_refs()]
+        git_refs = lambda: subprocess.check_output(['git', 'show-ref'],
+                                                   cwd=repo_path)
+        cache_dir = tempfile.mkdtemp()
+        cache = RefsCache(cache_dir)
+        other = RefsCache(cache_dir)
+        etag, data = cache.get(repo_path, 'git-upload-pack', create)
+        self.assertEqual(data, 'refs ' + git_refs())
+        self.assertEqual(cache.get(repo_path, 'git-upload-pack', create),
+                         (etag, data))
+        # other processes use the advertisement stored on disk
+        self.assertEqual(other.get(repo_path + '/', 'git-upload-pack', create),
+                         (etag, data))
+        self.assertEqual(len(created), 1)
+        # new refs are noticed even without invalidation
+        git('branch', 'feature/x')
+        etag2, data2 = cache.get(repo_path, 'git-upload-pack', create)
+        self.assertNotEqual(etag2, etag)
+        self.assertTrue('refs/heads/feature/x' in data2)
+        self.assertEqual(len(created), 2)
+        # invalidation by one process is seen by all of them
+        self.assertEqual(other.get(repo_path, 'git-upload-pack', create),
+                         (etag2, data2))
+        other.invalidate(repo_path)
+        cache.get(repo_path, 'git-upload-pack', create)
+        self.assertEqual(len(created), 3)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 3,
+                                         'entries': 1})
+
+    def test_git_http_refs_cache(self):
+        import tempfile
+        import kallithea
+        from webob import Request
+        from kallithea.lib.middleware.pygrack import GitDirectory
+        from kallithea.lib.refs_cache import get_refs_cache
+        app = GitDirectory(TESTS_TMP_PATH, GIT_REPO, {})
+        url = '/%s/info/refs?service=git-upload-pack' % GIT_REPO
+        with mock.patch.dict(kallithea.CONFIG,
+                             {'git_refs_cache_dir': tempfile.mkdtemp()}):
+            resp = Request.blank(url).get_response(app)
+            self.assertEqual(resp.status_int, 200)
+            self.assertTrue(resp.etag)
+            with mock.patch('kallithea.lib.vcs.subprocessio.'
+                            'SubprocessIOChunker') as chunker:
+                cached = Request.blank(url).get_response(app)
+                self.assertEqual(cached.body, resp.body)
+                not_modified = Request.blank(url,
+                    headers={'If-None-Match': '"%s"' % resp.etag}
+                ).get_response(app)
+                self.assertEqual(not_modified.status_int, 304)
+                self.assertFalse(chunker.called)
+            self.assertEqual(get_refs_cache().stats()['misses'], 1)
+            # advertisements for pushes are never cached
+            push = Request.blank('/%s/info/refs?service=git-receive-pack'
+                                 % GIT_REPO).get_response(app)
+            self.assertEqual(push.status_int, 200)
+            self.assertFalse(push.etag)
+
+    def test_credentials_cache(self):
+        import kallithea
+        from kallithea.lib import auth_modules
+        from kallithea.model.user import UserModel
+        from kallithea.model.meta import Session
+        from kallithea.tests.fixture import Fixture
+        user = Fixture().create_user(u'credentials_cache_user')
+        try:
+            with mock.patch.dict(kallithea.CONFIG, {'auth_cache_ttl': '30'}):
+                auth = auth_modules.authenticate_cached
+                self.assertTrue(auth(user.username, 'qweqwe'))
+                with mock.patch('kallithea.lib.auth.KallitheaCrypto.'
+                                'hash_check') as hash_check:
+                    self.assertEqual(auth(user.username, 'qweqwe')['username'],
+                                     user.username)
+                    self.assertFalse(hash_check.called)
+                    hash_check.return_value = False
+                    self.assertFalse(auth(user.username, 'wrong'))
+                    self.assertTrue(hash_check.called)
+                # changed password is noticed at once
+                UserModel().update_user(user.user_id, password='newpass')
+                Session().commit()
+                self.assertFalse(auth(user.username, 'qweqwe'))
+                self.assertTrue(auth(user.username, 'newpass'))
+                # and so is deactivation
+                UserModel().update_user(user.user_id, active=False)
+                Session().commit()
+                self.assertFalse(auth(user.username, 'newpass'))
+        finally:
+            auth_modules.get_credentials_cache().clear()
+            Fixture().destroy_user(user.user_id)
+
+    def test_auth_plugins_cache(self):
+        from kallithea.lib import auth_modules
+        from kallithea.lib.utils2 import str2bool
+        from kallithea.model.db import Setting
+        auth_modules.invalidate_auth_plugins_cache()
+        with mock.patch.object(Setting, 'get_auth_settings',
+                               wraps=Setting.get_auth_settings) as settings:
+            plugins = auth_modules.get_auth_plugins()
+            self.assertEqual(auth_modules.get_auth_plugins(), plugins)
+            self.assertEqual(settings.call_count, 1)
+            auth_modules.invalidate_auth_plugins_cache()
+            auth_modules.get_auth_plugins()
+            self.assertEqual(settings.call_count, 2)
+        module, plugin, plugin_settings = plugins[0]
+        self.assertEqual(module, 'kallithea.lib.auth_modules.auth_internal')
+        self.assertTrue(str2bool(plugin_settings['enabled']))
+
+    def test_action_log_writer(self):
+        import os
+        import shutil
+        import tempfile
+        from kallithea.lib.action_log import ActionLogWriter
+        from kallithea.model.db import UserLog, User
+        from kallithea.model.meta import Session
+        spool_dir = tempfile.mkdtemp(prefix='actionlog')
+        actions = lambda: UserLog.query()\
+            .filter(UserLog.action.like(u'test_action_log_writer%')).all()
+        try:
+            writer = ActionLogWriter(spool_dir, batch_size=100,
+                                     flush_interval=3600)
+            writer.log(TEST_USER_ADMIN_LOGIN, u'test_action_log_writer:1',
+                       HG_REPO, '127.0.0.1')
+            writer.log(TEST_USER_REGULAR_LOGIN, u'test_action_log_writer:2',
+                       u'/unknown', '127.0.0.2')
+            writer.log(TEST_USER_ADMIN_LOGIN, u'test_action_log_writer_push',
+                       HG_REPO, '127.0.0.1', revisions=['a' * 40, 'b' * 40])
+            self.assertEqual(len(writer), 3)
+            self.assertEqual(len(os.listdir(spool_dir)), 1)
+            self.assertEqual(actions(), [])
+
+            self.assertEqual(writer.flush(), 3)
+            self.assertEqual(len(writer), 0)
+            self.assertEqual(os.listdir(spool_dir), [])
+            logged = dict((ul.action, ul) for ul in actions())
+            ul = logged[u'test_action_log_writer:1']
+            self.assertEqual(ul.user_id,
+                             User.get_by_username(TEST_USER_ADMIN_LOGIN).user_id)
+            self.assertEqual(ul.repository_id,
+                             Repository.get_by_repo_name(HG_REPO).repo_id)
+            self.assertEqual(ul.user_ip, '127.0.0.1')
+            ul = logged[u'test_action_log_writer:2']
+            self.assertEqual(ul.repository_id, None)
+            self.assertEqual(ul.repository_name, u'/unknown')
+            ul = logged[u'test_action_log_writer_push']
+            self.assertEqual(ul.revisions_count, 2)
+            self.assertEqual([r.revision for r in ul.revisions],
+                             ['a' * 40, 'b' * 40])
+
+            # actions which failed to be written stay queued
+            with mock.patch.object(writer, '_insert',
+                                   side_effect=Exception('db down')):
+                writer.log(TEST_USER_ADMIN_LOGIN, u'test_action_log_writer:3',
+                           HG_REPO)
+                self.assertRaises(Exception, writer.flush)
+            self.assertEqual(len(writer), 1)
+            self.assertEqual(len(os.listdir(spool_dir)), 1)
+
+            # spool of a process which died is written by recover
+            name = os.listdir(spool_dir)[0]
+            os.rename(os.path.join(spool_dir, name),
+                      os.path.join(spool_dir, 'actions-%s-1.spool' % (2 ** 22 + 1)))
+            with open(os.path.join(spool_dir, 'actions-%s-1.spool'
+                                   % (2 ** 22 + 1)), 'ab') as f:
+                f.write('{"broken')
+            self.assertEqual(writer.recover(), 1)
+            self.assertEqual(os.listdir(spool_dir), [])
+            self.assertEqual(len(actions()), 4)
+
+            # spool files are claimed by a single recovery; files of
+            # recoveries which died are claimed again
+            dead = 'recovering-%s-actions-%s-2.spool' % (2 ** 22 + 1,
+                                                         2 ** 22 + 1)
+            alive = 'recovering-%s-actions-%s-3.spool' % (os.getppid(),
+                                                          2 ** 22 + 1)
+            for name in [dead, alive]:
+                with open(os.path.join(spool_dir, name), 'wb') as f:
+                    f.write('{"broken\n')
+            self.assertEqual(writer.recover(), 0)
+            self.assertEqual(os.listdir(spool_dir), [alive])
+            os.remove(os.path.join(spool_dir, alive))
+
+            # actions are dropped from memory after max_retries failures in
+            # a row, their spool file is left to recover
+            self.assertEqual(writer.flush(), 1)
+            self.assertEqual(os.listdir(spool_dir), [])
+            writer.max_retries = 2
+            with mock.patch.object(writer, '_insert',
+                                   side_effect=Exception('db down')):
+                writer.log(TEST_USER_ADMIN_LOGIN, u'test_action_log_writer:5',
+                           HG_REPO)
+                self.assertRaises(Exception, writer.flush)
+                self.assertEqual(len(writer), 1)
+                self.assertRaises(Exception, writer.flush)
+                self.assertEqual(len(writer), 0)
+                self.assertEqual(len(os.listdir(spool_dir)), 1)
+
+                # failed recovery leaves the spool file as it was
+                name = os.listdir(spool_dir)[0]
+                os.rename(os.path.join(spool_dir, name),
+                          os.path.join(spool_dir, 'actions-%s-5.spool'
+                                       % (2 ** 22 + 1)))
+                self.assertRaises(Exception, writer.recover)
+                self.assertEqual(os.listdir(spool_dir),
+                                 ['actions-%s-5.spool' % (2 ** 22 + 1)])
+            self.assertEqual(writer.recover(), 1)
+            self.assertEqual(len(actions()), 6)
+            writer.close()
+        finally:
+            shutil.rmtree(spool_dir)
+            for ul in actions():
+                Session().delete(ul)
+            Session().commit()
+
+    def test_action_logger_async(self):
+        import kallithea
+        from kallithea.lib import action_log
+        from kallithea.lib.utils import action_logger_async
+        from kallithea.model.db import UserLog
+        from kallithea.model.meta import Session
+        user = User.get_by_username(TEST_USER_ADMIN_LOGIN)
+        actions = lambda: UserLog.query()\
+            .filter(UserLog.action == u'test_action_logger_async').count()
+        try:
+            # synchronous unless enabled
+            action_logger_async(user, u'test_action_logger_async', HG_REPO,
+                                '127.0.0.1')
+            self.assertEqual(actions(), 1)
+            with mock.patch.dict(kallithea.CONFIG, {'action_log_async': 'true',
+                                                    'action_log_flush_interval': '3600'}):
+                with mock.patch.object(action_log, '_writer', None):
+                    action_logger_async(user, u'test_action_logger_async',
+                                        HG_REPO, '127.0.0.1')
+                    writer = action_log.get_action_log_writer()
+                    self.assertEqual(len(writer), 1)
+                    self.assertEqual(actions(), 1)
+                    writer.close()
+                    self.assertEqual(actions(), 2)
+        finally:
+            UserLog.query()\
+                .filter(UserLog.action == u'test_action_logger_async')\
+                .delete(synchronize_session=False)
+            Session().commit()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+kallithea.tests.scripts.bench_intraline
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Micro-benchmark comparing intraline highlighting engines of DiffProcessor
+on recorded diffs. Run it as a regular script with paths of diff files,
+for example saved by ``hg diff --git`` or ``git diff``:
+
+    python kallithea/tests/scripts/bench_intraline.py [-n 5] [FILE.diff ...]
+
+Without files the diffs in kallithea/tests/fixtures are used together with
+generated diffs of long and of minified lines.
+
+:license: GPLv3, see LICENSE.md for more details.
+"""
+
+import os
+import sys
+import glob
+import time
+import random
+import optparse
+from os.path import join as jn
+from os.path import dirname as dn
+
+__here__ = os.path.abspath(__file__)
+__root__ = dn(dn(dn(dn(__here__))))
+sys.path.append(__root__)
+
+from kallithea.lib.diffs import DiffProcessor, INTRALINE_ENGINES
+
+
+def minified_diff(lines=20, words=2000, seed=0):
+    """
+    Returns diff changing a few words on each of ``lines`` lines of
+    ``words`` words, like diffs of minified javascript.
+    """
+    rnd = random.Random(seed)
+    names = ['a', 'b', 'fn', 'this', 'length', 'push', 'return', 'var']
+    diff = ['diff --git a/app.min.js b/app.min.js\n',
+            'index 1111111..2222222 100644\n',
+            '--- a/app.min.js\n', '+++ b/app.min.js\n',
+            '@@ -1,%s +1,%s @@\n' % (lines, lines)]
+    removed, added = [], []
+    for _i in xrange(lines):
+        line = [rnd.choice(names) + rnd.choice('.,;(){}=+') for _w in xrange(words)]
+        removed.append('-%s\n' % ''.join(line))
+        for _c in xrange(rnd.randint(1, 10)):
+            line[rnd.randrange(words)] = rnd.choice(names) + '!'
+        added.append('+%s\n' % ''.join(line))
+    # pairs of removed and added lines are highlighted
+    for old, new in zip(removed, added):
+        diff.extend([old, new])
+    return ''.join(diff)
+
+
+def bench(diff, engine, repeat):
+    """
+    Returns best time of parsing ``diff`` with inline highlighting by
+    ``engine`` out of ``repeat`` runs, or without it if ``engine`` is None.
+    """
+    best = None
+    for _i in xrange(repeat):
+        start = time.time()
+        if engine is None:
+            DiffProcessor(diff).prepare(inline_diff=False)
+        else:
+            DiffProcessor(diff, intraline=engine).prepare()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [-n REPEAT] [FILE.diff ...]')
+    parser.add_option('-n', dest='repeat', type='int', default=5,
+                      help='number of runs, the best one is reported')
+    options, args = parser.parse_args(argv)
+
+    diffs = []
+    if args:
+        for path in args:
+            diffs.append((os.path.basename(path), open(path, 'rb').read()))
+    else:
+        fixtures = jn(dn(dn(__here__)), 'fixtures')
+        for path in sorted(glob.glob(jn(fixtures, '*.diff'))):
+            diffs.append((os.path.basename(path), open(path, 'rb').read()))
+        diffs.append(('<long lines>', minified_diff(lines=200, words=100)))
+        diffs.append(('<minified>', minified_diff()))
+
+    engines = sorted(INTRALINE_ENGINES)
+    print '%-50s %10s' % ('diff', 'no inline') + \
+        ''.join(' %10s' % e for e in engines)
+    totals = dict((e, 0.0) for e in [None] + engines)
+    for name, diff in diffs:
+        row = '%-50s' % name[:50]
+        for engine in [None] + engines:
+            elapsed = bench(diff, engine, options.repeat)
+            totals[engine] += elapsed
+            row += ' %9.2fms' % (elapsed * 1000)
+        print row
+    print '%-50s' % 'total' + ''.join(' %9.2fms' % (totals[e] * 1000)
+                                      for e in [None] + engines)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
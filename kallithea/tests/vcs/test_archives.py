@@ -73,6 +73,23 @@ class ArchivesTestCaseMixin(BackendTestMixin):
                 open(os.path.join(outdir, 'repo/' + node_path)).read(),
                 self.tip.get_node(node_path).content)
 
+    def test_chunked_archive(self):
+        for kind in ['tar', 'zip']:
+            stream = StringIO.StringIO()
+            self.tip.fill_archive(stream=stream, kind=kind, prefix='repo')
+            chunks = list(self.tip.get_chunked_archive(kind=kind,
+                prefix='repo', chunk_size=1024))
+            self.assertEqual(''.join(chunks), stream.getvalue())
+
+        # consumer may go away before the archive is complete
+        chunks = iter(self.tip.get_chunked_archive(kind='tar',
+                                                   chunk_size=1024))
+        chunks.next()
+        chunks.close()
+
+        with self.assertRaises(VCSError):
+            self.tip.get_chunked_archive(kind='wrong kind')
+
     def test_archive_default_stream(self):
         tmppath = tempfile.mkstemp()[1]
         with open(tmppath, 'w') as stream:
@@ -95,6 +112,22 @@ class ArchivesTestCaseMixin(BackendTestMixin):
         with self.assertRaises(VCSError):
             self.tip.fill_archive(prefix='/any')
 
+
+class ProcessOutputTestCase(unittest.TestCase):
+
+    def test_process_failure(self):
+        from subprocess import Popen, PIPE
+        from kallithea.lib.vcs.utils.archivers import iter_process_output
+        # more errors than fit into the pipe don't block the process
+        popen = Popen('head -c 200000 /dev/zero >&2; echo output; exit 3',
+                      stdout=PIPE, stderr=PIPE, shell=True)
+        chunks = iter_process_output(popen)
+        self.assertEqual(chunks.next(), 'output\n')
+        with self.assertRaises(VCSError):
+            chunks.next()
+        self.assertEqual(popen.returncode, 3)
+
+
 # For each backend create test case class
 for alias in SCM_TESTS:
     attrs = {
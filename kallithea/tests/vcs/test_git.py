@@ -5,6 +5,10 @@ import mock
 import datetime
 import urllib2
 from kallithea.lib.vcs.backends.git import GitRepository, GitChangeset
+from kallithea.lib.vcs.backends.git.history import (
+    GitLogHistoryEngine, DulwichHistoryEngine)
+from kallithea.lib.vcs.backends.git.revindex import GitRevisionIndex, \
+    GitRevisionIndexer
 from kallithea.lib.vcs.exceptions import RepositoryError, VCSError, NodeDoesNotExistError
 from kallithea.lib.vcs.nodes import NodeKind, FileNode, DirNode, NodeState
 from kallithea.lib.vcs.utils.compat import unittest
@@ -596,6 +600,25 @@ class GitChangesetTest(unittest.TestCase):
           .author_name)
 
 
+class GitHistoryEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = GitRepository(TEST_GIT_REPO)
+
+    def test_dulwich_engine_matches_git_log(self):
+        git_log = GitLogHistoryEngine(self.repo)
+        dulwich = DulwichHistoryEngine(self.repo)
+        for cs_id in ['2a13f185e4525f9d4b59882791a2d397b90d5ddc',
+                      'fa6600f6848800641328adbf7811fd2372c02ab2',
+                      self.repo.revisions[-1]]:
+            for path in ['setup.py', 'vcs/nodes.py', 'vcs/__init__.py',
+                         'docs/api/backends/hg.rst']:
+                for limit in (None, 1, 5):
+                    self.assertEqual(
+                        dulwich.get_history(cs_id, path, limit=limit),
+                        git_log.get_history(cs_id, path, limit=limit))
+
+
 class GitSpecificTest(unittest.TestCase):
 
     def test_error_is_raised_for_added_if_diff_name_status_is_wrong(self):
@@ -688,6 +711,65 @@ class GitSpecificWithRepoTest(BackendTestMixin, unittest.TestCase):
             % (3, self.repo._get_revision(0), self.repo._get_revision(1)))
 
 
+class GitRevisionIndexTest(BackendTestMixin, unittest.TestCase):
+    backend_alias = 'git'
+
+    def _rev_list(self):
+        return self.repo.run_git_command(
+            'rev-list --reverse --date-order --all')[0].splitlines()
+
+    def _add_commit(self, path):
+        imc = self.repo.in_memory_changeset
+        imc.add(FileNode(path, content=path))
+        return imc.commit(message=u'Added %s' % path,
+                          author=u'Joe Doe <joe.doe@example.com>')
+
+    def test_revisions_served_from_index(self):
+        revisions = GitRepository(self.repo.path).revisions
+        self.assertTrue(isinstance(revisions, GitRevisionIndex))
+        self.assertEqual(revisions, self._rev_list())
+        for rev, sha in enumerate(revisions):
+            self.assertEqual(revisions.index(sha), rev)
+        self.assertEqual(revisions.parentrevs(0), [])
+        self.assertEqual(revisions.parentrevs(1), [0])
+        self.assertFalse('f' * 40 in revisions)
+
+    def test_index_is_extended_by_new_commits(self):
+        old_revisions = GitRepository(self.repo.path).revisions
+        tip = self._add_commit('new_file')
+        revisions = GitRepository(self.repo.path).revisions
+        self.assertEqual(revisions.generation, old_revisions.generation)
+        self.assertEqual(list(revisions), list(old_revisions) + [tip.raw_id])
+        self.assertEqual(revisions.parentrevs(len(revisions) - 1),
+                         [len(revisions) - 2])
+
+    def test_index_is_rebuilt_after_history_rewrite(self):
+        old_revisions = GitRepository(self.repo.path).revisions
+        self.repo.run_git_command('update-ref refs/heads/master %s'
+                                  % old_revisions[0])
+        revisions = GitRepository(self.repo.path).revisions
+        self.assertTrue(revisions.generation > old_revisions.generation)
+        self.assertEqual(list(revisions), self._rev_list())
+        self.assertEqual(len(revisions), 1)
+
+    def test_index_is_rebuilt_when_indexed_tip_is_gone(self):
+        old_revisions = GitRepository(self.repo.path).revisions
+        tip = self._add_commit('new_file')
+        rev_list = GitRevisionIndexer._rev_list
+
+        def _rev_list(indexer, includes, excludes=()):
+            # excluded old tip was removed by a forced push and gc
+            if excludes:
+                raise RepositoryError('bad revision')
+            return rev_list(indexer, includes, excludes)
+
+        with mock.patch.object(GitRevisionIndexer, '_rev_list', _rev_list):
+            revisions = GitRepository(self.repo.path).revisions
+        self.assertTrue(revisions.generation > old_revisions.generation)
+        self.assertEqual(list(revisions), self._rev_list())
+        self.assertEqual(revisions[-1], tip.raw_id)
+
+
 class GitRegressionTest(BackendTestMixin, unittest.TestCase):
     backend_alias = 'git'
 
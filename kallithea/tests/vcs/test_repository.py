@@ -1,5 +1,6 @@
 from __future__ import with_statement
 import datetime
+import shutil
 from kallithea.tests.vcs.base import BackendTestMixin
 from kallithea.tests.vcs.conf import SCM_TESTS
 from kallithea.tests.vcs.conf import TEST_USER_CONFIG_FILE
@@ -34,6 +35,16 @@ class RepositoryBaseTest(BackendTestMixin):
     def test_repo_equality(self):
         self.assertTrue(self.repo == self.repo)
 
+    def test_change_token(self):
+        token = self.backend_class.get_change_token(self.repo.path)
+        self.assertEqual(self.backend_class.get_change_token(self.repo.path),
+                         token)
+        self.imc.add(FileNode(u'token.txt', content='token'))
+        self.tip = self.imc.commit(message=u'Change token', author=u'joe',
+                                   parents=[self.tip])
+        self.assertNotEqual(self.backend_class.get_change_token(self.repo.path),
+                            token)
+
     def test_repo_equality_broken_object(self):
         import copy
         _repo = copy.copy(self.repo)
@@ -46,6 +57,58 @@ class RepositoryBaseTest(BackendTestMixin):
         self.assertTrue(self.repo != dummy())
 
 
+class ChangesetMetadataTest(BackendTestMixin):
+
+    def _assert_matches_changesets(self, rows):
+        for row in rows:
+            cs = self.repo.get_changeset(row.raw_id)
+            self.assertEqual(row.revision, cs.revision)
+            self.assertEqual(row.author, cs.author)
+            self.assertEqual(row.message, cs.message)
+            self.assertEqual(row.date, cs.date)
+            self.assertEqual(row.branch, cs.branch)
+            self.assertEqual(row.tags, cs.tags)
+            self.assertEqual([p.raw_id for p in row.parents],
+                             [p.raw_id for p in cs.parents])
+
+    def test_metadata_matches_changesets(self):
+        rows = self.repo.get_changeset_metadata(range(len(self.repo.revisions)))
+        self.assertEqual([row.raw_id for row in rows], list(self.repo.revisions))
+        self._assert_matches_changesets(rows)
+        # read again from the persistent store
+        store = self.repo._get_changeset_metadata_store()
+        self.assertEqual(len(store), len(self.repo.revisions))
+        self._assert_matches_changesets(self.repo.get_changeset_metadata([1, 0, -1]))
+
+    def test_metadata_store_follows_new_changesets(self):
+        self.repo.update_changeset_metadata()
+        self.imc.add(FileNode(u'metadata.txt', content='metadata'))
+        tip = self.imc.commit(message=u'Message\nwith two lines',
+                              author=u'J\u00f6e <joe@example.com>',
+                              parents=[self.tip])
+        row = self.repo.get_changeset_metadata([-1])[0]
+        self.assertEqual(row.raw_id, tip.raw_id)
+        self.assertEqual(row.message, u'Message\nwith two lines')
+        self._assert_matches_changesets([row])
+        store = self.repo._get_changeset_metadata_store()
+        self.assertEqual(len(store), len(self.repo.revisions))
+
+    def test_metadata_update_limit(self):
+        shutil.rmtree(self.repo._get_changeset_metadata_path(),
+                      ignore_errors=True)
+        self.repo.update_changeset_metadata(limit=1)
+        self.assertEqual(len(self.repo._get_changeset_metadata_store()), 1)
+        self.repo.update_changeset_metadata()
+        self.assertEqual(len(self.repo._get_changeset_metadata_store()),
+                         len(self.repo.revisions))
+
+    def test_metadata_collection(self):
+        collection = self.repo.get_changesets().metadata()
+        self.assertEqual(len(collection), len(self.repo.revisions))
+        self.assertEqual([row.raw_id for row in collection[1:]],
+                         list(self.repo.revisions[1:]))
+
+
 class RepositoryGetDiffTest(BackendTestMixin):
 
     @classmethod
@@ -83,9 +146,34 @@ class RepositoryGetDiffTest(BackendTestMixin):
         ]
         return commits
 
+    def test_changed_paths(self):
+        revs = self.repo.revisions
+        self.assertEqual(self.repo.get_changed_paths(self.repo.EMPTY_CHANGESET,
+                                                     revs[0]),
+                         (['foobar', 'foobar2'], [], []))
+        self.assertEqual(self.repo.get_changed_paths(revs[0], revs[2]),
+                         (['foobar3'], [], ['foobar']))
+        self.assertEqual(self.repo.get_changed_paths(revs[1], revs[2]),
+                         ([], ['foobar3'], ['foobar']))
+        self.assertEqual(self.repo.get_changed_paths(revs[2], revs[2]),
+                         ([], [], []))
+
+    def test_chunked_diff(self):
+        revs = self.repo.revisions
+        for rev1, rev2 in [(self.repo.EMPTY_CHANGESET, revs[0]),
+                           (revs[0], revs[2])]:
+            chunks = self.repo.get_chunked_diff(rev1, rev2)
+            self.assertEqual(''.join(chunks), self.repo.get_diff(rev1, rev2))
+        # the rest of the diff isn't generated once it is closed
+        chunks = self.repo.get_chunked_diff(revs[0], revs[2])
+        self.assertTrue(next(iter(chunks)).startswith('diff --git'))
+        chunks.close()
+
     def test_raise_for_wrong(self):
         with self.assertRaises(ChangesetDoesNotExistError):
             self.repo.get_diff('a' * 40, 'b' * 40)
+        with self.assertRaises(ChangesetDoesNotExistError):
+            self.repo.get_chunked_diff('a' * 40, 'b' * 40)
 
 
 class GitRepositoryGetDiffTest(RepositoryGetDiffTest, unittest.TestCase):
@@ -221,9 +309,10 @@ for alias in SCM_TESTS:
     attrs = {
         'backend_alias': alias,
     }
-    cls_name = alias.capitalize() + RepositoryBaseTest.__name__
-    bases = (RepositoryBaseTest, unittest.TestCase)
-    globals()[cls_name] = type(cls_name, bases, attrs)
+    for test_class in (RepositoryBaseTest, ChangesetMetadataTest):
+        cls_name = alias.capitalize() + test_class.__name__
+        bases = (test_class, unittest.TestCase)
+        globals()[cls_name] = type(cls_name, bases, attrs)
 
 if __name__ == '__main__':
     unittest.main()
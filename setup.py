@@ -171,6 +171,7 @@ setup(
     make-rcext=kallithea.lib.paster_commands.make_rcextensions:Command
     repo-scan=kallithea.lib.paster_commands.repo_scan:Command
     cache-keys=kallithea.lib.paster_commands.cache_keys:Command
+    archive-cache=kallithea.lib.paster_commands.archive_cache:Command
     ishell=kallithea.lib.paster_commands.ishell:Command
     make-index=kallithea.lib.paster_commands.make_index:Command
     upgrade-db=kallithea.lib.dbmigrate:UpgradeDb